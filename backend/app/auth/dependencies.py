@@ -1,33 +1,76 @@
 from __future__ import annotations
 
 from fastapi import Cookie, Depends, Request
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 
 from app.core.exceptions import AuthenticationError
+from app.core.tracing import span
+from app.db.async_session import get_async_db
 from app.db.models import User
-from app.db.session import get_db
-from app.auth.service import get_session_by_token
+from app.db.session import get_db, get_read_db
+from app.auth.service import get_session_by_token, get_session_with_user_async
 
 
 SESSION_COOKIE_NAME = "session"
 
 
+def _resolve_user(request: Request, db: Session, session_token: str | None) -> User:
+    if session_token is None:
+        raise AuthenticationError("missing")
+
+    with span("auth.session_lookup"):
+        session = get_session_by_token(db, session_token)
+        if session is None:
+            raise AuthenticationError("invalid")
+
+        user = db.get(User, session.user_id)
+    if user is None or not user.is_active:
+        raise AuthenticationError("invalid")
+
+    # Attach session for logout.
+    request.state.session = session
+    return user
+
+
 def get_current_user(
     request: Request,
     db: Session = Depends(get_db),
     session_token: str | None = Cookie(default=None, alias=SESSION_COOKIE_NAME),
 ) -> User:
+    return _resolve_user(request, db, session_token)
+
+
+def get_current_user_read_only(
+    request: Request,
+    db: Session = Depends(get_read_db),
+    session_token: str | None = Cookie(default=None, alias=SESSION_COOKIE_NAME),
+) -> User:
+    """get_current_user for routes on get_read_db: the user is loaded in the same read-only session.
+
+    Do not modify the returned user; changes to it are never committed.
+    """
+
+    return _resolve_user(request, db, session_token)
+
+
+async def get_current_user_async(
+    request: Request,
+    db: AsyncSession = Depends(get_async_db),
+    session_token: str | None = Cookie(default=None, alias=SESSION_COOKIE_NAME),
+) -> User:
+    """get_current_user for async routes on get_async_db (read-only, like get_current_user_read_only)."""
+
     if session_token is None:
         raise AuthenticationError("missing")
 
-    session = get_session_by_token(db, session_token)
-    if session is None:
+    with span("auth.session_lookup"):
+        found = await get_session_with_user_async(db, session_token)
+    if found is None:
         raise AuthenticationError("invalid")
-
-    user = db.get(User, session.user_id)
-    if user is None or not user.is_active:
+    session, user = found
+    if not user.is_active:
         raise AuthenticationError("invalid")
 
-    # Attach session for logout.
     request.state.session = session
     return user
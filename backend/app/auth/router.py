@@ -8,6 +8,7 @@ from app.auth.service import authenticate_user, create_session, revoke_session
 from app.auth.dependencies import SESSION_COOKIE_NAME, get_current_user
 from app.core.config import settings
 from app.core.exceptions import AuthenticationError
+from app.core.tracing import TracedRoute
 from app.db.session import get_db
 from app.db.models import User
 from app.middlewares.rate_limit import FixedWindowRateLimiter
@@ -15,11 +16,11 @@ from app.users.schemas import RegisterRequest, RegisterResponse, UserPublic
 from app.users.service import create_user
 
 
-router = APIRouter(prefix="/auth", tags=["auth"])
+router = APIRouter(prefix="/auth", tags=["auth"], route_class=TracedRoute)
 
 # In-memory per-IP limiter for login attempts.
-_login_limiter = FixedWindowRateLimiter(window_seconds=60, max_requests=settings.login_rate_limit_per_minute)
-_register_limiter = FixedWindowRateLimiter(window_seconds=60 * 60, max_requests=settings.register_rate_limit_per_hour)
+_login_limiter = FixedWindowRateLimiter(window_seconds=60, max_requests=settings.login_rate_limit_per_minute, name="login")
+_register_limiter = FixedWindowRateLimiter(window_seconds=60 * 60, max_requests=settings.register_rate_limit_per_hour, name="register")
 
 
 def _client_ip(request: Request) -> str:
@@ -6,15 +6,17 @@ import secrets
 import time
 import uuid
 
-from sqlalchemy import select
+from sqlalchemy import case, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 
 from app.core.config import settings
 from app.core.exceptions import AuthenticationError
-from app.crypto.aes_gcm import AesGcmCipher
 from app.crypto.passwords import hash_password, verify_password
 from app.crypto.totp import verify_totp_code_and_step
 from app.db.models import User, UserSession, utcnow
+from app.db.write_queue import run_write
+from app.keyservice.base import RING_TOTP, get_key_service
 from app.users.service import is_locked
 
 
@@ -32,11 +34,23 @@ def _random_delay_on_failure() -> None:
 
 
 def _apply_failed_login(db: Session, user: User) -> None:
-    user.failed_login_count += 1
-    if user.failed_login_count >= settings.max_failed_logins:
-        user.locked_until = utcnow() + dt.timedelta(seconds=settings.lockout_seconds)
-    user.updated_at = utcnow()
-    db.commit()
+    # Counted in SQL: concurrent failures for one account must not lose increments.
+    now = utcnow()
+    user_id = user.id
+    bump = (
+        update(User)
+        .where(User.id == user_id)
+        .values(
+            failed_login_count=User.failed_login_count + 1,
+            locked_until=case(
+                (User.failed_login_count + 1 >= settings.max_failed_logins, now + dt.timedelta(seconds=settings.lockout_seconds)),
+                else_=User.locked_until,
+            ),
+            updated_at=now,
+        )
+        .execution_options(synchronize_session=False)
+    )
+    run_write(db, lambda s: s.execute(bump))
 
 
 def authenticate_user(
@@ -77,9 +91,11 @@ def authenticate_user(
             _random_delay_on_failure()
             raise AuthenticationError("invalid")
 
-        cipher = AesGcmCipher(settings.totp_kek_bytes)
         aad = f"users:totp_secret:{user.id}".encode("utf-8")
-        secret = cipher.decrypt(user.totp_secret_enc, user.totp_secret_nonce, user.totp_secret_tag, aad=aad).decode("utf-8")
+        secret = get_key_service().unwrap(
+            RING_TOTP,
+            user.totp_secret_version, user.totp_secret_enc, user.totp_secret_nonce, user.totp_secret_tag, aad=aad
+        ).decode("utf-8")
 
         step = verify_totp_code_and_step(secret, totp_code, valid_window=1)
         if step is None:
@@ -121,10 +137,12 @@ def create_session(db: Session, user: User, ip_address: str | None, user_agent:
         ip_address=ip_address,
         user_agent=user_agent,
     )
-    db.add(session)
-    db.commit()
-    db.refresh(session)
-    return token, session
+
+    def _insert(s: Session) -> UserSession:
+        s.add(session)
+        return session
+
+    return token, run_write(db, _insert)
 
 
 def revoke_session(db: Session, session: UserSession) -> None:
@@ -132,14 +150,20 @@ def revoke_session(db: Session, session: UserSession) -> None:
     db.commit()
 
 
-def get_session_by_token(db: Session, token: str) -> UserSession | None:
-    token_hash = _hash_session_token(token)
-    now = utcnow()
+def _session_by_token_query(token: str):
     return (
-        db.execute(
-            select(UserSession)
-            .where(UserSession.session_token_hash == token_hash)
-            .where(UserSession.revoked_at.is_(None))
-            .where(UserSession.expires_at > now)
-        ).scalar_one_or_none()
+        select(UserSession)
+        .where(UserSession.session_token_hash == _hash_session_token(token))
+        .where(UserSession.revoked_at.is_(None))
+        .where(UserSession.expires_at > utcnow())
     )
+
+
+def get_session_by_token(db: Session, token: str) -> UserSession | None:
+    return db.execute(_session_by_token_query(token)).scalar_one_or_none()
+
+
+async def get_session_with_user_async(db: AsyncSession, token: str) -> tuple[UserSession, User] | None:
+    # Session and user in one round trip for get_current_user_async.
+    row = (await db.execute(_session_by_token_query(token).add_columns(User).join(User, User.id == UserSession.user_id))).first()
+    return None if row is None else (row[0], row[1])
@@ -1,9 +1,13 @@
 from __future__ import annotations
 
 import base64
-from pydantic import AnyUrl, Field, field_validator
+from functools import cached_property
+
+from pydantic import AnyUrl, Field, field_validator, model_validator
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
+from app.crypto.key_ring import KeyRing
+
 
 class Settings(BaseSettings):
     model_config = SettingsConfigDict(env_file=".env", extra="forbid")
@@ -15,11 +19,87 @@ class Settings(BaseSettings):
     cors_allow_origins: str = Field(default="https://localhost", alias="CORS_ALLOW_ORIGINS")
 
     sqlite_path: str = Field(default="/var/lib/app/app.sqlite3", alias="SQLITE_PATH")
+    # Empty: SQLite at SQLITE_PATH. Otherwise a PostgreSQL SQLAlchemy URL, e.g.
+    # postgresql+psycopg://app:secret@db:5432/app (schema: database/schema.postgres.sql).
+    database_url: str = Field(default="", alias="DATABASE_URL")
+
+    # SQLite connection setup, applied to every pooled connection (see app/db/session.py)
+    sqlite_journal_mode: str = Field(default="WAL", alias="SQLITE_JOURNAL_MODE")
+    sqlite_synchronous: str = Field(default="NORMAL", alias="SQLITE_SYNCHRONOUS")
+    sqlite_busy_timeout_ms: int = Field(default=5000, alias="SQLITE_BUSY_TIMEOUT_MS")
+    sqlite_mmap_size_mb: int = Field(default=256, alias="SQLITE_MMAP_SIZE_MB")
+    sqlite_cache_size_mb: int = Field(default=16, alias="SQLITE_CACHE_SIZE_MB")
+    sqlite_journal_size_limit_mb: int = Field(default=64, alias="SQLITE_JOURNAL_SIZE_LIMIT_MB")
+    sqlite_foreign_keys: bool = Field(default=True, alias="SQLITE_FOREIGN_KEYS")
+    # Mailbox rows (message_recipients) in N extra SQLite files by recipient hash, each with
+    # its own write lock; 0 = in the main file (see app/db/shards.py). At most 8: every
+    # connection attaches all shards and SQLite allows 10 attached databases.
+    mailbox_shards: int = Field(default=0, ge=0, le=8, alias="MAILBOX_SHARDS")
+
+    # Process model (app/core/workers.py): uvicorn worker processes, 0 = one per usable CPU.
+    # Read by entrypoint.sh; every worker sees the resolved number.
+    web_concurrency: int = Field(default=0, ge=0, alias="WEB_CONCURRENCY")
+    # Where rate-limit counters live: memory (per process), database (shared by all workers),
+    # or auto = database when WEB_CONCURRENCY > 1.
+    rate_limit_store: str = Field(default="auto", alias="RATE_LIMIT_STORE")
+
+    # Connection pool (per worker process)
+    db_pool_size: int = Field(default=8, alias="DB_POOL_SIZE")
+    db_max_overflow: int = Field(default=32, alias="DB_MAX_OVERFLOW")
+    db_pool_timeout_seconds: float = Field(default=30.0, alias="DB_POOL_TIMEOUT_SECONDS")
+    # Read-only pool for GET routes (mode=ro, query_only)
+    db_read_pool_size: int = Field(default=8, alias="DB_READ_POOL_SIZE")
+    db_read_max_overflow: int = Field(default=32, alias="DB_READ_MAX_OVERFLOW")
+
+    # Async read path (inbox, sent, detail, session lookup). Empty: derived from DATABASE_URL
+    # (aiosqlite on SQLITE_PATH read-only, or psycopg's async mode for PostgreSQL).
+    async_database_url: str = Field(default="", alias="ASYNC_DATABASE_URL")
+    # Worker threads for crypto offloaded from async endpoints; 0 = this worker's share of
+    # the usable CPUs (at least 2, so key-service round trips can overlap)
+    crypto_threads: int = Field(default=0, ge=0, alias="CRYPTO_THREADS")
+
+    # Group commit of small writes (app/db/write_queue.py; WAL only)
+    write_queue_enabled: bool = Field(default=True, alias="WRITE_QUEUE_ENABLED")
+    write_queue_max_batch: int = Field(default=64, alias="WRITE_QUEUE_MAX_BATCH")
+    write_queue_max_delay_ms: float = Field(default=2.0, alias="WRITE_QUEUE_MAX_DELAY_MS")
+    write_queue_max_pending: int = Field(default=1000, alias="WRITE_QUEUE_MAX_PENDING")
+    write_queue_timeout_seconds: float = Field(default=30.0, alias="WRITE_QUEUE_TIMEOUT_SECONDS")
 
     max_attachment_bytes: int = Field(default=25 * 1024 * 1024, alias="MAX_ATTACHMENT_BYTES")
     max_attachments_per_message: int = Field(default=10, alias="MAX_ATTACHMENTS_PER_MESSAGE")
     max_recipients_per_message: int = Field(default=25, alias="MAX_RECIPIENTS_PER_MESSAGE")
 
+    # Resumable uploads (chunks are staged encrypted until finalize)
+    upload_chunk_max_bytes: int = Field(default=8 * 1024 * 1024, alias="UPLOAD_CHUNK_MAX_BYTES")
+    upload_session_ttl_seconds: int = Field(default=24 * 60 * 60, alias="UPLOAD_SESSION_TTL_SECONDS")
+    # PATCH chunk requests per client IP and minute (each encrypts and writes up to UPLOAD_CHUNK_MAX_BYTES).
+    upload_chunk_rate_limit_per_minute: int = Field(default=600, alias="UPLOAD_CHUNK_RATE_LIMIT_PER_MINUTE")
+
+    # Idempotency-Key support for /messages/send
+    idempotency_ttl_seconds: int = Field(default=24 * 60 * 60, alias="IDEMPOTENCY_TTL_SECONDS")
+    # How long a duplicate waits for the first request before getting 409.
+    idempotency_lock_timeout_seconds: int = Field(default=60, gt=0, alias="IDEMPOTENCY_LOCK_TIMEOUT_SECONDS")
+    # Lease of the first request, renewed every third of it while it sends; only an expired
+    # lease (a dead worker) lets a retry take the key over. Must outlast the wait above.
+    idempotency_lease_seconds: int = Field(default=180, gt=0, alias="IDEMPOTENCY_LEASE_SECONDS")
+
+    # Retention: self-destruct cap and the background purge worker (interval 0 disables it)
+    max_message_ttl_seconds: int = Field(default=30 * 24 * 60 * 60, alias="MAX_MESSAGE_TTL_SECONDS")
+    purge_interval_seconds: int = Field(default=300, alias="PURGE_INTERVAL_SECONDS")
+    purge_batch_size: int = Field(default=200, alias="PURGE_BATCH_SIZE")
+    purge_batch_pause_ms: int = Field(default=50, alias="PURGE_BATCH_PAUSE_MS")
+    purge_vacuum_pages: int = Field(default=2000, alias="PURGE_VACUUM_PAGES")
+
+    # Mailbox export: messages per keyset page (also the progress update granularity)
+    export_page_size: int = Field(default=100, alias="EXPORT_PAGE_SIZE")
+    # A running download renews its lease while it streams; a job whose lease ran out
+    # (client gone before the first byte, worker killed, restart) may be started again.
+    export_lease_seconds: int = Field(default=300, gt=0, alias="EXPORT_LEASE_SECONDS")
+
+    # Compression before encryption (none | deflate | zstd). zstd needs the optional `zstandard` wheel.
+    payload_compression: str = Field(default="deflate", alias="PAYLOAD_COMPRESSION")
+    payload_compression_min_bytes: int = Field(default=1024, alias="PAYLOAD_COMPRESSION_MIN_BYTES")
+
     login_rate_limit_per_minute: int = Field(default=10, alias="LOGIN_RATE_LIMIT_PER_MINUTE")
     register_rate_limit_per_hour: int = Field(default=20, alias="REGISTER_RATE_LIMIT_PER_HOUR")
     send_rate_limit_per_minute: int = Field(default=20, alias="SEND_RATE_LIMIT_PER_MINUTE")
@@ -27,11 +107,53 @@ class Settings(BaseSettings):
     cookie_secure: bool = Field(default=True, alias="COOKIE_SECURE")
     cookie_samesite: str = Field(default="strict", alias="COOKIE_SAMESITE")
 
-    # Required secrets (base64-encoded 32 bytes)
+    # Required secrets (base64-encoded 32 bytes). The three KEKs may be left out of the
+    # app's environment when KEY_SERVICE_SOCKET points at the key-service sidecar.
     app_secret_key: str = Field(alias="APP_SECRET_KEY")
-    data_key: str = Field(alias="DATA_KEY")
-    totp_key_encryption_key: str = Field(alias="TOTP_KEY_ENCRYPTION_KEY")
-    user_hmac_key_encryption_key: str = Field(alias="USER_HMAC_KEY_ENCRYPTION_KEY")
+    data_key: str = Field(default="", alias="DATA_KEY")
+    totp_key_encryption_key: str = Field(default="", alias="TOTP_KEY_ENCRYPTION_KEY")
+    user_hmac_key_encryption_key: str = Field(default="", alias="USER_HMAC_KEY_ENCRYPTION_KEY")
+
+    # KEK rotation: version of each key above, plus retired keys as "version:base64,..."
+    # kept until the re-wrap job has moved every envelope to the current version.
+    data_key_version: int = Field(default=1, alias="DATA_KEY_VERSION")
+    data_key_retired: str = Field(default="", alias="DATA_KEY_RETIRED")
+    totp_key_version: int = Field(default=1, alias="TOTP_KEY_VERSION")
+    totp_key_retired: str = Field(default="", alias="TOTP_KEY_RETIRED")
+    user_hmac_key_version: int = Field(default=1, alias="USER_HMAC_KEY_VERSION")
+    user_hmac_key_retired: str = Field(default="", alias="USER_HMAC_KEY_RETIRED")
+
+    # Background re-wrap of envelopes still under a retired KEK
+    key_rewrap_enabled: bool = Field(default=True, alias="KEY_REWRAP_ENABLED")
+    key_rewrap_batch_size: int = Field(default=500, alias="KEY_REWRAP_BATCH_SIZE")
+    key_rewrap_pause_ms: int = Field(default=100, alias="KEY_REWRAP_PAUSE_MS")
+
+    # Optional key-service sidecar (empty = unwrap in-process with the KEKs above)
+    key_service_socket: str = Field(default="", alias="KEY_SERVICE_SOCKET")
+    key_service_pool_size: int = Field(default=4, alias="KEY_SERVICE_POOL_SIZE")
+    key_service_timeout_seconds: float = Field(default=5.0, alias="KEY_SERVICE_TIMEOUT_SECONDS")
+    key_service_max_batch: int = Field(default=256, alias="KEY_SERVICE_MAX_BATCH")
+
+    # Diagnostics (outside production only): warn when one normalized SQL statement runs
+    # more than this many times in a single request (likely N+1). 0 disables.
+    n_plus_one_threshold: int = Field(default=20, alias="N_PLUS_ONE_THRESHOLD")
+
+    # Prometheus metrics on GET /metrics (backend port only; nginx does not route it).
+    # Several workers: set PROMETHEUS_MULTIPROC_DIR too, see app/core/metrics.py.
+    metrics_enabled: bool = Field(default=True, alias="METRICS_ENABLED")
+
+    # Request tracing: share of requests traced (0 = off, 1 = all). Exporter "memory" keeps the
+    # last TRACE_BUFFER_SIZE traces for GET /debug/traces (outside production); "jsonl" appends
+    # one trace per line to TRACE_JSONL_PATH.
+    trace_sample_rate: float = Field(default=0.0, alias="TRACE_SAMPLE_RATE")
+    trace_exporter: str = Field(default="memory", alias="TRACE_EXPORTER")
+    trace_buffer_size: int = Field(default=200, alias="TRACE_BUFFER_SIZE")
+    trace_jsonl_path: str = Field(default="/var/lib/app/traces.jsonl", alias="TRACE_JSONL_PATH")
+
+    # On-demand CPU/memory profiling (GET /debug/profile/..., ?profile=1 on a request).
+    # Disabled while empty; callers send the value in X-Profiling-Token.
+    profiling_token: str = Field(default="", alias="PROFILING_TOKEN")
+    profiling_max_seconds: int = Field(default=60, alias="PROFILING_MAX_SECONDS")
 
     # Auth/session
     session_ttl_seconds: int = Field(default=60 * 60 * 8, alias="SESSION_TTL_SECONDS")
@@ -51,13 +173,78 @@ class Settings(BaseSettings):
             raise ValueError(f"{field_name} must decode to 32 bytes")
         return raw
 
-    @field_validator("app_secret_key", "data_key", "totp_key_encryption_key", "user_hmac_key_encryption_key")
+    def _key_ring(self, current: str, current_version: int, retired: str, field_name: str) -> KeyRing:
+        keys = {current_version: self._decode_32b_b64(current, field_name)}
+        for entry in filter(None, (e.strip() for e in retired.split(","))):
+            version, sep, value = entry.partition(":")
+            if not sep or not version.strip().isdigit():
+                raise ValueError(f"{field_name}_RETIRED entries must be version:base64")
+            if int(version) in keys:
+                raise ValueError(f"{field_name}_RETIRED repeats key version {int(version)}")
+            keys[int(version)] = self._decode_32b_b64(value.strip(), f"{field_name}_RETIRED")
+        return KeyRing(current_version, keys)
+
+    @field_validator("app_secret_key")
     @classmethod
     def _no_empty_secrets(cls, v: str, info):
         if v is None or not isinstance(v, str) or not v.strip():
             raise ValueError(f"{info.field_name} must be set and non-empty")
         return v
 
+    @field_validator("sqlite_journal_mode", "sqlite_synchronous")
+    @classmethod
+    def _sqlite_pragma_keyword(cls, v: str, info):
+        # Interpolated into PRAGMA statements: only SQLite's own keywords are accepted.
+        allowed = {
+            "sqlite_journal_mode": {"WAL", "DELETE", "TRUNCATE", "PERSIST", "MEMORY", "OFF"},
+            "sqlite_synchronous": {"OFF", "NORMAL", "FULL", "EXTRA"},
+        }[info.field_name]
+        value = (v or "").strip().upper()
+        if value not in allowed:
+            raise ValueError(f"{info.field_name} must be one of: {', '.join(sorted(allowed))}")
+        return value
+
+    @field_validator("payload_compression")
+    @classmethod
+    def _payload_compression(cls, v: str) -> str:
+        value = (v or "").strip().lower()
+        if value in ("", "off"):
+            value = "none"
+        if value not in {"none", "deflate", "zstd"}:
+            raise ValueError("PAYLOAD_COMPRESSION must be one of: none, deflate, zstd")
+        return value
+
+    @field_validator("rate_limit_store")
+    @classmethod
+    def _rate_limit_store(cls, v: str) -> str:
+        value = (v or "").strip().lower()
+        if value not in {"auto", "memory", "database"}:
+            raise ValueError("RATE_LIMIT_STORE must be one of: auto, memory, database")
+        return value
+
+    @field_validator("database_url")
+    @classmethod
+    def _postgres_url(cls, v: str) -> str:
+        # SQLite is configured through SQLITE_PATH (the read-only pool and init use the path).
+        value = (v or "").strip()
+        if value and not value.startswith("postgresql"):
+            raise ValueError("DATABASE_URL must be a postgresql URL (leave it empty for SQLite at SQLITE_PATH)")
+        return value
+
+    @model_validator(mode="after")
+    def _idempotency_lease_outlasts_wait(self):
+        if self.idempotency_lease_seconds <= 2 * self.idempotency_lock_timeout_seconds:
+            raise ValueError("IDEMPOTENCY_LEASE_SECONDS must be more than twice IDEMPOTENCY_LOCK_TIMEOUT_SECONDS")
+        return self
+
+    @model_validator(mode="after")
+    def _keks_unless_key_service(self):
+        if not self.key_service_socket:
+            for name in ("data_key", "totp_key_encryption_key", "user_hmac_key_encryption_key"):
+                if not getattr(self, name).strip():
+                    raise ValueError(f"{name} must be set and non-empty")
+        return self
+
     @property
     def app_secret_key_bytes(self) -> bytes:
         return self._decode_32b_b64(self.app_secret_key, "APP_SECRET_KEY")
@@ -74,5 +261,22 @@ class Settings(BaseSettings):
     def user_hmac_kek_bytes(self) -> bytes:
         return self._decode_32b_b64(self.user_hmac_key_encryption_key, "USER_HMAC_KEY_ENCRYPTION_KEY")
 
+    @cached_property
+    def data_key_ring(self) -> KeyRing:
+        return self._key_ring(self.data_key, self.data_key_version, self.data_key_retired, "DATA_KEY")
+
+    @cached_property
+    def totp_key_ring(self) -> KeyRing:
+        return self._key_ring(self.totp_key_encryption_key, self.totp_key_version, self.totp_key_retired, "TOTP_KEY_ENCRYPTION_KEY")
+
+    @cached_property
+    def user_hmac_key_ring(self) -> KeyRing:
+        return self._key_ring(
+            self.user_hmac_key_encryption_key,
+            self.user_hmac_key_version,
+            self.user_hmac_key_retired,
+            "USER_HMAC_KEY_ENCRYPTION_KEY",
+        )
+
 
 settings = Settings()
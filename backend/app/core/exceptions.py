@@ -23,3 +23,13 @@ class RateLimitError(AppError):
 
 class IntegrityError(AppError):
     pass
+
+
+class ConflictError(AppError):
+    pass
+
+
+class NotFoundError(AppError):
+    # Only where existence is not a secret (operator endpoints); user resources answer
+    # AuthorizationError("not found") so ids cannot be probed.
+    pass
@@ -0,0 +1,253 @@
+from __future__ import annotations
+
+import logging
+import threading
+import time
+from collections.abc import Callable
+from dataclasses import dataclass
+
+from sqlalchemy import func, select, update
+from sqlalchemy.orm import Session
+
+from app.core.config import settings
+from app.core.workers import BackgroundLeader
+from app.db.models import KeyRotationCheckpoint, Message, UploadSession, User, utcnow
+from app.db.session import SessionLocal
+from app.keyservice.base import RING_DATA, RING_TOTP, RING_USER_HMAC, UnwrapItem, get_key_service
+from app.messages.service import _upgrade_message_hmac
+
+
+logger = logging.getLogger("app.key_rotation")
+
+
+@dataclass(frozen=True)
+class _Envelope:
+    """One family of wrapped keys: `<prefix>_enc/_nonce/_tag/_version` columns on `model`."""
+
+    name: str
+    model: type
+    prefix: str
+    ring: str
+    aad: Callable[[str], bytes]
+    # Runs before a row is re-wrapped, in the same transaction; False leaves the row as is.
+    prepare: Callable[[Session, str], bool] | None = None
+
+    def column(self, suffix: str):
+        return getattr(self.model, f"{self.prefix}_{suffix}")
+
+
+def _prepare_message(db: Session, message_id: str) -> bool:
+    # Legacy (v1) HMACs cover the wrapped DEK; move them to the v2 payload first. A message
+    # that fails the check keeps its DEK on the retired KEK: re-wrapping it would leave a
+    # v1 HMAC that can no longer verify, hiding whether it had been tampered with.
+    message = db.get(Message, message_id)
+    if message is not None and not _upgrade_message_hmac(db, message):
+        logger.warning(
+            "Message failed authenticity check during key re-wrap; DEK left on the retired KEK",
+            extra={"message_id": message_id},
+        )
+        return False
+    return True
+
+
+ENVELOPES: tuple[_Envelope, ...] = (
+    _Envelope("users.hmac_key", User, "hmac_key", RING_USER_HMAC, lambda i: f"users:hmac_key:{i}".encode("utf-8")),
+    _Envelope("users.totp_secret", User, "totp_secret", RING_TOTP, lambda i: f"users:totp_secret:{i}".encode("utf-8")),
+    _Envelope(
+        "messages.content_key",
+        Message,
+        "content_key",
+        RING_DATA,
+        lambda i: f"messages:dek:{i}".encode("utf-8"),
+        prepare=_prepare_message,
+    ),
+    _Envelope("upload_sessions.session_key", UploadSession, "session_key", RING_DATA, lambda i: f"uploads:key:{i}".encode("utf-8")),
+)
+
+
+def _checkpoint(db: Session, env: _Envelope, target_version: int) -> KeyRotationCheckpoint:
+    cp = db.get(KeyRotationCheckpoint, env.name)
+    if cp is None:
+        cp = KeyRotationCheckpoint(name=env.name, target_version=target_version, last_id=None, rewrapped=0, updated_at=utcnow())
+        db.add(cp)
+    elif cp.target_version != target_version:
+        # A newer rotation started: walk the whole table again.
+        cp.target_version = target_version
+        cp.last_id = None
+        cp.rewrapped = 0
+        cp.skipped = 0
+        cp.completed_at = None
+        cp.updated_at = utcnow()
+    db.commit()
+    return cp
+
+
+def rewrap_batch(
+    db: Session, env: _Envelope, current_version: int, *, after: str | None, limit: int
+) -> tuple[str | None, int, int]:
+    """Re-wrap one keyset batch (by primary key) to the current KEK version; caller commits.
+
+    Only the 32-byte wrapped keys are touched, in a single key-service call per batch.
+    Returns (last scanned id or None when the table is exhausted, rows re-wrapped,
+    rows skipped because `env.prepare` refused them).
+    """
+
+    enc, nonce, tag, version = (env.column(s) for s in ("enc", "nonce", "tag", "version"))
+    q = select(env.model.id, enc, nonce, tag, version).order_by(env.model.id).limit(limit)
+    if after is not None:
+        q = q.where(env.model.id > after)
+    rows = db.execute(q).all()
+    if not rows:
+        return None, 0, 0
+
+    stale = [r for r in rows if r[1] is not None and r[4] != current_version]
+    skipped = 0
+    if env.prepare is not None:
+        ready = [r for r in stale if env.prepare(db, r[0])]
+        skipped = len(stale) - len(ready)
+        stale = ready
+    rewrapped_keys = get_key_service().rewrap_many(
+        env.ring, [UnwrapItem(r[4], r[1], r[2], r[3], env.aad(r[0])) for r in stale]
+    )
+
+    rewrapped = 0
+    for (row_id, ciphertext, _nonce, _tag, row_version), (new_version, wrapped) in zip(stale, rewrapped_keys):
+        # Conditional on the old envelope: a concurrent writer (e.g. 2FA re-setup) wins.
+        rewrapped += db.execute(
+            update(env.model)
+            .where(env.model.id == row_id)
+            .where(version == row_version)
+            .where(enc == ciphertext)
+            .values(
+                {
+                    f"{env.prefix}_enc": wrapped.ciphertext,
+                    f"{env.prefix}_nonce": wrapped.nonce,
+                    f"{env.prefix}_tag": wrapped.tag,
+                    f"{env.prefix}_version": new_version,
+                }
+            )
+        ).rowcount
+
+    return rows[-1][0], rewrapped, skipped
+
+
+def rewrap_envelope(
+    db: Session,
+    env: _Envelope,
+    *,
+    batch_size: int,
+    pause_seconds: float = 0.0,
+    stop: threading.Event | None = None,
+) -> int:
+    """Walk `env` from its checkpoint to the end, one short transaction per batch."""
+
+    current_version, retired_versions = get_key_service().info()[env.ring]
+    if not retired_versions:
+        return 0
+
+    cp = _checkpoint(db, env, current_version)
+    if cp.completed_at is not None:
+        return 0
+
+    if cp.last_id is None:
+        # A fresh walk counts the rows it still has to skip from zero.
+        cp.skipped = 0
+
+    total = 0
+    while stop is None or not stop.is_set():
+        last_id, rewrapped, skipped = rewrap_batch(db, env, current_version, after=cp.last_id, limit=batch_size)
+        total += rewrapped
+        cp.rewrapped += rewrapped
+        cp.skipped += skipped
+        cp.updated_at = utcnow()
+        if last_id is None and cp.skipped:
+            # Not complete: the retired key is still needed. The next pass walks the table
+            # again, so rows fixed by the operator in the meantime get re-wrapped then.
+            cp.last_id = None
+            db.commit()
+            logger.warning(
+                "Key re-wrap pass finished with %s %s rows left on the retired KEK (failed authenticity check)",
+                cp.skipped,
+                env.name,
+            )
+            break
+        if last_id is None:
+            cp.completed_at = cp.updated_at
+            db.commit()
+            logger.info("Key re-wrap completed: %s (%s envelopes to v%s)", env.name, cp.rewrapped, current_version)
+            break
+        # Checkpoint commits with the batch, so a restart resumes exactly here.
+        cp.last_id = last_id
+        db.commit()
+        if stop is not None:
+            stop.wait(pause_seconds)
+        else:
+            time.sleep(pause_seconds)
+    return total
+
+
+def run_rewrap(*, stop: threading.Event | None = None) -> dict[str, int]:
+    db = SessionLocal()
+    try:
+        pause = settings.key_rewrap_pause_ms / 1000.0
+        return {
+            env.name: rewrap_envelope(db, env, batch_size=settings.key_rewrap_batch_size, pause_seconds=pause, stop=stop)
+            for env in ENVELOPES
+        }
+    finally:
+        db.close()
+
+
+def pending_rewrap_counts(db: Session) -> dict[str, int]:
+    """Envelopes still wrapped under a retired KEK (full scan; for operators, not hot paths)."""
+
+    info = get_key_service().info()
+    counts: dict[str, int] = {}
+    for env in ENVELOPES:
+        q = (
+            select(func.count())
+            .select_from(env.model)
+            .where(env.column("enc").is_not(None))
+            .where(env.column("version") != info[env.ring][0])
+        )
+        counts[env.name] = db.execute(q).scalar_one()
+    return counts
+
+
+class RewrapWorker:
+    """Background thread that runs one throttled re-wrap pass when retired KEKs are configured.
+
+    With a `leader`, the pass runs in the worker process holding it; the others keep
+    asking every minute and take over if that worker exits (a pass resumes from the
+    stored checkpoint).
+    """
+
+    def __init__(self, enabled: bool, leader: BackgroundLeader | None = None) -> None:
+        self.enabled = enabled
+        self.leader = leader
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def start(self) -> None:
+        if not self.enabled or self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name="key-rewrap-worker", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=10)
+            self._thread = None
+
+    def _run(self) -> None:
+        while self.leader is not None and not self.leader.held():
+            if self._stop.wait(60):
+                return
+        try:
+            if not any(retired for _current, retired in get_key_service().info().values()):
+                return
+            stats = run_rewrap(stop=self._stop)
+            logger.info("Key re-wrap pass finished: %s", stats)
+        except Exception:  # noqa: BLE001
+            logger.exception("Key re-wrap failed")
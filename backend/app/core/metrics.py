@@ -0,0 +1,138 @@
+from __future__ import annotations
+
+import os
+
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, generate_latest
+from prometheus_client import multiprocess
+
+
+# Prometheus metrics for GET /metrics.
+#
+# With several uvicorn workers set PROMETHEUS_MULTIPROC_DIR (an empty directory, wiped
+# before the workers start; the entrypoint does this): every worker then writes its
+# samples to mmap'ed files there and the scrape sums them, whichever worker answers it.
+# Without it the values live in process memory (single worker, tests, benchmarks).
+#
+# Labelled children are resolved once at import time where the label set is fixed, so the
+# hot paths (crypto, every request) pay one perf_counter() pair and a few increments.
+
+_MULTIPROC_DIR = os.environ.get("PROMETHEUS_MULTIPROC_DIR", "")
+
+# Request latency; bounded by the 30 s proxy timeout in nginx.
+_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+_DB_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+# Requests that matched no route share one label value, so scanners cannot blow up
+# the series count.
+UNMATCHED_ROUTE = "<unmatched>"
+
+http_requests_total = Counter(
+    "http_requests_total",
+    "HTTP requests by route template, method and status code.",
+    ("method", "route", "status"),
+)
+http_request_duration_seconds = Histogram(
+    "http_request_duration_seconds",
+    "Time until the response headers were ready (streamed bodies excluded).",
+    ("method", "route"),
+    buckets=_LATENCY_BUCKETS,
+)
+http_requests_in_flight = Gauge(
+    "http_requests_in_flight",
+    "Requests currently being handled.",
+    multiprocess_mode="livesum",
+)
+
+db_request_seconds = Histogram(
+    "db_request_seconds",
+    "SQL time spent per request (cursor execute, as counted by the query tracker).",
+    ("route",),
+    buckets=_DB_BUCKETS,
+)
+db_statements_total = Counter(
+    "db_statements_total",
+    "SQL statements executed while handling requests.",
+    ("route",),
+)
+
+write_queue_batch_size = Histogram(
+    "write_queue_batch_size",
+    "Write ops committed together by the group-commit queue.",
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128),
+)
+write_queue_wait_seconds = Histogram(
+    "write_queue_wait_seconds",
+    "Time a write op spent queued before its batch started.",
+    buckets=_DB_BUCKETS,
+)
+write_queue_commit_seconds = Histogram(
+    "write_queue_commit_seconds",
+    "Time to run and commit one group-commit batch.",
+    buckets=_DB_BUCKETS,
+)
+
+crypto_operations_total = Counter(
+    "crypto_operations_total",
+    "Cryptographic operations by kind.",
+    ("op",),
+)
+crypto_seconds_total = Counter(
+    "crypto_seconds_total",
+    "Wall time spent in cryptographic operations.",
+    ("op",),
+)
+crypto_bytes_total = Counter(
+    "crypto_bytes_total",
+    "Input bytes processed by cryptographic operations.",
+    ("op",),
+)
+
+rate_limit_rejections_total = Counter(
+    "rate_limit_rejections_total",
+    "Requests rejected by a rate limiter.",
+    ("limiter",),
+)
+
+cache_requests_total = Counter(
+    "cache_requests_total",
+    "Cache lookups by cache and result (hit ratio = hit / (hit + miss)).",
+    ("cache", "result"),
+)
+
+
+class CryptoOp:
+    """Pre-bound counters for one kind of crypto operation."""
+
+    __slots__ = ("_count", "_seconds", "_bytes")
+
+    def __init__(self, op: str) -> None:
+        self._count = crypto_operations_total.labels(op)
+        self._seconds = crypto_seconds_total.labels(op)
+        self._bytes = crypto_bytes_total.labels(op)
+
+    def observe(self, seconds: float, nbytes: int = 0) -> None:
+        self._count.inc()
+        self._seconds.inc(seconds)
+        if nbytes:
+            self._bytes.inc(nbytes)
+
+
+def record_cache(cache: str, *, hits: int = 0, misses: int = 0) -> None:
+    if hits:
+        cache_requests_total.labels(cache, "hit").inc(hits)
+    if misses:
+        cache_requests_total.labels(cache, "miss").inc(misses)
+
+
+def render_latest() -> tuple[bytes, str]:
+    if _MULTIPROC_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(), CONTENT_TYPE_LATEST
+
+
+def mark_worker_dead() -> None:
+    # Drops this worker's live gauge files so in-flight does not count a dead process.
+    if _MULTIPROC_DIR:
+        multiprocess.mark_process_dead(os.getpid())
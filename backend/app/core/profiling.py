@@ -0,0 +1,274 @@
+from __future__ import annotations
+
+import collections
+import contextlib
+import cProfile
+import io
+import marshal
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from types import CodeType, FrameType
+
+try:
+    import resource
+except ImportError:  # Windows dev hosts; the container is Linux
+    resource = None  # type: ignore[assignment]
+
+from app.core.config import settings
+from app.core.exceptions import ConflictError
+from app.crypto.hmac_sha256 import constant_time_equals
+
+
+# On-demand profiling for staging. Everything here is off unless PROFILING_TOKEN is set, and
+# every entry point requires that token (X-Profiling-Token):
+#
+# - sample_cpu(): wall-clock sampling of all threads via sys._current_frames() for N seconds,
+#   returned as collapsed stacks (flamegraph.pl / speedscope) or a pstats file built from the
+#   samples (snakeviz, `python -m pstats`);
+# - memory_diff(): tracemalloc snapshots N seconds apart, top allocators by line;
+# - request profiles: ?profile=1 (cProfile around the endpoint) or ?profile=memory
+#   (tracemalloc around the request) on a single request, fetched afterwards by request id.
+
+PROFILE_HEADER = "X-Profiling-Token"
+
+# Innermost frames in these stdlib modules mean a thread is parked (threadpool queue,
+# event loop selector, Event.wait) rather than burning CPU.
+_IDLE_MODULES = ("threading.py", "selectors.py", "queue.py")
+
+_cpu_lock = threading.Lock()
+_memory_lock = threading.Lock()
+
+
+def profiling_enabled() -> bool:
+    return bool(settings.profiling_token)
+
+
+def token_ok(token: str | None) -> bool:
+    if not settings.profiling_token or not token:
+        return False
+    return constant_time_equals(token.encode("utf-8"), settings.profiling_token.encode("utf-8"))
+
+
+def clamp_seconds(seconds: float) -> float:
+    return max(0.1, min(float(seconds), float(settings.profiling_max_seconds)))
+
+
+def _stack(frame: FrameType | None) -> list[CodeType]:
+    codes = []
+    while frame is not None:
+        codes.append(frame.f_code)
+        frame = frame.f_back
+    codes.reverse()  # root first
+    return codes
+
+
+def _label(code: CodeType) -> str:
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def _is_idle(codes: list[CodeType]) -> bool:
+    return not codes or codes[-1].co_filename.endswith(_IDLE_MODULES)
+
+
+@dataclass
+class CpuProfile:
+    interval: float
+    samples: int = 0
+    # Stack (root first) -> number of samples it was on top of a thread.
+    stacks: collections.Counter[tuple[CodeType, ...]] = field(default_factory=collections.Counter)
+
+    def collapsed(self) -> str:
+        folded: collections.Counter[str] = collections.Counter()
+        for codes, count in self.stacks.items():
+            folded[";".join(_label(c) for c in codes)] += count
+        return "".join(f"{stack} {count}\n" for stack, count in folded.most_common())
+
+    def pstats_bytes(self) -> bytes:
+        # The marshal layout pstats.Stats loads: {func: (cc, nc, tt, ct, {caller: (cc, nc, tt, ct)})}.
+        # Call counts are sample counts; times are samples * interval.
+        def key(code: CodeType) -> tuple[str, int, str]:
+            return (code.co_filename, code.co_firstlineno, code.co_name)
+
+        self_samples: collections.Counter = collections.Counter()
+        total_samples: collections.Counter = collections.Counter()
+        edges: dict[tuple, collections.Counter] = collections.defaultdict(collections.Counter)
+        edge_self: dict[tuple, collections.Counter] = collections.defaultdict(collections.Counter)
+        for codes, count in self.stacks.items():
+            keys = [key(c) for c in codes]
+            self_samples[keys[-1]] += count
+            for k in set(keys):
+                total_samples[k] += count
+            for caller, callee in zip(keys, keys[1:]):
+                edges[callee][caller] += count
+            if len(keys) > 1:
+                edge_self[keys[-1]][keys[-2]] += count
+
+        dt = self.interval
+        stats = {}
+        for k, total in total_samples.items():
+            callers = {
+                c: (n, n, edge_self[k][c] * dt, n * dt)
+                for c, n in edges[k].items()
+            }
+            stats[k] = (total, total, self_samples[k] * dt, total * dt, callers)
+        return marshal.dumps(stats)
+
+
+def sample_cpu(seconds: float, interval: float, *, include_idle: bool = False) -> CpuProfile:
+    if not _cpu_lock.acquire(blocking=False):
+        raise ConflictError("a CPU profile is already running")
+    try:
+        profile = CpuProfile(interval=interval)
+        me = threading.get_ident()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                codes = _stack(frame)
+                if include_idle or not _is_idle(codes):
+                    profile.stacks[tuple(codes)] += 1
+            profile.samples += 1
+            time.sleep(interval)
+        return profile
+    finally:
+        _cpu_lock.release()
+
+
+def _rss_mib() -> float | None:
+    # Peak RSS of the worker; ru_maxrss is KiB on Linux.
+    if resource is None:
+        return None
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0, 1)
+
+
+@contextlib.contextmanager
+def _tracemalloc_window(frames: int):
+    started_here = not tracemalloc.is_tracing()
+    if started_here:
+        tracemalloc.start(frames)
+    try:
+        yield
+    finally:
+        if started_here:
+            tracemalloc.stop()
+
+
+def _diff(before: tracemalloc.Snapshot, after: tracemalloc.Snapshot, top: int) -> list[dict]:
+    # Skip tracemalloc's own bookkeeping so it does not top the list.
+    filters = [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, "<frozen importlib._bootstrap>")]
+    stats = after.filter_traces(filters).compare_to(before.filter_traces(filters), "lineno")
+    return [
+        {
+            "location": f"{s.traceback[0].filename}:{s.traceback[0].lineno}",
+            "size_diff_bytes": s.size_diff,
+            "size_bytes": s.size,
+            "count_diff": s.count_diff,
+        }
+        for s in stats[:top]
+    ]
+
+
+def memory_diff(seconds: float, top: int) -> dict:
+    if not _memory_lock.acquire(blocking=False):
+        raise ConflictError("a memory profile is already running")
+    try:
+        with _tracemalloc_window(1):
+            before = tracemalloc.take_snapshot()
+            time.sleep(seconds)
+            after = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+        return {
+            "seconds": seconds,
+            "max_rss_mib": _rss_mib(),
+            "traced_current_bytes": current,
+            "traced_peak_bytes": peak,
+            "top": _diff(before, after, top),
+        }
+    finally:
+        _memory_lock.release()
+
+
+@dataclass
+class RequestProfile:
+    request_id: str
+    mode: str  # cpu | memory
+    path: str
+    created_at: float = field(default_factory=time.time)
+    profiler: cProfile.Profile | None = None
+    memory: dict | None = None
+
+    def text(self, limit: int = 40) -> str:
+        if self.profiler is None:
+            return ""
+        out = io.StringIO()
+        pstats.Stats(self.profiler, stream=out).sort_stats("cumulative").print_stats(limit)
+        return out.getvalue()
+
+    def pstats_bytes(self) -> bytes:
+        if self.profiler is None:
+            return b""
+        self.profiler.create_stats()
+        return marshal.dumps(self.profiler.stats)
+
+
+_request_profile: ContextVar[RequestProfile | None] = ContextVar("request_profile", default=None)
+_request_profiles: collections.deque[RequestProfile] = collections.deque(maxlen=20)
+
+
+def begin_request_profile(request_id: str, mode: str, path: str):
+    """Returns (profile, token), or None when another memory profile holds tracemalloc."""
+
+    profile = RequestProfile(request_id=request_id, mode=mode, path=path)
+    if mode == "cpu":
+        profile.profiler = cProfile.Profile()
+    elif not _memory_lock.acquire(blocking=False):
+        return None
+    return profile, _request_profile.set(profile)
+
+
+@contextlib.contextmanager
+def request_memory_window(profile: RequestProfile):
+    # The caller holds _memory_lock (begin_request_profile); tracemalloc is process-wide, so
+    # concurrent requests' allocations show up too.
+    try:
+        with _tracemalloc_window(25):
+            before = tracemalloc.take_snapshot()
+            yield
+            after = tracemalloc.take_snapshot()
+            _, peak = tracemalloc.get_traced_memory()
+        profile.memory = {"max_rss_mib": _rss_mib(), "traced_peak_bytes": peak, "top": _diff(before, after, 30)}
+    finally:
+        _memory_lock.release()
+
+
+def end_request_profile(profile: RequestProfile, token) -> None:
+    _request_profile.reset(token)
+    _request_profiles.append(profile)
+
+
+def get_request_profile(request_id: str) -> RequestProfile | None:
+    for p in reversed(list(_request_profiles)):
+        if p.request_id == request_id:
+            return p
+    return None
+
+
+@contextlib.contextmanager
+def endpoint_profile():
+    # Around the endpoint function, in the thread that runs it (cProfile is per thread).
+    profile = _request_profile.get()
+    if profile is None or profile.profiler is None:
+        yield
+        return
+    profile.profiler.enable()
+    try:
+        yield
+    finally:
+        profile.profiler.disable()
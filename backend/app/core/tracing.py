@@ -0,0 +1,264 @@
+from __future__ import annotations
+
+import collections
+import datetime as dt
+import functools
+import inspect
+import json
+import random
+import threading
+import time
+from contextvars import ContextVar, Token
+from dataclasses import dataclass, field
+from typing import Any
+
+from fastapi.routing import APIRoute
+
+from app.core.config import settings
+from app.core.profiling import endpoint_profile
+
+
+# Lightweight request tracing: a sampled request gets a Trace (keyed by its request id),
+# and code on the request path opens spans for its phases:
+#
+#     with span("messages.verify_hmac"):
+#         ...
+#
+# Outside a sampled request span() returns a shared no-op, so instrumented code costs one
+# ContextVar lookup. Finished traces go to an exporter: a ring buffer (GET /debug/traces
+# outside production) or a JSONL file, one trace per line.
+
+
+@dataclass
+class Span:
+    name: str
+    start: float  # perf_counter()
+    end: float | None = None
+    parent: int | None = None  # index into Trace.spans
+    attrs: dict[str, Any] = field(default_factory=dict)
+
+    def set(self, key: str, value: Any) -> None:
+        self.attrs[key] = value
+
+
+@dataclass
+class Trace:
+    request_id: str
+    name: str
+    started_at: dt.datetime
+    spans: list[Span] = field(default_factory=list)
+    attrs: dict[str, Any] = field(default_factory=dict)
+    # Set when the endpoint function returns; the rest until the response starts is serialization.
+    endpoint_returned: float | None = None
+
+    def add(self, span: Span) -> int:
+        # list.append is atomic: spans may come from the event loop and threadpool threads.
+        self.spans.append(span)
+        return len(self.spans) - 1
+
+    def to_dict(self) -> dict[str, Any]:
+        t0 = self.spans[0].start if self.spans else 0.0
+        return {
+            "request_id": self.request_id,
+            "name": self.name,
+            "started_at": self.started_at.isoformat(),
+            "duration_ms": _ms(self.spans[0]) if self.spans else None,
+            "attrs": self.attrs,
+            "spans": [
+                {
+                    "name": s.name,
+                    # Spans opened directly under the request hang off the root span.
+                    "parent": s.parent if s.parent is not None or i == 0 else 0,
+                    "start_ms": round((s.start - t0) * 1000.0, 3),
+                    "duration_ms": _ms(s),
+                    "attrs": s.attrs,
+                }
+                for i, s in enumerate(self.spans)
+            ],
+        }
+
+
+def _ms(s: Span) -> float | None:
+    return None if s.end is None else round((s.end - s.start) * 1000.0, 3)
+
+
+_trace: ContextVar[Trace | None] = ContextVar("trace", default=None)
+_parent: ContextVar[int | None] = ContextVar("trace_parent", default=None)
+
+
+class _NoopSpan:
+    __slots__ = ()
+
+    def __enter__(self) -> _NoopSpan:
+        return self
+
+    def __exit__(self, *exc: object) -> None:
+        return None
+
+    def set(self, key: str, value: Any) -> None:
+        return None
+
+    def end(self) -> None:
+        return None
+
+
+_NOOP = _NoopSpan()
+
+
+class _SpanScope:
+    __slots__ = ("_trace", "_span", "_token")
+
+    def __init__(self, trace: Trace, name: str, attrs: dict[str, Any]) -> None:
+        self._trace = trace
+        self._span = Span(name, 0.0, parent=_parent.get(), attrs=attrs)
+        self._token: Token | None = None
+
+    def __enter__(self) -> Span:
+        self._span.start = time.perf_counter()
+        self._token = _parent.set(self._trace.add(self._span))
+        return self._span
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self._span.end = time.perf_counter()
+        if exc_type is not None:
+            self._span.attrs["error"] = exc_type.__name__
+        _parent.reset(self._token)
+
+
+def span(name: str, **attrs: Any) -> _SpanScope | _NoopSpan:
+    trace = _trace.get()
+    if trace is None:
+        return _NOOP
+    return _SpanScope(trace, name, attrs)
+
+
+class _LeafSpan:
+    __slots__ = ("_span",)
+
+    def __init__(self, span: Span) -> None:
+        self._span = span
+
+    def set(self, key: str, value: Any) -> None:
+        self._span.attrs[key] = value
+
+    def end(self) -> None:
+        if self._span.end is None:
+            self._span.end = time.perf_counter()
+
+
+def start_span(name: str, **attrs: Any) -> _LeafSpan | _NoopSpan:
+    """Span without a `with` block (generators, event hooks); it never becomes a parent."""
+
+    trace = _trace.get()
+    if trace is None:
+        return _NOOP
+    s = Span(name, time.perf_counter(), parent=_parent.get(), attrs=attrs)
+    trace.add(s)
+    return _LeafSpan(s)
+
+
+def current_trace() -> Trace | None:
+    return _trace.get()
+
+
+def should_sample() -> bool:
+    rate = settings.trace_sample_rate
+    return rate > 0 and (rate >= 1 or random.random() < rate)
+
+
+def begin_trace(request_id: str, name: str) -> tuple[Trace, Token]:
+    trace = Trace(request_id=request_id, name=name, started_at=dt.datetime.now(dt.UTC))
+    trace.add(Span(name, time.perf_counter()))
+    return trace, _trace.set(trace)
+
+
+def detach_trace(token: Token) -> None:
+    _trace.reset(token)
+
+
+def finish_trace(trace: Trace) -> None:
+    root = trace.spans[0]
+    if root.end is None:
+        root.end = time.perf_counter()
+    get_exporter().export(trace)
+
+
+def mark_endpoint_returned() -> None:
+    trace = _trace.get()
+    if trace is not None:
+        trace.endpoint_returned = time.perf_counter()
+
+
+class TracedRoute(APIRoute):
+    """APIRoute that notes when the endpoint returns (start of the response.serialize span).
+
+    The endpoint also runs under the request's cProfile when it was sent with ?profile=1.
+    """
+
+    def __init__(self, path: str, endpoint, **kwargs) -> None:
+        super().__init__(path, _mark_return(endpoint), **kwargs)
+
+
+def _mark_return(endpoint):
+    if getattr(endpoint, "__traced__", False):
+        return endpoint
+    if inspect.iscoroutinefunction(endpoint):
+
+        @functools.wraps(endpoint)
+        async def traced_async(*args, **kwargs):
+            with endpoint_profile():
+                result = await endpoint(*args, **kwargs)
+            mark_endpoint_returned()
+            return result
+
+        traced_async.__traced__ = True
+        return traced_async
+
+    @functools.wraps(endpoint)
+    def traced_sync(*args, **kwargs):
+        with endpoint_profile():
+            result = endpoint(*args, **kwargs)
+        mark_endpoint_returned()
+        return result
+
+    traced_sync.__traced__ = True
+    return traced_sync
+
+
+class MemoryExporter:
+    def __init__(self, size: int) -> None:
+        # deque.append is thread-safe; the oldest traces fall off the end.
+        self._traces: collections.deque[dict[str, Any]] = collections.deque(maxlen=max(1, size))
+
+    def export(self, trace: Trace) -> None:
+        self._traces.append(trace.to_dict())
+
+    def recent(self, limit: int, request_id: str | None = None) -> list[dict[str, Any]]:
+        out = []
+        for t in reversed(list(self._traces)):
+            if request_id is None or t["request_id"] == request_id:
+                out.append(t)
+                if len(out) >= limit:
+                    break
+        return out
+
+
+class JsonlExporter:
+    def __init__(self, path: str) -> None:
+        self._path = path
+        self._lock = threading.Lock()
+
+    def export(self, trace: Trace) -> None:
+        line = json.dumps(trace.to_dict(), separators=(",", ":"), default=str) + "\n"
+        with self._lock, open(self._path, "a", encoding="utf-8") as f:
+            f.write(line)
+
+
+@functools.lru_cache(maxsize=1)
+def get_exporter() -> MemoryExporter | JsonlExporter:
+    kind = (settings.trace_exporter or "").strip().lower()
+    if kind == "memory":
+        return MemoryExporter(settings.trace_buffer_size)
+    if kind == "jsonl":
+        return JsonlExporter(settings.trace_jsonl_path)
+    raise ValueError("TRACE_EXPORTER must be one of: memory, jsonl")
@@ -0,0 +1,102 @@
+from __future__ import annotations
+
+import functools
+import logging
+import math
+import os
+import threading
+from pathlib import Path
+
+try:
+    import fcntl
+except ImportError:  # Windows: one process, nothing to elect
+    fcntl = None
+
+logger = logging.getLogger("app.workers")
+
+
+# Process model. The entrypoint runs `uvicorn --workers N`: N independent processes, each
+# importing the app and running its startup hooks, with its own connection pools, write
+# queue, crypto threads and caches. What must be shared lives outside the processes:
+# - data and the schema version in the database (migrations run once, under a lock);
+# - rate-limit counters in the database as well once N > 1 (RATE_LIMIT_STORE);
+# - metrics in PROMETHEUS_MULTIPROC_DIR;
+# - singleton background jobs (purge, key re-wrap) in the one worker holding the
+#   background lock file (BackgroundLeader).
+#
+# WEB_CONCURRENCY=0 sizes N to the CPUs the container may use (affinity and the cgroup
+# quota, e.g. `docker run --cpus`), not to the host's core count.
+
+
+@functools.lru_cache(maxsize=1)
+def usable_cpus() -> int:
+    try:
+        count = len(os.sched_getaffinity(0))
+    except AttributeError:
+        count = os.cpu_count() or 1
+    try:
+        quota, period = Path("/sys/fs/cgroup/cpu.max").read_text().split()[:2]
+        if quota != "max":
+            count = min(count, math.ceil(int(quota) / int(period)))
+    except (OSError, ValueError):
+        pass
+    return max(1, count)
+
+
+def worker_count(configured: int = 0) -> int:
+    """WEB_CONCURRENCY, or the usable CPU count when it is 0."""
+
+    return configured if configured > 0 else usable_cpus()
+
+
+def cpus_per_worker(configured_workers: int = 0) -> int:
+    return max(1, usable_cpus() // worker_count(configured_workers))
+
+
+class BackgroundLeader:
+    """Non-blocking exclusive lock on a file: its holder runs the singleton background jobs.
+
+    Every worker asks before each job run; the first to ask takes the lock and keeps it
+    until it exits (the kernel drops it with the process), then another worker takes over
+    on its next attempt.
+    """
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self._fd: int | None = None
+        # Purge and re-wrap threads share one instance: one open file, one flock.
+        self._lock = threading.Lock()
+
+    def held(self) -> bool:
+        with self._lock:
+            return self._acquire()
+
+    def _acquire(self) -> bool:
+        if self._fd is not None or fcntl is None:
+            return True
+        try:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        except OSError:
+            # No writable data directory (e.g. PostgreSQL without a volume): every worker runs the jobs.
+            logger.warning("Background lock %s unavailable; running background jobs in this worker", self.path)
+            self._fd = -1
+            return True
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return False
+        self._fd = fd
+        logger.info("Worker %d runs the background jobs", os.getpid())
+        return True
+
+    def release(self) -> None:
+        with self._lock:
+            fd, self._fd = self._fd, None
+        if fd is not None and fd >= 0:
+            os.close(fd)
+
+
+if __name__ == "__main__":
+    # Used by entrypoint.sh: prints the worker count for WEB_CONCURRENCY (0 or unset = CPUs).
+    print(worker_count(int(os.environ.get("WEB_CONCURRENCY") or 0)))
@@ -1,10 +1,17 @@
 from __future__ import annotations
 
 import os
+import time
 from dataclasses import dataclass
 
 from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 
+from app.core.metrics import CryptoOp
+
+
+_ENCRYPT_METRIC = CryptoOp("aes_gcm_encrypt")
+_DECRYPT_METRIC = CryptoOp("aes_gcm_decrypt")
+
 
 @dataclass(frozen=True)
 class AesGcmEncrypted:
@@ -28,7 +35,9 @@ class AesGcmCipher:
 
     def encrypt(self, plaintext: bytes, aad: bytes) -> AesGcmEncrypted:
         nonce = os.urandom(12)
+        started = time.perf_counter()
         ct_and_tag = self._aesgcm.encrypt(nonce, plaintext, aad)
+        _ENCRYPT_METRIC.observe(time.perf_counter() - started, len(plaintext))
         if len(ct_and_tag) < 16:
             raise ValueError("ciphertext too short")
         return AesGcmEncrypted(
@@ -38,4 +47,7 @@ class AesGcmCipher:
         )
 
     def decrypt(self, ciphertext: bytes, nonce: bytes, tag: bytes, aad: bytes) -> bytes:
-        return self._aesgcm.decrypt(nonce, ciphertext + tag, aad)
+        started = time.perf_counter()
+        plaintext = self._aesgcm.decrypt(nonce, ciphertext + tag, aad)
+        _DECRYPT_METRIC.observe(time.perf_counter() - started, len(ciphertext))
+        return plaintext
@@ -2,10 +2,19 @@ from __future__ import annotations
 
 import hmac
 import hashlib
+import time
+
+from app.core.metrics import CryptoOp
+
+
+_HMAC_METRIC = CryptoOp("hmac_sha256")
 
 
 def hmac_sha256(key: bytes, data: bytes) -> bytes:
-    return hmac.new(key, data, hashlib.sha256).digest()
+    started = time.perf_counter()
+    digest = hmac.new(key, data, hashlib.sha256).digest()
+    _HMAC_METRIC.observe(time.perf_counter() - started, len(data))
+    return digest
 
 
 def constant_time_equals(a: bytes, b: bytes) -> bool:
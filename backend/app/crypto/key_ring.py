@@ -0,0 +1,33 @@
+from __future__ import annotations
+
+from app.crypto.aes_gcm import AesGcmCipher, AesGcmEncrypted
+
+
+class KeyRing:
+    """Versioned KEKs: wraps under the current version, unwraps under any known one.
+
+    Envelopes store the key version next to ciphertext/nonce/tag, so rotating a KEK
+    only means adding a version and re-wrapping the small wrapped keys in the background.
+    """
+
+    def __init__(self, current_version: int, keys: dict[int, bytes]):
+        if current_version not in keys:
+            raise ValueError("current key version missing from key ring")
+        self.current_version = current_version
+        self._ciphers = {version: AesGcmCipher(key) for version, key in keys.items()}
+
+    @property
+    def retired_versions(self) -> list[int]:
+        return sorted(v for v in self._ciphers if v != self.current_version)
+
+    def encrypt(self, plaintext: bytes, aad: bytes) -> tuple[int, AesGcmEncrypted]:
+        return self.current_version, self._ciphers[self.current_version].encrypt(plaintext, aad=aad)
+
+    def decrypt(self, version: int, ciphertext: bytes, nonce: bytes, tag: bytes, aad: bytes) -> bytes:
+        cipher = self._ciphers.get(version)
+        if cipher is None:
+            raise ValueError(f"unknown key version {version}")
+        return cipher.decrypt(ciphertext, nonce, tag, aad=aad)
+
+    def rewrap(self, version: int, ciphertext: bytes, nonce: bytes, tag: bytes, aad: bytes) -> tuple[int, AesGcmEncrypted]:
+        return self.encrypt(self.decrypt(version, ciphertext, nonce, tag, aad), aad)
@@ -0,0 +1,34 @@
+from __future__ import annotations
+
+import functools
+from collections.abc import Callable
+from typing import TypeVar
+
+import anyio
+import anyio.to_thread
+
+from app.core.config import settings
+from app.core.workers import cpus_per_worker
+
+T = TypeVar("T")
+
+# Async endpoints must not run AES-GCM, HMAC or key-service round trips on the event loop.
+# They go to worker threads through this limiter, which is separate from the threadpool
+# running sync endpoints, so a burst of decrypts cannot starve them (and vice versa).
+# The cryptography primitives release the GIL, so CRYPTO_THREADS can usefully match the
+# cores each worker process gets (the default).
+
+_limiter: anyio.CapacityLimiter | None = None
+
+
+def _crypto_limiter() -> anyio.CapacityLimiter:
+    # Created lazily: a CapacityLimiter belongs to the event loop that first uses it.
+    global _limiter
+    if _limiter is None:
+        _limiter = anyio.CapacityLimiter(settings.crypto_threads or max(2, cpus_per_worker(settings.web_concurrency)))
+    return _limiter
+
+
+async def run_crypto(fn: Callable[..., T], *args, **kwargs) -> T:
+    # Context variables (trace, query stats) are copied into the worker thread.
+    return await anyio.to_thread.run_sync(functools.partial(fn, *args, **kwargs), limiter=_crypto_limiter())
@@ -1,10 +1,13 @@
 from __future__ import annotations
 
 import re
+import time
 
 from argon2 import PasswordHasher
 from argon2.exceptions import VerifyMismatchError
 
+from app.core.metrics import CryptoOp
+
 
 _password_hasher = PasswordHasher(
     time_cost=3,
@@ -14,6 +17,9 @@ _password_hasher = PasswordHasher(
     salt_len=16,
 )
 
+_HASH_METRIC = CryptoOp("argon2_hash")
+_VERIFY_METRIC = CryptoOp("argon2_verify")
+
 
 def validate_password_strength(password: str) -> None:
     """Deny-by-default minimal policy suitable for academic POC."""
@@ -35,11 +41,17 @@ def validate_password_strength(password: str) -> None:
 
 def hash_password(password: str) -> str:
     validate_password_strength(password)
-    return _password_hasher.hash(password)
+    started = time.perf_counter()
+    password_hash = _password_hasher.hash(password)
+    _HASH_METRIC.observe(time.perf_counter() - started)
+    return password_hash
 
 
 def verify_password(password: str, password_hash: str) -> bool:
+    started = time.perf_counter()
     try:
         return _password_hasher.verify(password_hash, password)
     except VerifyMismatchError:
         return False
+    finally:
+        _VERIFY_METRIC.observe(time.perf_counter() - started)
@@ -0,0 +1,77 @@
+from __future__ import annotations
+
+from collections.abc import AsyncGenerator
+
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+from app.core.config import settings
+from app.db.shards import attach_mailbox_shards
+from app.db.session import (
+    POSTGRES_READ_ONLY_OPTIONS,
+    _sqlite_read_only_url,
+    apply_sqlite_pragmas,
+    database_url,
+    instrument_engine,
+    is_sqlite_url,
+)
+
+
+# Async read path for the hottest GET routes (inbox, sent, detail and the session lookup
+# behind them). Async endpoints run on the event loop instead of taking one of the 40
+# threadpool slots for the whole request; only the driver I/O (aiosqlite's connection
+# threads) and the offloaded crypto leave it.
+#
+# SQLite: the same read-only file URI and connection PRAGMAs as read_engine. PostgreSQL:
+# DATABASE_URL with psycopg's async mode and the read pool's READ ONLY default, or an
+# explicit ASYNC_DATABASE_URL (e.g. postgresql+asyncpg://...); the queries are dialect-neutral.
+
+
+def async_database_url() -> str:
+    if settings.async_database_url:
+        return settings.async_database_url
+    if is_sqlite_url(database_url()):
+        return _sqlite_read_only_url(settings.sqlite_path).replace("sqlite://", "sqlite+aiosqlite://", 1)
+    # psycopg 3 serves both engines; postgresql:// alone would pick the sync-only psycopg2.
+    return make_url(database_url()).set(drivername="postgresql+psycopg").render_as_string(hide_password=False)
+
+
+def _connect_args() -> dict:
+    # Only for the derived psycopg URL; an explicit ASYNC_DATABASE_URL may use another driver.
+    if not settings.async_database_url and not is_sqlite_url(database_url()):
+        return {"options": POSTGRES_READ_ONLY_OPTIONS}
+    return {}
+
+
+async_engine = create_async_engine(
+    async_database_url(),
+    connect_args=_connect_args(),
+    poolclass=AsyncAdaptedQueuePool,
+    pool_size=settings.db_read_pool_size,
+    max_overflow=settings.db_read_max_overflow,
+    pool_timeout=settings.db_pool_timeout_seconds,
+    pool_pre_ping=not is_sqlite_url(async_database_url()),
+)
+
+
+if async_engine.dialect.name == "sqlite":
+
+    @event.listens_for(async_engine.sync_engine, "connect")
+    def _on_connect(dbapi_connection, connection_record) -> None:
+        attach_mailbox_shards(dbapi_connection, read_only=True)
+        apply_sqlite_pragmas(dbapi_connection, read_only=True)
+
+
+instrument_engine(async_engine.sync_engine)
+
+# expire_on_commit=False: attribute access after a commit would need an implicit (sync) reload.
+AsyncSessionLocal = async_sessionmaker(async_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
+
+
+async def get_async_db() -> AsyncGenerator[AsyncSession, None]:
+    """Read-only AsyncSession; writes go through run_write_async (app/db/write_queue.py)."""
+
+    async with AsyncSessionLocal() as db:
+        yield db
@@ -1,10 +1,37 @@
 from __future__ import annotations
 
+import datetime as dt
+import logging
 import os
 import sqlite3
+from collections.abc import Callable, Iterator
+from contextlib import contextmanager
 from pathlib import Path
 
+from sqlalchemy import text
+from sqlalchemy.engine import Connection, Engine
+
 from app.core.config import settings
+from app.db.session import apply_sqlite_pragmas, engine
+from app.db.shards import existing_shard_indexes, mailbox_shard_count, shard_path
+
+try:
+    import fcntl
+except ImportError:  # Windows: no advisory file locks, SQLite's own locking only
+    fcntl = None
+
+logger = logging.getLogger("app.db")
+
+# Versioned schema. Every migration runs once, in order, and is recorded in schema_version;
+# startup reads the current version and only takes the migration lock when it is behind
+# (first start, or new code with new steps). Steps stay idempotent (IF NOT EXISTS, column
+# checks) so a step interrupted before its version row commits can simply run again, and
+# databases created before schema_version existed go through all of them once.
+#
+# A schema change appends the next version to both _SQLITE_MIGRATIONS and
+# _POSTGRES_MIGRATIONS. schema.postgres.sql may take it too (new databases run it as their
+# baseline); schema.sql may not when it touches columns older files add in _apply_migrations.
+SCHEMA_VERSION = 6
 
 
 def _column_exists(conn: sqlite3.Connection, table: str, column: str) -> bool:
@@ -13,52 +40,345 @@ def _column_exists(conn: sqlite3.Connection, table: str, column: str) -> bool:
 
 
 def _apply_migrations(conn: sqlite3.Connection) -> None:
-    # schema.sql is authoritative for new DBs; existing DBs need additive migrations.
+    # Additive changes from before schema_version; part of the version 1 baseline.
     if not _column_exists(conn, "users", "totp_last_used_step"):
         conn.execute("ALTER TABLE users ADD COLUMN totp_last_used_step INTEGER;")
+    if not _column_exists(conn, "messages", "body_format"):
+        conn.execute("ALTER TABLE messages ADD COLUMN body_format INTEGER NOT NULL DEFAULT 0;")
+    if not _column_exists(conn, "attachments", "blob_format"):
+        conn.execute("ALTER TABLE attachments ADD COLUMN blob_format INTEGER NOT NULL DEFAULT 0;")
+    if not _column_exists(conn, "attachments", "blob_id"):
+        conn.execute("ALTER TABLE attachments ADD COLUMN blob_id TEXT REFERENCES attachment_blobs(id);")
+        conn.execute("ALTER TABLE attachments ADD COLUMN blob_key_enc BLOB;")
+        conn.execute("ALTER TABLE attachments ADD COLUMN blob_key_nonce BLOB;")
+        conn.execute("ALTER TABLE attachments ADD COLUMN blob_key_tag BLOB;")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_attachments_blob ON attachments(blob_id);")
+    if not _column_exists(conn, "messages", "thread_id"):
+        conn.execute("ALTER TABLE messages ADD COLUMN thread_id TEXT;")
+        conn.execute("ALTER TABLE messages ADD COLUMN in_reply_to TEXT REFERENCES messages(id) ON DELETE SET NULL;")
+        # Every pre-existing message starts its own thread.
+        conn.execute("UPDATE messages SET thread_id = id WHERE thread_id IS NULL;")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_messages_thread_created ON messages(thread_id, created_at);")
+    if not _column_exists(conn, "messages", "expires_at"):
+        conn.execute("ALTER TABLE messages ADD COLUMN expires_at TEXT;")
+    # Partial indexes keep purge candidate scans proportional to the garbage, not the table.
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_messages_expires ON messages(expires_at) WHERE expires_at IS NOT NULL;")
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_messages_sender_deleted ON messages(deleted_by_sender_at, id) "
+        "WHERE deleted_by_sender_at IS NOT NULL;"
+    )
+    # Key-versioned envelopes: everything written before rotation support used version 1.
+    for table, column in (
+        ("messages", "content_key_version"),
+        ("messages", "hmac_format"),
+        ("users", "hmac_key_version"),
+        ("users", "totp_secret_version"),
+        ("upload_sessions", "session_key_version"),
+    ):
+        if not _column_exists(conn, table, column):
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} INTEGER NOT NULL DEFAULT 1;")
 
 
-def init_sqlite_schema() -> None:
-    """Initialize SQLite schema from the versioned SQL file.
-
-    Rationale:
-    - schema.sql remains the authoritative, auditable schema document,
-    - on first start the DB file is created and schema applied.
-    """
-
-    db_path = Path(settings.sqlite_path)
-    db_path.parent.mkdir(parents=True, exist_ok=True)
-
-    if not db_path.exists():
-        db_path.touch(mode=0o600)
-
-    # Resolve schema file (works both locally and in Docker).
-    schema_path: Path | None = None
+def _schema_file(name: str) -> Path:
+    # Resolve the schema file (works both locally and in Docker).
     checked: list[str] = []
     for parent in Path(__file__).resolve().parents:
-        candidate = parent / "database" / "schema.sql"
+        candidate = parent / "database" / name
         checked.append(str(candidate))
         if candidate.exists():
-            schema_path = candidate
-            break
-    if schema_path is None:
-        raise RuntimeError(
-            "database/schema.sql not found. Checked:\n- " + "\n- ".join(checked)
-        )
+            return candidate
+    raise RuntimeError(f"database/{name} not found. Checked:\n- " + "\n- ".join(checked))
+
+
+def _sqlite_baseline(conn: sqlite3.Connection) -> None:
+    conn.executescript(_schema_file("schema.sql").read_text(encoding="utf-8"))
+    _apply_migrations(conn)
+
+
+def _sqlite_reference_indexes(conn: sqlite3.Connection) -> None:
+    # hard_delete_messages clears in_reply_to, and releasing a blob checks upload_sessions;
+    # both scanned the whole table per batch without these.
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_messages_in_reply_to ON messages(in_reply_to) WHERE in_reply_to IS NOT NULL;")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_upload_sessions_blob ON upload_sessions(blob_id) WHERE blob_id IS NOT NULL;")
+
+
+_RATE_LIMIT_BUCKETS = """
+CREATE TABLE IF NOT EXISTS rate_limit_buckets (
+  limiter TEXT NOT NULL,
+  bucket_key {blob} NOT NULL,
+  window_start {big} NOT NULL,
+  hits INTEGER NOT NULL DEFAULT 0,
+  PRIMARY KEY (limiter, bucket_key)
+)
+"""
+_RATE_LIMIT_BUCKETS_INDEX = "CREATE INDEX IF NOT EXISTS idx_rate_limit_buckets_window ON rate_limit_buckets(window_start)"
+
+
+def _sqlite_rate_limit_buckets(conn: sqlite3.Connection) -> None:
+    conn.execute(_RATE_LIMIT_BUCKETS.format(blob="BLOB", big="INTEGER"))
+    conn.execute(_RATE_LIMIT_BUCKETS_INDEX)
 
-    sql = schema_path.read_text(encoding="utf-8")
 
-    conn = sqlite3.connect(str(db_path))
+def _sqlite_idempotency_lease(conn: sqlite3.Connection) -> None:
+    if not _column_exists(conn, "idempotency_keys", "owner_token"):
+        conn.execute("ALTER TABLE idempotency_keys ADD COLUMN owner_token TEXT;")
+    if not _column_exists(conn, "idempotency_keys", "lease_expires_at"):
+        conn.execute("ALTER TABLE idempotency_keys ADD COLUMN lease_expires_at TEXT;")
+
+
+def _sqlite_rotation_skipped(conn: sqlite3.Connection) -> None:
+    if not _column_exists(conn, "key_rotation_checkpoints", "skipped"):
+        conn.execute("ALTER TABLE key_rotation_checkpoints ADD COLUMN skipped INTEGER NOT NULL DEFAULT 0;")
+
+
+def _sqlite_export_lease(conn: sqlite3.Connection) -> None:
+    if not _column_exists(conn, "export_jobs", "owner_token"):
+        conn.execute("ALTER TABLE export_jobs ADD COLUMN owner_token TEXT;")
+    if not _column_exists(conn, "export_jobs", "lease_expires_at"):
+        conn.execute("ALTER TABLE export_jobs ADD COLUMN lease_expires_at TEXT;")
+
+
+_SQLITE_MIGRATIONS: tuple[tuple[int, str, Callable[[sqlite3.Connection], None]], ...] = (
+    (1, "baseline: schema.sql and the pre-versioning column additions", _sqlite_baseline),
+    (2, "indexes on messages.in_reply_to and upload_sessions.blob_id", _sqlite_reference_indexes),
+    (3, "rate_limit_buckets (shared rate limits for several workers)", _sqlite_rate_limit_buckets),
+    (4, "idempotency_keys.owner_token and lease_expires_at", _sqlite_idempotency_lease),
+    (5, "key_rotation_checkpoints.skipped", _sqlite_rotation_skipped),
+    (6, "export_jobs.owner_token and lease_expires_at", _sqlite_export_lease),
+)
+
+_SQLITE_VERSION_TABLE = """
+CREATE TABLE IF NOT EXISTS schema_version (
+  version INTEGER PRIMARY KEY,
+  description TEXT NOT NULL,
+  applied_at TEXT NOT NULL
+)
+"""
+
+
+def _sqlite_version(conn: sqlite3.Connection) -> int:
     try:
-        conn.execute("PRAGMA foreign_keys = ON;")
-        conn.executescript(sql)
-        _apply_migrations(conn)
-        conn.commit()
+        row = conn.execute("SELECT MAX(version) FROM schema_version").fetchone()
+    except sqlite3.OperationalError:
+        # No table yet: a new file, or one created before schema versioning.
+        return 0
+    return row[0] or 0
+
+
+def _check_version(version: int) -> None:
+    if version > SCHEMA_VERSION:
+        raise RuntimeError(f"Database schema version {version} is newer than this code ({SCHEMA_VERSION}); refusing to start")
+
+
+@contextmanager
+def _migration_lock(path: Path) -> Iterator[None]:
+    # Workers starting together: the first one migrates, the rest wait here and then find
+    # the new version. A lock file rather than a SQLite lock, so a long index build does not
+    # run into the waiting workers' busy_timeout.
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        if fcntl is not None:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
     finally:
-        conn.close()
+        os.close(fd)  # releases the lock
+
 
+def _migrate_sqlite(db_path: Path) -> None:
+    db_path.parent.mkdir(parents=True, exist_ok=True)
+    with _migration_lock(db_path.with_name(db_path.name + ".migrate-lock")):
+        new_file = not db_path.exists()
+        if new_file:
+            db_path.touch(mode=0o600)
+        conn = sqlite3.connect(str(db_path))
+        try:
+            if new_file:
+                # Must precede the switch to WAL, which already writes the file header.
+                conn.execute("PRAGMA auto_vacuum = INCREMENTAL;")
+            # Switches the file to WAL before the pool opens its first connection.
+            apply_sqlite_pragmas(conn)
+            conn.execute("PRAGMA foreign_keys = ON;")
+            current = _sqlite_version(conn)
+            _check_version(current)
+            conn.execute(_SQLITE_VERSION_TABLE)
+            for version, description, step in _SQLITE_MIGRATIONS:
+                if version <= current:
+                    continue
+                started = dt.datetime.now(dt.UTC)
+                logger.info("Applying schema migration %d: %s", version, description)
+                step(conn)
+                conn.execute(
+                    "INSERT INTO schema_version (version, description, applied_at) VALUES (?, ?, ?)",
+                    (version, description, started.isoformat()),
+                )
+                conn.commit()
+        finally:
+            conn.close()
+    _chmod_private(db_path)
+
+
+def init_sqlite_schema() -> None:
+    """Bring the SQLite file to SCHEMA_VERSION.
+
+    schema.sql remains the authoritative, auditable schema document (the version 1
+    baseline). When the file is already current this is a single read of schema_version
+    (plus the mailbox shard layout check when MAILBOX_SHARDS is set).
+    """
+
+    db_path = Path(settings.sqlite_path)
+    version = 0
+    if db_path.exists():
+        conn = sqlite3.connect(str(db_path))
+        try:
+            version = _sqlite_version(conn)
+        finally:
+            conn.close()
+    _check_version(version)
+    if version < SCHEMA_VERSION:
+        _migrate_sqlite(db_path)
+
+    if mailbox_shard_count() or existing_shard_indexes():
+        conn = sqlite3.connect(str(db_path))
+        try:
+            _init_mailbox_shards(conn)
+        finally:
+            conn.close()
+
+
+def _chmod_private(path: Path) -> None:
     try:
-        os.chmod(db_path, 0o600)
+        os.chmod(path, 0o600)
     except Exception:
         # Best-effort on platforms that do not support chmod semantics.
         pass
+
+
+def _init_mailbox_shards(main: sqlite3.Connection) -> None:
+    # Create the MAILBOX_SHARDS files and refuse a layout that would hide mailbox rows:
+    # rows still in the main table, files of a larger layout, or files from another N.
+    n = mailbox_shard_count()
+    reshard = "run scripts/reshard_mailbox.py (app stopped) to move mailbox rows"
+    stray = [i for i in existing_shard_indexes() if i >= n]
+    if stray:
+        raise RuntimeError(f"MAILBOX_SHARDS={n} but shard files {stray} exist; {reshard}")
+    if n == 0:
+        return
+    if main.execute("SELECT 1 FROM message_recipients LIMIT 1").fetchone() is not None:
+        raise RuntimeError(f"MAILBOX_SHARDS={n} but the main database still holds message_recipients rows; {reshard}")
+
+    for i in range(n):
+        path = shard_path(i)
+        # Existing files only need their layout marker read.
+        conn = sqlite3.connect(str(path)) if path.exists() else open_mailbox_shard(path)
+        try:
+            layout = conn.execute("SELECT shard_index, shard_count FROM mailbox_shard").fetchone()
+            if layout is None:
+                conn.execute("INSERT INTO mailbox_shard (shard_index, shard_count) VALUES (?, ?)", (i, n))
+            elif tuple(layout) != (i, n):
+                raise RuntimeError(f"{path} is shard {layout[0]} of {layout[1]}, expected {i} of {n}; {reshard}")
+            conn.commit()
+        finally:
+            conn.close()
+
+
+def open_mailbox_shard(path: Path) -> sqlite3.Connection:
+    """Open (creating if needed) a mailbox shard file with its schema applied."""
+
+    conn = sqlite3.connect(str(path))
+    apply_sqlite_pragmas(conn)
+    conn.executescript(_schema_file("schema.mailbox.sql").read_text(encoding="utf-8"))
+    _chmod_private(path)
+    return conn
+
+
+# Arbitrary application-wide key: workers starting together apply the schema one at a time.
+_POSTGRES_SCHEMA_LOCK = 0x5EC0DE
+
+def _postgres_baseline(conn: Connection) -> None:
+    # No bound parameters: the driver sends the whole file as one simple query.
+    conn.exec_driver_sql(_schema_file("schema.postgres.sql").read_text(encoding="utf-8"))
+
+
+def _postgres_reference_indexes(conn: Connection) -> None:
+    # Already in schema.postgres.sql (written after them); kept for the shared numbering.
+    conn.exec_driver_sql("CREATE INDEX IF NOT EXISTS idx_messages_in_reply_to ON messages(in_reply_to) WHERE in_reply_to IS NOT NULL")
+    conn.exec_driver_sql("CREATE INDEX IF NOT EXISTS idx_upload_sessions_blob ON upload_sessions(blob_id) WHERE blob_id IS NOT NULL")
+
+
+def _postgres_rate_limit_buckets(conn: Connection) -> None:
+    conn.exec_driver_sql(_RATE_LIMIT_BUCKETS.format(blob="BYTEA", big="BIGINT"))
+    conn.exec_driver_sql(_RATE_LIMIT_BUCKETS_INDEX)
+
+
+def _postgres_idempotency_lease(conn: Connection) -> None:
+    conn.exec_driver_sql("ALTER TABLE idempotency_keys ADD COLUMN IF NOT EXISTS owner_token TEXT")
+    conn.exec_driver_sql("ALTER TABLE idempotency_keys ADD COLUMN IF NOT EXISTS lease_expires_at TIMESTAMPTZ")
+
+
+def _postgres_rotation_skipped(conn: Connection) -> None:
+    conn.exec_driver_sql("ALTER TABLE key_rotation_checkpoints ADD COLUMN IF NOT EXISTS skipped BIGINT NOT NULL DEFAULT 0")
+
+
+def _postgres_export_lease(conn: Connection) -> None:
+    conn.exec_driver_sql("ALTER TABLE export_jobs ADD COLUMN IF NOT EXISTS owner_token TEXT")
+    conn.exec_driver_sql("ALTER TABLE export_jobs ADD COLUMN IF NOT EXISTS lease_expires_at TIMESTAMPTZ")
+
+
+# Same version numbers as _SQLITE_MIGRATIONS.
+_POSTGRES_MIGRATIONS: tuple[tuple[int, str, Callable[[Connection], None]], ...] = (
+    (1, "baseline: schema.postgres.sql", _postgres_baseline),
+    (2, "indexes on messages.in_reply_to and upload_sessions.blob_id", _postgres_reference_indexes),
+    (3, "rate_limit_buckets (shared rate limits for several workers)", _postgres_rate_limit_buckets),
+    (4, "idempotency_keys.owner_token and lease_expires_at", _postgres_idempotency_lease),
+    (5, "key_rotation_checkpoints.skipped", _postgres_rotation_skipped),
+    (6, "export_jobs.owner_token and lease_expires_at", _postgres_export_lease),
+)
+
+_POSTGRES_VERSION_TABLE = """
+CREATE TABLE IF NOT EXISTS schema_version (
+  version INTEGER PRIMARY KEY,
+  description TEXT NOT NULL,
+  applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
+)
+"""
+
+
+def _postgres_version(conn: Connection) -> int:
+    if conn.execute(text("SELECT to_regclass('schema_version')")).scalar() is None:
+        return 0
+    return conn.execute(text("SELECT MAX(version) FROM schema_version")).scalar() or 0
+
+
+def init_postgres_schema(bind: Engine | None = None) -> None:
+    """Bring DATABASE_URL (or `bind`) to SCHEMA_VERSION; a version read when it is current."""
+
+    bind = bind or engine
+    with bind.connect() as conn:
+        version = _postgres_version(conn)
+    _check_version(version)
+    if version == SCHEMA_VERSION:
+        return
+
+    # One transaction: DDL is transactional in PostgreSQL, so a failed step leaves nothing behind.
+    with bind.begin() as conn:
+        conn.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": _POSTGRES_SCHEMA_LOCK})
+        conn.exec_driver_sql(_POSTGRES_VERSION_TABLE)
+        current = _postgres_version(conn)
+        for version, description, step in _POSTGRES_MIGRATIONS:
+            if version <= current:
+                continue
+            logger.info("Applying schema migration %d: %s", version, description)
+            step(conn)
+            conn.execute(
+                text("INSERT INTO schema_version (version, description) VALUES (:version, :description)"),
+                {"version": version, "description": description},
+            )
+
+
+def init_schema() -> None:
+    """Create or migrate the schema of the configured database (SQLite or PostgreSQL)."""
+
+    if engine.dialect.name == "sqlite":
+        init_sqlite_schema()
+    else:
+        init_postgres_schema()
@@ -30,6 +30,8 @@ class User(Base):
     totp_secret_enc: Mapped[Optional[bytes]] = mapped_column(LargeBinary, nullable=True)
     totp_secret_nonce: Mapped[Optional[bytes]] = mapped_column(LargeBinary, nullable=True)
     totp_secret_tag: Mapped[Optional[bytes]] = mapped_column(LargeBinary, nullable=True)
+    # TOTP_KEY_ENCRYPTION_KEY version the secret is wrapped under.
+    totp_secret_version: Mapped[int] = mapped_column(Integer, nullable=False, default=1)
 
     # Anti-replay: last accepted TOTP time-step counter.
     totp_last_used_step: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
@@ -37,6 +39,8 @@ class User(Base):
     hmac_key_enc: Mapped[Optional[bytes]] = mapped_column(LargeBinary, nullable=True)
     hmac_key_nonce: Mapped[Optional[bytes]] = mapped_column(LargeBinary, nullable=True)
     hmac_key_tag: Mapped[Optional[bytes]] = mapped_column(LargeBinary, nullable=True)
+    # USER_HMAC_KEY_ENCRYPTION_KEY version the HMAC key is wrapped under.
+    hmac_key_version: Mapped[int] = mapped_column(Integer, nullable=False, default=1)
 
     is_active: Mapped[bool] = mapped_column(Boolean, nullable=False, default=True)
     failed_login_count: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
@@ -80,6 +84,8 @@ class Message(Base):
     content_key_enc: Mapped[bytes] = mapped_column(LargeBinary, nullable=False)
     content_key_nonce: Mapped[bytes] = mapped_column(LargeBinary, nullable=False)
     content_key_tag: Mapped[bytes] = mapped_column(LargeBinary, nullable=False)
+    # DATA_KEY version the DEK is wrapped under.
+    content_key_version: Mapped[int] = mapped_column(Integer, nullable=False, default=1)
 
     subject_ciphertext: Mapped[bytes] = mapped_column(LargeBinary, nullable=False)
     subject_nonce: Mapped[bytes] = mapped_column(LargeBinary, nullable=False)
@@ -88,11 +94,21 @@ class Message(Base):
     body_ciphertext: Mapped[bytes] = mapped_column(LargeBinary, nullable=False)
     body_nonce: Mapped[bytes] = mapped_column(LargeBinary, nullable=False)
     body_tag: Mapped[bytes] = mapped_column(LargeBinary, nullable=False)
+    # Payload format of the body plaintext (0 = raw, 1 = deflate, 2 = zstd).
+    body_format: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
 
     hmac_sha256: Mapped[bytes] = mapped_column(LargeBinary, nullable=False)
+    # HMAC payload layout: 1 = legacy (covers the KEK-wrapped DEK), 2 = excludes KEK-wrapped fields.
+    hmac_format: Mapped[int] = mapped_column(Integer, nullable=False, default=1)
+
+    # Conversation threading: thread_id is the id of the thread's first message.
+    thread_id: Mapped[Optional[str]] = mapped_column(String, nullable=True)
+    in_reply_to: Mapped[Optional[str]] = mapped_column(String, ForeignKey("messages.id", ondelete="SET NULL"), nullable=True)
 
     created_at: Mapped[dt.datetime] = mapped_column(DateTime(timezone=True), nullable=False, index=True)
     deleted_by_sender_at: Mapped[Optional[dt.datetime]] = mapped_column(DateTime(timezone=True), nullable=True)
+    # Self-destruct: hidden once passed, then physically removed by the purge worker.
+    expires_at: Mapped[Optional[dt.datetime]] = mapped_column(DateTime(timezone=True), nullable=True)
 
     recipients: Mapped[list["MessageRecipient"]] = relationship(back_populates="message", cascade="all, delete-orphan")
     attachments: Mapped[list["Attachment"]] = relationship(back_populates="message", cascade="all, delete-orphan")
@@ -113,6 +129,25 @@ class MessageRecipient(Base):
     message: Mapped[Message] = relationship(back_populates="recipients")
 
 
+class AttachmentBlob(Base):
+    """Encrypted attachment content shared (by reference) between messages."""
+
+    __tablename__ = "attachment_blobs"
+
+    id: Mapped[str] = mapped_column(String, primary_key=True)
+
+    # Encrypted with a per-blob key; the key is wrapped per attachment under the message DEK.
+    # Deferred so metadata/HMAC checks never pull the whole blob into memory.
+    ciphertext: Mapped[bytes] = mapped_column(LargeBinary, nullable=False, deferred=True)
+    nonce: Mapped[bytes] = mapped_column(LargeBinary, nullable=False)
+    tag: Mapped[bytes] = mapped_column(LargeBinary, nullable=False)
+    payload_format: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    ciphertext_sha256: Mapped[bytes] = mapped_column(LargeBinary, nullable=False)
+
+    ref_count: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    created_at: Mapped[dt.datetime] = mapped_column(DateTime(timezone=True), nullable=False)
+
+
 class Attachment(Base):
     __tablename__ = "attachments"
 
@@ -123,13 +158,143 @@ class Attachment(Base):
     content_type: Mapped[str] = mapped_column(String, nullable=False)
     size_bytes: Mapped[int] = mapped_column(Integer, nullable=False)
 
+    # Legacy inline storage (encrypted with the message DEK); empty when blob_id is set.
     blob_ciphertext: Mapped[bytes] = mapped_column(LargeBinary, nullable=False)
     blob_nonce: Mapped[bytes] = mapped_column(LargeBinary, nullable=False)
     blob_tag: Mapped[bytes] = mapped_column(LargeBinary, nullable=False)
+    # Payload format of the inline blob plaintext (0 = raw, 1 = deflate, 2 = zstd).
+    blob_format: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+
+    # Shared storage: blob key wrapped under this message's DEK.
+    blob_id: Mapped[Optional[str]] = mapped_column(String, ForeignKey("attachment_blobs.id", ondelete="RESTRICT"), nullable=True, index=True)
+    blob_key_enc: Mapped[Optional[bytes]] = mapped_column(LargeBinary, nullable=True)
+    blob_key_nonce: Mapped[Optional[bytes]] = mapped_column(LargeBinary, nullable=True)
+    blob_key_tag: Mapped[Optional[bytes]] = mapped_column(LargeBinary, nullable=True)
 
     created_at: Mapped[dt.datetime] = mapped_column(DateTime(timezone=True), nullable=False)
 
     message: Mapped[Message] = relationship(back_populates="attachments")
+    blob: Mapped[Optional[AttachmentBlob]] = relationship()
+
+
+class UploadSession(Base):
+    """Resumable attachment upload; chunks are staged encrypted until finalize."""
+
+    __tablename__ = "upload_sessions"
+
+    id: Mapped[str] = mapped_column(String, primary_key=True)
+    user_id: Mapped[str] = mapped_column(String, ForeignKey("users.id", ondelete="CASCADE"), nullable=False, index=True)
+
+    filename: Mapped[str] = mapped_column(String, nullable=False)
+    content_type: Mapped[str] = mapped_column(String, nullable=False)
+    size_bytes: Mapped[int] = mapped_column(Integer, nullable=False)
+    received_bytes: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+
+    # Per-session staging key, wrapped under DATA_KEY.
+    session_key_enc: Mapped[bytes] = mapped_column(LargeBinary, nullable=False)
+    session_key_nonce: Mapped[bytes] = mapped_column(LargeBinary, nullable=False)
+    session_key_tag: Mapped[bytes] = mapped_column(LargeBinary, nullable=False)
+    session_key_version: Mapped[int] = mapped_column(Integer, nullable=False, default=1)
+
+    # Set on finalize: the assembled blob and its key wrapped under the session key.
+    blob_id: Mapped[Optional[str]] = mapped_column(String, ForeignKey("attachment_blobs.id", ondelete="RESTRICT"), nullable=True)
+    blob_key_enc: Mapped[Optional[bytes]] = mapped_column(LargeBinary, nullable=True)
+    blob_key_nonce: Mapped[Optional[bytes]] = mapped_column(LargeBinary, nullable=True)
+    blob_key_tag: Mapped[Optional[bytes]] = mapped_column(LargeBinary, nullable=True)
+
+    # open -> finalized -> consumed (attached to a sent message)
+    status: Mapped[str] = mapped_column(String, nullable=False, default="open")
+
+    created_at: Mapped[dt.datetime] = mapped_column(DateTime(timezone=True), nullable=False)
+    expires_at: Mapped[dt.datetime] = mapped_column(DateTime(timezone=True), nullable=False, index=True)
+
+    blob: Mapped[Optional[AttachmentBlob]] = relationship()
+
+
+class UploadChunk(Base):
+    __tablename__ = "upload_chunks"
+
+    upload_id: Mapped[str] = mapped_column(String, ForeignKey("upload_sessions.id", ondelete="CASCADE"), primary_key=True)
+    offset: Mapped[int] = mapped_column(Integer, primary_key=True)
+    size_bytes: Mapped[int] = mapped_column(Integer, nullable=False)
+
+    ciphertext: Mapped[bytes] = mapped_column(LargeBinary, nullable=False)
+    nonce: Mapped[bytes] = mapped_column(LargeBinary, nullable=False)
+    tag: Mapped[bytes] = mapped_column(LargeBinary, nullable=False)
+
+
+class IdempotencyKey(Base):
+    """Client-supplied Idempotency-Key for /messages/send (message_id is NULL while in progress)."""
+
+    __tablename__ = "idempotency_keys"
+
+    user_id: Mapped[str] = mapped_column(String, ForeignKey("users.id", ondelete="CASCADE"), primary_key=True)
+    key: Mapped[str] = mapped_column(String, primary_key=True)
+
+    # SHA-256 over the request; a reused key with a different request is rejected.
+    request_fingerprint: Mapped[bytes] = mapped_column(LargeBinary, nullable=False)
+    message_id: Mapped[Optional[str]] = mapped_column(String, nullable=True)
+
+    # The reserving request (random token) and its lease, renewed while it sends.
+    owner_token: Mapped[Optional[str]] = mapped_column(String, nullable=True)
+    lease_expires_at: Mapped[Optional[dt.datetime]] = mapped_column(DateTime(timezone=True), nullable=True)
+
+    created_at: Mapped[dt.datetime] = mapped_column(DateTime(timezone=True), nullable=False)
+    expires_at: Mapped[dt.datetime] = mapped_column(DateTime(timezone=True), nullable=False, index=True)
+
+
+class RateLimitBucket(Base):
+    """Fixed-window counter shared by all workers (RATE_LIMIT_STORE=database)."""
+
+    __tablename__ = "rate_limit_buckets"
+
+    limiter: Mapped[str] = mapped_column(String, primary_key=True)
+    # HMAC of the limiter key (client IP, e-mail): neither is stored in clear.
+    bucket_key: Mapped[bytes] = mapped_column(LargeBinary, primary_key=True)
+
+    # Unix time of the window start, aligned to the window length.
+    window_start: Mapped[int] = mapped_column(Integer, nullable=False, index=True)
+    hits: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+
+
+class ExportJob(Base):
+    """Mailbox export (streamed tar); progress is updated while the archive streams."""
+
+    __tablename__ = "export_jobs"
+
+    id: Mapped[str] = mapped_column(String, primary_key=True)
+    user_id: Mapped[str] = mapped_column(String, ForeignKey("users.id", ondelete="CASCADE"), nullable=False, index=True)
+
+    # pending -> running -> completed | failed
+    status: Mapped[str] = mapped_column(String, nullable=False, default="pending")
+    encrypted: Mapped[bool] = mapped_column(Boolean, nullable=False, default=False)
+
+    total_messages: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    exported_messages: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    exported_bytes: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+
+    created_at: Mapped[dt.datetime] = mapped_column(DateTime(timezone=True), nullable=False)
+    started_at: Mapped[Optional[dt.datetime]] = mapped_column(DateTime(timezone=True), nullable=True)
+    finished_at: Mapped[Optional[dt.datetime]] = mapped_column(DateTime(timezone=True), nullable=True)
+
+    # The download streaming the job (random token) and its lease, renewed while it streams.
+    owner_token: Mapped[Optional[str]] = mapped_column(String, nullable=True)
+    lease_expires_at: Mapped[Optional[dt.datetime]] = mapped_column(DateTime(timezone=True), nullable=True)
+
+
+class KeyRotationCheckpoint(Base):
+    """Resume point of the KEK re-wrap job for one envelope family."""
+
+    __tablename__ = "key_rotation_checkpoints"
+
+    name: Mapped[str] = mapped_column(String, primary_key=True)
+    target_version: Mapped[int] = mapped_column(Integer, nullable=False)
+    last_id: Mapped[Optional[str]] = mapped_column(String, nullable=True)
+    rewrapped: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    # Rows left under the retired KEK because they failed their authenticity check.
+    skipped: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    completed_at: Mapped[Optional[dt.datetime]] = mapped_column(DateTime(timezone=True), nullable=True)
+    updated_at: Mapped[dt.datetime] = mapped_column(DateTime(timezone=True), nullable=False)
 
 
 class AuditEvent(Base):
@@ -151,4 +316,5 @@ class AuditEvent(Base):
 # Helpful indexes beyond schema.sql (kept minimal)
 Index("idx_attachments_message", Attachment.message_id)
 Index("idx_messages_sender", Message.sender_user_id)
+Index("idx_messages_thread_created", Message.thread_id, Message.created_at)
 Index("idx_message_recipients_recipient", MessageRecipient.recipient_user_id)
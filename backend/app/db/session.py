@@ -1,11 +1,26 @@
 from __future__ import annotations
 
+import re
+import time
+import urllib.parse
+from collections import Counter
 from collections.abc import Generator
+from contextvars import ContextVar, Token
+from dataclasses import dataclass, field
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
 from sqlalchemy.orm import Session, sessionmaker
+from sqlalchemy.pool import QueuePool
 
 from app.core.config import settings
+from app.core.tracing import start_span
+from app.db.shards import attach_mailbox_shards
+
+
+# libpq startup option for the read pool: every transaction on it is READ ONLY, the
+# counterpart of SQLite's mode=ro + query_only.
+POSTGRES_READ_ONLY_OPTIONS = "-c default_transaction_read_only=on"
 
 
 def _sqlite_url(path: str) -> str:
@@ -14,13 +29,116 @@ def _sqlite_url(path: str) -> str:
     return f"sqlite:///{path}"
 
 
-engine = create_engine(
-    _sqlite_url(settings.sqlite_path),
-    connect_args={"check_same_thread": False},
-    future=True,
-)
+def _sqlite_read_only_url(path: str) -> str:
+    # URI filename: SQLite itself refuses writes on a mode=ro connection.
+    return f"sqlite:///file:{urllib.parse.quote(path)}?mode=ro&uri=true"
+
+
+def sqlite_pragmas(*, read_only: bool = False) -> list[str]:
+    """PRAGMAs run on every new connection (SQLITE_* settings)."""
+
+    if read_only:
+        # The journal mode is a property of the file (set by the write side); a read-only
+        # connection only needs its lock wait, caches and a second guard against writes.
+        return [
+            f"PRAGMA busy_timeout = {int(settings.sqlite_busy_timeout_ms)}",
+            f"PRAGMA mmap_size = {int(settings.sqlite_mmap_size_mb) * 1024 * 1024}",
+            f"PRAGMA cache_size = {-int(settings.sqlite_cache_size_mb) * 1024}",
+            "PRAGMA query_only = ON",
+        ]
+    return [
+        # WAL: readers see the last committed snapshot instead of waiting for a writer.
+        f"PRAGMA journal_mode = {settings.sqlite_journal_mode}",
+        # NORMAL under WAL: no fsync per commit, still safe against application crashes.
+        f"PRAGMA synchronous = {settings.sqlite_synchronous}",
+        # Writers queue for the lock instead of failing with "database is locked".
+        f"PRAGMA busy_timeout = {int(settings.sqlite_busy_timeout_ms)}",
+        f"PRAGMA mmap_size = {int(settings.sqlite_mmap_size_mb) * 1024 * 1024}",
+        # Negative = KiB; the page cache is per connection.
+        f"PRAGMA cache_size = {-int(settings.sqlite_cache_size_mb) * 1024}",
+        # Checkpointed WAL files shrink back to this size (attachments can make them large).
+        f"PRAGMA journal_size_limit = {int(settings.sqlite_journal_size_limit_mb) * 1024 * 1024}",
+        f"PRAGMA foreign_keys = {'ON' if settings.sqlite_foreign_keys else 'OFF'}",
+    ]
+
+
+def apply_sqlite_pragmas(dbapi_connection, *, read_only: bool = False) -> None:
+    cursor = dbapi_connection.cursor()
+    try:
+        for pragma in sqlite_pragmas(read_only=read_only):
+            cursor.execute(pragma)
+    finally:
+        cursor.close()
+
+
+def is_sqlite_url(url: str) -> bool:
+    return make_url(url).get_backend_name() == "sqlite"
+
+
+def database_url() -> str:
+    return settings.database_url or _sqlite_url(settings.sqlite_path)
+
+
+# Pool policy: sync endpoints run in AnyIO's threadpool (40 threads by default) and each
+# holds one connection for the request. pool_size connections stay open (with their page
+# cache and mmap); bursts open up to max_overflow more, and a request that still finds the
+# pool empty waits pool_timeout seconds before failing.
+_pool_args = {"poolclass": QueuePool, "pool_timeout": settings.db_pool_timeout_seconds, "future": True}
+
+if is_sqlite_url(database_url()):
+    engine = create_engine(
+        database_url(),
+        connect_args={"check_same_thread": False},
+        pool_size=settings.db_pool_size,
+        max_overflow=settings.db_max_overflow,
+        **_pool_args,
+    )
+    # Read-only side for GET routes (inbox and sent scans, detail, downloads): its own pool,
+    # so long reads never hold one of the write-capable connections, and under WAL they run
+    # alongside the writer instead of queueing behind it.
+    read_engine = create_engine(
+        _sqlite_read_only_url(settings.sqlite_path),
+        connect_args={"check_same_thread": False},
+        pool_size=settings.db_read_pool_size,
+        max_overflow=settings.db_read_max_overflow,
+        **_pool_args,
+    )
+
+    @event.listens_for(engine, "connect")
+    def _on_connect(dbapi_connection, connection_record) -> None:
+        attach_mailbox_shards(dbapi_connection)
+        apply_sqlite_pragmas(dbapi_connection)
+
+    @event.listens_for(read_engine, "connect")
+    def _on_read_connect(dbapi_connection, connection_record) -> None:
+        # Before query_only, which would refuse the TEMP VIEW.
+        attach_mailbox_shards(dbapi_connection, read_only=True)
+        apply_sqlite_pragmas(dbapi_connection, read_only=True)
+
+else:
+    # PostgreSQL: the server handles concurrent writers itself; pre_ping drops connections
+    # the server (or a pooler in front of it) closed while they sat idle.
+    engine = create_engine(
+        database_url(),
+        pool_size=settings.db_pool_size,
+        max_overflow=settings.db_max_overflow,
+        pool_pre_ping=True,
+        **_pool_args,
+    )
+    read_engine = create_engine(
+        database_url(),
+        connect_args={"options": POSTGRES_READ_ONLY_OPTIONS},
+        pool_size=settings.db_read_pool_size,
+        max_overflow=settings.db_read_max_overflow,
+        pool_pre_ping=True,
+        **_pool_args,
+    )
+
 
 SessionLocal = sessionmaker(bind=engine, class_=Session, autoflush=False, autocommit=False, future=True)
+ReadSessionLocal = sessionmaker(
+    bind=read_engine, class_=Session, autoflush=False, autocommit=False, future=True, info={"read_only": True}
+)
 
 
 def get_db() -> Generator[Session, None, None]:
@@ -29,3 +147,98 @@ def get_db() -> Generator[Session, None, None]:
         yield db
     finally:
         db.close()
+
+
+def get_read_db() -> Generator[Session, None, None]:
+    """Session on the read-only pool; writes through it fail (use run_write for side writes)."""
+
+    db = ReadSessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+def is_read_only(db: Session) -> bool:
+    return bool(db.info.get("read_only"))
+
+
+@dataclass
+class QueryStats:
+    """SQL statements and DB time attributed to one unit of work (usually a request)."""
+
+    statements: int = 0
+    seconds: float = 0.0
+    # Normalized statement -> executions; only filled for the N+1 detector.
+    by_statement: Counter[str] | None = field(default=None)
+
+
+# A ContextVar rather than a thread-local: sync endpoints run in the threadpool with a copy
+# of the request's context, and the copy still points at the same QueryStats object.
+_query_stats: ContextVar[QueryStats | None] = ContextVar("query_stats", default=None)
+
+_IN_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_statement(statement: str) -> str:
+    # Expanded IN lists differ only by their placeholder count.
+    return _WHITESPACE.sub(" ", _IN_LIST.sub("(?)", statement)).strip()
+
+
+def track_queries(*, by_statement: bool = False) -> tuple[QueryStats, Token]:
+    stats = QueryStats(by_statement=Counter() if by_statement else None)
+    return stats, _query_stats.set(stats)
+
+
+def stop_tracking(token: Token) -> None:
+    _query_stats.reset(token)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany) -> None:
+    if _query_stats.get() is not None:
+        conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany) -> None:
+    stats = _query_stats.get()
+    started = conn.info.get("query_started")
+    if stats is None or not started:
+        return
+    stats.statements += 1
+    stats.seconds += time.perf_counter() - started.pop()
+    if stats.by_statement is not None:
+        stats.by_statement[normalize_statement(statement)] += 1
+
+
+def _handle_error(exception_context) -> None:
+    # A failed statement never reaches after_cursor_execute; drop its start time.
+    conn = exception_context.connection
+    if conn is not None and conn.info.get("query_started"):
+        conn.info["query_started"].pop()
+
+
+def instrument_engine(target) -> None:
+    """Count `target`'s statements in the current QueryStats (X-Query-Stats, db metrics)."""
+
+    event.listen(target, "before_cursor_execute", _before_cursor_execute)
+    event.listen(target, "after_cursor_execute", _after_cursor_execute)
+    event.listen(target, "handle_error", _handle_error)
+
+
+instrument_engine(engine)
+instrument_engine(read_engine)
+
+
+# Tracing: every commit (flush + COMMIT) becomes a db.commit span of the sampled request.
+@event.listens_for(SessionLocal, "before_commit")
+def _before_commit(session) -> None:
+    session.info["commit_span"] = start_span("db.commit")
+
+
+@event.listens_for(SessionLocal, "after_commit")
+@event.listens_for(SessionLocal, "after_rollback")
+def _end_commit_span(session) -> None:
+    commit_span = session.info.pop("commit_span", None)
+    if commit_span is not None:
+        commit_span.end()
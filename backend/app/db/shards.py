@@ -0,0 +1,137 @@
+from __future__ import annotations
+
+import hashlib
+import urllib.parse
+from functools import lru_cache
+from pathlib import Path
+
+from sqlalchemy import Column, MetaData, Table
+from sqlalchemy.orm import aliased
+
+from app.core.config import settings
+from app.db.models import MessageRecipient
+
+
+# Mailbox sharding (SQLite only, MAILBOX_SHARDS=N > 0). message_recipients - the per-recipient
+# mailbox rows that every read mark, delete and delivery writes - lives in N extra SQLite
+# files next to SQLITE_PATH instead of the main file, placed by a hash of the recipient's
+# user id. Each file has its own write lock (and its own group-commit writer), so mailbox
+# writes of users on different shards no longer queue behind one another or behind sends.
+#
+# Every pooled connection ATTACHes the shard files as mbox0..mboxN-1 and creates a TEMP
+# VIEW message_recipients (UNION ALL of the shards) that shadows the main table. Reads that
+# span recipients (HMAC recipient list, sent counts, thread read states, purge checks) keep
+# using MessageRecipient unchanged; SQLite pushes their WHERE clauses into every shard and
+# probes each shard's index. Reads of one user's mailbox and all writes are routed to that
+# user's shard (mailbox_table / mailbox_entity); the view itself is read-only.
+#
+# Changing N (or turning sharding on for an existing database) moves rows between files:
+# scripts/reshard_mailbox.py, offline. Startup refuses a layout that does not match.
+
+SHARD_SCHEMA_PREFIX = "mbox"
+
+
+def mailbox_shard_count() -> int:
+    # PostgreSQL (DATABASE_URL) has no single-writer limit to work around.
+    return 0 if settings.database_url else settings.mailbox_shards
+
+
+def mailbox_sharded() -> bool:
+    return mailbox_shard_count() > 0
+
+
+def shard_for(user_id: str, count: int | None = None) -> int:
+    """Stable shard index of a user (same in every process and across restarts)."""
+
+    n = mailbox_shard_count() if count is None else count
+    digest = hashlib.blake2b(user_id.encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big") % n
+
+
+def shard_path(index: int) -> Path:
+    main = Path(settings.sqlite_path)
+    return main.with_name(f"{main.stem}.mailbox-{index}{main.suffix}")
+
+
+def existing_shard_indexes() -> list[int]:
+    """Indexes of the shard files present next to SQLITE_PATH (any layout)."""
+
+    main = Path(settings.sqlite_path)
+    found = []
+    for p in main.parent.glob(f"{main.stem}.mailbox-*{main.suffix}"):
+        index = p.name[len(f"{main.stem}.mailbox-") : len(p.name) - len(main.suffix)]
+        if index.isdigit():
+            found.append(int(index))
+    return sorted(found)
+
+
+def shard_schema(index: int) -> str:
+    return f"{SHARD_SCHEMA_PREFIX}{index}"
+
+
+@lru_cache(maxsize=None)
+def shard_table(index: int) -> Table:
+    # Same columns as message_recipients, qualified with the attached schema; no foreign
+    # keys (SQLite cannot enforce them across files).
+    base = MessageRecipient.__table__
+    return Table(
+        base.name,
+        MetaData(),
+        *(Column(c.name, c.type, primary_key=c.primary_key, nullable=c.nullable) for c in base.columns),
+        schema=shard_schema(index),
+    )
+
+
+@lru_cache(maxsize=None)
+def _shard_entity(index: int):
+    return aliased(MessageRecipient, shard_table(index), adapt_on_names=True)
+
+
+def mailbox_table(user_id: str) -> Table:
+    """The table holding `user_id`'s mailbox rows (for Core UPDATE/INSERT/DELETE)."""
+
+    if not mailbox_sharded():
+        return MessageRecipient.__table__
+    return shard_table(shard_for(user_id))
+
+
+def mailbox_entity(user_id: str):
+    """MessageRecipient, or an alias of it on `user_id`'s shard (for ORM selects)."""
+
+    if not mailbox_sharded():
+        return MessageRecipient
+    return _shard_entity(shard_for(user_id))
+
+
+def mailbox_writer(user_id: str) -> int | None:
+    """The write queue (run_write(shard=...)) for `user_id`'s mailbox rows."""
+
+    return shard_for(user_id) if mailbox_sharded() else None
+
+
+def mailbox_tables() -> list[Table]:
+    if not mailbox_sharded():
+        return [MessageRecipient.__table__]
+    return [shard_table(i) for i in range(mailbox_shard_count())]
+
+
+def attach_mailbox_shards(dbapi_connection, *, read_only: bool = False) -> None:
+    """ATTACH the shard files and shadow message_recipients with the UNION ALL view."""
+
+    n = mailbox_shard_count()
+    if n == 0:
+        return
+    cursor = dbapi_connection.cursor()
+    try:
+        for i in range(n):
+            # The read side opens its main file as a URI, so ATTACH takes URIs there too.
+            target = f"file:{urllib.parse.quote(str(shard_path(i)))}?mode=ro" if read_only else str(shard_path(i))
+            cursor.execute(f"ATTACH DATABASE ? AS {shard_schema(i)}", (target,))
+            cursor.execute(f"PRAGMA {shard_schema(i)}.synchronous = {settings.sqlite_synchronous}")
+            cursor.execute(f"PRAGMA {shard_schema(i)}.cache_size = {-int(settings.sqlite_cache_size_mb) * 1024}")
+            cursor.execute(f"PRAGMA {shard_schema(i)}.mmap_size = {int(settings.sqlite_mmap_size_mb) * 1024 * 1024}")
+        columns = ", ".join(c.name for c in MessageRecipient.__table__.columns)
+        union = " UNION ALL ".join(f"SELECT {columns} FROM {shard_schema(i)}.message_recipients" for i in range(n))
+        cursor.execute(f"CREATE TEMP VIEW message_recipients AS {union}")
+    finally:
+        cursor.close()
@@ -0,0 +1,272 @@
+from __future__ import annotations
+
+import asyncio
+import contextvars
+import logging
+import queue
+import threading
+import time
+from collections.abc import Callable
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from typing import Any, TypeVar
+
+import anyio.to_thread
+from sqlalchemy.orm import Session, sessionmaker
+
+from app.core import metrics
+from app.core.config import settings
+from app.core.exceptions import RateLimitError
+from app.core.tracing import span
+from app.db.session import SessionLocal, engine, is_read_only
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# Group commit for SQLite. SQLite runs one write transaction at a time, so small writes
+# from concurrent requests (a read mark, a session row, a failed-login counter, a send)
+# queue for the lock and each pays its own COMMIT (and fsync with SQLITE_SYNCHRONOUS=FULL).
+# Here one writer thread takes whatever writes are queued, waiting at most
+# WRITE_QUEUE_MAX_DELAY_MS for more, runs them in a single transaction and commits
+# once; every caller blocks on its own Future.
+#
+# A write is a callable op(session) -> result that only touches the session it is given
+# (new objects, UPDATE/DELETE statements by primary key) and does not commit. An op that
+# fails is rolled back with the batch, gets its exception, and the rest of the batch is
+# re-run without it, so one bad write does not fail its neighbours.
+#
+# The caller's own session must not hold uncommitted writes when it submits: the writer
+# would wait on that transaction's lock while the caller waits on the writer. Only WAL
+# lets the caller keep its read snapshot open meanwhile, so the queue is used under WAL
+# only; otherwise run_write() commits on the caller's session as before.
+#
+# With MAILBOX_SHARDS (app/db/shards.py) every shard file has its own lock and gets its
+# own writer (run_write(..., shard=k)): mailbox writes of different shards commit in
+# parallel with each other and with the main queue.
+
+_WriterSession = sessionmaker(bind=engine, class_=Session, autoflush=False, expire_on_commit=False, future=True)
+
+
+@dataclass
+class _Write:
+    op: Callable[[Session], Any]
+    # The submitter's context: SQL run by the op counts towards its request's QueryStats.
+    context: contextvars.Context
+    future: Future = field(default_factory=Future)
+    enqueued: float = field(default_factory=time.perf_counter)
+
+
+class WriteQueue:
+    """Single writer thread committing queued write ops in groups."""
+
+    def __init__(self, *, max_batch: int, max_delay_seconds: float, max_pending: int, name: str = "write-queue") -> None:
+        self.name = name
+        self.max_batch = max(1, max_batch)
+        self.max_delay_seconds = max(0.0, max_delay_seconds)
+        self._queue: queue.Queue[_Write | None] = queue.Queue(maxsize=max(1, max_pending))
+        self._lock = threading.Lock()
+        self._thread: threading.Thread | None = None
+
+    def start(self) -> None:
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        # Writes queued before the sentinel are still committed.
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._queue.put(None)
+            thread.join(timeout=10)
+
+    def submit(self, op: Callable[[Session], T], *, block: bool = True) -> Future:
+        # block=False on the event loop: a full queue is rejected at once instead of stalling it.
+        self.start()
+        item = _Write(op=op, context=contextvars.copy_context())
+        try:
+            self._queue.put(item, block=block, timeout=settings.write_queue_timeout_seconds if block else None)
+        except queue.Full as exc:
+            raise RateLimitError("write queue full") from exc
+        return item.future
+
+    def _take_batch(self, first: _Write) -> tuple[list[_Write], bool]:
+        batch = [first]
+        deadline = time.monotonic() + self.max_delay_seconds
+        while len(batch) < self.max_batch:
+            try:
+                # Whatever is already queued goes in without waiting.
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+            if item is None:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def _run(self) -> None:
+        stopping = False
+        while not stopping:
+            first = self._queue.get()
+            if first is None:
+                break
+            batch, stopping = self._take_batch(first)
+            # Writes whose caller gave up (a cancelled await) before the batch started are dropped.
+            batch = [item for item in batch if item.future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            started = time.perf_counter()
+            for item in batch:
+                metrics.write_queue_wait_seconds.observe(started - item.enqueued)
+            try:
+                self._commit_group(batch)
+            except Exception as exc:  # noqa: BLE001 - never leave a caller waiting
+                logger.exception("Write queue batch failed")
+                for item in batch:
+                    if not item.future.done():
+                        item.future.set_exception(exc)
+            metrics.write_queue_batch_size.observe(len(batch))
+            metrics.write_queue_commit_seconds.observe(time.perf_counter() - started)
+
+    def _commit_group(self, batch: list[_Write]) -> None:
+        pending = list(batch)
+        while pending:
+            with _WriterSession() as session:
+                results: list[tuple[_Write, Any]] = []
+                failed: tuple[_Write, BaseException] | None = None
+                for item in pending:
+                    try:
+                        results.append((item, item.context.run(_apply, item.op, session)))
+                    except Exception as exc:  # noqa: BLE001
+                        failed = (item, exc)
+                        break
+                if failed is not None:
+                    session.rollback()
+                    bad, exc = failed
+                    bad.future.set_exception(exc)
+                    # Everything before it was rolled back too; run the rest again.
+                    pending = [item for item in pending if item is not bad]
+                    continue
+                session.commit()
+            for item, result in results:
+                item.future.set_result(result)
+            return
+
+
+def _apply(op: Callable[[Session], T], session: Session) -> T:
+    result = op(session)
+    # Flush here so a constraint violation is charged to this op, not to the whole commit.
+    session.flush()
+    return result
+
+
+# None: the main database; k: mailbox shard k.
+_write_queues: dict[int | None, WriteQueue] = {}
+_write_queue_lock = threading.Lock()
+
+
+def write_queue_active() -> bool:
+    # PostgreSQL takes row locks and commits concurrent writers in parallel; nothing to group.
+    return settings.write_queue_enabled and engine.dialect.name == "sqlite" and settings.sqlite_journal_mode == "WAL"
+
+
+def get_write_queue(shard: int | None = None) -> WriteQueue:
+    with _write_queue_lock:
+        wq = _write_queues.get(shard)
+        if wq is None:
+            wq = _write_queues[shard] = WriteQueue(
+                max_batch=settings.write_queue_max_batch,
+                max_delay_seconds=settings.write_queue_max_delay_ms / 1000.0,
+                max_pending=settings.write_queue_max_pending,
+                name="write-queue" if shard is None else f"write-queue-mbox{shard}",
+            )
+        return wq
+
+
+def stop_write_queue() -> None:
+    with _write_queue_lock:
+        queues = list(_write_queues.values())
+        _write_queues.clear()
+    for wq in queues:
+        wq.stop()
+
+
+def run_write(db: Session, op: Callable[[Session], T], *, grouped: bool = True, shard: int | None = None) -> T:
+    """Run `op` and commit it: grouped with other requests' writes when the queue is active.
+
+    Pass grouped=False when `db` has already written in this transaction and the op's
+    changes must land together with that. Without the queue (or with pending ORM changes
+    in `db`) the op runs on `db` and `db` commits, as before; a read-only session
+    (get_read_db) gets a short-lived write session instead. `shard` picks the mailbox
+    shard writer for ops that only touch that shard's table.
+
+    Blocks the calling thread until the batch commits: call it from sync endpoints or
+    threadpool threads, never on the event loop (async code uses run_write_async).
+    """
+
+    if grouped and write_queue_active() and not (db.new or db.dirty or db.deleted):
+        with span("db.write_queue"):
+            future = get_write_queue(shard).submit(op)
+            return future.result(timeout=settings.write_queue_timeout_seconds)
+    if is_read_only(db):
+        with SessionLocal() as write_db:
+            result = op(write_db)
+            write_db.commit()
+            return result
+    result = op(db)
+    db.commit()
+    return result
+
+
+async def run_write_async(op: Callable[[Session], T], *, shard: int | None = None) -> T:
+    """run_write for async endpoints: awaits the queued op without holding a thread."""
+
+    if write_queue_active():
+        with span("db.write_queue"):
+            future = get_write_queue(shard).submit(op, block=False)
+            return await asyncio.wait_for(asyncio.wrap_future(future), timeout=settings.write_queue_timeout_seconds)
+
+    def _write_now() -> T:
+        with SessionLocal() as db:
+            result = op(db)
+            db.commit()
+            return result
+
+    return await anyio.to_thread.run_sync(_write_now)
+
+
+def run_shard_writes(ops: dict[int, Callable[[Session], Any]]) -> dict[int, Any]:
+    """Run one op per mailbox shard, the shards in parallel; returns {shard: result}.
+
+    Each shard commits on its own (SQLite commits attached WAL files one by one anyway),
+    so when one op fails the others may already be durable: the caller compensates.
+    Without the queue all ops run in one short-lived session and commit together.
+    """
+
+    if write_queue_active():
+        with span("db.write_queue"):
+            futures = {k: get_write_queue(k).submit(op) for k, op in ops.items()}
+            results: dict[int, Any] = {}
+            errors: list[BaseException] = []
+            for k, future in futures.items():
+                try:
+                    results[k] = future.result(timeout=settings.write_queue_timeout_seconds)
+                except Exception as exc:  # noqa: BLE001 - wait for every shard before raising
+                    errors.append(exc)
+            if errors:
+                raise errors[0]
+            return results
+
+    with SessionLocal() as db:
+        results = {k: op(db) for k, op in ops.items()}
+        db.commit()
+        return results
@@ -0,0 +1,60 @@
+from __future__ import annotations
+
+from fastapi import APIRouter, Depends, Header, Query, Response
+from fastapi.responses import JSONResponse, PlainTextResponse
+
+from app.core import profiling
+from app.core.exceptions import AuthorizationError, NotFoundError
+
+
+def require_profiling_token(token: str | None = Header(default=None, alias=profiling.PROFILE_HEADER)) -> None:
+    if not profiling.token_ok(token):
+        raise AuthorizationError("Forbidden")
+
+
+# Mounted without the /api prefix: reachable on the backend port only, nginx does not route it.
+router = APIRouter(prefix="/debug/profile", tags=["debug"], dependencies=[Depends(require_profiling_token)])
+
+
+@router.get("/cpu")
+def cpu_profile(
+    seconds: float = Query(default=10.0, gt=0),
+    interval_ms: float = Query(default=5.0, ge=1.0, le=100.0),
+    format: str = Query(default="collapsed", pattern="^(collapsed|pstats)$"),
+    idle: bool = False,
+) -> Response:
+    # Blocks one threadpool thread for the window; the sampler sees every other thread.
+    profile = profiling.sample_cpu(profiling.clamp_seconds(seconds), interval_ms / 1000.0, include_idle=idle)
+    if format == "pstats":
+        return Response(
+            content=profile.pstats_bytes(),
+            media_type="application/octet-stream",
+            headers={"Content-Disposition": 'attachment; filename="cpu.pstats"'},
+        )
+    return PlainTextResponse(profile.collapsed(), headers={"X-Profile-Samples": str(profile.samples)})
+
+
+@router.get("/memory")
+def memory_profile(seconds: float = Query(default=10.0, gt=0), top: int = Query(default=30, ge=1, le=500)) -> dict:
+    return profiling.memory_diff(profiling.clamp_seconds(seconds), top)
+
+
+@router.get("/requests/{request_id}")
+def request_profile(
+    request_id: str,
+    format: str = Query(default="text", pattern="^(text|pstats)$"),
+    limit: int = Query(default=40, ge=1, le=500),
+) -> Response:
+    profile = profiling.get_request_profile(request_id)
+    if profile is None:
+        # 404, not 403: the token was accepted, the profile is unknown or already evicted.
+        raise NotFoundError("profile not found")
+    if profile.mode == "memory":
+        return JSONResponse({"request_id": request_id, "path": profile.path, **(profile.memory or {})})
+    if format == "pstats":
+        return Response(
+            content=profile.pstats_bytes(),
+            media_type="application/octet-stream",
+            headers={"Content-Disposition": f'attachment; filename="{request_id}.pstats"'},
+        )
+    return PlainTextResponse(profile.text(limit))
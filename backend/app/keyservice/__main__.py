@@ -0,0 +1,4 @@
+from app.keyservice.server import main
+
+
+main()
@@ -0,0 +1,118 @@
+from __future__ import annotations
+
+import abc
+import functools
+from dataclasses import dataclass
+
+from app.core.config import settings
+from app.crypto.aes_gcm import AesGcmEncrypted
+from app.crypto.key_ring import KeyRing
+
+
+# Key ring names (one per KEK).
+RING_DATA = "data"
+RING_TOTP = "totp"
+RING_USER_HMAC = "user_hmac"
+
+
+class KeyServiceError(RuntimeError):
+    """Key service unreachable or returned a protocol-level error."""
+
+
+@dataclass(frozen=True)
+class UnwrapItem:
+    version: int
+    ciphertext: bytes
+    nonce: bytes
+    tag: bytes
+    aad: bytes
+
+
+class KeyService(abc.ABC):
+    """Wrap/unwrap of small secrets (DEKs, HMAC keys, TOTP secrets) under the KEK rings.
+
+    Batch methods are the primitive so a remote implementation can answer a whole
+    inbox or export page in one round trip; single-item helpers are built on top.
+    An authentication failure raises cryptography's InvalidTag, like AESGCM itself.
+    """
+
+    @abc.abstractmethod
+    def info(self) -> dict[str, tuple[int, list[int]]]:
+        """ring -> (current_version, retired_versions)"""
+
+    @abc.abstractmethod
+    def wrap_many(self, ring: str, items: list[tuple[bytes, bytes]]) -> list[tuple[int, AesGcmEncrypted]]:
+        """Encrypt (plaintext, aad) pairs under the ring's current version."""
+
+    @abc.abstractmethod
+    def unwrap_many(self, ring: str, items: list[UnwrapItem]) -> list[bytes]:
+        """Decrypt items wrapped under any (current or retired) version of the ring."""
+
+    @abc.abstractmethod
+    def rewrap_many(self, ring: str, items: list[UnwrapItem]) -> list[tuple[int, AesGcmEncrypted]]:
+        """Move items to the ring's current version without returning the plaintext."""
+
+    def unwrap_rings(self, batches: list[tuple[str, list[UnwrapItem]]]) -> list[list[bytes]]:
+        """unwrap_many over several rings; a remote implementation answers all in one round trip."""
+        return [self.unwrap_many(ring, items) for ring, items in batches]
+
+    def wrap(self, ring: str, plaintext: bytes, aad: bytes) -> tuple[int, AesGcmEncrypted]:
+        return self.wrap_many(ring, [(plaintext, aad)])[0]
+
+    def unwrap(self, ring: str, version: int, ciphertext: bytes, nonce: bytes, tag: bytes, aad: bytes) -> bytes:
+        return self.unwrap_many(ring, [UnwrapItem(version, ciphertext, nonce, tag, aad)])[0]
+
+    def close(self) -> None:
+        pass
+
+
+class LocalKeyService(KeyService):
+    """In-process implementation (default; also used by tests, benchmarks and the sidecar itself)."""
+
+    def __init__(self, rings: dict[str, KeyRing]):
+        self._rings = rings
+
+    @classmethod
+    def from_settings(cls) -> LocalKeyService:
+        return cls(
+            {
+                RING_DATA: settings.data_key_ring,
+                RING_TOTP: settings.totp_key_ring,
+                RING_USER_HMAC: settings.user_hmac_key_ring,
+            }
+        )
+
+    def _ring(self, name: str) -> KeyRing:
+        ring = self._rings.get(name)
+        if ring is None:
+            raise KeyServiceError(f"unknown key ring {name!r}")
+        return ring
+
+    def info(self) -> dict[str, tuple[int, list[int]]]:
+        return {name: (ring.current_version, ring.retired_versions) for name, ring in self._rings.items()}
+
+    def wrap_many(self, ring: str, items: list[tuple[bytes, bytes]]) -> list[tuple[int, AesGcmEncrypted]]:
+        r = self._ring(ring)
+        return [r.encrypt(plaintext, aad) for plaintext, aad in items]
+
+    def unwrap_many(self, ring: str, items: list[UnwrapItem]) -> list[bytes]:
+        r = self._ring(ring)
+        return [r.decrypt(i.version, i.ciphertext, i.nonce, i.tag, i.aad) for i in items]
+
+    def rewrap_many(self, ring: str, items: list[UnwrapItem]) -> list[tuple[int, AesGcmEncrypted]]:
+        r = self._ring(ring)
+        return [r.rewrap(i.version, i.ciphertext, i.nonce, i.tag, i.aad) for i in items]
+
+
+@functools.lru_cache(maxsize=1)
+def get_key_service() -> KeyService:
+    if settings.key_service_socket:
+        from app.keyservice.client import SocketKeyService
+
+        return SocketKeyService(
+            settings.key_service_socket,
+            pool_size=settings.key_service_pool_size,
+            timeout_seconds=settings.key_service_timeout_seconds,
+            max_batch=settings.key_service_max_batch,
+        )
+    return LocalKeyService.from_settings()
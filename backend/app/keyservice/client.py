@@ -0,0 +1,148 @@
+from __future__ import annotations
+
+import itertools
+import json
+import queue
+import socket
+import threading
+
+from cryptography.exceptions import InvalidTag
+
+from app.crypto.aes_gcm import AesGcmEncrypted
+from app.keyservice.base import KeyService, KeyServiceError, UnwrapItem
+from app.keyservice.protocol import (
+    MAX_FRAME_BYTES,
+    OP_INFO,
+    OP_REWRAP,
+    OP_UNWRAP,
+    OP_WRAP,
+    STATUS_INVALID_TAG,
+    STATUS_OK,
+    ProtocolError,
+    decode_response,
+    encode_request,
+)
+
+
+class SocketKeyService(KeyService):
+    """Client for the key-service sidecar over a Unix socket.
+
+    Connections are pooled (one request pipeline per borrowed connection, so worker
+    threads never interleave frames). A large batch is split into `max_batch` frames
+    that are all written before the first response is read.
+    """
+
+    def __init__(self, path: str, *, pool_size: int = 4, timeout_seconds: float = 5.0, max_batch: int = 256) -> None:
+        self.path = path
+        self.timeout_seconds = timeout_seconds
+        self.max_batch = max(1, max_batch)
+        self._idle: queue.LifoQueue[socket.socket] = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(pool_size)
+        self._ids = itertools.count(1)
+        self._ids_lock = threading.Lock()
+
+    def _connect(self) -> socket.socket:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout_seconds)
+        try:
+            sock.connect(self.path)
+        except OSError as exc:
+            sock.close()
+            raise KeyServiceError(f"key service unavailable at {self.path}") from exc
+        return sock
+
+    def _next_id(self) -> int:
+        with self._ids_lock:
+            return next(self._ids) & 0xFFFFFFFF
+
+    @staticmethod
+    def _recv_exact(sock: socket.socket, n: int) -> bytes:
+        buf = bytearray()
+        while len(buf) < n:
+            chunk = sock.recv(n - len(buf))
+            if not chunk:
+                raise ConnectionError("key service closed the connection")
+            buf += chunk
+        return bytes(buf)
+
+    def _roundtrip(self, sock: socket.socket, op: int, frames: list[tuple[str, list]]) -> list[list]:
+        ids = [self._next_id() for _ in frames]
+        # Pipelining: every frame goes out before any response is awaited.
+        sock.sendall(b"".join(encode_request(rid, op, ring, batch) for rid, (ring, batch) in zip(ids, frames)))
+
+        results: list[list] = []
+        for rid in ids:
+            size = int.from_bytes(self._recv_exact(sock, 4), "big")
+            if size > MAX_FRAME_BYTES:
+                raise ProtocolError("frame too large")
+            resp_id, status, items = decode_response(self._recv_exact(sock, size), op)
+            if resp_id != rid:
+                raise ProtocolError("response out of order")
+            if status == STATUS_INVALID_TAG:
+                raise InvalidTag()
+            if status != STATUS_OK:
+                raise KeyServiceError(items[0].decode("utf-8", "replace") if items else "key service error")
+            results.append(items)
+        return results
+
+    def _call(self, op: int, ring: str, items: list) -> list:
+        return self._call_rings(op, [(ring, items)])[0]
+
+    def _call_rings(self, op: int, requests: list[tuple[str, list]]) -> list[list]:
+        # Every request becomes one or more frames of at most `max_batch` items (an empty
+        # request still sends one); all of them share a single pipelined round trip.
+        frames: list[tuple[str, list]] = []
+        owners: list[int] = []
+        for n, (ring, items) in enumerate(requests):
+            for i in range(0, max(len(items), 1), self.max_batch):
+                frames.append((ring, items[i : i + self.max_batch]))
+                owners.append(n)
+        with self._slots:
+            # One retry on a fresh connection covers a pooled socket left stale by a sidecar restart.
+            for attempt in (1, 2):
+                try:
+                    sock = self._idle.get_nowait()
+                except queue.Empty:
+                    sock = self._connect()
+                try:
+                    responses = self._roundtrip(sock, op, frames)
+                except (OSError, ConnectionError, ProtocolError) as exc:
+                    sock.close()
+                    if attempt == 2:
+                        raise KeyServiceError("key service request failed") from exc
+                    continue
+                except BaseException:
+                    # InvalidTag / remote error: the pipeline may still hold unread frames.
+                    sock.close()
+                    raise
+                self._idle.put(sock)
+                results: list[list] = [[] for _ in requests]
+                for n, items in zip(owners, responses):
+                    results[n].extend(items)
+                return results
+        raise AssertionError("unreachable")
+
+    def info(self) -> dict[str, tuple[int, list[int]]]:
+        raw = json.loads(self._call(OP_INFO, "", [])[0])
+        return {name: (int(v["current"]), [int(x) for x in v["retired"]]) for name, v in raw.items()}
+
+    def wrap_many(self, ring: str, items: list[tuple[bytes, bytes]]) -> list[tuple[int, AesGcmEncrypted]]:
+        return self._call(OP_WRAP, ring, items) if items else []
+
+    def unwrap_many(self, ring: str, items: list[UnwrapItem]) -> list[bytes]:
+        return self._call(OP_UNWRAP, ring, items) if items else []
+
+    def rewrap_many(self, ring: str, items: list[UnwrapItem]) -> list[tuple[int, AesGcmEncrypted]]:
+        return self._call(OP_REWRAP, ring, items) if items else []
+
+    def unwrap_rings(self, batches: list[tuple[str, list[UnwrapItem]]]) -> list[list[bytes]]:
+        requests = [(ring, items) for ring, items in batches if items]
+        results = iter(self._call_rings(OP_UNWRAP, requests) if requests else [])
+        return [next(results) if items else [] for _ring, items in batches]
+
+    def close(self) -> None:
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
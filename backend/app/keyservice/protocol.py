@@ -0,0 +1,139 @@
+from __future__ import annotations
+
+import struct
+
+from app.crypto.aes_gcm import AesGcmEncrypted
+from app.keyservice.base import UnwrapItem
+
+
+# Frame: u32 length || payload.
+# Request payload:  u32 request_id || u8 op || u8 len(ring) || ring || u32 count || items
+# Response payload: u32 request_id || u8 status || u32 count || items
+# Byte strings inside items are u32-length-prefixed. Responses on a connection come back
+# in request order, so a client may pipeline many frames before reading.
+
+OP_INFO = 1
+OP_WRAP = 2
+OP_UNWRAP = 3
+OP_REWRAP = 4
+
+STATUS_OK = 0
+STATUS_INVALID_TAG = 1
+STATUS_ERROR = 2
+
+MAX_FRAME_BYTES = 16 * 1024 * 1024
+
+_U32 = struct.Struct(">I")
+_REQ_HEAD = struct.Struct(">IBB")
+_RESP_HEAD = struct.Struct(">IBI")
+
+
+class ProtocolError(ValueError):
+    pass
+
+
+class Writer:
+    def __init__(self) -> None:
+        self.buf = bytearray()
+
+    def u32(self, v: int) -> Writer:
+        self.buf += _U32.pack(v)
+        return self
+
+    def blob(self, b: bytes) -> Writer:
+        self.buf += _U32.pack(len(b))
+        self.buf += b
+        return self
+
+
+class Reader:
+    def __init__(self, data: bytes, offset: int = 0) -> None:
+        self._view = memoryview(data)
+        self._pos = offset
+
+    def u32(self) -> int:
+        if self._pos + 4 > len(self._view):
+            raise ProtocolError("truncated frame")
+        (v,) = _U32.unpack_from(self._view, self._pos)
+        self._pos += 4
+        return v
+
+    def blob(self) -> bytes:
+        n = self.u32()
+        if self._pos + n > len(self._view):
+            raise ProtocolError("truncated frame")
+        out = bytes(self._view[self._pos : self._pos + n])
+        self._pos += n
+        return out
+
+    def done(self) -> None:
+        if self._pos != len(self._view):
+            raise ProtocolError("trailing bytes in frame")
+
+
+def frame(payload: bytes | bytearray) -> bytes:
+    if len(payload) > MAX_FRAME_BYTES:
+        raise ProtocolError("frame too large")
+    return _U32.pack(len(payload)) + bytes(payload)
+
+
+def encode_request(request_id: int, op: int, ring: str, items: list) -> bytes:
+    ring_raw = ring.encode("ascii")
+    w = Writer()
+    w.buf += _REQ_HEAD.pack(request_id, op, len(ring_raw))
+    w.buf += ring_raw
+    w.u32(len(items))
+    for item in items:
+        if op == OP_WRAP:
+            plaintext, aad = item
+            w.blob(plaintext).blob(aad)
+        else:
+            w.u32(item.version).blob(item.ciphertext).blob(item.nonce).blob(item.tag).blob(item.aad)
+    return frame(w.buf)
+
+
+def decode_request(payload: bytes) -> tuple[int, int, str, list]:
+    if len(payload) < _REQ_HEAD.size:
+        raise ProtocolError("truncated frame")
+    request_id, op, ring_len = _REQ_HEAD.unpack_from(payload, 0)
+    ring = payload[_REQ_HEAD.size : _REQ_HEAD.size + ring_len].decode("ascii")
+    r = Reader(payload, _REQ_HEAD.size + ring_len)
+    count = r.u32()
+    items: list = []
+    for _ in range(count):
+        if op == OP_WRAP:
+            items.append((r.blob(), r.blob()))
+        elif op in (OP_UNWRAP, OP_REWRAP):
+            items.append(UnwrapItem(r.u32(), r.blob(), r.blob(), r.blob(), r.blob()))
+        else:
+            raise ProtocolError("items not allowed for this op")
+    r.done()
+    return request_id, op, ring, items
+
+
+def encode_response(request_id: int, status: int, op: int, results: list) -> bytes:
+    w = Writer()
+    w.buf += _RESP_HEAD.pack(request_id, status, len(results))
+    for res in results:
+        if status != STATUS_OK or op in (OP_INFO, OP_UNWRAP):
+            w.blob(res)
+        else:
+            version, enc = res
+            w.u32(version).blob(enc.ciphertext).blob(enc.nonce).blob(enc.tag)
+    return frame(w.buf)
+
+
+def decode_response(payload: bytes, op: int) -> tuple[int, int, list]:
+    if len(payload) < _RESP_HEAD.size:
+        raise ProtocolError("truncated frame")
+    request_id, status, count = _RESP_HEAD.unpack_from(payload, 0)
+    r = Reader(payload, _RESP_HEAD.size)
+    results: list = []
+    for _ in range(count):
+        if status != STATUS_OK or op in (OP_INFO, OP_UNWRAP):
+            results.append(r.blob())
+        else:
+            version = r.u32()
+            results.append((version, AesGcmEncrypted(ciphertext=r.blob(), nonce=r.blob(), tag=r.blob())))
+    r.done()
+    return request_id, status, results
@@ -0,0 +1,112 @@
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import signal
+
+from cryptography.exceptions import InvalidTag
+
+from app.core.config import settings
+from app.core.logging import configure_logging
+from app.keyservice.base import KeyServiceError, LocalKeyService
+from app.keyservice.protocol import (
+    MAX_FRAME_BYTES,
+    OP_INFO,
+    OP_REWRAP,
+    OP_UNWRAP,
+    OP_WRAP,
+    STATUS_ERROR,
+    STATUS_INVALID_TAG,
+    STATUS_OK,
+    ProtocolError,
+    decode_request,
+    encode_response,
+)
+
+
+logger = logging.getLogger("app.keyservice")
+
+
+class KeyServiceServer:
+    """Answers framed wrap/unwrap requests from the app workers; the only process holding the KEKs."""
+
+    def __init__(self, service: LocalKeyService) -> None:
+        self.service = service
+
+    def handle_frame(self, payload: bytes) -> bytes:
+        request_id = int.from_bytes(payload[:4], "big") if len(payload) >= 4 else 0
+        op = OP_INFO
+        try:
+            request_id, op, ring, items = decode_request(payload)
+            if op == OP_INFO:
+                info = {name: {"current": cur, "retired": retired} for name, (cur, retired) in self.service.info().items()}
+                results: list = [json.dumps(info).encode("utf-8")]
+            elif op == OP_WRAP:
+                results = self.service.wrap_many(ring, items)
+            elif op == OP_UNWRAP:
+                results = self.service.unwrap_many(ring, items)
+            elif op == OP_REWRAP:
+                results = self.service.rewrap_many(ring, items)
+            else:
+                raise ProtocolError(f"unknown op {op}")
+            return encode_response(request_id, STATUS_OK, op, results)
+        except InvalidTag:
+            return encode_response(request_id, STATUS_INVALID_TAG, op, [])
+        except (ProtocolError, KeyServiceError, ValueError) as exc:
+            # Never echo key material: messages here are protocol/ring errors only.
+            return encode_response(request_id, STATUS_ERROR, op, [str(exc).encode("utf-8")])
+
+    async def _client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                try:
+                    head = await reader.readexactly(4)
+                except asyncio.IncompleteReadError:
+                    return
+                size = int.from_bytes(head, "big")
+                if size > MAX_FRAME_BYTES:
+                    logger.warning("Key service frame too large; dropping connection")
+                    return
+                writer.write(self.handle_frame(await reader.readexactly(size)))
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            return
+        finally:
+            writer.close()
+
+    async def serve(self, path: str) -> None:
+        if os.path.exists(path):
+            os.unlink(path)
+        old_umask = os.umask(0o177)
+        try:
+            server = await asyncio.start_unix_server(self._client, path=path)
+        finally:
+            os.umask(old_umask)
+
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop.set)
+
+        logger.info("Key service listening", extra={"socket": path})
+        async with server:
+            await stop.wait()
+        if os.path.exists(path):
+            os.unlink(path)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Local key service (holds the KEKs, serves wrap/unwrap over a Unix socket)")
+    parser.add_argument("--socket", default=settings.key_service_socket or "/run/keyservice/keyservice.sock")
+    args = parser.parse_args()
+
+    configure_logging()
+    # The sidecar always uses the in-process rings; decoding here fails fast on bad keys.
+    asyncio.run(KeyServiceServer(LocalKeyService.from_settings()).serve(args.socket))
+
+
+if __name__ == "__main__":
+    main()
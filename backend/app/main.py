@@ -1,21 +1,43 @@
 from __future__ import annotations
 
-from fastapi import FastAPI, Request
+import logging
+import os
+from pathlib import Path
+
+from fastapi import FastAPI, Query, Request
 from fastapi.exceptions import RequestValidationError
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response
 
 from app.core.config import settings
+from app.core.key_rotation import RewrapWorker
 from app.core.logging import configure_logging
-from app.db.init import init_sqlite_schema
+from app.core.metrics import mark_worker_dead, render_latest
+from app.core.profiling import profiling_enabled
+from app.core.tracing import MemoryExporter, get_exporter
+from app.core.workers import BackgroundLeader, worker_count
+from app.db.async_session import async_engine
+from app.db.init import init_schema
+from app.db.write_queue import stop_write_queue
+from app.keyservice.base import KeyServiceError, get_key_service
+from app.messages.payload import check_compression_available
+from app.messages.retention import PurgeWorker
 from app.middlewares.error_handler import error_handling_middleware
 from app.middlewares.origin import origin_check_middleware
 from app.middlewares.request_id import request_id_middleware
 from app.middlewares.content_type import content_type_guard_middleware
+from app.middlewares.query_stats import query_stats_middleware
+from app.middlewares.metrics import metrics_middleware
+from app.middlewares.tracing import tracing_middleware
+from app.middlewares.profiling import request_profile_middleware
 from app.users.router import router as users_router
 from app.auth.router import router as auth_router
 from app.twofa.router import router as twofa_router
 from app.messages.router import router as messages_router
+from app.debug.router import router as debug_router
+
+
+logger = logging.getLogger("app.main")
 
 
 def _parse_origins(value: str) -> list[str]:
@@ -53,30 +75,88 @@ def create_app() -> FastAPI:
         allow_origins=allow_origins,
         allow_credentials=True,
         allow_methods=["GET", "POST", "PUT", "PATCH", "DELETE"],
-        allow_headers=["Authorization", "Content-Type", "X-Requested-With"],
+        allow_headers=["Authorization", "Content-Type", "X-Requested-With", "Upload-Offset", "Idempotency-Key", "X-Export-Key"],
     )
 
     # Middlewares (order matters): request id -> origin check -> content type -> error normalization.
+    # Tracing and profiling sit innermost, where request.state.request_id is already set.
+    if profiling_enabled():
+        app.middleware("http")(request_profile_middleware)
+    app.middleware("http")(tracing_middleware)
     app.middleware("http")(request_id_middleware)
     app.middleware("http")(origin_check_middleware)
     app.middleware("http")(content_type_guard_middleware)
     app.middleware("http")(error_handling_middleware)
+    # Registered late = outer: also counts queries behind error responses.
+    app.middleware("http")(query_stats_middleware)
+    if settings.metrics_enabled:
+        # Outside query_stats so the request's DB time is final when it is recorded.
+        app.middleware("http")(metrics_middleware)
+
+    # With several workers only the holder of this lock runs purge and re-wrap.
+    leader = BackgroundLeader(Path(f"{settings.sqlite_path}.background-lock"))
+    purge_worker = PurgeWorker(interval_seconds=settings.purge_interval_seconds, leader=leader)
+    rewrap_worker = RewrapWorker(enabled=settings.key_rewrap_enabled, leader=leader)
 
     @app.on_event("startup")
     def _startup() -> None:
         # Fail-fast check: decode secrets at startup for clear logs.
         _ = settings.app_secret_key_bytes
-        _ = settings.data_key_bytes
-        _ = settings.totp_kek_bytes
-        _ = settings.user_hmac_kek_bytes
-
-        init_sqlite_schema()
+        check_compression_available()
+        get_exporter()
+        if settings.key_service_socket:
+            try:
+                get_key_service().info()
+            except KeyServiceError:
+                # The sidecar may still be starting; requests needing keys fail until it is up.
+                logger.warning("Key service not reachable at startup", extra={"socket": settings.key_service_socket})
+        else:
+            get_key_service().info()
+
+        # Runs in every worker; migrations are serialized (and skipped once current) in init_schema.
+        init_schema()
+        purge_worker.start()
+        rewrap_worker.start()
+        logger.info(
+            "Worker started",
+            extra={"pid": os.getpid(), "workers": worker_count(settings.web_concurrency), "rate_limit_store": settings.rate_limit_store},
+        )
+
+    @app.on_event("shutdown")
+    def _shutdown() -> None:
+        purge_worker.stop()
+        rewrap_worker.stop()
+        leader.release()
+        stop_write_queue()
+        get_key_service().close()
+        mark_worker_dead()
+
+    @app.on_event("shutdown")
+    async def _dispose_async_engine() -> None:
+        await async_engine.dispose()
+
+    if settings.metrics_enabled:
+
+        @app.get("/metrics", include_in_schema=False)
+        def _metrics() -> Response:
+            body, content_type = render_latest()
+            return Response(content=body, media_type=content_type)
+
+    if settings.app_env.lower() != "production" and settings.trace_exporter.strip().lower() == "memory":
+
+        @app.get("/debug/traces", include_in_schema=False)
+        def _traces(limit: int = Query(default=50, ge=1, le=1000), request_id: str | None = None) -> dict:
+            exporter = get_exporter()
+            assert isinstance(exporter, MemoryExporter)
+            return {"sample_rate": settings.trace_sample_rate, "traces": exporter.recent(limit, request_id)}
 
     # Routers
     app.include_router(auth_router, prefix="/api")
     app.include_router(users_router, prefix="/api")
     app.include_router(twofa_router, prefix="/api")
     app.include_router(messages_router, prefix="/api")
+    if profiling_enabled():
+        app.include_router(debug_router)
 
     return app
 
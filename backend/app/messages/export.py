@@ -0,0 +1,400 @@
+from __future__ import annotations
+
+import base64
+import datetime as dt
+import json
+import logging
+import os
+import secrets
+import tarfile
+import time
+import uuid
+from collections.abc import Iterable, Iterator
+
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from sqlalchemy import and_, exists, func, or_, select, update
+from sqlalchemy.orm import Session, defer
+
+from app.core.config import settings
+from app.core.exceptions import AuthorizationError, ConflictError, IntegrityError, ValidationError
+from app.core.metrics import CryptoOp, record_cache
+from app.crypto.aes_gcm import AesGcmCipher
+from app.crypto.hmac_sha256 import constant_time_equals, hmac_sha256
+from app.db.models import Attachment, ExportJob, Message, MessageRecipient, User, utcnow
+from app.db.session import SessionLocal
+from app.db.shards import mailbox_entity
+from app.keyservice.base import RING_DATA, RING_USER_HMAC, get_key_service
+from app.messages.payload import decode_payload
+from app.messages.service import (
+    _MAX_BODY_BYTES,
+    _aad,
+    _dek_item,
+    _iter_attachment_plaintext,
+    _message_hmac_payload,
+    _not_expired,
+    _payload_aad,
+    _user_hmac_key_item,
+)
+
+
+logger = logging.getLogger("app.export")
+
+_ENCRYPTED_SUFFIX = ".enc"
+
+
+def _visible_to(user_id: str):
+    mr = mailbox_entity(user_id)
+    live_recipient = exists(
+        select(mr.message_id)
+        .where(mr.message_id == Message.id)
+        .where(mr.recipient_user_id == user_id)
+        .where(mr.deleted_at.is_(None))
+    )
+    own = and_(Message.sender_user_id == user_id, Message.deleted_by_sender_at.is_(None))
+    return and_(or_(own, live_recipient), _not_expired())
+
+
+def parse_export_key(value: str | None) -> bytes | None:
+    if value is None:
+        return None
+    try:
+        raw = base64.b64decode(value, validate=True)
+    except Exception as exc:  # noqa: BLE001
+        raise ValidationError("Export key must be base64") from exc
+    if len(raw) != 32:
+        raise ValidationError("Export key must decode to 32 bytes")
+    return raw
+
+
+def create_export_job(db: Session, user: User) -> ExportJob:
+    total = db.execute(select(func.count()).select_from(Message).where(_visible_to(user.id))).scalar_one()
+    job = ExportJob(
+        id=str(uuid.uuid4()),
+        user_id=user.id,
+        status="pending",
+        encrypted=False,
+        total_messages=total,
+        exported_messages=0,
+        exported_bytes=0,
+        created_at=utcnow(),
+    )
+    db.add(job)
+    db.commit()
+    db.refresh(job)
+    return job
+
+
+def get_export_job(db: Session, user: User, job_id: str) -> ExportJob:
+    job = db.execute(select(ExportJob).where(ExportJob.id == job_id).where(ExportJob.user_id == user.id)).scalar_one_or_none()
+    if job is None:
+        raise AuthorizationError("not found")
+    return job
+
+
+def _lease_expiry(now: dt.datetime) -> dt.datetime:
+    return now + dt.timedelta(seconds=settings.export_lease_seconds)
+
+
+def start_export_job(db: Session, user: User, job_id: str, *, encrypted: bool) -> ExportJob:
+    """Claim the job for one download; pass the returned job's owner_token to stream_export."""
+
+    job = get_export_job(db, user, job_id)
+    now = utcnow()
+    # Conditional update: one download per job at a time. A running job whose lease ran
+    # out lost its download without the failure path running (client gone before the
+    # first chunk, worker killed, restart); rows from before leases existed count as lost.
+    started = db.execute(
+        update(ExportJob)
+        .where(ExportJob.id == job.id)
+        .where(
+            (ExportJob.status != "running")
+            | ExportJob.lease_expires_at.is_(None)
+            | (ExportJob.lease_expires_at < now)
+        )
+        .values(
+            status="running",
+            encrypted=encrypted,
+            exported_messages=0,
+            exported_bytes=0,
+            started_at=now,
+            finished_at=None,
+            owner_token=secrets.token_urlsafe(16),
+            lease_expires_at=_lease_expiry(now),
+        )
+        # `job` is refreshed below; evaluating the lease in Python would compare SQLite's
+        # naive datetimes with `now`.
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    if started != 1:
+        raise ConflictError("Export already running")
+    db.commit()
+    db.refresh(job)
+    return job
+
+
+def _tar_member(name: str, size: int, chunks: Iterable[bytes], mtime: float) -> Iterator[bytes]:
+    # Header and data are emitted separately so an attachment never has to sit in a tar buffer.
+    info = tarfile.TarInfo(name)
+    info.size = size
+    info.mtime = int(mtime)
+    info.mode = 0o600
+    yield info.tobuf(tarfile.PAX_FORMAT, "utf-8", "surrogateescape")
+    written = 0
+    for chunk in chunks:
+        written += len(chunk)
+        yield chunk
+    if written != size:
+        raise IntegrityError("export member size mismatch")
+    pad = -size % tarfile.BLOCKSIZE
+    if pad:
+        yield tarfile.NUL * pad
+
+
+_SEAL_METRIC = CryptoOp("aes_gcm_encrypt")
+
+# Sealed members are a sequence of segments, each nonce(12) || ciphertext || tag(16) over
+# at most _SEGMENT_BYTES of plaintext; every segment but the last is full. The AAD binds
+# the member name, the segment index and whether it is the last one, so segments cannot
+# be reordered, moved between members, or dropped from the end.
+_SEGMENT_BYTES = 64 * 1024
+_SEGMENT_OVERHEAD = 12 + 16
+_ENCRYPTION_DESCRIPTION = (
+    f"AES-256-GCM per member in segments of {_SEGMENT_BYTES} plaintext bytes (the last may be shorter or empty): "
+    "nonce(12) || ciphertext || tag(16) each, AAD = member name || 0x00 || segment index (uint32 BE) || last (1 byte: 0 or 1)"
+)
+
+
+def _segment_count(size: int) -> int:
+    return max(1, -(-size // _SEGMENT_BYTES))
+
+
+class _MemberSealer:
+    """Re-encrypts each member to the export key segment by segment (see _SEGMENT_BYTES)."""
+
+    def __init__(self, key: bytes) -> None:
+        self._aesgcm = AESGCM(key)
+
+    @staticmethod
+    def sealed_size(size: int) -> int:
+        return size + _segment_count(size) * _SEGMENT_OVERHEAD
+
+    def _segment(self, name: bytes, index: int, last: bool, plaintext: bytes) -> bytes:
+        nonce = os.urandom(12)
+        aad = name + b"\x00" + index.to_bytes(4, "big") + (b"\x01" if last else b"\x00")
+        started = time.perf_counter()
+        sealed = self._aesgcm.encrypt(nonce, plaintext, aad)
+        _SEAL_METRIC.observe(time.perf_counter() - started, len(plaintext))
+        return nonce + sealed
+
+    def seal(self, name: str, chunks: Iterable[bytes], size: int) -> Iterator[bytes]:
+        # Holds at most one incoming chunk plus one segment.
+        raw_name = name.encode("utf-8")
+        last = _segment_count(size) - 1
+        index = 0
+        pending = bytearray()
+        for chunk in chunks:
+            pending += chunk
+            offset = 0
+            while index < last and len(pending) - offset >= _SEGMENT_BYTES:
+                yield self._segment(raw_name, index, False, bytes(pending[offset : offset + _SEGMENT_BYTES]))
+                offset += _SEGMENT_BYTES
+                index += 1
+            del pending[:offset]
+        if index != last or len(pending) != size - last * _SEGMENT_BYTES:
+            raise IntegrityError("export member size mismatch")
+        yield self._segment(raw_name, index, True, bytes(pending))
+
+
+def _member(name: str, chunks: Iterable[bytes], size: int, mtime: float, sealer: _MemberSealer | None) -> Iterator[bytes]:
+    if sealer is not None:
+        name += _ENCRYPTED_SUFFIX
+        return _tar_member(name, sealer.sealed_size(size), sealer.seal(name, chunks, size), mtime)
+    return _tar_member(name, size, chunks, mtime)
+
+
+def _json_member(name: str, doc: dict, mtime: float, sealer: _MemberSealer | None, **dumps) -> Iterator[bytes]:
+    data = json.dumps(doc, **dumps).encode("utf-8")
+    return _member(name, (data,), len(data), mtime, sealer)
+
+
+def _as_utc(value: dt.datetime) -> dt.datetime:
+    return value if value.tzinfo is not None else value.replace(tzinfo=dt.UTC)
+
+
+class _Exporter:
+    def __init__(self, db: Session, user_id: str, sealer: _MemberSealer | None) -> None:
+        self.db = db
+        self.user_id = user_id
+        self.sealer = sealer
+        # Correspondents repeat across a mailbox: unwrap each sender HMAC key once.
+        self._users: dict[str, User] = {}
+        self._hmac_keys: dict[str, bytes] = {}
+
+    def _page(self, after: tuple[dt.datetime, str] | None) -> list[Message]:
+        q = (
+            select(Message)
+            .where(_visible_to(self.user_id))
+            .order_by(Message.created_at, Message.id)
+            .limit(settings.export_page_size)
+        )
+        if after is not None:
+            q = q.where(or_(Message.created_at > after[0], and_(Message.created_at == after[0], Message.id > after[1])))
+        return list(self.db.execute(q).scalars().all())
+
+    def _load_users(self, user_ids: set[str]) -> None:
+        missing = user_ids - self._users.keys()
+        record_cache("export_users", hits=len(user_ids) - len(missing), misses=len(missing))
+        if missing:
+            for u in self.db.execute(select(User).where(User.id.in_(missing))).scalars():
+                self._users[u.id] = u
+
+    def _load_hmac_keys(self, sender_ids: set[str]) -> None:
+        # One key-service round trip for every new correspondent on the page.
+        missing = sorted(sender_ids - self._hmac_keys.keys())
+        record_cache("export_hmac_keys", hits=len(sender_ids) - len(missing), misses=len(missing))
+        keys = get_key_service().unwrap_many(RING_USER_HMAC, [_user_hmac_key_item(self._users[uid]) for uid in missing])
+        self._hmac_keys.update(zip(missing, keys))
+
+    def _message_members(self, m: Message, dek: bytes, recipient_ids: list[str], attachments: list[Attachment]) -> Iterator[bytes]:
+        payload = _message_hmac_payload(message=m, recipient_ids_sorted=recipient_ids, attachments=attachments)
+        verified = constant_time_equals(hmac_sha256(self._hmac_keys[m.sender_user_id], payload), m.hmac_sha256)
+
+        dek_cipher = AesGcmCipher(dek)
+        subject = dek_cipher.decrypt(m.subject_ciphertext, m.subject_nonce, m.subject_tag, aad=_aad("messages:subject", m.id))
+        body_plain = dek_cipher.decrypt(
+            m.body_ciphertext, m.body_nonce, m.body_tag, aad=_payload_aad("messages:body", m.body_format, m.id)
+        )
+        body = decode_payload(m.body_format, body_plain, max_bytes=_MAX_BODY_BYTES)
+
+        created = _as_utc(m.created_at)
+        prefix = f"messages/{created:%Y%m%dT%H%M%S}_{m.id}/"
+        meta = {
+            "id": m.id,
+            "thread_id": m.thread_id or m.id,
+            "in_reply_to": m.in_reply_to,
+            "direction": "sent" if m.sender_user_id == self.user_id else "received",
+            "sender": self._users[m.sender_user_id].username,
+            "recipients": [self._users[rid].username for rid in recipient_ids if rid in self._users],
+            "created_at": created.isoformat(),
+            "subject": subject.decode("utf-8"),
+            "body": body.decode("utf-8"),
+            "authenticity_verified": verified,
+            "attachments": [
+                {
+                    "id": a.id,
+                    "filename": a.filename,
+                    "content_type": a.content_type,
+                    "size_bytes": a.size_bytes,
+                    "path": f"{prefix}attachments/{a.id}_{a.filename}",
+                }
+                for a in attachments
+            ],
+        }
+        mtime = created.timestamp()
+        yield from _json_member(prefix + "message.json", meta, mtime, self.sealer, ensure_ascii=False, indent=2)
+
+        for a in attachments:
+            chunks = _iter_attachment_plaintext(dek_cipher, a)
+            yield from _member(f"{prefix}attachments/{a.id}_{a.filename}", chunks, a.size_bytes, mtime, self.sealer)
+            # Drop the (possibly 25 MiB) ciphertext so memory stays flat across the page.
+            if a.blob_id is None:
+                self.db.expire(a, ["blob_ciphertext"])
+            elif a.blob is not None:
+                self.db.expire(a.blob, ["ciphertext"])
+
+    def run(self, on_progress) -> Iterator[bytes]:
+        exported = 0
+        after: tuple[dt.datetime, str] | None = None
+        while True:
+            page = self._page(after)
+            if not page:
+                break
+            ids = [m.id for m in page]
+
+            recipients: dict[str, list[str]] = {mid: [] for mid in ids}
+            for mid, rid in self.db.execute(
+                select(MessageRecipient.message_id, MessageRecipient.recipient_user_id).where(MessageRecipient.message_id.in_(ids))
+            ).all():
+                recipients[mid].append(rid)
+
+            attachments: dict[str, list[Attachment]] = {mid: [] for mid in ids}
+            for a in self.db.execute(
+                select(Attachment).where(Attachment.message_id.in_(ids)).options(defer(Attachment.blob_ciphertext))
+            ).scalars():
+                attachments[a.message_id].append(a)
+
+            self._load_users({m.sender_user_id for m in page} | {rid for rids in recipients.values() for rid in rids})
+            self._load_hmac_keys({m.sender_user_id for m in page})
+            deks = get_key_service().unwrap_many(RING_DATA, [_dek_item(m) for m in page])
+
+            for m, dek in zip(page, deks):
+                yield from self._message_members(m, dek, sorted(recipients[m.id]), attachments[m.id])
+
+            exported += len(page)
+            after = (page[-1].created_at, page[-1].id)
+            on_progress(exported)
+
+        manifest = {
+            "format": "secure-messaging-export/v2",
+            "user_id": self.user_id,
+            "exported_at": utcnow().isoformat(),
+            "messages": exported,
+            "encryption": _ENCRYPTION_DESCRIPTION if self.sealer is not None else None,
+        }
+        yield from _json_member("manifest.json", manifest, utcnow().timestamp(), None, indent=2)
+
+
+def stream_export(job_id: str, user_id: str, export_key: bytes | None, owner: str) -> Iterator[bytes]:
+    """Yield the tar archive for a started export job, reporting progress per page.
+
+    Uses its own session: the response body outlives the request-scoped one. Every update
+    is conditional on `owner` (the claiming download) and renews its lease; once a new
+    download has taken the job over, this stream stops.
+    """
+
+    db = SessionLocal()
+    written = 0
+    owned = (ExportJob.id == job_id) & (ExportJob.owner_token == owner)
+    renew_every = settings.export_lease_seconds / 3
+    renew_at = time.monotonic() + renew_every
+
+    def _update(**values) -> None:
+        nonlocal renew_at
+        values = {"lease_expires_at": _lease_expiry(utcnow()), **values}
+        if not db.execute(update(ExportJob).where(owned).values(values)).rowcount:
+            db.rollback()
+            raise ConflictError("Export taken over by another download")
+        db.commit()
+        renew_at = time.monotonic() + renew_every
+
+    def _progress(exported_messages: int) -> None:
+        _update(exported_messages=exported_messages, exported_bytes=written)
+
+    try:
+        exporter = _Exporter(db, user_id, _MemberSealer(export_key) if export_key is not None else None)
+        for chunk in exporter.run(_progress):
+            written += len(chunk)
+            yield chunk
+            # A page of large attachments to a slow client can outlast the lease.
+            if time.monotonic() >= renew_at:
+                _update(exported_bytes=written)
+
+        # End-of-archive marker, padded to a full tar record.
+        trailer_len = 2 * tarfile.BLOCKSIZE
+        trailer_len += -(written + trailer_len) % tarfile.RECORDSIZE
+        written += trailer_len
+        yield tarfile.NUL * trailer_len
+
+        _update(status="completed", exported_bytes=written, finished_at=utcnow(), lease_expires_at=None)
+    except BaseException as exc:
+        # Includes GeneratorExit when the client disconnects mid-stream.
+        if isinstance(exc, GeneratorExit):
+            logger.warning("Mailbox export aborted by client", extra={"job_id": job_id})
+        else:
+            logger.exception("Mailbox export failed", extra={"job_id": job_id})
+        db.rollback()
+        db.execute(update(ExportJob).where(owned).values(status="failed", finished_at=utcnow(), lease_expires_at=None))
+        db.commit()
+        raise
+    finally:
+        db.close()
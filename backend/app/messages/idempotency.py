@@ -0,0 +1,189 @@
+from __future__ import annotations
+
+import asyncio
+import contextlib
+import datetime as dt
+import hashlib
+import logging
+
+from sqlalchemy import delete, select, update
+from sqlalchemy.exc import IntegrityError as DbIntegrityError
+from sqlalchemy.orm import Session
+
+from app.core.config import settings
+from app.core.exceptions import ConflictError
+from app.db.models import IdempotencyKey, utcnow
+from app.db.write_queue import run_write_async
+
+logger = logging.getLogger("app.idempotency")
+
+
+RESERVED = "reserved"
+PENDING = "pending"
+COMPLETED = "completed"
+
+
+def request_fingerprint(
+    *,
+    recipients_json: str,
+    subject: str,
+    body: str,
+    files: list[tuple[str, str, bytes]],
+    upload_ids_json: str | None,
+    ttl_seconds: int | None = None,
+) -> bytes:
+    h = hashlib.sha256()
+    for part in (recipients_json, subject, body, upload_ids_json or "", str(ttl_seconds or "")):
+        raw = part.encode("utf-8")
+        h.update(len(raw).to_bytes(4, "big"))
+        h.update(raw)
+    for filename, content_type, data in files:
+        h.update(filename.encode("utf-8") + b"\x00" + content_type.encode("utf-8") + b"\x00")
+        h.update(hashlib.sha256(data).digest())
+    return h.digest()
+
+
+def _lease_expiry(now: dt.datetime) -> dt.datetime:
+    return now + dt.timedelta(seconds=settings.idempotency_lease_seconds)
+
+
+def reserve_idempotency_key(db: Session, user_id: str, key: str, fingerprint: bytes, owner: str) -> tuple[str, str | None]:
+    """Claim `key` for a new request identified by the random `owner` token.
+
+    Returns (RESERVED, None) when the caller should do the work (and keep the lease alive
+    with IdempotencyLease), (COMPLETED, message_id) for a replay, or (PENDING, None) while
+    another request with the same key runs.
+    """
+
+    now = utcnow()
+    # Rows from before leases existed: their creation time stands in for the lease.
+    legacy_stale_before = now - dt.timedelta(seconds=settings.idempotency_lease_seconds)
+
+    # Expired records and abandoned locks (lease not renewed: crashed worker) do not block
+    # a new attempt. A live sender renews its lease long before it runs out.
+    db.execute(
+        delete(IdempotencyKey)
+        .where(IdempotencyKey.user_id == user_id)
+        .where(IdempotencyKey.key == key)
+        .where(
+            (IdempotencyKey.expires_at <= now)
+            | (
+                IdempotencyKey.message_id.is_(None)
+                & (
+                    (IdempotencyKey.lease_expires_at < now)
+                    | (IdempotencyKey.lease_expires_at.is_(None) & (IdempotencyKey.created_at < legacy_stale_before))
+                )
+            )
+        )
+    )
+
+    db.add(
+        IdempotencyKey(
+            user_id=user_id,
+            key=key,
+            request_fingerprint=fingerprint,
+            message_id=None,
+            owner_token=owner,
+            lease_expires_at=_lease_expiry(now),
+            created_at=now,
+            expires_at=now + dt.timedelta(seconds=settings.idempotency_ttl_seconds),
+        )
+    )
+    try:
+        db.commit()
+        return RESERVED, None
+    except DbIntegrityError:
+        db.rollback()
+
+    row = db.execute(
+        select(IdempotencyKey.request_fingerprint, IdempotencyKey.message_id)
+        .where(IdempotencyKey.user_id == user_id)
+        .where(IdempotencyKey.key == key)
+    ).first()
+    if row is None:
+        # Released between our insert and read; let the caller retry.
+        return PENDING, None
+
+    stored_fingerprint, message_id = row
+    if stored_fingerprint != fingerprint:
+        raise ConflictError("Idempotency-Key reused with a different request")
+    if message_id is None:
+        return PENDING, None
+    return COMPLETED, message_id
+
+
+def _owned(user_id: str, key: str, owner: str):
+    return (
+        (IdempotencyKey.user_id == user_id)
+        & (IdempotencyKey.key == key)
+        & (IdempotencyKey.owner_token == owner)
+        & IdempotencyKey.message_id.is_(None)
+    )
+
+
+def complete_idempotency_key(db: Session, user_id: str, key: str, owner: str, message_id: str) -> None:
+    # No commit: runs inside the send transaction so the message and the key land together.
+    # A lost lease means a retry took the key over; raising rolls this send back so the
+    # message is not stored twice.
+    done = db.execute(update(IdempotencyKey).where(_owned(user_id, key, owner)).values(message_id=message_id)).rowcount
+    if not done:
+        raise ConflictError("Idempotency-Key lease lost to a retry")
+
+
+def release_idempotency_key(db: Session, user_id: str, key: str, owner: str) -> None:
+    # A failed attempt must not pin the key; the client may retry with it. Only our own
+    # reservation is released, never one a retry has taken over.
+    db.rollback()
+    db.execute(delete(IdempotencyKey).where(_owned(user_id, key, owner)))
+    db.commit()
+
+
+def renew_idempotency_lease(db: Session, user_id: str, key: str, owner: str) -> bool:
+    # Caller commits (run through run_write_async).
+    renewed = db.execute(update(IdempotencyKey).where(_owned(user_id, key, owner)).values(lease_expires_at=_lease_expiry(utcnow()))).rowcount
+    return bool(renewed)
+
+
+class IdempotencyLease:
+    """Renews a reservation's lease from an asyncio task while the send runs in the threadpool.
+
+    Renewal errors are logged and retried on the next tick; a lease only runs out after
+    three missed renewals.
+    """
+
+    def __init__(self, user_id: str, key: str, owner: str) -> None:
+        self.user_id = user_id
+        self.key = key
+        self.owner = owner
+        self._task: asyncio.Task | None = None
+
+    async def __aenter__(self) -> IdempotencyLease:
+        self._task = asyncio.create_task(self._run())
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(settings.idempotency_lease_seconds / 3)
+            try:
+                renewed = await run_write_async(lambda s: renew_idempotency_lease(s, self.user_id, self.key, self.owner))
+            except Exception:  # noqa: BLE001
+                logger.warning("Could not renew Idempotency-Key lease", exc_info=True)
+                continue
+            if not renewed:
+                return
+
+
+def purge_expired_idempotency_keys(db: Session, *, limit: int = 500) -> int:
+    expired = select(IdempotencyKey.user_id, IdempotencyKey.key).where(IdempotencyKey.expires_at <= utcnow()).limit(limit)
+    rows = db.execute(expired).all()
+    for user_id, key in rows:
+        db.execute(delete(IdempotencyKey).where(IdempotencyKey.user_id == user_id).where(IdempotencyKey.key == key))
+    if rows:
+        db.commit()
+    return len(rows)
@@ -0,0 +1,147 @@
+from __future__ import annotations
+
+import zlib
+from collections.abc import Iterator
+
+from app.core.config import settings
+
+try:  # Optional: zstd gives a better ratio/CPU trade-off than deflate when available.
+    import zstandard
+except ImportError:  # pragma: no cover - depends on the deployment image
+    zstandard = None
+
+
+# Payload format versions (stored next to the ciphertext; bound into the AEAD AAD).
+# 0 is the legacy format: the plaintext is stored as-is.
+PAYLOAD_FORMAT_RAW = 0
+PAYLOAD_FORMAT_DEFLATE = 1
+PAYLOAD_FORMAT_ZSTD = 2
+
+_DEFLATE_LEVEL = 6
+_ZSTD_LEVEL = 3
+
+# Compressed output must be at least this much smaller to be worth the read-side CPU.
+_MIN_SAVINGS_RATIO = 0.9
+
+_STREAM_CHUNK = 1024 * 1024  # 1 MiB
+
+# Formats that are already compressed (or encrypted); recompressing only burns CPU.
+_INCOMPRESSIBLE_PREFIXES = ("image/", "audio/", "video/")
+_INCOMPRESSIBLE_TYPES = {
+    "application/gzip",
+    "application/pdf",
+    "application/vnd.rar",
+    "application/x-7z-compressed",
+    "application/x-bzip2",
+    "application/x-rar-compressed",
+    "application/x-xz",
+    "application/zip",
+    "application/zstd",
+    "application/epub+zip",
+    "application/java-archive",
+}
+# SVG is text even though it lives under image/.
+_COMPRESSIBLE_OVERRIDES = {"image/svg+xml", "image/bmp", "image/x-ms-bmp", "image/tiff"}
+
+
+_FORMATS = {"none": PAYLOAD_FORMAT_RAW, "deflate": PAYLOAD_FORMAT_DEFLATE, "zstd": PAYLOAD_FORMAT_ZSTD}
+
+
+def _configured_format() -> int:
+    # PAYLOAD_COMPRESSION is validated in Settings; zstd availability at startup.
+    return _FORMATS[settings.payload_compression]
+
+
+def check_compression_available() -> None:
+    """Fail fast when PAYLOAD_COMPRESSION=zstd but the `zstandard` wheel is not installed."""
+
+    if settings.payload_compression == "zstd" and zstandard is None:
+        raise RuntimeError("PAYLOAD_COMPRESSION=zstd requires the optional `zstandard` package")
+
+
+def is_compressible_content_type(content_type: str) -> bool:
+    ct = (content_type or "").lower()
+    if ct in _COMPRESSIBLE_OVERRIDES:
+        return True
+    if ct in _INCOMPRESSIBLE_TYPES:
+        return False
+    if ct.startswith(_INCOMPRESSIBLE_PREFIXES):
+        return False
+    # OOXML/ODF documents are zip containers.
+    if ct.startswith("application/vnd.openxmlformats-") or ct.startswith("application/vnd.oasis.opendocument."):
+        return False
+    return True
+
+
+def _compress(fmt: int, data: bytes) -> bytes:
+    if fmt == PAYLOAD_FORMAT_DEFLATE:
+        return zlib.compress(data, _DEFLATE_LEVEL)
+    if fmt == PAYLOAD_FORMAT_ZSTD:
+        return zstandard.ZstdCompressor(level=_ZSTD_LEVEL).compress(data)
+    raise ValueError("unknown payload format")
+
+
+def encode_payload(data: bytes, content_type: str) -> tuple[int, bytes]:
+    """Return (payload_format, plaintext_to_encrypt).
+
+    Compression is applied only when policy allows it and it actually saves space;
+    otherwise the data is stored raw (format 0), exactly as before.
+    """
+
+    fmt = _configured_format()
+    if fmt == PAYLOAD_FORMAT_RAW:
+        return PAYLOAD_FORMAT_RAW, data
+    if len(data) < settings.payload_compression_min_bytes or not is_compressible_content_type(content_type):
+        return PAYLOAD_FORMAT_RAW, data
+
+    packed = _compress(fmt, data)
+    if len(packed) > len(data) * _MIN_SAVINGS_RATIO:
+        return PAYLOAD_FORMAT_RAW, data
+    return fmt, packed
+
+
+def iter_decoded(fmt: int, payload: bytes, *, max_bytes: int) -> Iterator[bytes]:
+    """Yield the original plaintext in chunks without materializing it whole."""
+
+    if fmt == PAYLOAD_FORMAT_RAW:
+        for i in range(0, len(payload), _STREAM_CHUNK):
+            yield payload[i : i + _STREAM_CHUNK]
+        return
+
+    produced = 0
+    if fmt == PAYLOAD_FORMAT_DEFLATE:
+        d = zlib.decompressobj()
+        pending = payload
+        while pending:
+            out = d.decompress(pending, _STREAM_CHUNK)
+            pending = d.unconsumed_tail
+            if out:
+                produced += len(out)
+                if produced > max_bytes:
+                    raise ValueError("decoded payload too large")
+                yield out
+        tail = d.flush()
+        if tail:
+            produced += len(tail)
+            if produced > max_bytes:
+                raise ValueError("decoded payload too large")
+            yield tail
+        return
+
+    if fmt == PAYLOAD_FORMAT_ZSTD:
+        if zstandard is None:
+            raise RuntimeError("zstandard is required to read zstd payloads")
+        for out in zstandard.ZstdDecompressor().read_to_iter(payload, read_size=_STREAM_CHUNK, write_size=_STREAM_CHUNK):
+            produced += len(out)
+            if produced > max_bytes:
+                raise ValueError("decoded payload too large")
+            yield out
+        return
+
+    raise ValueError("unknown payload format")
+
+
+def decode_payload(fmt: int, payload: bytes, *, max_bytes: int) -> bytes:
+    if fmt == PAYLOAD_FORMAT_RAW:
+        return payload
+    return b"".join(iter_decoded(fmt, payload, max_bytes=max_bytes))
@@ -0,0 +1,184 @@
+from __future__ import annotations
+
+import logging
+import threading
+import time
+
+from sqlalchemy import and_, delete, exists, or_, select, text, update
+from sqlalchemy.orm import Session
+
+from app.core.config import settings
+from app.core.workers import BackgroundLeader
+from app.db.models import Attachment, Message, MessageRecipient, utcnow
+from app.db.session import SessionLocal
+from app.db.shards import mailbox_tables
+from app.messages.idempotency import purge_expired_idempotency_keys
+from app.middlewares.rate_limit import purge_expired_rate_limit_buckets
+from app.messages.service import _release_blob
+from app.messages.uploads import purge_expired_uploads
+
+
+logger = logging.getLogger("app.retention")
+
+
+def _purgeable_batch(db: Session, *, limit: int, after: tuple | None) -> list[tuple]:
+    """Next batch of (deleted_by_sender_at, id) for messages nobody can see anymore.
+
+    Walks idx_messages_sender_deleted in key order so rows still held by a recipient
+    are skipped once per pass instead of being rescanned by every batch.
+    """
+
+    live_recipient = exists(
+        select(MessageRecipient.message_id)
+        .where(MessageRecipient.message_id == Message.id)
+        .where(MessageRecipient.deleted_at.is_(None))
+    )
+    q = (
+        select(Message.deleted_by_sender_at, Message.id)
+        .where(Message.deleted_by_sender_at.is_not(None))
+        .where(~live_recipient)
+        .order_by(Message.deleted_by_sender_at, Message.id)
+        .limit(limit)
+    )
+    if after is not None:
+        q = q.where(
+            or_(
+                Message.deleted_by_sender_at > after[0],
+                and_(Message.deleted_by_sender_at == after[0], Message.id > after[1]),
+            )
+        )
+    return [tuple(r) for r in db.execute(q).all()]
+
+
+def _expired_batch(db: Session, *, limit: int) -> list[str]:
+    # Served by the partial idx_messages_expires index.
+    q = (
+        select(Message.id)
+        .where(Message.expires_at.is_not(None))
+        .where(Message.expires_at <= utcnow())
+        .order_by(Message.expires_at)
+        .limit(limit)
+    )
+    return list(db.execute(q).scalars().all())
+
+
+def hard_delete_messages(db: Session, message_ids: list[str]) -> None:
+    """Physically remove messages with their recipients and attachments (caller commits).
+
+    Children are deleted explicitly in foreign-key order rather than through cascades
+    (SQLITE_FOREIGN_KEYS may be off), and shared attachment blobs are released by
+    reference count.
+    """
+
+    if not message_ids:
+        return
+
+    blob_ids = db.execute(
+        select(Attachment.blob_id).where(Attachment.message_id.in_(message_ids)).where(Attachment.blob_id.is_not(None))
+    ).scalars().all()
+
+    db.execute(delete(Attachment).where(Attachment.message_id.in_(message_ids)))
+    for blob_id in blob_ids:
+        _release_blob(db, blob_id)
+
+    for table in mailbox_tables():
+        db.execute(delete(table).where(table.c.message_id.in_(message_ids)))
+    db.execute(update(Message).where(Message.in_reply_to.in_(message_ids)).values(in_reply_to=None))
+    db.execute(delete(Message).where(Message.id.in_(message_ids)))
+
+
+def purge_messages(db: Session, *, batch_size: int, pause_seconds: float = 0.0) -> int:
+    """Hard-delete expired messages and messages deleted by sender and all recipients.
+
+    Each batch is its own short transaction; the pause between batches lets queued
+    writers take the SQLite write lock.
+    """
+
+    purged = 0
+
+    while True:
+        ids = _expired_batch(db, limit=batch_size)
+        if not ids:
+            break
+        hard_delete_messages(db, ids)
+        db.commit()
+        purged += len(ids)
+        if len(ids) < batch_size:
+            break
+        time.sleep(pause_seconds)
+
+    after: tuple | None = None
+    while True:
+        batch = _purgeable_batch(db, limit=batch_size, after=after)
+        if not batch:
+            break
+        hard_delete_messages(db, [mid for _deleted_at, mid in batch])
+        db.commit()
+        purged += len(batch)
+        if len(batch) < batch_size:
+            break
+        after = batch[-1]
+        time.sleep(pause_seconds)
+
+    return purged
+
+
+def incremental_vacuum(db: Session, *, pages: int) -> None:
+    # No-op unless the database was created (or VACUUMed) with auto_vacuum = INCREMENTAL.
+    # PostgreSQL reclaims space through autovacuum.
+    if pages <= 0 or db.get_bind().dialect.name != "sqlite":
+        return
+    db.execute(text(f"PRAGMA incremental_vacuum({int(pages)})"))
+    db.commit()
+
+
+def run_purge_cycle() -> dict[str, int]:
+    db = SessionLocal()
+    try:
+        pause = settings.purge_batch_pause_ms / 1000.0
+        stats = {
+            "messages": purge_messages(db, batch_size=settings.purge_batch_size, pause_seconds=pause),
+            "uploads": purge_expired_uploads(db, limit=settings.purge_batch_size),
+            "idempotency_keys": purge_expired_idempotency_keys(db, limit=settings.purge_batch_size),
+            "rate_limit_buckets": purge_expired_rate_limit_buckets(db),
+        }
+        incremental_vacuum(db, pages=settings.purge_vacuum_pages)
+        return stats
+    finally:
+        db.close()
+
+
+class PurgeWorker:
+    """Background thread running `run_purge_cycle` every `interval_seconds`.
+
+    With a `leader`, cycles run only in the worker process holding it.
+    """
+
+    def __init__(self, interval_seconds: int, leader: BackgroundLeader | None = None) -> None:
+        self.interval_seconds = interval_seconds
+        self.leader = leader
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def start(self) -> None:
+        if self.interval_seconds <= 0 or self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name="purge-worker", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=10)
+            self._thread = None
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval_seconds):
+            if self.leader is not None and not self.leader.held():
+                continue
+            try:
+                stats = run_purge_cycle()
+                if any(stats.values()):
+                    logger.info("Purge cycle completed: %s", stats)
+            except Exception:  # noqa: BLE001
+                logger.exception("Purge cycle failed")
@@ -1,40 +1,75 @@
 from __future__ import annotations
 
+import asyncio
+import contextlib
 import re
+import secrets
+import time
 from urllib.parse import quote
 
-from fastapi import APIRouter, Depends, File, Form, Request, UploadFile
-from fastapi.responses import Response
+from fastapi import APIRouter, Depends, File, Form, Header, Query, Request, Response, UploadFile
+from fastapi.responses import StreamingResponse
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
 
-from app.auth.dependencies import get_current_user
+from app.auth.dependencies import get_current_user, get_current_user_async, get_current_user_read_only
 from app.core.config import settings
-from app.core.exceptions import ValidationError
-from app.db.models import User
-from app.db.session import get_db
+from app.core.exceptions import ConflictError, ValidationError
+from app.core.tracing import TracedRoute
+from app.db.models import ExportJob, Message, UploadSession, User
+from app.db.async_session import get_async_db
+from app.db.session import get_db, get_read_db
 from app.middlewares.rate_limit import FixedWindowRateLimiter
+from app.messages.export import create_export_job, get_export_job, parse_export_key, start_export_job, stream_export
+from app.messages.idempotency import (
+    COMPLETED,
+    RESERVED,
+    IdempotencyLease,
+    release_idempotency_key,
+    request_fingerprint,
+    reserve_idempotency_key,
+)
 from app.messages.schemas import (
     AttachmentMeta,
+    CreateUploadRequest,
     DeleteResponse,
+    ExportJobStatus,
     InboxMessageItem,
     MarkReadResponse,
     MessageDetail,
     SendMessageResponse,
     SentMessageItem,
+    ThreadMessageItem,
+    ThreadPage,
+    ThreadParticipantState,
+    UploadStatus,
 )
 from app.messages.service import (
     delete_message_for_user,
     download_attachment,
-    list_inbox,
-    list_sent,
-    read_message_detail,
+    forward_message,
+    list_inbox_async,
+    list_sent_async,
+    list_thread,
+    read_message_detail_async,
+    reply_to_message,
     send_message,
 )
+from app.messages.uploads import append_chunk, claim_uploads, create_upload, finalize_upload, get_upload
 
 
-router = APIRouter(prefix="/messages", tags=["messages"])
+router = APIRouter(prefix="/messages", tags=["messages"], route_class=TracedRoute)
 
-_send_limiter = FixedWindowRateLimiter(window_seconds=60, max_requests=settings.send_rate_limit_per_minute)
+_send_limiter = FixedWindowRateLimiter(window_seconds=60, max_requests=settings.send_rate_limit_per_minute, name="send")
+_upload_limiter = FixedWindowRateLimiter(
+    window_seconds=60,
+    max_requests=settings.send_rate_limit_per_minute * settings.max_attachments_per_message,
+    name="upload",
+)
+_upload_chunk_limiter = FixedWindowRateLimiter(
+    window_seconds=60, max_requests=settings.upload_chunk_rate_limit_per_minute, name="upload_chunk"
+)
 
 
 def _client_ip(request: Request) -> str:
@@ -54,6 +89,39 @@ async def _read_upload_limited(f: UploadFile, *, max_bytes: int) -> bytes:
     return bytes(buf)
 
 
+async def _read_uploads(files: list[UploadFile]) -> list[tuple[str, str, bytes]]:
+    if len(files) > settings.max_attachments_per_message:
+        raise ValidationError("Too many attachments")
+
+    # Read attachments (POC uses in-memory) but enforce strict caps during read.
+    file_tuples: list[tuple[str, str, bytes]] = []
+    total = 0
+    for f in files:
+        data = await _read_upload_limited(f, max_bytes=settings.max_attachment_bytes)
+        total += len(data)
+        if total > settings.max_attachment_bytes:
+            raise ValidationError("Attachments too large")
+        file_tuples.append((f.filename or "attachment", f.content_type or "application/octet-stream", data))
+    return file_tuples
+
+
+async def _reserve_or_replay(db: Session, user: User, key: str, fingerprint: bytes, owner: str) -> str | None:
+    # Returns the original message id for a replay, or None once this request owns the key.
+    # Concurrent duplicates poll until the first request finishes (works across workers);
+    # the first request's lease outlasts this wait, so a slow send is never taken over.
+    # Each attempt (DELETE, INSERT, commit) runs in the threadpool; the wait is asyncio.sleep.
+    deadline = time.monotonic() + settings.idempotency_lock_timeout_seconds
+    while True:
+        state, message_id = await run_in_threadpool(reserve_idempotency_key, db, user.id, key, fingerprint, owner)
+        if state == COMPLETED:
+            return message_id
+        if state == RESERVED:
+            return None
+        if time.monotonic() >= deadline:
+            raise ConflictError("Request with this Idempotency-Key is still in progress")
+        await asyncio.sleep(0.1)
+
+
 _SAFE_FALLBACK_RE = re.compile(r"[^A-Za-z0-9._\-]+")
 
 
@@ -68,35 +136,233 @@ def _content_disposition_attachment(filename: str) -> str:
 @router.post("/send", response_model=SendMessageResponse)
 async def send(
     request: Request,
+    response: Response,
     recipients: str = Form(...),
     subject: str = Form(..., max_length=200),
     body: str = Form(..., max_length=20000),
     files: list[UploadFile] = File(default=[]),
+    upload_ids: str | None = Form(default=None),
+    ttl_seconds: int | None = Form(default=None, gt=0),
+    idempotency_key: str | None = Header(default=None, alias="Idempotency-Key", min_length=1, max_length=255),
     db: Session = Depends(get_db),
     current_user: User = Depends(get_current_user),
 ) -> SendMessageResponse:
-    _send_limiter.check(f"send:{_client_ip(request)}")
+    # upload_ids: JSON list of finalized resumable uploads to attach instead of inline files.
+    # ttl_seconds: optional self-destruct; the message is hidden and purged once it expires.
+    await _send_limiter.check_async(f"send:{_client_ip(request)}")
 
-    if len(files) > settings.max_attachments_per_message:
-        raise ValidationError("Too many attachments")
+    file_tuples = await _read_uploads(files)
 
-    # Read attachments (POC uses in-memory) but enforce strict caps during read.
-    file_tuples: list[tuple[str, str, bytes]] = []
-    total = 0
-    for f in files:
-        data = await _read_upload_limited(f, max_bytes=settings.max_attachment_bytes)
-        total += len(data)
-        if total > settings.max_attachment_bytes:
-            raise ValidationError("Attachments too large")
-        file_tuples.append((f.filename or "attachment", f.content_type or "application/octet-stream", data))
+    if idempotency_key is not None:
+        fingerprint = request_fingerprint(
+            recipients_json=recipients,
+            subject=subject,
+            body=body,
+            files=file_tuples,
+            upload_ids_json=upload_ids,
+            ttl_seconds=ttl_seconds,
+        )
+        owner = secrets.token_urlsafe(16)
+        replayed_id = await _reserve_or_replay(db, current_user, idempotency_key, fingerprint, owner)
+        if replayed_id is not None:
+            response.headers["Idempotent-Replayed"] = "true"
+            return SendMessageResponse(id=replayed_id)
+        lease = IdempotencyLease(current_user.id, idempotency_key, owner)
+    else:
+        owner = None
+        lease = contextlib.nullcontext()
+
+    def _send() -> Message:
+        # Encryption, HMAC and the grouped commit (which waits for the write queue's batch
+        # window) run in a threadpool thread; the loop keeps serving, so concurrent sends
+        # reach the queue together and share a commit.
+        staged = claim_uploads(db, current_user, upload_ids)
+        return send_message(
+            db=db,
+            sender=current_user,
+            recipients_json=recipients,
+            subject=subject,
+            body=body,
+            files=file_tuples,
+            staged=staged,
+            idempotency_key=idempotency_key,
+            idempotency_owner=owner,
+            ttl_seconds=ttl_seconds,
+        )
+
+    try:
+        async with lease:
+            m = await run_in_threadpool(_send)
+    except Exception:
+        if idempotency_key is not None:
+            await run_in_threadpool(release_idempotency_key, db, current_user.id, idempotency_key, owner)
+        raise
+    return SendMessageResponse(id=m.id)
+
+
+def _upload_status(upload: UploadSession) -> UploadStatus:
+    return UploadStatus(
+        id=upload.id,
+        status=upload.status,
+        offset=upload.received_bytes,
+        size_bytes=upload.size_bytes,
+        expires_at=upload.expires_at,
+    )
+
+
+@router.post("/uploads", response_model=UploadStatus, status_code=201)
+def create_upload_session(
+    payload: CreateUploadRequest,
+    request: Request,
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_user),
+) -> UploadStatus:
+    _upload_limiter.check(f"upload:{_client_ip(request)}")
+    upload = create_upload(
+        db,
+        current_user,
+        filename=payload.filename,
+        content_type=payload.content_type,
+        size_bytes=payload.size_bytes,
+    )
+    return _upload_status(upload)
+
+
+@router.get("/uploads/{upload_id}", response_model=UploadStatus)
+def upload_status(upload_id: str, db: Session = Depends(get_read_db), current_user: User = Depends(get_current_user_read_only)) -> UploadStatus:
+    # Clients resume from the returned offset after a dropped connection.
+    return _upload_status(get_upload(db, current_user, upload_id))
+
+
+@router.patch("/uploads/{upload_id}", response_model=UploadStatus)
+async def upload_chunk(
+    upload_id: str,
+    request: Request,
+    upload_offset: int = Header(..., alias="Upload-Offset", ge=0),
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_user),
+) -> UploadStatus:
+    # Checked before the body is read, so rejected chunks cost no encryption or write.
+    await _upload_chunk_limiter.check_async(f"upload_chunk:{_client_ip(request)}")
 
-    m = send_message(db=db, sender=current_user, recipients_json=recipients, subject=subject, body=body, files=file_tuples)
+    # Raw chunk body (application/offset+octet-stream), capped while streaming.
+    buf = bytearray()
+    async for piece in request.stream():
+        buf.extend(piece)
+        if len(buf) > settings.upload_chunk_max_bytes:
+            raise ValidationError("Chunk too large")
+
+    def _append() -> UploadSession:
+        # Chunk encryption and the session UPDATE/commit run in the threadpool, not on the loop.
+        append_chunk(db, current_user, upload_id, offset=upload_offset, data=bytes(buf))
+        return get_upload(db, current_user, upload_id)
+
+    return _upload_status(await run_in_threadpool(_append))
+
+
+@router.post("/uploads/{upload_id}/finalize", response_model=UploadStatus)
+def finalize_upload_session(
+    upload_id: str,
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_user),
+) -> UploadStatus:
+    return _upload_status(finalize_upload(db, current_user, upload_id))
+
+
+def _export_status(job: ExportJob) -> ExportJobStatus:
+    return ExportJobStatus(
+        id=job.id,
+        status=job.status,
+        encrypted=job.encrypted,
+        total_messages=job.total_messages,
+        exported_messages=job.exported_messages,
+        exported_bytes=job.exported_bytes,
+        created_at=job.created_at,
+        started_at=job.started_at,
+        finished_at=job.finished_at,
+    )
+
+
+@router.post("/exports", response_model=ExportJobStatus, status_code=201)
+def create_export(db: Session = Depends(get_db), current_user: User = Depends(get_current_user)) -> ExportJobStatus:
+    return _export_status(create_export_job(db, current_user))
+
+
+@router.get("/exports/{job_id}", response_model=ExportJobStatus)
+def export_status(job_id: str, db: Session = Depends(get_read_db), current_user: User = Depends(get_current_user_read_only)) -> ExportJobStatus:
+    # Progress is committed once per page while the download streams.
+    return _export_status(get_export_job(db, current_user, job_id))
+
+
+@router.get("/exports/{job_id}/download")
+def download_export(
+    job_id: str,
+    export_key: str | None = Header(default=None, alias="X-Export-Key"),
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_user),
+):
+    # Optional base64 AES-256 key: members are re-encrypted to it instead of sent in clear.
+    key = parse_export_key(export_key)
+    job = start_export_job(db, current_user, job_id, encrypted=key is not None)
+    headers = {"Content-Disposition": _content_disposition_attachment(f"mailbox-export-{job.id}.tar")}
+    return StreamingResponse(stream_export(job.id, current_user.id, key, job.owner_token), media_type="application/x-tar", headers=headers)
+
+
+@router.post("/{message_id}/forward", response_model=SendMessageResponse)
+async def forward(
+    message_id: str,
+    request: Request,
+    recipients: str = Form(...),
+    subject: str | None = Form(default=None, max_length=200),
+    body: str = Form(default="", max_length=20000),
+    attachment_ids: str | None = Form(default=None),
+    files: list[UploadFile] = File(default=[]),
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_user),
+) -> SendMessageResponse:
+    # attachment_ids: JSON list of the original's attachment ids to carry over (default: all).
+    await _send_limiter.check_async(f"send:{_client_ip(request)}")
+
+    file_tuples = await _read_uploads(files)
+
+    # Unwrapping, HMAC and the commit run in the threadpool, not on the event loop.
+    m = await run_in_threadpool(
+        forward_message,
+        db=db,
+        user=current_user,
+        message_id=message_id,
+        recipients_json=recipients,
+        subject=subject,
+        body=body,
+        attachment_ids_json=attachment_ids,
+        files=file_tuples,
+    )
+    return SendMessageResponse(id=m.id)
+
+
+@router.post("/{message_id}/reply", response_model=SendMessageResponse)
+async def reply(
+    message_id: str,
+    request: Request,
+    subject: str | None = Form(default=None, max_length=200),
+    body: str = Form(..., max_length=20000),
+    files: list[UploadFile] = File(default=[]),
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_user),
+) -> SendMessageResponse:
+    await _send_limiter.check_async(f"send:{_client_ip(request)}")
+
+    file_tuples = await _read_uploads(files)
+
+    m = await run_in_threadpool(
+        reply_to_message, db=db, user=current_user, message_id=message_id, subject=subject, body=body, files=file_tuples
+    )
     return SendMessageResponse(id=m.id)
 
 
 @router.get("/inbox", response_model=list[InboxMessageItem])
-def inbox(db: Session = Depends(get_db), current_user: User = Depends(get_current_user)) -> list[InboxMessageItem]:
-    rows = list_inbox(db, current_user)
+async def inbox(db: AsyncSession = Depends(get_async_db), current_user: User = Depends(get_current_user_async)) -> list[InboxMessageItem]:
+    rows = await list_inbox_async(db, current_user)
     out: list[InboxMessageItem] = []
     for mr, m, sender, has_att in rows:
         out.append(
@@ -113,17 +379,46 @@ def inbox(db: Session = Depends(get_db), current_user: User = Depends(get_curren
 
 
 @router.get("/sent", response_model=list[SentMessageItem])
-def sent(db: Session = Depends(get_db), current_user: User = Depends(get_current_user)) -> list[SentMessageItem]:
-    rows = list_sent(db, current_user)
+async def sent(db: AsyncSession = Depends(get_async_db), current_user: User = Depends(get_current_user_async)) -> list[SentMessageItem]:
+    rows = await list_sent_async(db, current_user)
     out: list[SentMessageItem] = []
     for m, rcpt_count, has_att in rows:
         out.append(SentMessageItem(id=m.id, created_at=m.created_at, recipients_count=rcpt_count, has_attachments=has_att))
     return out
 
 
+@router.get("/threads/{thread_id}", response_model=ThreadPage)
+def thread(
+    thread_id: str,
+    after: str | None = Query(default=None),
+    limit: int = Query(default=50, ge=1, le=200),
+    db: Session = Depends(get_read_db),
+    current_user: User = Depends(get_current_user_read_only),
+) -> ThreadPage:
+    rows, read_states, next_cursor = list_thread(db, current_user, thread_id, after=after, limit=limit)
+    items = [
+        ThreadMessageItem(
+            id=mid,
+            sender_username=sender_username,
+            created_at=created_at,
+            in_reply_to=reply_to,
+            has_attachments=has_att,
+            read=read,
+            participants=[
+                ThreadParticipantState(username=username, read=read_at is not None, read_at=read_at)
+                for username, read_at in read_states.get(mid, [])
+            ],
+        )
+        for mid, sender_username, created_at, reply_to, has_att, read in rows
+    ]
+    return ThreadPage(thread_id=thread_id, items=items, next_cursor=next_cursor)
+
+
 @router.get("/{message_id}", response_model=MessageDetail)
-def detail(message_id: str, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)) -> MessageDetail:
-    m, sender, attachments, subject, body, ok = read_message_detail(db, current_user, message_id)
+async def detail(
+    message_id: str, db: AsyncSession = Depends(get_async_db), current_user: User = Depends(get_current_user_async)
+) -> MessageDetail:
+    m, sender, attachments, subject, body, ok = await read_message_detail_async(db, current_user, message_id)
     metas = [
         AttachmentMeta(id=a.id, filename=a.filename, content_type=a.content_type, size_bytes=a.size_bytes)
         for a in attachments
@@ -136,6 +431,8 @@ def detail(message_id: str, db: Session = Depends(get_db), current_user: User =
         body=body,
         attachments=metas,
         authenticity_verified=ok,
+        thread_id=m.thread_id or m.id,
+        in_reply_to=m.in_reply_to,
     )
 
 
@@ -149,10 +446,13 @@ def delete(message_id: str, db: Session = Depends(get_db), current_user: User =
 def get_attachment(
     message_id: str,
     attachment_id: str,
-    db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_read_db),
+    current_user: User = Depends(get_current_user_read_only),
 ):
-    filename, _content_type, data = download_attachment(db, current_user, message_id, attachment_id)
-    headers = {"Content-Disposition": _content_disposition_attachment(filename)}
+    filename, _content_type, size_bytes, chunks = download_attachment(db, current_user, message_id, attachment_id)
+    headers = {
+        "Content-Disposition": _content_disposition_attachment(filename),
+        "Content-Length": str(size_bytes),
+    }
     # Force download and avoid reflecting attacker-controlled types.
-    return Response(content=data, media_type="application/octet-stream", headers=headers)
+    return StreamingResponse(chunks, media_type="application/octet-stream", headers=headers)
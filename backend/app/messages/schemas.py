@@ -40,6 +40,57 @@ class MessageDetail(BaseModel):
     body: str
     attachments: list[AttachmentMeta]
     authenticity_verified: bool
+    thread_id: str | None = None
+    in_reply_to: str | None = None
+
+
+class ThreadParticipantState(BaseModel):
+    username: str
+    read: bool
+    read_at: datetime | None = None
+
+
+class ThreadMessageItem(BaseModel):
+    id: str
+    sender_username: str
+    created_at: datetime
+    in_reply_to: str | None = None
+    has_attachments: bool
+    read: bool
+    participants: list[ThreadParticipantState]
+
+
+class ThreadPage(BaseModel):
+    thread_id: str
+    items: list[ThreadMessageItem]
+    # Pass as `after` to fetch the next page; null when the thread is exhausted.
+    next_cursor: str | None = None
+
+
+class CreateUploadRequest(BaseModel):
+    filename: str = Field(min_length=1, max_length=255)
+    content_type: str = Field(default="application/octet-stream", max_length=255)
+    size_bytes: int = Field(gt=0)
+
+
+class UploadStatus(BaseModel):
+    id: str
+    status: str
+    offset: int
+    size_bytes: int
+    expires_at: datetime
+
+
+class ExportJobStatus(BaseModel):
+    id: str
+    status: str
+    encrypted: bool
+    total_messages: int
+    exported_messages: int
+    exported_bytes: int
+    created_at: datetime
+    started_at: datetime | None = None
+    finished_at: datetime | None = None
 
 
 class DeleteResponse(BaseModel):
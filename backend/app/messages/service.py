@@ -1,26 +1,55 @@
 from __future__ import annotations
 
 import datetime as dt
+import hashlib
 import json
+import logging
 import os
 import re
 import uuid
+from collections.abc import Iterator
 
-from sqlalchemy import and_, select
-from sqlalchemy.orm import Session
+from sqlalchemy import and_, delete, exists, func, insert, or_, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session, joinedload
 
 from app.core.config import settings
-from app.core.exceptions import AuthorizationError, IntegrityError, ValidationError
+from app.core.exceptions import AuthorizationError, ConflictError, IntegrityError, ValidationError
+from app.core.tracing import span
 from app.crypto.aes_gcm import AesGcmCipher
 from app.crypto.hmac_sha256 import constant_time_equals, hmac_sha256
 from app.crypto.key_management import generate_aes256_key
-from app.db.models import Attachment, Message, MessageRecipient, User, utcnow
+from app.crypto.offload import run_crypto
+from app.db.models import Attachment, AttachmentBlob, Message, MessageRecipient, User, utcnow
+from app.db.shards import mailbox_entity, mailbox_sharded, mailbox_table, mailbox_writer, shard_for, shard_table
+from app.db.write_queue import run_shard_writes, run_write, run_write_async
+from app.keyservice.base import RING_DATA, RING_USER_HMAC, UnwrapItem, get_key_service
+from app.messages.idempotency import complete_idempotency_key
+from app.messages.payload import PAYLOAD_FORMAT_RAW, decode_payload, encode_payload, iter_decoded
+
+
+logger = logging.getLogger(__name__)
+
+# Router caps the body at 20000 characters; UTF-8 needs at most 4 bytes per character.
+_MAX_BODY_BYTES = 20000 * 4
 
 
 def _aad(purpose: str, *parts: str) -> bytes:
     return (purpose + ":" + ":".join(parts)).encode("utf-8")
 
 
+def _not_expired():
+    # Self-destructed messages disappear immediately, before the purge worker removes them.
+    return or_(Message.expires_at.is_(None), Message.expires_at > utcnow())
+
+
+def _payload_aad(purpose: str, payload_format: int, *parts: str) -> bytes:
+    # Legacy (raw) payloads keep their original AAD; compressed ones bind the format so it cannot be swapped.
+    if payload_format == PAYLOAD_FORMAT_RAW:
+        return _aad(purpose, *parts)
+    return _aad(purpose, *parts, f"fmt{payload_format}")
+
+
 def _safe_filename(name: str) -> str:
     # Prevent path traversal and header injection in Content-Disposition contexts.
     name = (name or "").replace("\x00", "")
@@ -67,18 +96,18 @@ def _message_hmac_payload(
     attachments: list[Attachment],
 ) -> bytes:
     parts: list[bytes] = []
-    parts.append(b"v1")
+    parts.append(b"v1" if message.hmac_format == 1 else b"v2")
     parts.append(message.id.encode("utf-8"))
     parts.append(message.sender_user_id.encode("utf-8"))
     for rid in recipient_ids_sorted:
         parts.append(rid.encode("utf-8"))
 
-    # Include all encrypted fields
+    # Include all encrypted fields. v2 leaves out the KEK-wrapped DEK: GCM already binds it
+    # to the message id, and leaving it out lets KEK rotation re-wrap it without re-signing.
+    if message.hmac_format == 1:
+        parts.extend([message.content_key_enc, message.content_key_nonce, message.content_key_tag])
     parts.extend(
         [
-            message.content_key_enc,
-            message.content_key_nonce,
-            message.content_key_tag,
             message.subject_ciphertext,
             message.subject_nonce,
             message.subject_tag,
@@ -94,35 +123,48 @@ def _message_hmac_payload(
         parts.append(a.filename.encode("utf-8"))
         parts.append(a.content_type.encode("utf-8"))
         parts.append(str(a.size_bytes).encode("utf-8"))
-        parts.append(a.blob_ciphertext)
-        parts.append(a.blob_nonce)
-        parts.append(a.blob_tag)
+        if a.blob_id is None:
+            parts.append(a.blob_ciphertext)
+            parts.append(a.blob_nonce)
+            parts.append(a.blob_tag)
+        else:
+            # Shared blob: cover the wrapped key and the stored ciphertext digest, not the bytes.
+            blob = a.blob
+            parts.extend(
+                [
+                    b"blob",
+                    a.blob_id.encode("utf-8"),
+                    a.blob_key_enc or b"",
+                    a.blob_key_nonce or b"",
+                    a.blob_key_tag or b"",
+                    blob.ciphertext_sha256,
+                    blob.nonce,
+                    blob.tag,
+                ]
+            )
 
     return _encode_len_prefixed(parts)
 
 
-def _decrypt_user_hmac_key(user: User) -> bytes:
+def _user_hmac_key_item(user: User) -> UnwrapItem:
     if user.hmac_key_enc is None or user.hmac_key_nonce is None or user.hmac_key_tag is None:
         raise IntegrityError("missing hmac key")
+    return UnwrapItem(user.hmac_key_version, user.hmac_key_enc, user.hmac_key_nonce, user.hmac_key_tag, _aad("users:hmac_key", user.id))
 
-    cipher = AesGcmCipher(settings.user_hmac_kek_bytes)
-    return cipher.decrypt(
-        user.hmac_key_enc,
-        user.hmac_key_nonce,
-        user.hmac_key_tag,
-        aad=_aad("users:hmac_key", user.id),
-    )
 
+def _decrypt_user_hmac_key(user: User) -> bytes:
+    with span("keys.unwrap_hmac_key"):
+        return get_key_service().unwrap_many(RING_USER_HMAC, [_user_hmac_key_item(user)])[0]
 
-def send_message(
-    *,
-    db: Session,
-    sender: User,
-    recipients_json: str,
-    subject: str,
-    body: str,
-    files: list[tuple[str, str, bytes]],
-) -> Message:
+
+def _resolve_recipients(db: Session, sender: User, recipients_json: str) -> list[str]:
+    with span("messages.resolve_recipients") as s:
+        recipient_ids = _resolve_recipient_ids(db, sender, recipients_json)
+        s.set("recipients", len(recipient_ids))
+        return recipient_ids
+
+
+def _resolve_recipient_ids(db: Session, sender: User, recipients_json: str) -> list[str]:
     try:
         recipients_raw = json.loads(recipients_json)
     except json.JSONDecodeError as exc:
@@ -158,7 +200,144 @@ def send_message(
         # allow self-send only if explicitly needed; keep minimal: reject.
         raise ValidationError("Invalid recipients")
 
-    recipient_ids_sorted = sorted(uniq.keys())
+    return sorted(uniq.keys())
+
+
+def _new_blob(data: bytes, content_type: str, now: dt.datetime) -> tuple[AttachmentBlob, bytes]:
+    # Each blob gets its own key so it can be shared by re-wrapping 32 bytes instead of re-encrypting.
+    # The caller adds the row to its session.
+    blob_id = str(uuid.uuid4())
+    blob_key = generate_aes256_key()
+    payload_format, plain = encode_payload(data, content_type)
+    enc = AesGcmCipher(blob_key).encrypt(plain, aad=_payload_aad("attachment_blobs:data", payload_format, blob_id))
+    blob = AttachmentBlob(
+        id=blob_id,
+        ciphertext=enc.ciphertext,
+        nonce=enc.nonce,
+        tag=enc.tag,
+        payload_format=payload_format,
+        ciphertext_sha256=hashlib.sha256(enc.ciphertext).digest(),
+        ref_count=1,
+        created_at=now,
+    )
+    return blob, blob_key
+
+
+def _add_blob_ref(db: Session, blob: AttachmentBlob) -> None:
+    # Atomic increment: concurrent forwards of the same blob must not lose updates. A purge
+    # may have released the last reference (and deleted the blob) since `blob` was read.
+    added = db.execute(
+        update(AttachmentBlob)
+        .where(AttachmentBlob.id == blob.id)
+        .where(AttachmentBlob.ref_count > 0)
+        .values(ref_count=AttachmentBlob.ref_count + 1)
+    ).rowcount
+    if added != 1:
+        raise ConflictError("Attachment no longer available")
+
+
+def _release_blob(db: Session, blob_id: str) -> None:
+    db.execute(update(AttachmentBlob).where(AttachmentBlob.id == blob_id).values(ref_count=AttachmentBlob.ref_count - 1))
+    db.execute(delete(AttachmentBlob).where(AttachmentBlob.id == blob_id).where(AttachmentBlob.ref_count <= 0))
+
+
+def _unwrap_blob_key(dek_cipher: AesGcmCipher, a: Attachment) -> bytes:
+    if a.blob_key_enc is None or a.blob_key_nonce is None or a.blob_key_tag is None:
+        raise IntegrityError("missing blob key")
+    return dek_cipher.decrypt(a.blob_key_enc, a.blob_key_nonce, a.blob_key_tag, aad=_aad("attachments:blob_key", a.message_id, a.id))
+
+
+def _iter_attachment_plaintext(dek_cipher: AesGcmCipher, a: Attachment) -> Iterator[bytes]:
+    if a.blob_id is None:
+        payload_format = a.blob_format
+        payload = _decrypt_legacy_blob(dek_cipher, a)
+    else:
+        blob = a.blob
+        blob_key = _unwrap_blob_key(dek_cipher, a)
+        payload_format = blob.payload_format
+        payload = AesGcmCipher(blob_key).decrypt(
+            blob.ciphertext,
+            blob.nonce,
+            blob.tag,
+            aad=_payload_aad("attachment_blobs:data", blob.payload_format, blob.id),
+        )
+    return iter_decoded(payload_format, payload, max_bytes=a.size_bytes)
+
+
+def _decrypt_legacy_blob(dek_cipher: AesGcmCipher, a: Attachment) -> bytes:
+    return dek_cipher.decrypt(
+        a.blob_ciphertext,
+        a.blob_nonce,
+        a.blob_tag,
+        aad=_payload_aad("attachments:blob", a.blob_format, a.message_id, a.id),
+    )
+
+
+def _share_legacy_attachment(db: Session, src: Attachment, src_dek_cipher: AesGcmCipher, now: dt.datetime) -> tuple[AttachmentBlob, bytes]:
+    """Move a legacy inline attachment into a shared blob that the source row references too.
+
+    The blob is added to `db` with a reference for the source row and one for the caller's
+    new attachment; the source message is re-signed over the blob reference. Later forwards
+    then share the blob instead of copying it. A source whose HMAC does not verify is left
+    untouched (its evidence is kept) and the caller gets a private copy, as does the loser
+    of two concurrent first forwards.
+    """
+
+    data = decode_payload(src.blob_format, _decrypt_legacy_blob(src_dek_cipher, src), max_bytes=src.size_bytes)
+    blob, blob_key = _new_blob(data, src.content_type, now)
+    db.add(blob)
+
+    source = db.get(Message, src.message_id)
+    sender = db.get(User, source.sender_user_id) if source is not None else None
+    if sender is None or not _verify_authenticity(db, source, sender):
+        return blob, blob_key
+
+    db.flush()
+    wrapped = src_dek_cipher.encrypt(blob_key, aad=_aad("attachments:blob_key", src.message_id, src.id))
+    moved = db.execute(
+        update(Attachment)
+        .where(Attachment.id == src.id)
+        .where(Attachment.blob_id.is_(None))
+        .values(
+            blob_id=blob.id,
+            blob_key_enc=wrapped.ciphertext,
+            blob_key_nonce=wrapped.nonce,
+            blob_key_tag=wrapped.tag,
+            blob_ciphertext=b"",
+            blob_nonce=b"",
+            blob_tag=b"",
+            blob_format=0,
+        )
+    ).rowcount
+    if moved:
+        blob.ref_count = 2
+        db.expire(src)
+        _sign_stored_message(db, source, sender)
+    return blob, blob_key
+
+
+def _create_message(
+    *,
+    db: Session,
+    sender: User,
+    recipient_ids_sorted: list[str],
+    subject: str,
+    body: str,
+    files: list[tuple[str, str, bytes]],
+    forwarded: list[tuple[Attachment, AesGcmCipher]] | None = None,
+    staged: list[tuple[AttachmentBlob, bytes, str, str, int]] | None = None,
+    thread_id: str | None = None,
+    in_reply_to: str | None = None,
+    idempotency_key: str | None = None,
+    idempotency_owner: str | None = None,
+    ttl_seconds: int | None = None,
+) -> Message:
+    forwarded = forwarded or []
+    staged = staged or []
+    if len(files) + len(forwarded) + len(staged) > settings.max_attachments_per_message:
+        raise ValidationError("Too many attachments")
+    if ttl_seconds is not None and not (0 < ttl_seconds <= settings.max_message_ttl_seconds):
+        raise ValidationError("Invalid ttl")
 
     now = utcnow()
     message_id = str(uuid.uuid4())
@@ -166,13 +345,13 @@ def send_message(
     # Envelope encryption
     dek = generate_aes256_key()
 
-    kek_cipher = AesGcmCipher(settings.data_key_bytes)
-    dek_enc = kek_cipher.encrypt(dek, aad=_aad("messages:dek", message_id))
+    dek_version, dek_enc = get_key_service().wrap(RING_DATA, dek, _aad("messages:dek", message_id))
 
     dek_cipher = AesGcmCipher(dek)
 
     subject_enc = dek_cipher.encrypt(subject.encode("utf-8"), aad=_aad("messages:subject", message_id))
-    body_enc = dek_cipher.encrypt(body.encode("utf-8"), aad=_aad("messages:body", message_id))
+    body_format, body_plain = encode_payload(body.encode("utf-8"), "text/plain")
+    body_enc = dek_cipher.encrypt(body_plain, aad=_payload_aad("messages:body", body_format, message_id))
 
     message = Message(
         id=message_id,
@@ -180,34 +359,66 @@ def send_message(
         content_key_enc=dek_enc.ciphertext,
         content_key_nonce=dek_enc.nonce,
         content_key_tag=dek_enc.tag,
+        content_key_version=dek_version,
         subject_ciphertext=subject_enc.ciphertext,
         subject_nonce=subject_enc.nonce,
         subject_tag=subject_enc.tag,
         body_ciphertext=body_enc.ciphertext,
         body_nonce=body_enc.nonce,
         body_tag=body_enc.tag,
+        body_format=body_format,
         hmac_sha256=b"",  # set after attachments are ready
+        hmac_format=2,
+        thread_id=thread_id or message_id,
+        in_reply_to=in_reply_to,
         created_at=now,
         deleted_by_sender_at=None,
+        expires_at=now + dt.timedelta(seconds=ttl_seconds) if ttl_seconds is not None else None,
     )
 
-    db.add(message)
-
-    # Recipients rows
-    for rid in recipient_ids_sorted:
-        db.add(
-            MessageRecipient(
-                message_id=message_id,
-                recipient_user_id=rid,
-                delivered_at=now,
-                read_at=None,
-                deleted_at=None,
-                authenticity_verified=False,
+    # New rows are collected and added in one go by the commit step below.
+    rows: list[object] = [message]
+
+    # Recipients rows (sharded mailboxes get theirs in _deliver_to_shards instead)
+    if not mailbox_sharded():
+        for rid in recipient_ids_sorted:
+            rows.append(
+                MessageRecipient(
+                    message_id=message_id,
+                    recipient_user_id=rid,
+                    delivered_at=now,
+                    read_at=None,
+                    deleted_at=None,
+                    authenticity_verified=False,
+                )
             )
+
+    attachments: list[Attachment] = []
+
+    def _attach(blob: AttachmentBlob, blob_key: bytes, filename: str, content_type: str, size_bytes: int) -> None:
+        att_id = str(uuid.uuid4())
+        wrapped = dek_cipher.encrypt(blob_key, aad=_aad("attachments:blob_key", message_id, att_id))
+        a = Attachment(
+            id=att_id,
+            message_id=message_id,
+            filename=filename,
+            content_type=content_type,
+            size_bytes=size_bytes,
+            blob_ciphertext=b"",
+            blob_nonce=b"",
+            blob_tag=b"",
+            blob_format=0,
+            blob_id=blob.id,
+            blob_key_enc=wrapped.ciphertext,
+            blob_key_nonce=wrapped.nonce,
+            blob_key_tag=wrapped.tag,
+            created_at=now,
         )
+        a.blob = blob
+        attachments.append(a)
+        rows.append(a)
 
     # Attachments
-    attachments: list[Attachment] = []
     total_bytes = 0
     for original_filename, content_type, data in files:
         total_bytes += len(data)
@@ -216,60 +427,203 @@ def send_message(
         if total_bytes > settings.max_attachment_bytes:
             raise ValidationError("Attachments too large")
 
-        att_id = str(uuid.uuid4())
-        enc = dek_cipher.encrypt(data, aad=_aad("attachments:blob", message_id, att_id))
-        a = Attachment(
-            id=att_id,
-            message_id=message_id,
-            filename=_safe_filename(original_filename or "attachment"),
-            content_type=_sanitize_content_type(content_type),
-            size_bytes=len(data),
-            blob_ciphertext=enc.ciphertext,
-            blob_nonce=enc.nonce,
-            blob_tag=enc.tag,
-            created_at=now,
-        )
-        attachments.append(a)
-        db.add(a)
+        safe_content_type = _sanitize_content_type(content_type)
+        blob, blob_key = _new_blob(data, safe_content_type, now)
+        rows.append(blob)
+        _attach(blob, blob_key, _safe_filename(original_filename or "attachment"), safe_content_type, len(data))
+
+    # Finalized resumable uploads: the upload session's blob reference moves to the attachment.
+    for blob, blob_key, filename, content_type, size_bytes in staged:
+        total_bytes += size_bytes
+        if total_bytes > settings.max_attachment_bytes:
+            raise ValidationError("Attachments too large")
+        _attach(blob, blob_key, filename, content_type, size_bytes)
+
+    # Forwarded attachments: only the 32-byte blob key is re-wrapped under the new DEK.
+    for src, src_dek_cipher in forwarded:
+        total_bytes += src.size_bytes
+        if total_bytes > settings.max_attachment_bytes:
+            raise ValidationError("Attachments too large")
+
+        if src.blob_id is not None:
+            blob = src.blob
+            blob_key = _unwrap_blob_key(src_dek_cipher, src)
+            _add_blob_ref(db, blob)
+        else:
+            # Legacy inline attachment: moved into shared storage once, source row included.
+            blob, blob_key = _share_legacy_attachment(db, src, src_dek_cipher, now)
+        _attach(blob, blob_key, src.filename, src.content_type, src.size_bytes)
 
     # HMAC over integral message + attachments.
-    sender_hmac_key = _decrypt_user_hmac_key(sender)
-    payload = _message_hmac_payload(message=message, recipient_ids_sorted=recipient_ids_sorted, attachments=attachments)
-    message.hmac_sha256 = hmac_sha256(sender_hmac_key, payload)
+    with span("messages.sign_hmac"):
+        sender_hmac_key = _decrypt_user_hmac_key(sender)
+        payload = _message_hmac_payload(message=message, recipient_ids_sorted=recipient_ids_sorted, attachments=attachments)
+        message.hmac_sha256 = hmac_sha256(sender_hmac_key, payload)
+
+    def _persist(s: Session) -> Message:
+        s.add_all(rows)
+        if idempotency_key is not None:
+            complete_idempotency_key(s, sender.id, idempotency_key, idempotency_owner, message_id)
+        return message
+
+    # Claimed uploads and forwarded blob references are already written in this session's
+    # transaction (and reference its objects), so those sends commit here.
+    if not mailbox_sharded():
+        return run_write(db, _persist, grouped=not (forwarded or staged))
+
+    delivered = _deliver_to_shards(message_id, recipient_ids_sorted, now)
+    try:
+        return run_write(db, _persist, grouped=not (forwarded or staged))
+    except Exception:
+        _undeliver(message_id, delivered)
+        raise
+
+
+def _deliver_to_shards(message_id: str, recipient_ids: list[str], now: dt.datetime) -> list[int]:
+    # Recipient rows are written first, all shards in parallel. Until the message row
+    # commits they are invisible: every mailbox read joins them to messages.
+    by_shard: dict[int, list[dict]] = {}
+    for rid in recipient_ids:
+        by_shard.setdefault(shard_for(rid), []).append(
+            {
+                "message_id": message_id,
+                "recipient_user_id": rid,
+                "delivered_at": now,
+                "read_at": None,
+                "deleted_at": None,
+                "authenticity_verified": False,
+            }
+        )
+    with span("messages.deliver") as s:
+        s.set("shards", len(by_shard))
+        run_shard_writes({k: (lambda sess, k=k, values=values: sess.execute(insert(shard_table(k)), values)) for k, values in by_shard.items()})
+    return list(by_shard)
 
-    db.commit()
-    db.refresh(message)
-    return message
+
+def _undeliver(message_id: str, shards: list[int]) -> None:
+    # Best effort: rows left behind stay invisible (no message row) and unreferenced.
+    try:
+        run_shard_writes(
+            {k: (lambda sess, k=k: sess.execute(delete(shard_table(k)).where(shard_table(k).c.message_id == message_id))) for k in shards}
+        )
+    except Exception:  # noqa: BLE001 - the send's own error is the one to report
+        logger.exception("Could not remove mailbox rows of failed send %s", message_id)
 
 
-def _decrypt_dek(message: Message) -> bytes:
-    kek_cipher = AesGcmCipher(settings.data_key_bytes)
-    return kek_cipher.decrypt(
+def send_message(
+    *,
+    db: Session,
+    sender: User,
+    recipients_json: str,
+    subject: str,
+    body: str,
+    files: list[tuple[str, str, bytes]],
+    staged: list[tuple[AttachmentBlob, bytes, str, str, int]] | None = None,
+    idempotency_key: str | None = None,
+    idempotency_owner: str | None = None,
+    ttl_seconds: int | None = None,
+) -> Message:
+    recipient_ids_sorted = _resolve_recipients(db, sender, recipients_json)
+    return _create_message(
+        db=db,
+        sender=sender,
+        recipient_ids_sorted=recipient_ids_sorted,
+        subject=subject,
+        body=body,
+        files=files,
+        staged=staged,
+        idempotency_key=idempotency_key,
+        idempotency_owner=idempotency_owner,
+        ttl_seconds=ttl_seconds,
+    )
+
+
+def _dek_item(message: Message) -> UnwrapItem:
+    return UnwrapItem(
+        message.content_key_version,
         message.content_key_enc,
         message.content_key_nonce,
         message.content_key_tag,
-        aad=_aad("messages:dek", message.id),
+        _aad("messages:dek", message.id),
     )
 
 
+def _decrypt_dek(message: Message) -> bytes:
+    with span("keys.unwrap_dek"):
+        return get_key_service().unwrap_many(RING_DATA, [_dek_item(message)])[0]
+
+
+def _unwrap_message_keys(message: Message, sender: User) -> tuple[bytes, bytes]:
+    # The sender's HMAC key and the DEK in one key-service call (one round trip to a sidecar).
+    with span("keys.unwrap_message_keys"):
+        (sender_hmac_key,), (dek,) = get_key_service().unwrap_rings(
+            [(RING_USER_HMAC, [_user_hmac_key_item(sender)]), (RING_DATA, [_dek_item(message)])]
+        )
+    return sender_hmac_key, dek
+
+
 def _verify_authenticity(db: Session, message: Message, sender: User) -> bool:
+    with span("messages.verify_hmac") as s:
+        ok = _verify_hmac(db, message, sender)
+        s.set("verified", ok)
+        return ok
+
+
+def _verify_hmac(db: Session, message: Message, sender: User) -> bool:
     recipients = db.execute(select(MessageRecipient).where(MessageRecipient.message_id == message.id)).scalars().all()
     recipient_ids_sorted = sorted([r.recipient_user_id for r in recipients])
     attachments = db.execute(select(Attachment).where(Attachment.message_id == message.id)).scalars().all()
+    return _hmac_matches(message, _decrypt_user_hmac_key(sender), recipient_ids_sorted, attachments)
+
 
-    sender_hmac_key = _decrypt_user_hmac_key(sender)
+def _hmac_matches(message: Message, sender_hmac_key: bytes, recipient_ids_sorted: list[str], attachments: list[Attachment]) -> bool:
     payload = _message_hmac_payload(message=message, recipient_ids_sorted=recipient_ids_sorted, attachments=attachments)
     expected = hmac_sha256(sender_hmac_key, payload)
     return constant_time_equals(expected, message.hmac_sha256)
 
 
+def _upgrade_message_hmac(db: Session, message: Message) -> bool:
+    """Re-sign a verified v1 message with the v2 payload so its DEK can be re-wrapped (caller commits).
+
+    Returns False (and leaves the message untouched) when the v1 HMAC does not verify.
+    """
+
+    if message.hmac_format != 1:
+        return True
+    sender = db.get(User, message.sender_user_id)
+    if sender is None or not _verify_authenticity(db, message, sender):
+        return False
+
+    message.hmac_format = 2
+    attachments = _sign_stored_message(db, message, sender)
+    # Legacy attachments carry their ciphertext inline; do not hold them for a whole batch.
+    for a in attachments:
+        db.expunge(a)
+    return True
+
+
+def _sign_stored_message(db: Session, message: Message, sender: User) -> list[Attachment]:
+    """Recompute the HMAC of a stored message over its current rows (caller verified it first)."""
+
+    recipient_ids_sorted = sorted(
+        db.execute(select(MessageRecipient.recipient_user_id).where(MessageRecipient.message_id == message.id)).scalars()
+    )
+    attachments = db.execute(select(Attachment).where(Attachment.message_id == message.id)).scalars().all()
+    payload = _message_hmac_payload(message=message, recipient_ids_sorted=recipient_ids_sorted, attachments=attachments)
+    message.hmac_sha256 = hmac_sha256(_decrypt_user_hmac_key(sender), payload)
+    db.flush()
+    return attachments
+
+
 def list_inbox(db: Session, user: User) -> list[tuple[MessageRecipient, Message, User, bool]]:
+    mr = mailbox_entity(user.id)
     q = (
-        select(MessageRecipient, Message, User)
-        .join(Message, Message.id == MessageRecipient.message_id)
+        select(mr, Message, User)
+        .join(Message, Message.id == mr.message_id)
         .join(User, User.id == Message.sender_user_id)
-        .where(MessageRecipient.recipient_user_id == user.id)
-        .where(MessageRecipient.deleted_at.is_(None))
+        .where(mr.recipient_user_id == user.id)
+        .where(mr.deleted_at.is_(None))
+        .where(_not_expired())
         .order_by(Message.created_at.desc())
     )
     rows = db.execute(q).all()
@@ -282,7 +636,13 @@ def list_inbox(db: Session, user: User) -> list[tuple[MessageRecipient, Message,
 
 
 def list_sent(db: Session, user: User) -> list[tuple[Message, int, bool]]:
-    q = select(Message).where(Message.sender_user_id == user.id).where(Message.deleted_by_sender_at.is_(None)).order_by(Message.created_at.desc())
+    q = (
+        select(Message)
+        .where(Message.sender_user_id == user.id)
+        .where(Message.deleted_by_sender_at.is_(None))
+        .where(_not_expired())
+        .order_by(Message.created_at.desc())
+    )
     messages = db.execute(q).scalars().all()
 
     out: list[tuple[Message, int, bool]] = []
@@ -293,8 +653,124 @@ def list_sent(db: Session, user: User) -> list[tuple[Message, int, bool]]:
     return out
 
 
+# Async variants for the async routes (app/db/async_session.py). One statement per list:
+# the per-row attachment and recipient lookups of list_inbox/list_sent become correlated
+# subqueries, since every round trip is an await through the driver thread.
+
+
+async def list_inbox_async(db: AsyncSession, user: User) -> list[tuple[MessageRecipient, Message, User, bool]]:
+    mr = mailbox_entity(user.id)
+    has_attachments = exists(select(Attachment.id).where(Attachment.message_id == Message.id))
+    q = (
+        select(mr, Message, User, has_attachments)
+        .join(Message, Message.id == mr.message_id)
+        .join(User, User.id == Message.sender_user_id)
+        .where(mr.recipient_user_id == user.id)
+        .where(mr.deleted_at.is_(None))
+        .where(_not_expired())
+        .order_by(Message.created_at.desc())
+    )
+    rows = (await db.execute(q)).all()
+    return [(mr, m, sender, bool(has_att)) for mr, m, sender, has_att in rows]
+
+
+async def list_sent_async(db: AsyncSession, user: User) -> list[tuple[Message, int, bool]]:
+    rcpt_count = (
+        select(func.count())
+        .select_from(MessageRecipient)
+        .where(MessageRecipient.message_id == Message.id)
+        .scalar_subquery()
+    )
+    has_attachments = exists(select(Attachment.id).where(Attachment.message_id == Message.id))
+    q = (
+        select(Message, rcpt_count, has_attachments)
+        .where(Message.sender_user_id == user.id)
+        .where(Message.deleted_by_sender_at.is_(None))
+        .where(_not_expired())
+        .order_by(Message.created_at.desc())
+    )
+    rows = (await db.execute(q)).all()
+    return [(m, int(count), bool(has_att)) for m, count, has_att in rows]
+
+
+def list_thread(
+    db: Session,
+    user: User,
+    thread_id: str,
+    *,
+    after: str | None = None,
+    limit: int = 50,
+) -> tuple[list[tuple[str, str, dt.datetime, str | None, bool, bool]], dict[str, list[tuple[str, dt.datetime | None]]], str | None]:
+    """Page through the messages of a thread visible to `user`, oldest first.
+
+    Returns (rows, read_states, next_cursor) where rows are
+    (message_id, sender_username, created_at, in_reply_to, has_attachments, read_by_user)
+    and read_states maps message_id -> [(recipient_username, read_at)].
+    Uses idx_messages_thread_created; ciphertext columns are never loaded.
+    """
+
+    mr = mailbox_entity(user.id)
+    own_rcpt = (
+        select(mr.read_at)
+        .where(mr.message_id == Message.id)
+        .where(mr.recipient_user_id == user.id)
+        .where(mr.deleted_at.is_(None))
+    )
+    is_recipient = exists(own_rcpt)
+    is_sender = and_(Message.sender_user_id == user.id, Message.deleted_by_sender_at.is_(None))
+    has_attachments = exists(select(Attachment.id).where(Attachment.message_id == Message.id))
+
+    q = (
+        select(
+            Message.id,
+            User.username,
+            Message.created_at,
+            Message.in_reply_to,
+            has_attachments,
+            own_rcpt.limit(1).scalar_subquery(),
+            is_recipient,
+        )
+        .join(User, User.id == Message.sender_user_id)
+        .where(Message.thread_id == thread_id)
+        .where(_not_expired())
+        .where(or_(is_sender, is_recipient))
+        .order_by(Message.created_at, Message.id)
+        .limit(limit + 1)
+    )
+
+    if after is not None:
+        cursor = db.execute(select(Message.created_at).where(Message.id == after).where(Message.thread_id == thread_id)).first()
+        if cursor is None:
+            raise ValidationError("Invalid cursor")
+        q = q.where(or_(Message.created_at > cursor[0], and_(Message.created_at == cursor[0], Message.id > after)))
+
+    fetched = db.execute(q).all()
+    if not fetched and after is None:
+        raise AuthorizationError("not found")
+
+    next_cursor = fetched[limit - 1][0] if len(fetched) > limit else None
+    rows = [
+        # Own messages count as read; as a recipient the read marker decides.
+        (mid, sender_username, created_at, reply_to, bool(has_att), (not rcpt) or own_read_at is not None)
+        for mid, sender_username, created_at, reply_to, has_att, own_read_at, rcpt in fetched[:limit]
+    ]
+
+    read_states: dict[str, list[tuple[str, dt.datetime | None]]] = {r[0]: [] for r in rows}
+    if rows:
+        states = db.execute(
+            select(MessageRecipient.message_id, User.username, MessageRecipient.read_at)
+            .join(User, User.id == MessageRecipient.recipient_user_id)
+            .where(MessageRecipient.message_id.in_(list(read_states)))
+            .order_by(User.username)
+        ).all()
+        for mid, username, read_at in states:
+            read_states[mid].append((username, read_at))
+
+    return rows, read_states, next_cursor
+
+
 def get_message_for_user(db: Session, user: User, message_id: str) -> tuple[Message, User, MessageRecipient | None]:
-    m = db.get(Message, message_id)
+    m = db.execute(select(Message).where(Message.id == message_id).where(_not_expired())).scalar_one_or_none()
     if m is None:
         raise AuthorizationError("not found")
 
@@ -305,11 +781,12 @@ def get_message_for_user(db: Session, user: User, message_id: str) -> tuple[Mess
     if m.sender_user_id == user.id:
         return m, sender, None
 
+    own = mailbox_entity(user.id)
     mr = db.execute(
-        select(MessageRecipient)
-        .where(MessageRecipient.message_id == message_id)
-        .where(MessageRecipient.recipient_user_id == user.id)
-        .where(MessageRecipient.deleted_at.is_(None))
+        select(own)
+        .where(own.message_id == message_id)
+        .where(own.recipient_user_id == user.id)
+        .where(own.deleted_at.is_(None))
     ).scalar_one_or_none()
 
     if mr is None:
@@ -321,26 +798,109 @@ def get_message_for_user(db: Session, user: User, message_id: str) -> tuple[Mess
 def read_message_detail(db: Session, user: User, message_id: str) -> tuple[Message, User, list[Attachment], str, str, bool]:
     m, sender, mr = get_message_for_user(db, user, message_id)
 
-    ok = _verify_authenticity(db, m, sender)
+    recipient_ids_sorted = sorted(
+        db.execute(select(MessageRecipient.recipient_user_id).where(MessageRecipient.message_id == message_id)).scalars()
+    )
+    attachments = db.execute(select(Attachment).where(Attachment.message_id == message_id)).scalars().all()
+
+    subject, body = _open_message(m, sender, recipient_ids_sorted, attachments)
+
+    if mr is not None and mr.read_at is None:
+        mark_read = _mark_read_statement(mr)
+        run_write(db, lambda s: s.execute(mark_read), shard=mailbox_writer(mr.recipient_user_id))
+
+    return m, sender, attachments, subject, body, True
+
+
+async def get_message_for_user_async(db: AsyncSession, user: User, message_id: str) -> tuple[Message, User, MessageRecipient | None]:
+    # get_message_for_user's three lookups as one statement (each await is a driver round trip).
+    own = mailbox_entity(user.id)
+    own_rcpt = and_(
+        own.message_id == Message.id,
+        own.recipient_user_id == user.id,
+        own.deleted_at.is_(None),
+    )
+    row = (
+        await db.execute(
+            select(Message, User, own)
+            .join(User, User.id == Message.sender_user_id)
+            .outerjoin(own, own_rcpt)
+            .where(Message.id == message_id)
+            .where(_not_expired())
+        )
+    ).first()
+    if row is None:
+        raise AuthorizationError("not found")
+
+    m, sender, mr = row
+    if m.sender_user_id == user.id:
+        return m, sender, None
+    if mr is None:
+        raise AuthorizationError("not found")
+    return m, sender, mr
+
+
+def _open_message(m: Message, sender: User, recipient_ids_sorted: list[str], attachments: list[Attachment]) -> tuple[str, str]:
+    # Everything CPU-bound (and the key service round trip) of a detail read, in one hop.
+    sender_hmac_key, dek = _unwrap_message_keys(m, sender)
+    with span("messages.verify_hmac") as s:
+        ok = _hmac_matches(m, sender_hmac_key, recipient_ids_sorted, attachments)
+        s.set("verified", ok)
     if not ok:
         raise IntegrityError("bad hmac")
+    return _decrypt_subject_body(m, dek)
 
-    attachments = db.execute(select(Attachment).where(Attachment.message_id == message_id)).scalars().all()
 
-    dek = _decrypt_dek(m)
-    dek_cipher = AesGcmCipher(dek)
+async def read_message_detail_async(db: AsyncSession, user: User, message_id: str) -> tuple[Message, User, list[Attachment], str, str, bool]:
+    m, sender, mr = await get_message_for_user_async(db, user, message_id)
 
-    subject = dek_cipher.decrypt(m.subject_ciphertext, m.subject_nonce, m.subject_tag, aad=_aad("messages:subject", m.id)).decode("utf-8")
-    body = dek_cipher.decrypt(m.body_ciphertext, m.body_nonce, m.body_tag, aad=_aad("messages:body", m.id)).decode("utf-8")
+    recipient_ids_sorted = sorted(
+        (await db.execute(select(MessageRecipient.recipient_user_id).where(MessageRecipient.message_id == message_id))).scalars()
+    )
+    # The HMAC covers shared blobs' digests; load them now (a lazy load cannot run off the loop).
+    attachments = list(
+        (
+            await db.execute(select(Attachment).where(Attachment.message_id == message_id).options(joinedload(Attachment.blob)))
+        ).scalars()
+    )
+
+    subject, body = await run_crypto(_open_message, m, sender, recipient_ids_sorted, attachments)
 
     if mr is not None and mr.read_at is None:
-        mr.read_at = utcnow()
-        mr.authenticity_verified = True
-        db.commit()
+        mark_read = _mark_read_statement(mr)
+        await run_write_async(lambda s: s.execute(mark_read), shard=mailbox_writer(mr.recipient_user_id))
 
     return m, sender, attachments, subject, body, True
 
 
+def _decrypt_subject_body(m: Message, dek: bytes) -> tuple[str, str]:
+    dek_cipher = AesGcmCipher(dek)
+
+    with span("messages.decrypt"):
+        subject = dek_cipher.decrypt(m.subject_ciphertext, m.subject_nonce, m.subject_tag, aad=_aad("messages:subject", m.id)).decode("utf-8")
+        body_plain = dek_cipher.decrypt(
+            m.body_ciphertext, m.body_nonce, m.body_tag, aad=_payload_aad("messages:body", m.body_format, m.id)
+        )
+        try:
+            body = decode_payload(m.body_format, body_plain, max_bytes=_MAX_BODY_BYTES).decode("utf-8")
+        except ValueError as exc:
+            raise IntegrityError("bad payload") from exc
+    return subject, body
+
+
+def _mark_read_statement(mr: MessageRecipient):
+    # Core UPDATE on the recipient's own table: with sharded mailboxes MessageRecipient
+    # maps the read-only view.
+    table = mailbox_table(mr.recipient_user_id)
+    return (
+        update(table)
+        .where(table.c.message_id == mr.message_id)
+        .where(table.c.recipient_user_id == mr.recipient_user_id)
+        .where(table.c.read_at.is_(None))
+        .values(read_at=utcnow(), authenticity_verified=True)
+    )
+
+
 def delete_message_for_user(db: Session, user: User, message_id: str) -> None:
     m = db.get(Message, message_id)
     if m is None:
@@ -351,21 +911,23 @@ def delete_message_for_user(db: Session, user: User, message_id: str) -> None:
         db.commit()
         return
 
-    mr = db.execute(
-        select(MessageRecipient)
-        .where(MessageRecipient.message_id == message_id)
-        .where(MessageRecipient.recipient_user_id == user.id)
-        .where(MessageRecipient.deleted_at.is_(None))
-    ).scalar_one_or_none()
-
-    if mr is None:
+    table = mailbox_table(user.id)
+    deleted = db.execute(
+        update(table)
+        .where(table.c.message_id == message_id)
+        .where(table.c.recipient_user_id == user.id)
+        .where(table.c.deleted_at.is_(None))
+        .values(deleted_at=utcnow())
+    ).rowcount
+
+    if not deleted:
+        db.rollback()
         raise AuthorizationError("not found")
 
-    mr.deleted_at = utcnow()
     db.commit()
 
 
-def download_attachment(db: Session, user: User, message_id: str, attachment_id: str) -> tuple[str, str, bytes]:
+def download_attachment(db: Session, user: User, message_id: str, attachment_id: str) -> tuple[str, str, int, Iterator[bytes]]:
     m, sender, _mr = get_message_for_user(db, user, message_id)
 
     ok = _verify_authenticity(db, m, sender)
@@ -384,10 +946,102 @@ def download_attachment(db: Session, user: User, message_id: str, attachment_id:
     dek = _decrypt_dek(m)
     dek_cipher = AesGcmCipher(dek)
 
-    data = dek_cipher.decrypt(
-        a.blob_ciphertext,
-        a.blob_nonce,
-        a.blob_tag,
-        aad=_aad("attachments:blob", message_id, attachment_id),
+    # Decompression is streamed so only the (compressed) plaintext is held whole.
+    with span("attachments.decrypt", size_bytes=a.size_bytes):
+        chunks = _iter_attachment_plaintext(dek_cipher, a)
+    return a.filename, a.content_type, a.size_bytes, chunks
+
+
+def _prefixed_subject(prefix: str, subject: str) -> str:
+    if subject.lower().startswith(prefix.lower()):
+        return subject
+    return (prefix + subject)[:200]
+
+
+def _load_source_message(db: Session, user: User, message_id: str) -> tuple[Message, AesGcmCipher, str]:
+    m, sender, _mr = get_message_for_user(db, user, message_id)
+
+    ok = _verify_authenticity(db, m, sender)
+    if not ok:
+        raise IntegrityError("bad hmac")
+
+    dek_cipher = AesGcmCipher(_decrypt_dek(m))
+    subject = dek_cipher.decrypt(m.subject_ciphertext, m.subject_nonce, m.subject_tag, aad=_aad("messages:subject", m.id)).decode("utf-8")
+    return m, dek_cipher, subject
+
+
+def forward_message(
+    *,
+    db: Session,
+    user: User,
+    message_id: str,
+    recipients_json: str,
+    subject: str | None,
+    body: str,
+    attachment_ids_json: str | None,
+    files: list[tuple[str, str, bytes]],
+) -> Message:
+    """Forward a message; its attachments are shared by reference, not re-encrypted."""
+
+    m, src_dek_cipher, src_subject = _load_source_message(db, user, message_id)
+
+    src_attachments = db.execute(select(Attachment).where(Attachment.message_id == m.id)).scalars().all()
+    if attachment_ids_json:
+        try:
+            wanted = json.loads(attachment_ids_json)
+        except json.JSONDecodeError as exc:
+            raise ValidationError("Invalid attachment ids") from exc
+        if not isinstance(wanted, list) or not all(isinstance(x, str) for x in wanted):
+            raise ValidationError("Invalid attachment ids")
+        by_id = {a.id: a for a in src_attachments}
+        if any(x not in by_id for x in wanted):
+            raise AuthorizationError("not found")
+        src_attachments = [by_id[x] for x in dict.fromkeys(wanted)]
+
+    recipient_ids_sorted = _resolve_recipients(db, user, recipients_json)
+    return _create_message(
+        db=db,
+        sender=user,
+        recipient_ids_sorted=recipient_ids_sorted,
+        subject=subject if subject else _prefixed_subject("Fwd: ", src_subject),
+        body=body,
+        files=files,
+        forwarded=[(a, src_dek_cipher) for a in src_attachments],
+    )
+
+
+def reply_to_message(
+    *,
+    db: Session,
+    user: User,
+    message_id: str,
+    subject: str | None,
+    body: str,
+    files: list[tuple[str, str, bytes]],
+) -> Message:
+    """Reply to the sender (or, for the sender, follow up to the original recipients)."""
+
+    m, _src_dek_cipher, src_subject = _load_source_message(db, user, message_id)
+
+    if m.sender_user_id == user.id:
+        candidate_ids = list(
+            db.execute(select(MessageRecipient.recipient_user_id).where(MessageRecipient.message_id == m.id)).scalars().all()
+        )
+    else:
+        candidate_ids = [m.sender_user_id]
+
+    active_ids = db.execute(select(User.id).where(User.id.in_(candidate_ids)).where(User.is_active.is_(True))).scalars().all()
+    recipient_ids_sorted = sorted(set(active_ids) - {user.id})
+    if not recipient_ids_sorted:
+        raise ValidationError("Invalid recipients")
+
+    return _create_message(
+        db=db,
+        sender=user,
+        recipient_ids_sorted=recipient_ids_sorted,
+        subject=subject if subject else _prefixed_subject("Re: ", src_subject),
+        body=body,
+        files=files,
+        thread_id=m.thread_id or m.id,
+        in_reply_to=m.id,
     )
-    return a.filename, a.content_type, data
@@ -0,0 +1,210 @@
+from __future__ import annotations
+
+import datetime as dt
+import json
+import uuid
+
+from sqlalchemy import delete, select, update
+from sqlalchemy.orm import Session
+
+from app.core.config import settings
+from app.core.exceptions import AuthorizationError, ValidationError
+from app.crypto.aes_gcm import AesGcmCipher
+from app.crypto.key_management import generate_aes256_key
+from app.db.models import AttachmentBlob, UploadChunk, UploadSession, User, utcnow
+from app.keyservice.base import RING_DATA, get_key_service
+from app.messages.service import _aad, _new_blob, _release_blob, _safe_filename, _sanitize_content_type
+
+
+def _session_key(upload: UploadSession) -> bytes:
+    return get_key_service().unwrap(
+        RING_DATA,
+        upload.session_key_version,
+        upload.session_key_enc,
+        upload.session_key_nonce,
+        upload.session_key_tag,
+        aad=_aad("uploads:key", upload.id),
+    )
+
+
+def create_upload(db: Session, user: User, *, filename: str, content_type: str, size_bytes: int) -> UploadSession:
+    if size_bytes <= 0 or size_bytes > settings.max_attachment_bytes:
+        raise ValidationError("Attachment too large" if size_bytes > 0 else "Invalid size")
+
+    # Opportunistic cleanup keeps the staging area bounded even without the purge worker.
+    purge_expired_uploads(db, limit=20)
+
+    now = utcnow()
+    upload_id = str(uuid.uuid4())
+    session_key = generate_aes256_key()
+    key_version, wrapped = get_key_service().wrap(RING_DATA, session_key, _aad("uploads:key", upload_id))
+
+    upload = UploadSession(
+        id=upload_id,
+        user_id=user.id,
+        filename=_safe_filename(filename or "attachment"),
+        content_type=_sanitize_content_type(content_type),
+        size_bytes=size_bytes,
+        received_bytes=0,
+        session_key_enc=wrapped.ciphertext,
+        session_key_nonce=wrapped.nonce,
+        session_key_tag=wrapped.tag,
+        session_key_version=key_version,
+        status="open",
+        created_at=now,
+        expires_at=now + dt.timedelta(seconds=settings.upload_session_ttl_seconds),
+    )
+    db.add(upload)
+    db.commit()
+    db.refresh(upload)
+    return upload
+
+
+def get_upload(db: Session, user: User, upload_id: str) -> UploadSession:
+    upload = db.execute(
+        select(UploadSession)
+        .where(UploadSession.id == upload_id)
+        .where(UploadSession.user_id == user.id)
+        .where(UploadSession.expires_at > utcnow())
+    ).scalar_one_or_none()
+    if upload is None:
+        raise AuthorizationError("not found")
+    return upload
+
+
+def append_chunk(db: Session, user: User, upload_id: str, *, offset: int, data: bytes) -> int:
+    """Encrypt and stage one chunk; `offset` must equal the bytes received so far."""
+
+    upload = get_upload(db, user, upload_id)
+    if upload.status != "open":
+        raise ValidationError("Upload already finalized")
+    if not data:
+        raise ValidationError("Empty chunk")
+    if offset != upload.received_bytes:
+        raise ValidationError("Offset mismatch")
+    if offset + len(data) > upload.size_bytes:
+        raise ValidationError("Chunk exceeds declared size")
+
+    enc = AesGcmCipher(_session_key(upload)).encrypt(data, aad=_aad("uploads:chunk", upload.id, str(offset)))
+
+    # Optimistic concurrency: only one writer may advance from this offset.
+    advanced = db.execute(
+        update(UploadSession)
+        .where(UploadSession.id == upload.id)
+        .where(UploadSession.received_bytes == offset)
+        .values(received_bytes=offset + len(data))
+    ).rowcount
+    if advanced != 1:
+        db.rollback()
+        raise ValidationError("Offset mismatch")
+
+    db.add(
+        UploadChunk(
+            upload_id=upload.id,
+            offset=offset,
+            size_bytes=len(data),
+            ciphertext=enc.ciphertext,
+            nonce=enc.nonce,
+            tag=enc.tag,
+        )
+    )
+    db.commit()
+    return offset + len(data)
+
+
+def finalize_upload(db: Session, user: User, upload_id: str) -> UploadSession:
+    """Assemble staged chunks into a shared attachment blob; the session holds its reference."""
+
+    upload = get_upload(db, user, upload_id)
+    if upload.status != "open":
+        raise ValidationError("Upload already finalized")
+    if upload.received_bytes != upload.size_bytes:
+        raise ValidationError("Upload incomplete")
+
+    session_cipher = AesGcmCipher(_session_key(upload))
+    data = bytearray()
+    for chunk in db.execute(
+        select(UploadChunk).where(UploadChunk.upload_id == upload.id).order_by(UploadChunk.offset)
+    ).scalars():
+        if chunk.offset != len(data):
+            raise ValidationError("Upload incomplete")
+        data.extend(
+            session_cipher.decrypt(chunk.ciphertext, chunk.nonce, chunk.tag, aad=_aad("uploads:chunk", upload.id, str(chunk.offset)))
+        )
+        db.expunge(chunk)
+    if len(data) != upload.size_bytes:
+        raise ValidationError("Upload incomplete")
+
+    blob, blob_key = _new_blob(bytes(data), upload.content_type, utcnow())
+    db.add(blob)
+    del data
+    wrapped = session_cipher.encrypt(blob_key, aad=_aad("uploads:blob_key", upload.id))
+
+    upload.blob_id = blob.id
+    upload.blob_key_enc = wrapped.ciphertext
+    upload.blob_key_nonce = wrapped.nonce
+    upload.blob_key_tag = wrapped.tag
+    upload.status = "finalized"
+    db.execute(delete(UploadChunk).where(UploadChunk.upload_id == upload.id))
+    db.commit()
+    db.refresh(upload)
+    return upload
+
+
+def claim_uploads(db: Session, user: User, upload_ids_json: str | None) -> list[tuple[AttachmentBlob, bytes, str, str, int]]:
+    """Mark finalized uploads as consumed and return them for attaching (caller commits)."""
+
+    if not upload_ids_json:
+        return []
+    try:
+        upload_ids = json.loads(upload_ids_json)
+    except json.JSONDecodeError as exc:
+        raise ValidationError("Invalid upload ids") from exc
+    if not isinstance(upload_ids, list) or not all(isinstance(x, str) for x in upload_ids):
+        raise ValidationError("Invalid upload ids")
+    if len(upload_ids) > settings.max_attachments_per_message:
+        raise ValidationError("Too many attachments")
+
+    staged: list[tuple[AttachmentBlob, bytes, str, str, int]] = []
+    for upload_id in dict.fromkeys(upload_ids):
+        upload = get_upload(db, user, upload_id)
+        if upload.status != "finalized" or upload.blob is None:
+            raise ValidationError("Upload not finalized")
+        if upload.blob_key_enc is None or upload.blob_key_nonce is None or upload.blob_key_tag is None:
+            raise ValidationError("Upload not finalized")
+
+        blob_key = AesGcmCipher(_session_key(upload)).decrypt(
+            upload.blob_key_enc, upload.blob_key_nonce, upload.blob_key_tag, aad=_aad("uploads:blob_key", upload.id)
+        )
+        blob = upload.blob
+
+        # The blob reference now belongs to the attachment row; the conditional update
+        # makes sure two concurrent sends cannot both claim it.
+        claimed = db.execute(
+            update(UploadSession)
+            .where(UploadSession.id == upload.id)
+            .where(UploadSession.status == "finalized")
+            .values(status="consumed", blob_id=None, blob_key_enc=None, blob_key_nonce=None, blob_key_tag=None)
+        ).rowcount
+        if claimed != 1:
+            raise ValidationError("Upload not finalized")
+        staged.append((blob, blob_key, upload.filename, upload.content_type, upload.size_bytes))
+    return staged
+
+
+def purge_expired_uploads(db: Session, *, limit: int = 100) -> int:
+    """Drop expired sessions with their staged chunks and any unclaimed blob."""
+
+    expired = db.execute(
+        select(UploadSession).where(UploadSession.expires_at <= utcnow()).order_by(UploadSession.expires_at).limit(limit)
+    ).scalars().all()
+    for upload in expired:
+        db.execute(delete(UploadChunk).where(UploadChunk.upload_id == upload.id))
+        blob_id = upload.blob_id
+        db.delete(upload)
+        db.flush()
+        if blob_id is not None:
+            _release_blob(db, blob_id)
+    if expired:
+        db.commit()
+    return len(expired)
@@ -9,6 +9,8 @@ _ALLOWED_CT_PREFIXES = (
     "application/json",
     "multipart/form-data",
     "application/x-www-form-urlencoded",
+    # Resumable upload chunks (PATCH /api/messages/uploads/{id}).
+    "application/offset+octet-stream",
 )
 
 
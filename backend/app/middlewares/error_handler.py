@@ -6,7 +6,16 @@ from fastapi import Request
 from fastapi.responses import JSONResponse
 
 from app.core.config import settings
-from app.core.exceptions import AppError, AuthenticationError, AuthorizationError, IntegrityError, RateLimitError, ValidationError
+from app.core.exceptions import (
+    AppError,
+    AuthenticationError,
+    AuthorizationError,
+    ConflictError,
+    IntegrityError,
+    NotFoundError,
+    RateLimitError,
+    ValidationError,
+)
 
 
 logger = logging.getLogger("app.errors")
@@ -31,6 +40,12 @@ async def error_handling_middleware(request: Request, call_next):
     except ValidationError as exc:
         msg = str(exc) if str(exc) else "Invalid request"
         return JSONResponse(status_code=400, content={"detail": msg}, headers={"X-Request-Id": request_id})
+    except ConflictError as exc:
+        msg = str(exc) if str(exc) else "Conflict"
+        return JSONResponse(status_code=409, content={"detail": msg}, headers={"X-Request-Id": request_id})
+    except NotFoundError as exc:
+        msg = str(exc) if str(exc) else "Not found"
+        return JSONResponse(status_code=404, content={"detail": msg}, headers={"X-Request-Id": request_id})
     except IntegrityError:
         return JSONResponse(status_code=400, content={"detail": "Integrity check failed"}, headers={"X-Request-Id": request_id})
     except AppError:
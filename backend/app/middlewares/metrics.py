@@ -0,0 +1,46 @@
+from __future__ import annotations
+
+import time
+
+from fastapi import Request
+
+from app.core import metrics
+
+
+def route_template(request: Request) -> str:
+    # The matched route's template keeps the label set bounded (/api/messages/{message_id},
+    # not one series per id). Depending on the FastAPI version route.path may lack the
+    # include_router() prefix; recover it from the part of the URL the route did not match.
+    route = request.scope.get("route")
+    template = getattr(route, "path", None)
+    if not template:
+        return metrics.UNMATCHED_ROUTE
+    path = request.scope.get("path", "")
+    regex = getattr(route, "path_regex", None)
+    if regex is None or regex.match(path):
+        return template
+    for i, ch in enumerate(path):
+        if ch == "/" and i and regex.match(path[i:]):
+            return path[:i] + template
+    return template
+
+
+async def metrics_middleware(request: Request, call_next):
+    metrics.http_requests_in_flight.inc()
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        elapsed = time.perf_counter() - started
+        metrics.http_requests_in_flight.dec()
+        route = route_template(request)
+        metrics.http_requests_total.labels(request.method, route, str(status)).inc()
+        metrics.http_request_duration_seconds.labels(request.method, route).observe(elapsed)
+        stats = getattr(request.state, "query_stats", None)
+        if stats is not None:
+            metrics.db_request_seconds.labels(route).observe(stats.seconds)
+            if stats.statements:
+                metrics.db_statements_total.labels(route).inc(stats.statements)
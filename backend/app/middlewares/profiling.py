@@ -0,0 +1,36 @@
+from __future__ import annotations
+
+from fastapi import Request
+
+from app.core import profiling
+
+
+_MODES = {"1": "cpu", "cpu": "cpu", "memory": "memory"}
+
+
+async def request_profile_middleware(request: Request, call_next):
+    # ?profile=1 (or cpu|memory) plus a valid X-Profiling-Token profiles this one request;
+    # without the token the parameter is ignored. GET /debug/profile/requests/{request_id}
+    # returns the result.
+    mode = _MODES.get(request.query_params.get("profile", ""))
+    if mode is None or not profiling.token_ok(request.headers.get(profiling.PROFILE_HEADER)):
+        return await call_next(request)
+
+    request_id = getattr(request.state, "request_id", "") or request.headers.get("X-Request-Id") or ""
+    started = profiling.begin_request_profile(request_id, mode, request.url.path)
+    if started is None:
+        response = await call_next(request)
+        response.headers["X-Profile"] = "busy"
+        return response
+
+    profile, token = started
+    try:
+        if mode == "memory":
+            with profiling.request_memory_window(profile):
+                response = await call_next(request)
+        else:
+            response = await call_next(request)
+    finally:
+        profiling.end_request_profile(profile, token)
+    response.headers["X-Profile"] = request_id
+    return response
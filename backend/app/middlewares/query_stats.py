@@ -0,0 +1,48 @@
+from __future__ import annotations
+
+import logging
+import time
+
+from fastapi import Request
+
+from app.core.config import settings
+from app.db.session import stop_tracking, track_queries
+
+
+logger = logging.getLogger("app.db")
+
+
+async def query_stats_middleware(request: Request, call_next):
+    # Counts SQL statements and DB time for the request (request.state.query_stats).
+    # Outside production: Server-Timing header and the N+1 warning.
+    debug = settings.app_env.lower() != "production"
+    threshold = settings.n_plus_one_threshold if debug else 0
+    stats, token = track_queries(by_statement=threshold > 0)
+    request.state.query_stats = stats
+    started = time.perf_counter()
+    try:
+        response = await call_next(request)
+    finally:
+        stop_tracking(token)
+
+    if debug:
+        # Streamed bodies (downloads, exports) query after this point; the header covers the handler only.
+        total_ms = (time.perf_counter() - started) * 1000.0
+        response.headers.append(
+            "Server-Timing",
+            f'db;dur={stats.seconds * 1000.0:.2f};desc="{stats.statements} queries", app;dur={total_ms:.2f}',
+        )
+
+    if threshold > 0 and stats.by_statement:
+        statement, count = stats.by_statement.most_common(1)[0]
+        if count > threshold:
+            logger.warning(
+                "Possible N+1: same statement ran %d times in %s %s (request_id=%s): %s",
+                count,
+                request.method,
+                request.url.path,
+                getattr(request.state, "request_id", ""),
+                statement[:300],
+                extra={"path": request.url.path, "count": count},
+            )
+    return response
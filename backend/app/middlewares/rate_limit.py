@@ -3,22 +3,60 @@ from __future__ import annotations
 import time
 from dataclasses import dataclass
 
+from sqlalchemy import case, delete
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session
+
+from app.core.config import settings
 from app.core.exceptions import RateLimitError
+from app.core.metrics import rate_limit_rejections_total
+from app.crypto.hmac_sha256 import hmac_sha256
+from app.db.models import RateLimitBucket
+from app.db.session import SessionLocal, engine
+from app.db.write_queue import run_write, run_write_async
+
+# Buckets older than this are dropped by the purge worker (longest window: 1 h).
+BUCKET_RETENTION_SECONDS = 24 * 60 * 60
+
+
+def shared_store() -> bool:
+    """Whether limiters count in the database (rate_limit_buckets) instead of in memory.
+
+    In memory every worker process would allow max_requests on its own, i.e. N times the
+    limit with WEB_CONCURRENCY=N.
+    """
+
+    if settings.rate_limit_store == "auto":
+        return settings.web_concurrency > 1
+    return settings.rate_limit_store == "database"
+
+
+def purge_expired_rate_limit_buckets(db: Session) -> int:
+    cutoff = int(time.time()) - BUCKET_RETENTION_SECONDS
+    deleted = db.execute(delete(RateLimitBucket).where(RateLimitBucket.window_start < cutoff)).rowcount
+    if deleted:
+        db.commit()
+    return deleted
 
 
 @dataclass
 class FixedWindowRateLimiter:
-    """In-memory fixed-window rate limiter.
+    """Fixed-window rate limiter.
 
     Notes:
-    - Suitable for single-instance academic POC.
-    - For multi-instance, use a shared store (Redis) — intentionally out of scope.
+    - In memory by default: one process, one set of counters.
+    - With several workers (RATE_LIMIT_STORE, see shared_store) the counters live in
+      rate_limit_buckets, windows aligned to the clock, so all workers share one limit.
+      Async endpoints use check_async so the database write does not hold a thread.
     """
 
     window_seconds: int
     max_requests: int
     max_buckets: int = 50_000
     cleanup_interval_seconds: int = 60
+    # Label for rate_limit_rejections_total.
+    name: str = "default"
 
     def __post_init__(self) -> None:
         self._buckets: dict[str, tuple[int, float]] = {}
@@ -31,7 +69,47 @@ class FixedWindowRateLimiter:
         expired_before = now - self.window_seconds
         self._buckets = {k: v for k, v in self._buckets.items() if v[1] >= expired_before}
 
+    def _hit_statement(self, key: str):
+        # One upsert per request: a new window restarts the count at 1.
+        now = int(time.time())
+        insert = postgresql_insert if engine.dialect.name == "postgresql" else sqlite_insert
+        stmt = insert(RateLimitBucket).values(
+            limiter=self.name,
+            bucket_key=hmac_sha256(settings.app_secret_key_bytes, key.encode("utf-8")),
+            window_start=now - now % self.window_seconds,
+            hits=1,
+        )
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[RateLimitBucket.limiter, RateLimitBucket.bucket_key],
+            set_={
+                "hits": case((RateLimitBucket.window_start == stmt.excluded.window_start, RateLimitBucket.hits + 1), else_=1),
+                "window_start": stmt.excluded.window_start,
+            },
+        )
+        return stmt.returning(RateLimitBucket.hits)
+
+    def _reject_over_limit(self, hits: int) -> None:
+        if hits > self.max_requests:
+            rate_limit_rejections_total.labels(self.name).inc()
+            raise RateLimitError("rate limit")
+
     def check(self, key: str) -> None:
+        if shared_store():
+            stmt = self._hit_statement(key)
+            with SessionLocal() as db:
+                hits = run_write(db, lambda s: s.execute(stmt).scalar_one())
+            self._reject_over_limit(hits)
+            return
+        self._check_in_memory(key)
+
+    async def check_async(self, key: str) -> None:
+        if shared_store():
+            stmt = self._hit_statement(key)
+            self._reject_over_limit(await run_write_async(lambda s: s.execute(stmt).scalar_one()))
+            return
+        self._check_in_memory(key)
+
+    def _check_in_memory(self, key: str) -> None:
         now = time.time()
         if len(self._buckets) > self.max_buckets:
             self._cleanup(now, force=True)
@@ -42,6 +120,7 @@ class FixedWindowRateLimiter:
             return
 
         if count + 1 > self.max_requests:
+            rate_limit_rejections_total.labels(self.name).inc()
             raise RateLimitError("rate limit")
 
         self._buckets[key] = (count + 1, window_start)
@@ -0,0 +1,47 @@
+from __future__ import annotations
+
+import time
+
+from fastapi import Request
+
+from app.core import tracing
+from app.middlewares.metrics import route_template
+
+
+async def _traced_body(body, trace: tracing.Trace, body_span: tracing.Span):
+    # Streamed downloads/exports keep working (and opening spans) after the handler returned;
+    # the trace is exported once the last chunk has been sent.
+    try:
+        async for chunk in body:
+            yield chunk
+    finally:
+        body_span.end = time.perf_counter()
+        tracing.finish_trace(trace)
+
+
+async def tracing_middleware(request: Request, call_next):
+    if not tracing.should_sample():
+        return await call_next(request)
+
+    request_id = getattr(request.state, "request_id", "") or request.headers.get("X-Request-Id") or ""
+    trace, token = tracing.begin_trace(request_id, f"{request.method} {request.url.path}")
+    try:
+        response = await call_next(request)
+    except BaseException as exc:
+        trace.attrs["error"] = type(exc).__name__
+        tracing.finish_trace(trace)
+        raise
+    finally:
+        tracing.detach_trace(token)
+
+    started = time.perf_counter()
+    trace.name = trace.spans[0].name = f"{request.method} {route_template(request)}"
+    trace.attrs["status"] = response.status_code
+    if trace.endpoint_returned is not None:
+        # Response model validation, serialization and response start (see TracedRoute).
+        trace.add(tracing.Span("response.serialize", trace.endpoint_returned, started, parent=0))
+    body_span = tracing.Span("response.body", started, parent=0)
+    trace.add(body_span)
+    response.body_iterator = _traced_body(response.body_iterator, trace, body_span)
+    return response
+
@@ -3,8 +3,9 @@ from __future__ import annotations
 from fastapi import APIRouter, Depends, Request, Response
 from sqlalchemy.orm import Session
 
-from app.auth.dependencies import get_current_user
+from app.auth.dependencies import get_current_user, get_current_user_read_only
 from app.core.config import settings
+from app.core.tracing import TracedRoute
 from app.db.models import User
 from app.db.session import get_db
 from app.middlewares.rate_limit import FixedWindowRateLimiter
@@ -12,9 +13,9 @@ from app.twofa.schemas import TwoFaSetupResponse, TwoFaStatusResponse, TwoFaVeri
 from app.twofa.service import disable_totp, enable_totp, setup_totp
 
 
-router = APIRouter(prefix="/2fa", tags=["2fa"])
+router = APIRouter(prefix="/2fa", tags=["2fa"], route_class=TracedRoute)
 
-_twofa_limiter = FixedWindowRateLimiter(window_seconds=60, max_requests=max(5, settings.login_rate_limit_per_minute))
+_twofa_limiter = FixedWindowRateLimiter(window_seconds=60, max_requests=max(5, settings.login_rate_limit_per_minute), name="twofa")
 
 
 def _client_ip(request: Request) -> str:
@@ -22,7 +23,7 @@ def _client_ip(request: Request) -> str:
 
 
 @router.get("/status", response_model=TwoFaStatusResponse)
-def status(current_user: User = Depends(get_current_user)) -> TwoFaStatusResponse:
+def status(current_user: User = Depends(get_current_user_read_only)) -> TwoFaStatusResponse:
     return TwoFaStatusResponse(enabled=bool(current_user.totp_enabled))
 
 
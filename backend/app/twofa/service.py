@@ -4,21 +4,21 @@ from sqlalchemy.orm import Session
 
 from app.core.config import settings
 from app.core.exceptions import AuthenticationError, ValidationError
-from app.crypto.aes_gcm import AesGcmCipher
 from app.crypto.totp import generate_totp_secret, provisioning_uri, verify_totp_code_and_step
 from app.db.models import User, utcnow
+from app.keyservice.base import RING_TOTP, get_key_service
 
 
 def setup_totp(db: Session, user: User) -> tuple[str, str]:
     secret = generate_totp_secret()
 
-    cipher = AesGcmCipher(settings.totp_kek_bytes)
     aad = f"users:totp_secret:{user.id}".encode("utf-8")
-    enc = cipher.encrypt(secret.encode("utf-8"), aad=aad)
+    version, enc = get_key_service().wrap(RING_TOTP, secret.encode("utf-8"), aad)
 
     user.totp_secret_enc = enc.ciphertext
     user.totp_secret_nonce = enc.nonce
     user.totp_secret_tag = enc.tag
+    user.totp_secret_version = version
 
     # not enabled until verified
     user.totp_enabled = False
@@ -34,9 +34,11 @@ def enable_totp(db: Session, user: User, code: str) -> None:
     if user.totp_secret_enc is None or user.totp_secret_nonce is None or user.totp_secret_tag is None:
         raise ValidationError("2FA not initialized")
 
-    cipher = AesGcmCipher(settings.totp_kek_bytes)
     aad = f"users:totp_secret:{user.id}".encode("utf-8")
-    secret = cipher.decrypt(user.totp_secret_enc, user.totp_secret_nonce, user.totp_secret_tag, aad=aad).decode("utf-8")
+    secret = get_key_service().unwrap(
+        RING_TOTP,
+        user.totp_secret_version, user.totp_secret_enc, user.totp_secret_nonce, user.totp_secret_tag, aad=aad
+    ).decode("utf-8")
 
     step = verify_totp_code_and_step(secret, code, valid_window=1)
     if step is None:
@@ -56,9 +58,11 @@ def disable_totp(db: Session, user: User, code: str) -> None:
     if user.totp_secret_enc is None or user.totp_secret_nonce is None or user.totp_secret_tag is None:
         raise AuthenticationError("invalid")
 
-    cipher = AesGcmCipher(settings.totp_kek_bytes)
     aad = f"users:totp_secret:{user.id}".encode("utf-8")
-    secret = cipher.decrypt(user.totp_secret_enc, user.totp_secret_nonce, user.totp_secret_tag, aad=aad).decode("utf-8")
+    secret = get_key_service().unwrap(
+        RING_TOTP,
+        user.totp_secret_version, user.totp_secret_enc, user.totp_secret_nonce, user.totp_secret_tag, aad=aad
+    ).decode("utf-8")
 
     if verify_totp_code_and_step(secret, code, valid_window=1) is None:
         raise AuthenticationError("invalid")
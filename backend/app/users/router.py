@@ -3,14 +3,15 @@ from __future__ import annotations
 from fastapi import APIRouter, Depends
 from sqlalchemy.orm import Session
 
+from app.core.tracing import TracedRoute
 from app.db.session import get_db
 from app.users.schemas import MeResponse, RegisterRequest, RegisterResponse, UserPublic
 from app.users.service import create_user
-from app.auth.dependencies import get_current_user
+from app.auth.dependencies import get_current_user_read_only
 from app.db.models import User
 
 
-router = APIRouter(prefix="/users", tags=["users"])
+router = APIRouter(prefix="/users", tags=["users"], route_class=TracedRoute)
 
 
 @router.post("/register", response_model=RegisterResponse, status_code=201)
@@ -20,5 +21,5 @@ def register(payload: RegisterRequest, db: Session = Depends(get_db)) -> Registe
 
 
 @router.get("/me", response_model=MeResponse)
-def me(current_user: User = Depends(get_current_user)) -> MeResponse:
+def me(current_user: User = Depends(get_current_user_read_only)) -> MeResponse:
     return MeResponse(user=UserPublic(id=current_user.id, email=current_user.email, username=current_user.username))
@@ -7,11 +7,10 @@ from sqlalchemy import select
 from sqlalchemy.orm import Session
 
 from app.core.exceptions import ValidationError
-from app.crypto.aes_gcm import AesGcmCipher
 from app.crypto.key_management import generate_hmac_key
 from app.crypto.passwords import hash_password
 from app.db.models import User, utcnow
-from app.core.config import settings
+from app.keyservice.base import RING_USER_HMAC, get_key_service
 
 
 def create_user(db: Session, email: str, username: str, password: str) -> User:
@@ -34,9 +33,8 @@ def create_user(db: Session, email: str, username: str, password: str) -> User:
 
     # Per-user HMAC key is generated server-side and stored encrypted at rest.
     hmac_key = generate_hmac_key()
-    cipher = AesGcmCipher(settings.user_hmac_kek_bytes)
     aad = f"users:hmac_key:{user_id}".encode("utf-8")
-    enc = cipher.encrypt(hmac_key, aad=aad)
+    hmac_key_version, enc = get_key_service().wrap(RING_USER_HMAC, hmac_key, aad)
 
     user = User(
         id=user_id,
@@ -51,6 +49,7 @@ def create_user(db: Session, email: str, username: str, password: str) -> User:
         hmac_key_enc=enc.ciphertext,
         hmac_key_nonce=enc.nonce,
         hmac_key_tag=enc.tag,
+        hmac_key_version=hmac_key_version,
         is_active=True,
         failed_login_count=0,
         locked_until=None,
@@ -12,4 +12,22 @@ mkdir -p "$DATA_DIR"
 chown -R "$APP_UID:$APP_GID" "$DATA_DIR"
 chmod 700 "$DATA_DIR"
 
-exec su -s /bin/sh -c "uvicorn app.main:app --host 0.0.0.0 --port 8000" appuser
+# Worker processes: WEB_CONCURRENCY, or one per CPU the container may use (app/core/workers.py).
+# Exported so every worker sees the resolved number (rate-limit store, crypto threads).
+WEB_CONCURRENCY="$(python -m app.core.workers)"
+export WEB_CONCURRENCY
+
+# Several workers need a shared metrics directory (docker-compose.yml sets one).
+if [ "$WEB_CONCURRENCY" -gt 1 ] && [ -z "${PROMETHEUS_MULTIPROC_DIR:-}" ]; then
+  export PROMETHEUS_MULTIPROC_DIR="/tmp/app-metrics"
+fi
+
+# Prometheus multiprocess mode: every worker writes its samples here. Stale files from a
+# previous run would be summed into the new one, so start from an empty directory.
+if [ -n "${PROMETHEUS_MULTIPROC_DIR:-}" ]; then
+  rm -rf "$PROMETHEUS_MULTIPROC_DIR"
+  mkdir -p "$PROMETHEUS_MULTIPROC_DIR"
+  chown "$APP_UID:$APP_GID" "$PROMETHEUS_MULTIPROC_DIR"
+fi
+
+exec su -s /bin/sh -c "uvicorn app.main:app --host 0.0.0.0 --port 8000 --workers $WEB_CONCURRENCY" appuser
@@ -0,0 +1,177 @@
+from __future__ import annotations
+
+import base64
+import datetime as dt
+import hashlib
+import importlib.metadata
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+
+
+# Shared helpers for the bench_*.py scripts: timing, percentile summaries and the JSON
+# report format read by perf_gate.py. Reports are keyed by suite + benchmark name; the
+# host fingerprint and Python version say which baseline a result may be compared with.
+
+SCHEMA_VERSION = 1
+
+
+@dataclass
+class Result:
+    name: str
+    unit: str
+    samples: int
+    p50: float
+    p95: float
+    p99: float
+    mean: float
+    stdev: float
+    min: float
+    max: float
+    extra: dict = field(default_factory=dict)
+
+
+def percentile(sorted_values: list[float], q: float) -> float:
+    # Linear interpolation between closest ranks (same as numpy's default).
+    if not sorted_values:
+        return 0.0
+    pos = (len(sorted_values) - 1) * q
+    lo = int(pos)
+    hi = min(lo + 1, len(sorted_values) - 1)
+    return sorted_values[lo] + (sorted_values[hi] - sorted_values[lo]) * (pos - lo)
+
+
+def summarize(name: str, seconds: list[float], *, unit: str = "ms", **extra) -> Result:
+    scale = {"ms": 1000.0, "us": 1_000_000.0, "s": 1.0}[unit]
+    values = sorted(s * scale for s in seconds)
+    return Result(
+        name=name,
+        unit=unit,
+        samples=len(values),
+        p50=round(percentile(values, 0.50), 4),
+        p95=round(percentile(values, 0.95), 4),
+        p99=round(percentile(values, 0.99), 4),
+        mean=round(statistics.fmean(values), 4) if values else 0.0,
+        stdev=round(statistics.stdev(values), 4) if len(values) > 1 else 0.0,
+        min=round(values[0], 4) if values else 0.0,
+        max=round(values[-1], 4) if values else 0.0,
+        extra=extra,
+    )
+
+
+def measure(fn, *, repeat: int, warmup: int = 1, budget_seconds: float | None = None) -> list[float]:
+    """Per-call wall times in seconds. Stops early once `budget_seconds` is spent (min 3 samples)."""
+
+    for _ in range(warmup):
+        fn()
+    out: list[float] = []
+    started = time.perf_counter()
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        out.append(time.perf_counter() - t0)
+        if budget_seconds is not None and len(out) >= 3 and time.perf_counter() - started > budget_seconds:
+            break
+    return out
+
+
+def _cpu_model() -> str:
+    try:
+        for line in Path("/proc/cpuinfo").read_text().splitlines():
+            if line.startswith("model name"):
+                return line.split(":", 1)[1].strip()
+    except OSError:
+        pass
+    return platform.processor() or platform.machine()
+
+
+def host_info() -> dict:
+    info = {
+        "system": platform.system(),
+        "machine": platform.machine(),
+        "cpu": _cpu_model(),
+        "cpu_count": os.cpu_count() or 1,
+    }
+    # Stable across runs on the same box; kernel/hostname are left out on purpose.
+    info["fingerprint"] = hashlib.sha256(json.dumps(info, sort_keys=True).encode()).hexdigest()[:16]
+    return info
+
+
+def _versions(*packages: str) -> dict[str, str | None]:
+    out: dict[str, str | None] = {}
+    for p in packages:
+        try:
+            out[p] = importlib.metadata.version(p)
+        except importlib.metadata.PackageNotFoundError:
+            out[p] = None
+    return out
+
+
+def _git_revision() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, timeout=5, check=True
+        ).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def report(suite: str, results: list[Result], params: dict) -> dict:
+    return {
+        "schema": SCHEMA_VERSION,
+        "suite": suite,
+        "created_at": dt.datetime.now(dt.UTC).isoformat(timespec="seconds"),
+        "revision": _git_revision(),
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "host": host_info(),
+        "packages": _versions("cryptography", "argon2-cffi", "SQLAlchemy", "fastapi", "pyotp"),
+        "params": params,
+        "results": [asdict(r) for r in results],
+    }
+
+
+def emit(doc: dict, *, as_json: bool, out: Path | None) -> None:
+    if out is not None:
+        out.write_text(json.dumps(doc, indent=2) + "\n")
+        print(f"[bench] wrote {out}", file=sys.stderr)
+    if as_json:
+        json.dump(doc, sys.stdout, indent=2)
+        print()
+        return
+    print(f"[bench] {doc['suite']} python={doc['python']} host={doc['host']['fingerprint']} ({doc['host']['cpu']})")
+    print(f"{'benchmark':<40} {'n':>5} {'p50':>10} {'p95':>10} {'p99':>10} {'unit':>4}  extra")
+    for r in doc["results"]:
+        extra = " ".join(f"{k}={v}" for k, v in r["extra"].items())
+        print(f"{r['name']:<40} {r['samples']:>5} {r['p50']:>10} {r['p95']:>10} {r['p99']:>10} {r['unit']:>4}  {extra}")
+
+
+def bench_env(sqlite_path: str | None = None, *, stable_keys: bool = False) -> None:
+    """Fill in throwaway settings so benchmarks run outside a deployment.
+
+    Must run before anything imports `app`. Values already in the environment win,
+    so a benchmark can also be pointed at real settings. `stable_keys` derives fixed
+    (public, bench-only) keys so a seeded database can be reused between runs.
+    """
+
+    def _key(name: str) -> str:
+        raw = hashlib.sha256(b"bench-only:" + name.encode()).digest() if stable_keys else os.urandom(32)
+        return base64.b64encode(raw).decode("ascii")
+
+    os.environ.setdefault("PUBLIC_BASE_URL", "https://localhost")
+    os.environ.setdefault("APP_ENV", "development")
+    os.environ.setdefault("APP_SECRET_KEY", _key("APP_SECRET_KEY"))
+    if not os.environ.get("KEY_SERVICE_SOCKET"):
+        for name in ("DATA_KEY", "TOTP_KEY_ENCRYPTION_KEY", "USER_HMAC_KEY_ENCRYPTION_KEY"):
+            os.environ.setdefault(name, _key(name))
+    if sqlite_path is not None:
+        os.environ["SQLITE_PATH"] = sqlite_path
+    else:
+        os.environ.setdefault("SQLITE_PATH", str(Path(tempfile.mkdtemp(prefix="bench-")) / "app.sqlite3"))
@@ -0,0 +1,173 @@
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import sys
+import time
+from pathlib import Path
+
+import _bench
+
+
+# Concurrent throughput of the hot read endpoints on the sync path (threadpool, read-only
+# Session, list_inbox / read_message_detail) against the async path the routes now use
+# (AsyncSession, list_inbox_async / read_message_detail_async, crypto via run_crypto).
+# Both variants are mounted side by side on a small app with the real dependencies and
+# driven in-process through httpx's ASGI transport, --concurrency requests in flight.
+# The list endpoints also differ in statement count: list_inbox issues one attachment
+# lookup per row, list_inbox_async a single statement.
+#
+# Usage (from backend/): python scripts/bench_async_db.py --concurrency 200 --requests 2000
+
+_PASSWORD = "Bench-Password-123!"
+
+
+def _seed(messages: int) -> tuple[str, list[str]]:
+    """Returns (session token of the reader, ids of messages in its inbox)."""
+
+    from sqlalchemy import select
+
+    from app.auth.service import create_session
+    from app.db.models import User
+    from app.db.session import SessionLocal
+    from app.messages.service import send_message
+    from app.users.service import create_user
+
+    db = SessionLocal()
+    try:
+        users = []
+        for name in ("async_bench_reader", "async_bench_sender"):
+            u = db.execute(select(User).where(User.username == name)).scalar_one_or_none()
+            users.append(u or create_user(db, f"{name}@example.com", name, _PASSWORD))
+        reader, sender = users
+        ids = []
+        for i in range(messages):
+            files = [("note.txt", "text/plain", b"x" * 2048)] if i % 4 == 0 else []
+            m = send_message(
+                db=db,
+                sender=sender,
+                recipients_json=json.dumps([reader.username]),
+                subject=f"Benchmark {i}",
+                body="lorem ipsum " * 40,
+                files=files,
+            )
+            ids.append(m.id)
+        token, _ = create_session(db, reader, ip_address="127.0.0.1", user_agent="bench")
+        return token, ids
+    finally:
+        db.close()
+
+
+def _app():
+    from fastapi import Depends, FastAPI
+    from sqlalchemy.ext.asyncio import AsyncSession
+    from sqlalchemy.orm import Session
+
+    from app.auth.dependencies import get_current_user_async, get_current_user_read_only
+    from app.db.async_session import get_async_db
+    from app.db.models import User
+    from app.db.session import get_read_db
+    from app.messages import service
+
+    app = FastAPI()
+
+    @app.get("/sync/inbox")
+    def sync_inbox(db: Session = Depends(get_read_db), user: User = Depends(get_current_user_read_only)) -> int:
+        return len(service.list_inbox(db, user))
+
+    @app.get("/async/inbox")
+    async def async_inbox(db: AsyncSession = Depends(get_async_db), user: User = Depends(get_current_user_async)) -> int:
+        return len(await service.list_inbox_async(db, user))
+
+    @app.get("/sync/detail/{message_id}")
+    def sync_detail(message_id: str, db: Session = Depends(get_read_db), user: User = Depends(get_current_user_read_only)) -> int:
+        return len(service.read_message_detail(db, user, message_id)[4])
+
+    @app.get("/async/detail/{message_id}")
+    async def async_detail(message_id: str, db: AsyncSession = Depends(get_async_db), user: User = Depends(get_current_user_async)) -> int:
+        return len((await service.read_message_detail_async(db, user, message_id))[4])
+
+    return app
+
+
+async def _drive(app, paths: list[str], token: str, concurrency: int) -> tuple[list[float], int, float]:
+    import httpx
+
+    latencies: list[float] = []
+    errors = 0
+    sem = asyncio.Semaphore(concurrency)
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", cookies={"session": token}) as client:
+
+        async def one(path: str) -> None:
+            nonlocal errors
+            async with sem:
+                t0 = time.perf_counter()
+                try:
+                    r = await client.get(path)
+                except Exception:  # noqa: BLE001 - e.g. pool checkout timeouts on the sync path
+                    errors += 1
+                    return
+                if r.status_code != 200:
+                    errors += 1
+                    return
+                latencies.append(time.perf_counter() - t0)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(one(p) for p in paths))
+        elapsed = time.perf_counter() - started
+    return latencies, errors, elapsed
+
+
+async def _main_async(args: argparse.Namespace, token: str, ids: list[str]) -> list[_bench.Result]:
+    from app.db.async_session import async_engine
+
+    app = _app()
+    results = []
+    for workload in args.workload or ["inbox", "detail"]:
+        for variant in ("sync", "async"):
+            if workload == "inbox":
+                paths = [f"/{variant}/inbox"] * args.requests
+            else:
+                paths = [f"/{variant}/detail/{ids[i % len(ids)]}" for i in range(args.requests)]
+            await _drive(app, paths[: min(50, len(paths))], token, args.concurrency)  # warm pools and caches
+            latencies, errors, elapsed = await _drive(app, paths, token, args.concurrency)
+            print(f"[bench] {workload}/{variant}: {len(latencies)} ok, {errors} errors, {elapsed:.2f}s", file=sys.stderr)
+            results.append(
+                _bench.summarize(
+                    f"read_path.{workload}[{variant}]",
+                    latencies,
+                    requests_per_s=round(len(latencies) / elapsed, 1) if elapsed else None,
+                    errors=errors,
+                )
+            )
+    await async_engine.dispose()
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Hot read endpoints: sync Session in the threadpool vs. AsyncSession")
+    parser.add_argument("--workload", action="append", choices=["inbox", "detail"], help="default: inbox and detail")
+    parser.add_argument("--concurrency", type=int, default=200, help="requests in flight")
+    parser.add_argument("--requests", type=int, default=2000, help="requests per variant")
+    parser.add_argument("--messages", type=int, default=200, help="messages in the reader's inbox")
+    parser.add_argument("--json", action="store_true", help="emit machine-readable JSON")
+    parser.add_argument("--out", type=Path, help="also write the JSON report to this file")
+    args = parser.parse_args()
+
+    _bench.bench_env()
+    from app.db.init import init_schema
+    from app.db.write_queue import stop_write_queue
+
+    init_schema()
+    token, ids = _seed(args.messages)
+    results = asyncio.run(_main_async(args, token, ids))
+    stop_write_queue()
+
+    params = {k: v for k, v in vars(args).items() if k not in ("json", "out")}
+    _bench.emit(_bench.report("async_db", results, params), as_json=args.json, out=args.out)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+from __future__ import annotations
+
+import argparse
+import json
+import mimetypes
+import os
+import random
+import sys
+import time
+from dataclasses import asdict, dataclass
+from pathlib import Path
+
+import _bench
+
+
+# Storage saved vs. CPU spent for compression-before-encryption, through the app's own
+# encode_payload / iter_decoded: the configured levels and the policy (minimum size,
+# content type, minimum savings) apply, so a sample the app would store raw shows up as
+# stored_format "raw" under every codec.
+# Usage: python scripts/bench_compression.py [--json] [--content-type TYPE] [FILE ...]
+# Without files a synthetic corpus (logs, JSON, CSV, random bytes) is used.
+
+
+@dataclass
+class Row:
+    sample: str
+    content_type: str
+    codec: str
+    stored_format: str
+    raw_bytes: int
+    stored_bytes: int
+    ratio: float
+    compress_ms: float
+    decompress_ms: float
+    encrypt_ms: float
+    decrypt_ms: float
+
+
+def _synthetic_corpus(size: int) -> dict[str, tuple[str, bytes]]:
+    rnd = random.Random(42)
+    levels = ["INFO", "WARN", "ERROR", "DEBUG"]
+    log = bytearray()
+    while len(log) < size:
+        log.extend(
+            f"2024-05-{rnd.randint(1, 28):02d}T12:{rnd.randint(0, 59):02d}:{rnd.randint(0, 59):02d}Z "
+            f"{rnd.choice(levels)} app.messages request_id={rnd.getrandbits(64):016x} "
+            f"user={rnd.randint(1, 5000)} took={rnd.random() * 100:.2f}ms\n".encode()
+        )
+    records = []
+    while sum(len(r) for r in records) < size:
+        records.append(json.dumps({"id": rnd.randint(1, 10**9), "name": f"user{rnd.randint(1, 999)}", "active": rnd.random() > 0.5}))
+    csv = bytearray(b"id,amount,currency,status\n")
+    while len(csv) < size:
+        csv.extend(f"{rnd.randint(1, 10**6)},{rnd.random() * 1000:.2f},PLN,{rnd.choice(['ok', 'pending', 'failed'])}\n".encode())
+    return {
+        "log": ("text/plain", bytes(log[:size])),
+        "json": ("application/json", ("[" + ",".join(records) + "]").encode()[:size]),
+        "csv": ("text/csv", bytes(csv[:size])),
+        "random": ("application/octet-stream", os.urandom(size)),
+    }
+
+
+def _timed(fn, repeat: int) -> tuple[float, object]:
+    best = float("inf")
+    out = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        out = fn()
+        best = min(best, time.perf_counter() - t0)
+    return best * 1000.0, out
+
+
+def _codecs() -> list[str]:
+    # PAYLOAD_COMPRESSION values to compare.
+    from app.messages import payload
+
+    return ["none", "deflate"] + (["zstd"] if payload.zstandard is not None else [])
+
+
+def run(samples: dict[str, tuple[str, bytes]], repeat: int) -> list[Row]:
+    from app.core.config import settings
+    from app.crypto.aes_gcm import AesGcmCipher
+    from app.messages.payload import PAYLOAD_FORMAT_DEFLATE, PAYLOAD_FORMAT_ZSTD, encode_payload, iter_decoded
+
+    format_names = {PAYLOAD_FORMAT_DEFLATE: "deflate", PAYLOAD_FORMAT_ZSTD: "zstd"}
+    cipher = AesGcmCipher(os.urandom(32))
+    aad = b"bench"
+    rows: list[Row] = []
+    for name, (content_type, data) in samples.items():
+        for codec in _codecs():
+            settings.payload_compression = codec
+            c_ms, (fmt, packed) = _timed(lambda: encode_payload(data, content_type), repeat)
+            d_ms, _ = _timed(lambda: b"".join(iter_decoded(fmt, packed, max_bytes=len(data))), repeat)
+            e_ms, enc = _timed(lambda: cipher.encrypt(packed, aad), repeat)
+            x_ms, _ = _timed(lambda: cipher.decrypt(enc.ciphertext, enc.nonce, enc.tag, aad), repeat)
+            rows.append(
+                Row(
+                    sample=name,
+                    content_type=content_type,
+                    codec=codec,
+                    stored_format=format_names.get(fmt, "raw"),
+                    raw_bytes=len(data),
+                    stored_bytes=len(enc.ciphertext),
+                    ratio=round(len(data) / max(1, len(packed)), 2),
+                    compress_ms=round(c_ms, 3),
+                    decompress_ms=round(d_ms, 3),
+                    encrypt_ms=round(e_ms, 3),
+                    decrypt_ms=round(x_ms, 3),
+                )
+            )
+    return rows
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark compression-before-encryption")
+    parser.add_argument("files", nargs="*", type=Path)
+    parser.add_argument("--content-type", help="content type for FILEs (default: guessed from the name)")
+    parser.add_argument("--size", type=int, default=1024 * 1024, help="synthetic sample size in bytes")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--json", action="store_true", help="emit machine-readable JSON")
+    args = parser.parse_args()
+
+    _bench.bench_env()
+    if args.files:
+        samples = {
+            p.name: (args.content_type or mimetypes.guess_type(p.name)[0] or "application/octet-stream", p.read_bytes())
+            for p in args.files
+        }
+    else:
+        samples = _synthetic_corpus(args.size)
+
+    rows = run(samples, args.repeat)
+
+    if args.json:
+        json.dump([asdict(r) for r in rows], sys.stdout, indent=2)
+        print()
+        return
+
+    print(f"[bench] zstd={'yes' if 'zstd' in _codecs() else 'no (pip install zstandard)'}")
+    print(
+        f"{'sample':<12} {'codec':<8} {'stored as':<9} {'raw':>10} {'stored':>10} {'ratio':>6} "
+        f"{'comp ms':>9} {'decomp ms':>9} {'enc ms':>8} {'dec ms':>8}"
+    )
+    for r in rows:
+        print(
+            f"{r.sample:<12} {r.codec:<8} {r.stored_format:<9} {r.raw_bytes:>10} {r.stored_bytes:>10} {r.ratio:>6} "
+            f"{r.compress_ms:>9} {r.decompress_ms:>9} {r.encrypt_ms:>8} {r.decrypt_ms:>8}"
+        )
+
+
+if __name__ == "__main__":
+    main()
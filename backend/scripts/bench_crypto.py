@@ -0,0 +1,169 @@
+from __future__ import annotations
+
+import argparse
+import os
+import uuid
+from pathlib import Path
+
+import _bench
+
+
+# Crypto primitives on the request paths, measured in isolation:
+#   - AES-GCM encrypt/decrypt (AesGcmCipher) from 1 KiB up to the 25 MiB attachment cap
+#   - message HMAC: payload construction and HMAC-SHA256 over it
+#   - Argon2id hash/verify at the parameters the app uses
+#   - TOTP verification (accepting and rejecting a code)
+#   - KEK unwrap through the configured KeyService (in-process unless KEY_SERVICE_SOCKET is set)
+# Usage: python scripts/bench_crypto.py [--json] [--out FILE] [--repeat N]
+# Output is the _bench report format; compare runs with scripts/perf_gate.py.
+
+_SIZES = [1024, 64 * 1024, 1024 * 1024, 8 * 1024 * 1024, 25 * 1024 * 1024]
+
+
+def _size_label(n: int) -> str:
+    return f"{n // (1024 * 1024)}MiB" if n >= 1024 * 1024 else f"{n // 1024}KiB"
+
+
+def _aes(results: list, sizes: list[int], repeat: int, budget: float) -> None:
+    from app.crypto.aes_gcm import AesGcmCipher
+
+    cipher = AesGcmCipher(os.urandom(32))
+    aad = b"messages:attachment:bench"
+    for size in sizes:
+        data = os.urandom(size)
+        enc = cipher.encrypt(data, aad)
+        for op, fn in (
+            ("encrypt", lambda: cipher.encrypt(data, aad)),
+            ("decrypt", lambda: cipher.decrypt(enc.ciphertext, enc.nonce, enc.tag, aad)),
+        ):
+            samples = _bench.measure(fn, repeat=repeat, budget_seconds=budget)
+            r = _bench.summarize(f"aes_gcm.{op}[{_size_label(size)}]", samples, bytes=size)
+            r.extra["mib_per_s"] = round(size / (1024 * 1024) / (r.p50 / 1000.0), 1) if r.p50 else None
+            results.append(r)
+
+
+def _fake_message(attachments: int, attachment_bytes: int):
+    from app.db.models import Attachment, Message
+
+    mid = str(uuid.uuid4())
+    m = Message(
+        id=mid,
+        sender_user_id=str(uuid.uuid4()),
+        hmac_format=2,
+        content_key_enc=os.urandom(32),
+        content_key_nonce=os.urandom(12),
+        content_key_tag=os.urandom(16),
+        subject_ciphertext=os.urandom(64),
+        subject_nonce=os.urandom(12),
+        subject_tag=os.urandom(16),
+        body_ciphertext=os.urandom(4096),
+        body_nonce=os.urandom(12),
+        body_tag=os.urandom(16),
+    )
+    atts = [
+        Attachment(
+            id=str(uuid.uuid4()),
+            message_id=mid,
+            filename=f"file{i}.bin",
+            content_type="application/octet-stream",
+            size_bytes=attachment_bytes,
+            blob_id=None,
+            blob_ciphertext=os.urandom(attachment_bytes),
+            blob_nonce=os.urandom(12),
+            blob_tag=os.urandom(16),
+        )
+        for i in range(attachments)
+    ]
+    return m, sorted(str(uuid.uuid4()) for _ in range(5)), atts
+
+
+def _hmac(results: list, repeat: int, budget: float) -> None:
+    from app.crypto.hmac_sha256 import hmac_sha256
+    from app.messages.service import _message_hmac_payload
+
+    key = os.urandom(32)
+    for label, count, size in (("text", 0, 0), ("3x1MiB", 3, 1024 * 1024)):
+        m, rids, atts = _fake_message(count, size)
+        payload = _message_hmac_payload(message=m, recipient_ids_sorted=rids, attachments=atts)
+        build = _bench.measure(
+            lambda: _message_hmac_payload(message=m, recipient_ids_sorted=rids, attachments=atts),
+            repeat=repeat,
+            budget_seconds=budget,
+        )
+        results.append(_bench.summarize(f"hmac.payload_build[{label}]", build, unit="us", bytes=len(payload)))
+        sign = _bench.measure(lambda: hmac_sha256(key, payload), repeat=repeat, budget_seconds=budget)
+        results.append(_bench.summarize(f"hmac.sign[{label}]", sign, unit="us", bytes=len(payload)))
+
+
+def _argon2(results: list, repeat: int) -> None:
+    from app.crypto.passwords import _password_hasher
+
+    password = "Bench-Password-123!"
+    stored = _password_hasher.hash(password)
+    params = {
+        "time_cost": _password_hasher.time_cost,
+        "memory_kib": _password_hasher.memory_cost,
+        "parallelism": _password_hasher.parallelism,
+    }
+    results.append(_bench.summarize("argon2.hash", _bench.measure(lambda: _password_hasher.hash(password), repeat=repeat), **params))
+    results.append(
+        _bench.summarize("argon2.verify", _bench.measure(lambda: _password_hasher.verify(stored, password), repeat=repeat), **params)
+    )
+
+
+def _totp(results: list, repeat: int, budget: float) -> None:
+    import pyotp
+
+    from app.crypto.totp import generate_totp_secret, verify_totp_code_and_step
+
+    secret = generate_totp_secret()
+    totp = pyotp.TOTP(secret)
+    # The code is fetched per call so a 30 s step boundary mid-run does not turn hits into misses.
+    ok = _bench.measure(lambda: verify_totp_code_and_step(secret, totp.now()), repeat=repeat, budget_seconds=budget)
+    results.append(_bench.summarize("totp.verify[accept]", ok, unit="us"))
+    # A rejected code walks the whole window: the worst case a login attempt can force.
+    bad = _bench.measure(lambda: verify_totp_code_and_step(secret, "000000x"), repeat=repeat, budget_seconds=budget)
+    results.append(_bench.summarize("totp.verify[reject]", bad, unit="us"))
+
+
+def _key_service(results: list, repeat: int, budget: float) -> None:
+    from app.keyservice.base import RING_DATA, UnwrapItem, get_key_service
+
+    ks = get_key_service()
+    for batch in (1, 50):
+        wrapped = ks.wrap_many(RING_DATA, [(os.urandom(32), f"messages:dek:{i}".encode()) for i in range(batch)])
+        items = [
+            UnwrapItem(version, enc.ciphertext, enc.nonce, enc.tag, f"messages:dek:{i}".encode())
+            for i, (version, enc) in enumerate(wrapped)
+        ]
+        samples = _bench.measure(lambda: ks.unwrap_many(RING_DATA, items), repeat=repeat, budget_seconds=budget)
+        results.append(_bench.summarize(f"keyservice.unwrap[batch={batch}]", samples, unit="us", backend=type(ks).__name__))
+    ks.close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark crypto primitives")
+    parser.add_argument("--repeat", type=int, default=200, help="max samples per benchmark")
+    parser.add_argument("--budget-seconds", type=float, default=3.0, help="time cap per benchmark (min 3 samples)")
+    parser.add_argument("--argon2-repeat", type=int, default=10)
+    parser.add_argument("--max-size", type=int, default=25 * 1024 * 1024, help="largest AES-GCM payload in bytes")
+    parser.add_argument("--json", action="store_true", help="emit machine-readable JSON")
+    parser.add_argument("--out", type=Path, help="also write the JSON report to this file")
+    args = parser.parse_args()
+
+    _bench.bench_env()
+    sizes = [s for s in _SIZES if s <= args.max_size]
+
+    results: list[_bench.Result] = []
+    _aes(results, sizes, args.repeat, args.budget_seconds)
+    _hmac(results, args.repeat, args.budget_seconds)
+    _argon2(results, args.argon2_repeat)
+    _totp(results, args.repeat, args.budget_seconds)
+    _key_service(results, args.repeat, args.budget_seconds)
+
+    params = {"repeat": args.repeat, "budget_seconds": args.budget_seconds, "argon2_repeat": args.argon2_repeat, "sizes": sizes}
+    _bench.emit(_bench.report("crypto", results, params), as_json=args.json, out=args.out)
+
+
+if __name__ == "__main__":
+    main()
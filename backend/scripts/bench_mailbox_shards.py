@@ -0,0 +1,163 @@
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from dataclasses import asdict
+from pathlib import Path
+
+import _bench
+
+
+# Mailbox write throughput against MAILBOX_SHARDS (app/db/shards.py). Every thread is one
+# recipient and runs the write the service issues for it, in its own session like a
+# request: "readmark" marks its inbox read one message at a time (the UPDATE of
+# read_message_detail, through run_write on the user's shard writer), "send" sends a
+# text message to --fanout recipients (rows fanned out to their shards, then the message
+# row). Each --shards value runs in a fresh process on a fresh database, since the shard
+# files are attached when pooled connections open.
+#
+# Usage (from backend/): python scripts/bench_mailbox_shards.py --shards 0 --shards 4 --threads 16
+
+_PASSWORD = "Bench-Password-123!"
+
+
+def _seed(args: argparse.Namespace) -> list[str]:
+    from app.db.session import SessionLocal
+    from app.messages.service import send_message
+    from app.users.service import create_user
+
+    db = SessionLocal()
+    try:
+        users = [create_user(db, f"mbox_bench_{i}@example.com", f"mbox_bench_{i}", _PASSWORD) for i in range(args.threads + 1)]
+        sender, recipients = users[0], users[1:]
+        for _ in range(args.writes):
+            send_message(
+                db=db,
+                sender=sender,
+                recipients_json=json.dumps([u.username for u in recipients]),
+                subject="Benchmark",
+                body="lorem ipsum " * 20,
+                files=[],
+            )
+        return [u.id for u in recipients]
+    finally:
+        db.close()
+
+
+def _child(args: argparse.Namespace) -> None:
+    from app.core.config import settings
+    from app.db.init import init_sqlite_schema
+    from app.db.models import User
+    from app.db.session import SessionLocal
+    from app.db.shards import mailbox_writer
+    from app.db.write_queue import run_write, stop_write_queue
+    from app.messages.service import _mark_read_statement, list_inbox, send_message
+
+    init_sqlite_schema()
+    user_ids = _seed(args)
+    names = {}
+    with SessionLocal() as db:
+        for uid in user_ids:
+            names[uid] = db.get(User, uid).username
+
+    latencies: list[float] = []
+    errors = 0
+    lock = threading.Lock()
+    start = threading.Barrier(args.threads + 1)
+
+    def worker(i: int) -> None:
+        nonlocal errors
+        uid = user_ids[i]
+        with SessionLocal() as db:
+            inbox = [mr for mr, *_ in list_inbox(db, db.get(User, uid))]
+        start.wait()
+        for n in range(args.writes):
+            t0 = time.perf_counter()
+            db = SessionLocal()
+            try:
+                if args.workload == "readmark":
+                    mark_read = _mark_read_statement(inbox[n])
+                    run_write(db, lambda s: s.execute(mark_read), shard=mailbox_writer(uid))
+                else:
+                    to = [names[user_ids[(i + k + 1) % len(user_ids)]] for k in range(args.fanout)]
+                    send_message(
+                        db=db,
+                        sender=db.get(User, uid),
+                        recipients_json=json.dumps(to),
+                        subject="Benchmark",
+                        body="lorem ipsum " * 20,
+                        files=[],
+                    )
+            except Exception:  # noqa: BLE001 - "database is locked" and friends
+                with lock:
+                    errors += 1
+                continue
+            finally:
+                db.close()
+            with lock:
+                latencies.append(time.perf_counter() - t0)
+
+    threads = [threading.Thread(target=worker, args=(i,), daemon=True) for i in range(args.threads)]
+    for t in threads:
+        t.start()
+    start.wait()
+    t0 = time.perf_counter()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - t0
+    stop_write_queue()
+
+    shards = settings.mailbox_shards
+    print(f"[bench] {args.workload}[shards={shards}]: {len(latencies)} ok, {errors} errors, {elapsed:.2f}s", file=sys.stderr)
+    result = _bench.summarize(
+        f"mailbox.{args.workload}[shards={shards}]",
+        latencies,
+        ops_per_s=round(len(latencies) / elapsed, 1) if elapsed else None,
+        errors=errors,
+    )
+    json.dump(asdict(result), sys.stdout)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Mailbox write throughput vs. MAILBOX_SHARDS")
+    parser.add_argument("--shards", type=int, action="append", help="shard counts to compare (default: 0 and 4)")
+    parser.add_argument("--workload", default="readmark", choices=["readmark", "send"])
+    parser.add_argument("--threads", type=int, default=16, help="concurrent recipients")
+    parser.add_argument("--writes", type=int, default=50, help="writes per thread")
+    parser.add_argument("--fanout", type=int, default=4, help="recipients per message (send)")
+    parser.add_argument("--synchronous", default="FULL", choices=["OFF", "NORMAL", "FULL", "EXTRA"])
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--json", action="store_true", help="emit machine-readable JSON")
+    parser.add_argument("--out", type=Path, help="also write the JSON report to this file")
+    args = parser.parse_args()
+
+    if args.child:
+        _bench.bench_env()
+        _child(args)
+        return
+
+    results: list[_bench.Result] = []
+    for shards in args.shards or [0, 4]:
+        env = dict(
+            os.environ,
+            MAILBOX_SHARDS=str(shards),
+            SQLITE_SYNCHRONOUS=args.synchronous,
+            SQLITE_PATH=str(Path(tempfile.mkdtemp(prefix="bench-")) / "app.sqlite3"),
+        )
+        cmd = [sys.executable, __file__, "--child", "--workload", args.workload, "--threads", str(args.threads)]
+        cmd += ["--writes", str(args.writes), "--fanout", str(args.fanout)]
+        out = subprocess.run(cmd, env=env, check=True, stdout=subprocess.PIPE, text=True).stdout
+        results.append(_bench.Result(**json.loads(out)))
+
+    params = {k: v for k, v in vars(args).items() if k not in ("json", "out", "child")}
+    _bench.emit(_bench.report("mailbox_shards", results, params), as_json=args.json, out=args.out)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,528 @@
+from __future__ import annotations
+
+import argparse
+import datetime as dt
+import hashlib
+import json
+import os
+import random
+import sys
+import time
+import uuid
+from dataclasses import asdict, dataclass
+from pathlib import Path
+
+import _bench
+
+
+# Service-layer benchmark against a large seeded SQLite database.
+# Usage (from backend/): python scripts/bench_service.py [--users N] [--messages N] [--json] [--out FILE]
+#
+# Seeding writes rows straight through the models (bulk INSERTs) with the same envelope
+# encryption and HMAC as send_message, but with a single Argon2 hash shared by every
+# user. Attachments reference a small pool of shared blobs (as forwards do), so 1M
+# messages do not need 1M attachment payloads on disk. The database and its seed
+# parameters are kept next to each other and reused until the parameters change.
+#
+# One user ("bench_hot") gets a large inbox and sent folder; that is the list_inbox /
+# list_sent worst case. Timed calls each run in a fresh session, like a request. Probe
+# users and messages are picked deterministically, read state is reset before the
+# detail run and messages created by send_message are deleted afterwards, so repeated
+# runs see the same dataset (and the same SQL statement counts).
+
+_PASSWORD = "Bench-Password-123!"
+_HOT_USERNAME = "bench_hot"
+
+# Attachment size classes: (label, bytes, weight among seeded attachments, pool size)
+_SIZE_CLASSES = [
+    ("4KiB", 4 * 1024, 70, 32),
+    ("256KiB", 256 * 1024, 25, 16),
+    ("4MiB", 4 * 1024 * 1024, 4.5, 4),
+    ("25MiB", 25 * 1024 * 1024, 0.5, 1),
+]
+
+
+@dataclass
+class SeedParams:
+    users: int
+    messages: int
+    hot_inbox: int
+    hot_sent: int
+    attachment_ratio: float
+    seed: int
+
+
+def _seed_file(db_path: Path) -> Path:
+    return db_path.with_name(db_path.name + ".seed.json")
+
+
+def _progress(label: str, done: int, total: int) -> None:
+    print(f"[seed] {label}: {done}/{total}", file=sys.stderr)
+
+
+def _seed_users(db, params: SeedParams, rnd: random.Random) -> tuple[list[str], dict[str, bytes]]:
+    from sqlalchemy import insert
+
+    from app.crypto.key_management import generate_hmac_key
+    from app.crypto.passwords import hash_password
+    from app.db.models import User, utcnow
+    from app.keyservice.base import RING_USER_HMAC, get_key_service
+
+    ks = get_key_service()
+    password_hash = hash_password(_PASSWORD)  # the only Argon2 call: every user shares it
+    now = utcnow()
+    ids: list[str] = []
+    hmac_keys: dict[str, bytes] = {}
+    batch = 2000
+    for start in range(0, params.users, batch):
+        chunk = []
+        for i in range(start, min(start + batch, params.users)):
+            uid = str(uuid.UUID(int=rnd.getrandbits(128), version=4))
+            chunk.append((uid, _HOT_USERNAME if i == 0 else f"bench{i:06d}", generate_hmac_key()))
+        wrapped = ks.wrap_many(RING_USER_HMAC, [(key, f"users:hmac_key:{uid}".encode("utf-8")) for uid, _name, key in chunk])
+        rows = []
+        for (uid, name, key), (version, enc) in zip(chunk, wrapped):
+            ids.append(uid)
+            hmac_keys[uid] = key
+            rows.append(
+                dict(
+                    id=uid,
+                    email=f"{name}@bench.invalid",
+                    username=name,
+                    password_hash=password_hash,
+                    password_updated_at=now,
+                    totp_enabled=False,
+                    hmac_key_enc=enc.ciphertext,
+                    hmac_key_nonce=enc.nonce,
+                    hmac_key_tag=enc.tag,
+                    hmac_key_version=version,
+                    is_active=True,
+                    failed_login_count=0,
+                    created_at=now,
+                    updated_at=now,
+                )
+            )
+        db.execute(insert(User), rows)
+        db.commit()
+        _progress("users", len(ids), params.users)
+    return ids, hmac_keys
+
+
+def _seed_blob_pool(db, rnd: random.Random) -> dict[str, list[tuple]]:
+    from app.db.models import utcnow
+    from app.messages.service import _new_blob
+
+    pool: dict[str, list[tuple]] = {}
+    for label, size, _weight, count in _SIZE_CLASSES:
+        pool[label] = []
+        for _ in range(count):
+            blob, key = _new_blob(rnd.randbytes(size), "application/octet-stream", utcnow())
+            db.add(blob)
+            pool[label].append((blob.id, key, blob.ciphertext_sha256, blob.nonce, blob.tag, size))
+        db.commit()
+    return pool
+
+
+def _seed_messages(db, params: SeedParams, rnd: random.Random, user_ids: list[str], hmac_keys: dict[str, bytes], pool) -> None:
+    from sqlalchemy import insert, update
+
+    from app.crypto.aes_gcm import AesGcmCipher
+    from app.crypto.hmac_sha256 import hmac_sha256
+    from app.crypto.key_management import generate_aes256_key
+    from app.db.models import Attachment, AttachmentBlob, Message, MessageRecipient, utcnow
+    from app.keyservice.base import RING_DATA, get_key_service
+    from app.messages.payload import encode_payload
+    from app.messages.service import _aad, _message_hmac_payload, _payload_aad
+
+    ks = get_key_service()
+    hot = user_ids[0]
+    others = user_ids[1:]
+    picked = rnd.sample(range(params.messages), min(params.messages, params.hot_inbox + params.hot_sent))
+    hot_inbox = set(picked[: params.hot_inbox])
+    hot_sent = set(picked[params.hot_inbox :])
+    # Every size class shows up in the hot inbox at least once, so downloads can be timed per class.
+    forced = [label for label, *_ in _SIZE_CLASSES]
+
+    labels = [label for label, *_ in _SIZE_CLASSES]
+    weights = [w for _label, _size, w, _count in _SIZE_CLASSES]
+    blob_models = {
+        b[0]: AttachmentBlob(id=b[0], ciphertext_sha256=b[2], nonce=b[3], tag=b[4]) for entries in pool.values() for b in entries
+    }
+    refs: dict[str, int] = {b: 0 for b in blob_models}
+    words = "lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor incididunt ut labore".split()
+    now = utcnow()
+    batch = 2000
+
+    for start in range(0, params.messages, batch):
+        plans = []
+        for i in range(start, min(start + batch, params.messages)):
+            if i in hot_sent:
+                sender = hot
+            else:
+                sender = rnd.choice(others)
+            n = rnd.choices([1, 2, 3, 5], weights=[60, 25, 10, 5])[0]
+            recipients = set(rnd.sample(others, min(n, len(others))))
+            recipients.discard(sender)
+            if i in hot_inbox:
+                recipients.add(hot)
+            while not recipients:
+                candidate = rnd.choice(others)
+                if candidate != sender:
+                    recipients.add(candidate)
+            atts: list[str] = []
+            if hot in recipients and forced:
+                atts.append(forced.pop())
+            elif rnd.random() < params.attachment_ratio:
+                atts = rnd.choices(labels, weights=weights, k=rnd.choice([1, 1, 1, 2, 3]))
+            mid = str(uuid.UUID(int=rnd.getrandbits(128), version=4))
+            created = now - dt.timedelta(seconds=rnd.randint(0, 365 * 24 * 3600))
+            plans.append((mid, sender, sorted(recipients), atts, created, generate_aes256_key()))
+
+        wrapped = ks.wrap_many(RING_DATA, [(dek, _aad("messages:dek", mid)) for mid, _s, _r, _a, _c, dek in plans])
+
+        msg_rows, rcpt_rows, att_rows = [], [], []
+        for (mid, sender, recipients, atts, created, dek), (version, dek_enc) in zip(plans, wrapped):
+            cipher = AesGcmCipher(dek)
+            subject = " ".join(rnd.choices(words, k=rnd.randint(2, 8))).capitalize()
+            body = " ".join(rnd.choices(words, k=rnd.randint(20, 400)))
+            subject_enc = cipher.encrypt(subject.encode("utf-8"), aad=_aad("messages:subject", mid))
+            body_format, body_plain = encode_payload(body.encode("utf-8"), "text/plain")
+            body_enc = cipher.encrypt(body_plain, aad=_payload_aad("messages:body", body_format, mid))
+            row = dict(
+                id=mid,
+                sender_user_id=sender,
+                content_key_enc=dek_enc.ciphertext,
+                content_key_nonce=dek_enc.nonce,
+                content_key_tag=dek_enc.tag,
+                content_key_version=version,
+                subject_ciphertext=subject_enc.ciphertext,
+                subject_nonce=subject_enc.nonce,
+                subject_tag=subject_enc.tag,
+                body_ciphertext=body_enc.ciphertext,
+                body_nonce=body_enc.nonce,
+                body_tag=body_enc.tag,
+                body_format=body_format,
+                hmac_sha256=b"",
+                hmac_format=2,
+                thread_id=mid,
+                in_reply_to=None,
+                created_at=created,
+                deleted_by_sender_at=None,
+                expires_at=None,
+            )
+
+            attachments = []
+            for label in atts:
+                blob_id, blob_key, _sha, _nonce, _tag, size = rnd.choice(pool[label])
+                att_id = str(uuid.UUID(int=rnd.getrandbits(128), version=4))
+                key_enc = cipher.encrypt(blob_key, aad=_aad("attachments:blob_key", mid, att_id))
+                att_row = dict(
+                    id=att_id,
+                    message_id=mid,
+                    filename=f"{label}-{att_id[:8]}.bin",
+                    content_type="application/octet-stream",
+                    size_bytes=size,
+                    blob_ciphertext=b"",
+                    blob_nonce=b"",
+                    blob_tag=b"",
+                    blob_format=0,
+                    blob_id=blob_id,
+                    blob_key_enc=key_enc.ciphertext,
+                    blob_key_nonce=key_enc.nonce,
+                    blob_key_tag=key_enc.tag,
+                    created_at=created,
+                )
+                a = Attachment(**att_row)
+                a.blob = blob_models[blob_id]
+                attachments.append(a)
+                att_rows.append(att_row)
+                refs[blob_id] += 1
+
+            payload = _message_hmac_payload(message=Message(**row), recipient_ids_sorted=recipients, attachments=attachments)
+            row["hmac_sha256"] = hmac_sha256(hmac_keys[sender], payload)
+            msg_rows.append(row)
+            rcpt_rows.extend(
+                dict(message_id=mid, recipient_user_id=rid, delivered_at=created, read_at=None, deleted_at=None, authenticity_verified=False)
+                for rid in recipients
+            )
+
+        db.execute(insert(Message), msg_rows)
+        db.execute(insert(MessageRecipient), rcpt_rows)
+        if att_rows:
+            db.execute(insert(Attachment), att_rows)
+        db.commit()
+        done = start + len(plans)
+        if done % 50_000 < batch or done == params.messages:
+            _progress("messages", done, params.messages)
+
+    for blob_id, count in refs.items():
+        # Unreferenced pool blobs keep ref_count=1 from _new_blob; nothing collects them here.
+        db.execute(update(AttachmentBlob).where(AttachmentBlob.id == blob_id).values(ref_count=max(1, count)))
+    db.commit()
+
+
+def _key_fingerprint() -> str:
+    names = ("DATA_KEY", "DATA_KEY_VERSION", "USER_HMAC_KEY_ENCRYPTION_KEY", "USER_HMAC_KEY_VERSION", "KEY_SERVICE_SOCKET")
+    material = "\0".join(os.environ.get(n, "") for n in names)
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()[:16]
+
+
+def _ensure_seeded(db_path: Path, params: SeedParams, reseed: bool) -> None:
+    from app.db.init import init_sqlite_schema
+    from app.db.session import SessionLocal
+
+    marker = _seed_file(db_path)
+    # Envelopes only open with the keys they were sealed with: a key change means a reseed.
+    seed_doc = asdict(params) | {"keys": _key_fingerprint()}
+    if not reseed and db_path.exists() and marker.exists() and json.loads(marker.read_text()) == seed_doc:
+        print(f"[seed] reusing {db_path}", file=sys.stderr)
+        init_sqlite_schema()
+        return
+
+    for p in (db_path, marker, db_path.with_name(db_path.name + "-wal"), db_path.with_name(db_path.name + "-shm")):
+        if p.exists():
+            p.unlink()
+    init_sqlite_schema()
+
+    started = time.perf_counter()
+    rnd = random.Random(params.seed)
+    db = SessionLocal()
+    try:
+        user_ids, hmac_keys = _seed_users(db, params, rnd)
+        pool = _seed_blob_pool(db, rnd)
+        _seed_messages(db, params, rnd, user_ids, hmac_keys, pool)
+    finally:
+        db.close()
+    marker.write_text(json.dumps(seed_doc, indent=2) + "\n")
+    print(f"[seed] done in {time.perf_counter() - started:.1f}s ({db_path.stat().st_size / 1e6:.0f} MB)", file=sys.stderr)
+
+
+def _timed_calls(op, users: list[str], *, repeat: int, budget: float, warmup: int = 1) -> list[tuple[float, int]]:
+    """(seconds, SQL statements) per op(db, user) call, each in a fresh session cycling through `users`.
+
+    The user lookup is neither timed nor counted.
+    """
+
+    from app.db.models import User
+    from app.db.session import SessionLocal, stop_tracking, track_queries
+
+    out: list[tuple[float, int]] = []
+    started = time.perf_counter()
+    for i in range(warmup + repeat):
+        db = SessionLocal()
+        try:
+            user = db.get(User, users[i % len(users)])
+            stats, token = track_queries()
+            try:
+                t0 = time.perf_counter()
+                op(db, user, i)
+                elapsed = time.perf_counter() - t0
+            finally:
+                stop_tracking(token)
+        finally:
+            db.close()
+        if i >= warmup:
+            out.append((elapsed, stats.statements))
+            if len(out) >= 3 and time.perf_counter() - started > budget:
+                break
+    return out
+
+
+def _result(name: str, calls: list[tuple[float, int]], **extra) -> _bench.Result:
+    # Statement count is deterministic, so perf_gate.py can flag an N+1 without timing noise.
+    queries = sorted(n for _s, n in calls)
+    return _bench.summarize(name, [s for s, _n in calls], queries=queries[len(queries) // 2], **extra)
+
+
+def _run(params: SeedParams, repeat: int, budget: float, send_repeat: int) -> list[_bench.Result]:
+    from sqlalchemy import func, select
+
+    from app.db.models import Attachment, Message, MessageRecipient, User
+    from app.db.session import SessionLocal
+    from app.messages.service import download_attachment, list_inbox, list_sent, read_message_detail, send_message
+
+    rnd = random.Random(params.seed + 1)
+    names = [f"bench{i:06d}" for i in rnd.sample(range(1, params.users), min(70, params.users - 1))]
+    db = SessionLocal()
+    try:
+        hot = db.execute(select(User.id).where(User.username == _HOT_USERNAME)).scalar_one()
+        typical = [db.execute(select(User.id).where(User.username == n)).scalar_one() for n in names[:50]]
+        recipient_names = names[50:] or names
+        inbox_size = db.execute(select(func.count()).select_from(MessageRecipient).where(MessageRecipient.recipient_user_id == hot)).scalar_one()
+        sent_size = db.execute(select(func.count()).select_from(Message).where(Message.sender_user_id == hot)).scalar_one()
+        detail_ids = list(
+            db.execute(
+                select(MessageRecipient.message_id)
+                .where(MessageRecipient.recipient_user_id == hot)
+                .order_by(MessageRecipient.message_id)
+                .limit(200)
+            ).scalars()
+        )
+        downloads: dict[str, list[tuple[str, str]]] = {}
+        for label, size, _w, _c in _SIZE_CLASSES:
+            downloads[label] = [
+                (mid, aid)
+                for mid, aid in db.execute(
+                    select(Attachment.message_id, Attachment.id)
+                    .join(MessageRecipient, MessageRecipient.message_id == Attachment.message_id)
+                    .where(MessageRecipient.recipient_user_id == hot)
+                    .where(Attachment.size_bytes == size)
+                    .order_by(Attachment.id)
+                    .limit(20)
+                ).all()
+            ]
+    finally:
+        db.close()
+
+    results: list[_bench.Result] = []
+    results.append(
+        _result(
+            "list_inbox[hot]",
+            _timed_calls(lambda db, u, i: list_inbox(db, u), [hot], repeat=repeat, budget=budget),
+            rows=inbox_size,
+        )
+    )
+    results.append(
+        _result("list_inbox[typical]", _timed_calls(lambda db, u, i: list_inbox(db, u), typical, repeat=repeat, budget=budget))
+    )
+    results.append(
+        _result(
+            "list_sent[hot]",
+            _timed_calls(lambda db, u, i: list_sent(db, u), [hot], repeat=repeat, budget=budget),
+            rows=sent_size,
+        )
+    )
+    results.append(
+        _result("list_sent[typical]", _timed_calls(lambda db, u, i: list_sent(db, u), typical, repeat=repeat, budget=budget))
+    )
+    # First read marks the message read (one extra UPDATE); every run starts from unread.
+    _reset_read_state(hot, detail_ids)
+    results.append(
+        _result(
+            "read_message_detail",
+            _timed_calls(lambda db, u, i: read_message_detail(db, u, detail_ids[i % len(detail_ids)]), [hot], repeat=repeat, budget=budget),
+        )
+    )
+    _reset_read_state(hot, detail_ids)
+
+    for label, size, _w, _c in _SIZE_CLASSES:
+        targets = downloads[label]
+        if not targets:
+            print(f"[bench] no {label} attachment in the hot inbox; skipping download", file=sys.stderr)
+            continue
+
+        def _download(db, u, i, targets=targets):
+            mid, aid = targets[i % len(targets)]
+            _name, _ct, _size, chunks = download_attachment(db, u, mid, aid)
+            for _chunk in chunks:
+                pass
+
+        r = _result(f"download_attachment[{label}]", _timed_calls(_download, [hot], repeat=repeat, budget=budget), bytes=size)
+        r.extra["mib_per_s"] = round(size / (1024 * 1024) / (r.p50 / 1000.0), 1) if r.p50 else None
+        results.append(r)
+
+    sent: list[str] = []
+    try:
+        for label, size in (("text", 0), ("1MiB", 1024 * 1024), ("25MiB", 25 * 1024 * 1024)):
+            data = rnd.randbytes(size) if size else b""
+            files = [("bench.bin", "application/octet-stream", data)] if size else []
+
+            def _send(db, u, i, files=files):
+                m = send_message(
+                    db=db,
+                    sender=u,
+                    recipients_json=json.dumps([recipient_names[i % len(recipient_names)], recipient_names[(i + 1) % len(recipient_names)]]),
+                    subject="Benchmark",
+                    body="lorem ipsum " * 50,
+                    files=files,
+                )
+                sent.append(m.id)
+
+            results.append(
+                _result(f"send_message[{label}]", _timed_calls(_send, [hot], repeat=send_repeat, budget=budget), bytes=size)
+            )
+    finally:
+        _discard_messages(sent)
+    return results
+
+
+def _reset_read_state(user_id: str, message_ids: list[str]) -> None:
+    from sqlalchemy import update
+
+    from app.db.models import MessageRecipient
+    from app.db.session import SessionLocal
+
+    db = SessionLocal()
+    try:
+        db.execute(
+            update(MessageRecipient)
+            .where(MessageRecipient.recipient_user_id == user_id)
+            .where(MessageRecipient.message_id.in_(message_ids))
+            .values(read_at=None, authenticity_verified=False)
+        )
+        db.commit()
+    finally:
+        db.close()
+
+
+def _discard_messages(message_ids: list[str]) -> None:
+    # No FK cascades in SQLite here: children first. Blobs from send_message are never shared.
+    from sqlalchemy import delete, select
+
+    from app.db.models import Attachment, AttachmentBlob, Message, MessageRecipient
+    from app.db.session import SessionLocal
+
+    if not message_ids:
+        return
+    db = SessionLocal()
+    try:
+        blob_ids = [b for b in db.execute(select(Attachment.blob_id).where(Attachment.message_id.in_(message_ids))).scalars() if b]
+        db.execute(delete(MessageRecipient).where(MessageRecipient.message_id.in_(message_ids)))
+        db.execute(delete(Attachment).where(Attachment.message_id.in_(message_ids)))
+        if blob_ids:
+            db.execute(delete(AttachmentBlob).where(AttachmentBlob.id.in_(blob_ids)))
+        db.execute(delete(Message).where(Message.id.in_(message_ids)))
+        db.commit()
+    finally:
+        db.close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark the messages service layer on a large seeded database")
+    parser.add_argument("--db", type=Path, default=Path(os.environ.get("TMPDIR", "/tmp")) / "bench_service.sqlite3")
+    parser.add_argument("--users", type=int, default=10_000)
+    parser.add_argument("--messages", type=int, default=1_000_000)
+    parser.add_argument("--hot-inbox", type=int, default=10_000, help="messages received by bench_hot")
+    parser.add_argument("--hot-sent", type=int, default=2_000, help="messages sent by bench_hot")
+    parser.add_argument("--attachment-ratio", type=float, default=0.1, help="share of messages with attachments")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--reseed", action="store_true", help="rebuild the database even if it matches")
+    parser.add_argument("--repeat", type=int, default=50, help="max samples per benchmark")
+    parser.add_argument("--send-repeat", type=int, default=20)
+    parser.add_argument("--budget-seconds", type=float, default=20.0, help="time cap per benchmark (min 3 samples)")
+    parser.add_argument("--json", action="store_true", help="emit machine-readable JSON")
+    parser.add_argument("--out", type=Path, help="also write the JSON report to this file")
+    args = parser.parse_args()
+
+    if args.users < 3:
+        parser.error("--users must be at least 3")
+    db_path = args.db.resolve()
+    _bench.bench_env(str(db_path), stable_keys=True)
+
+    params = SeedParams(
+        users=args.users,
+        messages=args.messages,
+        hot_inbox=min(args.hot_inbox, args.messages),
+        hot_sent=min(args.hot_sent, max(0, args.messages - args.hot_inbox)),
+        attachment_ratio=args.attachment_ratio,
+        seed=args.seed,
+    )
+    _ensure_seeded(db_path, params, args.reseed)
+    results = _run(params, args.repeat, args.budget_seconds, args.send_repeat)
+
+    doc_params = asdict(params) | {"repeat": args.repeat, "send_repeat": args.send_repeat, "budget_seconds": args.budget_seconds}
+    _bench.emit(_bench.report("service", results, doc_params), as_json=args.json, out=args.out)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,187 @@
+from __future__ import annotations
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from pathlib import Path
+
+import _bench
+
+
+# Readers vs. writers on one SQLite file, once with the connection setup the app used
+# before SQLITE_* existed (rollback journal, synchronous=FULL) and once with the current
+# settings (WAL by default). Writers insert attachment-sized blobs and hold their write
+# transaction open for --hold-ms, like a send that encrypts between statements; readers
+# run point lookups through the same kind of pool the app uses. With a rollback journal
+# every commit locks readers out; under WAL reader latency should not move.
+#
+# Usage (from backend/): python scripts/bench_sqlite_concurrency.py --duration 10
+
+_PROFILES = {
+    # What a bare create_engine() + pysqlite gave us: sqlite3's 5 s busy handler, no tuning.
+    "legacy": {
+        "sqlite_journal_mode": "DELETE",
+        "sqlite_synchronous": "FULL",
+        "sqlite_busy_timeout_ms": 5000,
+        "sqlite_mmap_size_mb": 0,
+        "sqlite_cache_size_mb": 2,
+        "sqlite_journal_size_limit_mb": -1,
+        "sqlite_foreign_keys": False,
+    },
+    "tuned": {},  # current settings
+}
+
+
+def _engine(path: str):
+    from sqlalchemy import create_engine, event
+    from sqlalchemy.pool import QueuePool
+
+    from app.core.config import settings
+    from app.db.session import apply_sqlite_pragmas
+
+    # Same pool policy and connect hook as app.db.session.engine, on a throwaway file.
+    engine = create_engine(
+        f"sqlite:///{path}",
+        connect_args={"check_same_thread": False},
+        poolclass=QueuePool,
+        pool_size=settings.db_pool_size,
+        max_overflow=settings.db_max_overflow,
+        pool_timeout=settings.db_pool_timeout_seconds,
+    )
+    event.listen(engine, "connect", lambda conn, _record: apply_sqlite_pragmas(conn))
+    return engine
+
+
+def _insert_blob(conn, size: int) -> str:
+    from sqlalchemy import text
+
+    blob_id = str(uuid.uuid4())
+    conn.execute(
+        text(
+            "INSERT INTO attachment_blobs (id, ciphertext, nonce, tag, payload_format, ciphertext_sha256, ref_count, created_at) "
+            "VALUES (:id, :ct, :nonce, :tag, 0, :sha, 1, datetime('now'))"
+        ),
+        {"id": blob_id, "ct": os.urandom(size), "nonce": os.urandom(12), "tag": os.urandom(16), "sha": os.urandom(32)},
+    )
+    return blob_id
+
+
+def _run_profile(profile: str, args: argparse.Namespace, results: list) -> None:
+    from sqlalchemy import text
+
+    from app.core.config import settings
+    from app.db.init import init_sqlite_schema
+
+    saved = {k: getattr(settings, k) for k in _PROFILES[profile]}
+    for k, v in _PROFILES[profile].items():
+        setattr(settings, k, v)
+    tmp = tempfile.mkdtemp(prefix="bench-sqlite-")
+    settings.sqlite_path = str(Path(tmp) / "app.sqlite3")
+    try:
+        init_sqlite_schema()
+        engine = _engine(settings.sqlite_path)
+        with engine.begin() as conn:
+            ids = [_insert_blob(conn, 1024) for _ in range(200)]
+            mode = conn.execute(text("PRAGMA journal_mode")).scalar()
+
+        stop = threading.Event()
+        read_lat: list[float] = []
+        write_lat: list[float] = []
+        errors = {"read": 0, "write": 0}
+        lock = threading.Lock()
+
+        def reader() -> None:
+            rnd = random.Random()
+            while not stop.is_set():
+                t0 = time.perf_counter()
+                try:
+                    with engine.connect() as conn:
+                        conn.execute(text("SELECT id, ref_count FROM attachment_blobs WHERE id = :id"), {"id": rnd.choice(ids)}).all()
+                        conn.execute(text("SELECT count(*) FROM attachment_blobs WHERE ref_count > 0")).scalar()
+                except Exception:  # noqa: BLE001 - "database is locked" and friends
+                    with lock:
+                        errors["read"] += 1
+                    continue
+                with lock:
+                    read_lat.append(time.perf_counter() - t0)
+                time.sleep(args.read_pause_ms / 1000.0)
+
+        def writer() -> None:
+            while not stop.is_set():
+                t0 = time.perf_counter()
+                try:
+                    with engine.begin() as conn:
+                        for _ in range(args.blobs_per_tx):
+                            _insert_blob(conn, args.blob_kib * 1024)
+                        time.sleep(args.hold_ms / 1000.0)
+                except Exception:  # noqa: BLE001
+                    with lock:
+                        errors["write"] += 1
+                    continue
+                with lock:
+                    write_lat.append(time.perf_counter() - t0)
+
+        threads = [threading.Thread(target=reader, daemon=True) for _ in range(args.readers)]
+        threads += [threading.Thread(target=writer, daemon=True) for _ in range(args.writers)]
+        for t in threads:
+            t.start()
+        time.sleep(args.duration)
+        stop.set()
+        for t in threads:
+            t.join()
+        engine.dispose()
+
+        print(f"[bench] {profile}: journal_mode={mode} reads={len(read_lat)} writes={len(write_lat)} errors={errors}", file=sys.stderr)
+        results.append(
+            _bench.summarize(
+                f"sqlite.read[{profile}]",
+                read_lat,
+                journal_mode=mode,
+                ops_per_s=round(len(read_lat) / args.duration, 1),
+                errors=errors["read"],
+            )
+        )
+        results.append(
+            _bench.summarize(
+                f"sqlite.write[{profile}]",
+                write_lat,
+                journal_mode=mode,
+                ops_per_s=round(len(write_lat) / args.duration, 1),
+                errors=errors["write"],
+            )
+        )
+    finally:
+        for k, v in saved.items():
+            setattr(settings, k, v)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="SQLite readers vs. writers: legacy setup vs. current SQLITE_* settings")
+    parser.add_argument("--profile", action="append", choices=sorted(_PROFILES), help="default: legacy and tuned")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds per profile")
+    parser.add_argument("--readers", type=int, default=8)
+    parser.add_argument("--writers", type=int, default=2)
+    parser.add_argument("--blob-kib", type=int, default=4096, help="size of each blob a writer inserts")
+    parser.add_argument("--blobs-per-tx", type=int, default=1)
+    parser.add_argument("--hold-ms", type=float, default=20.0, help="time a writer keeps its transaction open")
+    parser.add_argument("--read-pause-ms", type=float, default=1.0)
+    parser.add_argument("--json", action="store_true", help="emit machine-readable JSON")
+    parser.add_argument("--out", type=Path, help="also write the JSON report to this file")
+    args = parser.parse_args()
+
+    _bench.bench_env()
+    results: list[_bench.Result] = []
+    for profile in args.profile or ["legacy", "tuned"]:
+        _run_profile(profile, args, results)
+
+    params = {k: v for k, v in vars(args).items() if k not in ("json", "out")}
+    _bench.emit(_bench.report("sqlite_concurrency", results, params), as_json=args.json, out=args.out)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+from __future__ import annotations
+
+import argparse
+import asyncio
+import logging
+import os
+import tempfile
+from pathlib import Path
+
+import _bench
+import loadgen
+
+
+# Throughput against the number of uvicorn worker processes (app/core/workers.py). Each
+# --workers value starts `uvicorn --workers N` on a fresh SQLite database (with
+# WEB_CONCURRENCY=N, as entrypoint.sh does, so rate limits are counted in the database)
+# and drives it with the loadgen.py virtual users for the same duration. The report has
+# one row per N: latency over all requests, throughput and its ratio to the first N.
+# Scaling is bounded by the CPUs the process may use (usable_cpus in the report) and by
+# SQLite's single writer for write-heavy mixes.
+#
+# Usage (from backend/): python scripts/bench_workers.py --workers 1 --workers 2 --workers 4 --users 40
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="HTTP throughput vs. uvicorn worker count")
+    parser.add_argument("--workers", type=int, action="append", help="worker counts to compare (default: 1, 2 and 4)")
+    parser.add_argument("--users", type=int, default=40, help="concurrent virtual users")
+    parser.add_argument("--ramp-seconds", type=float, default=3.0)
+    parser.add_argument("--duration", type=float, default=20.0, help="steady-state seconds after the ramp")
+    parser.add_argument("--mix", type=loadgen._parse_mix, default=loadgen._parse_mix("login=1,inbox=5,detail=4,send=1,download=2"))
+    parser.add_argument("--attachment-bytes", default="0,16384", help="comma-separated attachment sizes picked per send")
+    parser.add_argument("--seed-messages", type=int, default=5, help="messages each user sends before the run")
+    parser.add_argument("--timeout", type=float, default=60.0)
+    parser.add_argument("--json", action="store_true", help="emit machine-readable JSON")
+    parser.add_argument("--out", type=Path, help="also write the JSON report to this file")
+    args = parser.parse_args()
+
+    if args.users < 3:
+        parser.error("--users must be at least 3")
+
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    _bench.bench_env()
+    for name in ("LOGIN_RATE_LIMIT_PER_MINUTE", "REGISTER_RATE_LIMIT_PER_HOUR", "SEND_RATE_LIMIT_PER_MINUTE"):
+        os.environ.setdefault(name, "1000000")
+
+    from app.core.workers import usable_cpus
+
+    results: list[_bench.Result] = []
+    baseline_rps = None
+    for workers in args.workers or [1, 2, 4]:
+        os.environ["SQLITE_PATH"] = str(Path(tempfile.mkdtemp(prefix="bench-")) / "app.sqlite3")
+        cfg = loadgen.Cfg(
+            target="uvicorn",
+            users=args.users,
+            ramp_seconds=args.ramp_seconds,
+            duration=args.duration,
+            mix=args.mix,
+            attachment_bytes=[int(x) for x in args.attachment_bytes.split(",") if x.strip()],
+            seed_messages=args.seed_messages,
+            workers=workers,
+            timeout=args.timeout,
+            origin=os.environ["PUBLIC_BASE_URL"].rstrip("/"),
+        )
+        with loadgen._uvicorn(workers) as base_url:
+            stats, elapsed = asyncio.run(loadgen._drive(cfg, None, base_url))
+
+        _, overall = loadgen._summaries(stats, elapsed)
+        baseline_rps = baseline_rps or overall["throughput_rps"]
+        results.append(
+            _bench.summarize(
+                f"load[workers={workers}]",
+                [s for samples in stats.latencies.values() for s in samples],
+                rps=overall["throughput_rps"],
+                scaling=round(overall["throughput_rps"] / baseline_rps, 2) if baseline_rps else None,
+                errors=overall["errors"],
+            )
+        )
+
+    params = {k: v for k, v in vars(args).items() if k not in ("json", "out")}
+    params["usable_cpus"] = usable_cpus()
+    _bench.emit(_bench.report("workers", results, params), as_json=args.json, out=args.out)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+from __future__ import annotations
+
+import argparse
+import json
+import sys
+import threading
+import time
+from pathlib import Path
+
+import _bench
+
+
+# Burst of concurrent writes with and without the group-commit queue (app/db/write_queue.py).
+# Every thread runs the real service call in its own session, like a request: text-only
+# send_message, or create_session (the login insert). "direct" commits each write on the
+# request's session; "grouped" hands it to the writer thread. Run with the default
+# --synchronous FULL (one fsync per commit) to see the fsyncs being shared; under NORMAL
+# WAL commits do not fsync and the gap comes from lock hand-offs alone.
+#
+# Usage (from backend/): python scripts/bench_write_queue.py --threads 32 --writes 50
+
+_PASSWORD = "Bench-Password-123!"
+
+
+def _seed_users(count: int) -> list[tuple[str, str]]:
+    from sqlalchemy import select
+
+    from app.db.models import User
+    from app.db.session import SessionLocal
+    from app.users.service import create_user
+
+    users = []
+    db = SessionLocal()
+    try:
+        for i in range(count):
+            name = f"wq_bench_{i}"
+            u = db.execute(select(User).where(User.username == name)).scalar_one_or_none()
+            if u is None:
+                u = create_user(db, f"{name}@example.com", name, _PASSWORD)
+            users.append((u.id, u.username))
+    finally:
+        db.close()
+    return users
+
+
+def _batch_stats() -> tuple[float, float]:
+    from app.core import metrics
+
+    samples = {s.name: s.value for s in metrics.write_queue_batch_size.collect()[0].samples}
+    return samples.get("write_queue_batch_size_count", 0.0), samples.get("write_queue_batch_size_sum", 0.0)
+
+
+def _run(profile: str, workload: str, users: list[tuple[str, str]], args: argparse.Namespace, results: list) -> None:
+    from app.auth.service import create_session
+    from app.core.config import settings
+    from app.db.models import User
+    from app.db.session import SessionLocal
+    from app.db.write_queue import stop_write_queue
+    from app.messages.service import send_message
+
+    settings.write_queue_enabled = profile == "grouped"
+    latencies: list[float] = []
+    errors = 0
+    lock = threading.Lock()
+    start = threading.Barrier(args.threads + 1)
+
+    def worker(i: int) -> None:
+        nonlocal errors
+        uid, _name = users[i % len(users)]
+        recipient = users[(i + 1) % len(users)][1]
+        start.wait()
+        for _ in range(args.writes):
+            t0 = time.perf_counter()
+            db = SessionLocal()
+            try:
+                user = db.get(User, uid)
+                if workload == "send":
+                    send_message(
+                        db=db,
+                        sender=user,
+                        recipients_json=json.dumps([recipient]),
+                        subject="Benchmark",
+                        body="lorem ipsum " * 20,
+                        files=[],
+                    )
+                else:
+                    create_session(db, user, ip_address="127.0.0.1", user_agent="bench")
+            except Exception:  # noqa: BLE001 - "database is locked" and friends
+                with lock:
+                    errors += 1
+                continue
+            finally:
+                db.close()
+            with lock:
+                latencies.append(time.perf_counter() - t0)
+
+    batches_before, ops_before = _batch_stats()
+    threads = [threading.Thread(target=worker, args=(i,), daemon=True) for i in range(args.threads)]
+    for t in threads:
+        t.start()
+    start.wait()
+    t0 = time.perf_counter()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - t0
+    stop_write_queue()
+    batches_after, ops_after = _batch_stats()
+
+    batches = batches_after - batches_before
+    avg_batch = round((ops_after - ops_before) / batches, 1) if batches else None
+    print(f"[bench] {workload}/{profile}: {len(latencies)} ok, {errors} errors, {elapsed:.2f}s, avg batch {avg_batch}", file=sys.stderr)
+    results.append(
+        _bench.summarize(
+            f"write_queue.{workload}[{profile}]",
+            latencies,
+            ops_per_s=round(len(latencies) / elapsed, 1) if elapsed else None,
+            errors=errors,
+            avg_batch=avg_batch,
+        )
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Concurrent writes: per-request commits vs. the group-commit queue")
+    parser.add_argument("--workload", action="append", choices=["send", "session"], help="default: send and session")
+    parser.add_argument("--threads", type=int, default=32)
+    parser.add_argument("--writes", type=int, default=50, help="writes per thread")
+    parser.add_argument("--users", type=int, default=8)
+    parser.add_argument("--synchronous", default="FULL", choices=["OFF", "NORMAL", "FULL", "EXTRA"])
+    parser.add_argument("--max-delay-ms", type=float, default=None, help="override WRITE_QUEUE_MAX_DELAY_MS")
+    parser.add_argument("--json", action="store_true", help="emit machine-readable JSON")
+    parser.add_argument("--out", type=Path, help="also write the JSON report to this file")
+    args = parser.parse_args()
+
+    _bench.bench_env()
+    from app.core.config import settings
+    from app.db.init import init_sqlite_schema
+    from app.db.session import engine
+
+    settings.sqlite_synchronous = args.synchronous
+    if args.max_delay_ms is not None:
+        settings.write_queue_max_delay_ms = args.max_delay_ms
+    # Pooled connections pick the PRAGMAs up when they open.
+    engine.dispose()
+    init_sqlite_schema()
+    users = _seed_users(max(2, args.users))
+
+    results: list[_bench.Result] = []
+    for workload in args.workload or ["send", "session"]:
+        for profile in ("direct", "grouped"):
+            _run(profile, workload, users, args, results)
+
+    params = {k: v for k, v in vars(args).items() if k not in ("json", "out")}
+    params["max_batch"] = settings.write_queue_max_batch
+    params["max_delay_ms"] = settings.write_queue_max_delay_ms
+    _bench.emit(_bench.report("write_queue", results, params), as_json=args.json, out=args.out)
+
+
+if __name__ == "__main__":
+    main()
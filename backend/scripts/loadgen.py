@@ -0,0 +1,386 @@
+from __future__ import annotations
+
+import argparse
+import asyncio
+import contextlib
+import json
+import logging
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+from collections import defaultdict
+from dataclasses import dataclass, field
+from pathlib import Path
+
+import httpx
+
+import _bench
+
+
+# HTTP load generator: virtual users drive a weighted mix of flows against the API.
+# Usage (from backend/):
+#   python scripts/loadgen.py                                  # in-process ASGI app, temp DB
+#   python scripts/loadgen.py --target uvicorn --workers 2     # local uvicorn subprocess
+#   python scripts/loadgen.py --target https://localhost       # already running stack (via NGINX)
+#   ... --users 50 --ramp-seconds 10 --duration 60 --mix login=1,inbox=5,detail=4,send=1,download=2 [--json] [--out FILE]
+#
+# Local targets get throwaway settings (see _bench.bench_env) with rate limits raised so
+# the limiter does not dominate the numbers. In-process ASGI shares one event loop with
+# the generator: fine for comparing code changes, use uvicorn for absolute throughput.
+# Against an external target the users are registered through the API, so its
+# REGISTER/LOGIN/SEND rate limits must allow the configured load.
+
+_PASSWORD = "Load-Password-123!"
+_FLOWS = ("login", "inbox", "detail", "send", "download")
+
+
+@dataclass
+class Cfg:
+    target: str
+    users: int
+    ramp_seconds: float
+    duration: float
+    mix: dict[str, float]
+    attachment_bytes: list[int]
+    seed_messages: int
+    workers: int
+    timeout: float
+    origin: str
+
+
+@dataclass
+class Stats:
+    latencies: dict[str, list[float]] = field(default_factory=lambda: defaultdict(list))
+    errors: dict[str, int] = field(default_factory=lambda: defaultdict(int))
+    statuses: dict[str, dict[int, int]] = field(default_factory=lambda: defaultdict(lambda: defaultdict(int)))
+
+    def record(self, endpoint: str, seconds: float, status: int | None) -> None:
+        self.latencies[endpoint].append(seconds)
+        if status is None:
+            self.errors[endpoint] += 1
+            return
+        self.statuses[endpoint][status] += 1
+        if status >= 400:
+            self.errors[endpoint] += 1
+
+
+@dataclass
+class VirtualUser:
+    email: str
+    username: str
+    client: httpx.AsyncClient
+    inbox: list[str] = field(default_factory=list)
+    attachments: list[tuple[str, str]] = field(default_factory=list)
+
+
+def die(msg: str) -> None:
+    print(msg, file=sys.stderr)
+    raise SystemExit(1)
+
+
+def _parse_mix(value: str) -> dict[str, float]:
+    mix: dict[str, float] = {}
+    for part in value.split(","):
+        name, _, weight = part.partition("=")
+        name = name.strip()
+        if name not in _FLOWS:
+            raise argparse.ArgumentTypeError(f"unknown flow {name!r} (expected one of {', '.join(_FLOWS)})")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+async def _timed(stats: Stats, endpoint: str, request) -> httpx.Response | None:
+    t0 = time.perf_counter()
+    try:
+        resp = await request
+    except httpx.HTTPError:
+        stats.record(endpoint, time.perf_counter() - t0, None)
+        return None
+    stats.record(endpoint, time.perf_counter() - t0, resp.status_code)
+    return resp
+
+
+async def _login(vu: VirtualUser, stats: Stats) -> bool:
+    resp = await _timed(stats, "POST /auth/login", vu.client.post("/api/auth/login", json={"email": vu.email, "password": _PASSWORD}))
+    return resp is not None and resp.status_code == 200
+
+
+async def _inbox(vu: VirtualUser, stats: Stats) -> None:
+    resp = await _timed(stats, "GET /messages/inbox", vu.client.get("/api/messages/inbox"))
+    if resp is not None and resp.status_code == 200:
+        vu.inbox = [item["id"] for item in resp.json()]
+
+
+async def _detail(vu: VirtualUser, stats: Stats, rnd: random.Random) -> None:
+    if not vu.inbox:
+        await _inbox(vu, stats)
+        if not vu.inbox:
+            return
+    mid = rnd.choice(vu.inbox)
+    resp = await _timed(stats, "GET /messages/{id}", vu.client.get(f"/api/messages/{mid}"))
+    if resp is not None and resp.status_code == 200:
+        for a in resp.json()["attachments"]:
+            if (mid, a["id"]) not in vu.attachments:
+                vu.attachments.append((mid, a["id"]))
+
+
+async def _send(vu: VirtualUser, stats: Stats, rnd: random.Random, cfg: Cfg, peers: list[str]) -> None:
+    recipients = rnd.sample([p for p in peers if p != vu.username], k=min(2, len(peers) - 1))
+    size = rnd.choice(cfg.attachment_bytes) if cfg.attachment_bytes else 0
+    files = [("files", ("load.bin", rnd.randbytes(size), "application/octet-stream"))] if size else None
+    data = {"recipients": json.dumps(recipients), "subject": "Load test", "body": "lorem ipsum dolor sit amet " * 20}
+    await _timed(stats, "POST /messages/send", vu.client.post("/api/messages/send", data=data, files=files))
+
+
+async def _download(vu: VirtualUser, stats: Stats, rnd: random.Random) -> None:
+    if not vu.attachments:
+        await _detail(vu, stats, rnd)
+        if not vu.attachments:
+            return
+    mid, aid = rnd.choice(vu.attachments)
+    await _timed(stats, "GET /messages/{id}/attachments/{id}", vu.client.get(f"/api/messages/{mid}/attachments/{aid}"))
+
+
+async def _run_user(vu: VirtualUser, stats: Stats, cfg: Cfg, peers: list[str], stop_at: float, seed: int) -> None:
+    rnd = random.Random(seed)
+    flows = list(cfg.mix)
+    weights = [cfg.mix[f] for f in flows]
+    if not await _login(vu, stats):
+        return
+    while time.perf_counter() < stop_at:
+        flow = rnd.choices(flows, weights=weights)[0]
+        if flow == "login":
+            vu.client.cookies.clear()
+            await _login(vu, stats)
+        elif flow == "inbox":
+            await _inbox(vu, stats)
+        elif flow == "detail":
+            await _detail(vu, stats, rnd)
+        elif flow == "send":
+            await _send(vu, stats, rnd, cfg, peers)
+        else:
+            await _download(vu, stats, rnd)
+
+
+def _client(transport: httpx.AsyncBaseTransport | None, base_url: str, cfg: Cfg) -> httpx.AsyncClient:
+    # Origin is required on cookie-authenticated POSTs (CSRF guard).
+    return httpx.AsyncClient(
+        transport=transport, base_url=base_url, verify=False, timeout=cfg.timeout, headers={"Origin": cfg.origin}
+    )
+
+
+async def _prepare(cfg: Cfg, transport, base_url: str, run_id: str) -> list[VirtualUser]:
+    """Register the users and seed every inbox with a few messages (not measured)."""
+
+    vus = [
+        VirtualUser(email=f"load{run_id}_{i}@example.com", username=f"load{run_id}_{i}", client=_client(transport, base_url, cfg))
+        for i in range(cfg.users)
+    ]
+    sem = asyncio.Semaphore(16)
+
+    async def _register(vu: VirtualUser) -> None:
+        async with sem:
+            r = await vu.client.post("/api/auth/register", json={"email": vu.email, "username": vu.username, "password": _PASSWORD})
+            if r.status_code not in (200, 201):
+                die(f"[load] register failed: {r.status_code} {r.text}")
+            r = await vu.client.post("/api/auth/login", json={"email": vu.email, "password": _PASSWORD})
+            if r.status_code != 200:
+                die(f"[load] login failed: {r.status_code} {r.text}")
+
+    await asyncio.gather(*(_register(vu) for vu in vus))
+
+    rnd = random.Random(0)
+    usernames = [vu.username for vu in vus]
+    scratch = Stats()
+
+    async def _seed(vu: VirtualUser) -> None:
+        async with sem:
+            for _ in range(cfg.seed_messages):
+                await _send(vu, scratch, rnd, cfg, usernames)
+
+    await asyncio.gather(*(_seed(vu) for vu in vus))
+    if scratch.errors:
+        die(f"[load] seeding messages failed: {dict(scratch.statuses)}")
+    for vu in vus:
+        vu.client.cookies.clear()
+    return vus
+
+
+async def _drive(cfg: Cfg, transport, base_url: str) -> tuple[Stats, float]:
+    run_id = os.urandom(3).hex()
+    print(f"[load] preparing {cfg.users} users against {base_url}", file=sys.stderr)
+    vus = await _prepare(cfg, transport, base_url, run_id)
+    peers = [vu.username for vu in vus]
+
+    stats = Stats()
+    started = time.perf_counter()
+    stop_at = started + cfg.ramp_seconds + cfg.duration
+    tasks = []
+    print(f"[load] ramping to {cfg.users} users over {cfg.ramp_seconds}s, then {cfg.duration}s steady", file=sys.stderr)
+    for i, vu in enumerate(vus):
+        # Linear ramp: user i starts at i/users of the ramp window.
+        delay = cfg.ramp_seconds * i / max(1, cfg.users)
+        await asyncio.sleep(max(0.0, started + delay - time.perf_counter()))
+        tasks.append(asyncio.create_task(_run_user(vu, stats, cfg, peers, stop_at, seed=i)))
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - started
+    for vu in vus:
+        await vu.client.aclose()
+    return stats, elapsed
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+@contextlib.contextmanager
+def _uvicorn(workers: int):
+    port = _free_port()
+    # WEB_CONCURRENCY as entrypoint.sh exports it: the workers share rate limits through the database.
+    env = dict(os.environ, COOKIE_SECURE="false", WEB_CONCURRENCY=str(workers))
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app.main:app", "--host", "127.0.0.1", "--port", str(port), "--workers", str(workers), "--log-level", "warning"],
+        env=env,
+    )
+    base_url = f"http://127.0.0.1:{port}"
+    try:
+        deadline = time.monotonic() + 30
+        while True:
+            if proc.poll() is not None:
+                die(f"[load] uvicorn exited with {proc.returncode}")
+            try:
+                httpx.get(base_url + "/api/users/me", timeout=1.0)
+                break
+            except httpx.HTTPError:
+                if time.monotonic() > deadline:
+                    die("[load] uvicorn did not come up within 30s")
+                time.sleep(0.2)
+        yield base_url
+    finally:
+        proc.terminate()
+        try:
+            proc.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+
+
+async def _run_asgi(cfg: Cfg) -> tuple[Stats, float]:
+    from app.main import app
+
+    async with app.router.lifespan_context(app):
+        transport = httpx.ASGITransport(app=app)
+        return await _drive(cfg, transport, os.environ["PUBLIC_BASE_URL"])
+
+
+def _summaries(stats: Stats, elapsed: float) -> tuple[list[_bench.Result], dict]:
+    results: list[_bench.Result] = []
+    total = errors = 0
+    for endpoint in sorted(stats.latencies):
+        samples = stats.latencies[endpoint]
+        total += len(samples)
+        errors += stats.errors[endpoint]
+        results.append(
+            _bench.summarize(
+                endpoint,
+                samples,
+                requests=len(samples),
+                errors=stats.errors[endpoint],
+                rps=round(len(samples) / elapsed, 2),
+                statuses={str(k): v for k, v in sorted(stats.statuses[endpoint].items())},
+            )
+        )
+    overall = {
+        "elapsed_seconds": round(elapsed, 2),
+        "requests": total,
+        "errors": errors,
+        "error_rate": round(errors / total, 4) if total else 0.0,
+        "throughput_rps": round(total / elapsed, 2) if elapsed else 0.0,
+    }
+    return results, overall
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Async HTTP load generator for the messaging API")
+    parser.add_argument("--target", default="asgi", help="asgi | uvicorn | base URL of a running instance")
+    parser.add_argument("--users", type=int, default=20, help="concurrent virtual users")
+    parser.add_argument("--ramp-seconds", type=float, default=5.0)
+    parser.add_argument("--duration", type=float, default=30.0, help="steady-state seconds after the ramp")
+    parser.add_argument("--mix", type=_parse_mix, default=_parse_mix("login=1,inbox=5,detail=4,send=1,download=2"))
+    parser.add_argument(
+        "--attachment-bytes",
+        default="0,16384,1048576",
+        help="comma-separated attachment sizes picked per send (0 = text only)",
+    )
+    parser.add_argument("--seed-messages", type=int, default=5, help="messages each user sends before the run")
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn workers (--target uvicorn)")
+    parser.add_argument("--timeout", type=float, default=60.0)
+    parser.add_argument("--db", type=Path, help="SQLite file for local targets (default: fresh temp file)")
+    parser.add_argument("--json", action="store_true", help="emit machine-readable JSON")
+    parser.add_argument("--out", type=Path, help="also write the JSON report to this file")
+    args = parser.parse_args()
+
+    if args.users < 3:
+        parser.error("--users must be at least 3")
+
+    # The app's logging config would otherwise print one httpx line per request.
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    local = args.target in ("asgi", "uvicorn")
+    if local:
+        _bench.bench_env(str(args.db.resolve()) if args.db else None)
+        for name, value in (
+            ("LOGIN_RATE_LIMIT_PER_MINUTE", "1000000"),
+            ("REGISTER_RATE_LIMIT_PER_HOUR", "1000000"),
+            ("SEND_RATE_LIMIT_PER_MINUTE", "1000000"),
+        ):
+            os.environ.setdefault(name, value)
+    origin = os.environ.get("PUBLIC_BASE_URL", args.target if not local else "https://localhost").rstrip("/")
+
+    cfg = Cfg(
+        target=args.target,
+        users=args.users,
+        ramp_seconds=args.ramp_seconds,
+        duration=args.duration,
+        mix=args.mix,
+        attachment_bytes=[int(x) for x in args.attachment_bytes.split(",") if x.strip()],
+        seed_messages=args.seed_messages,
+        workers=args.workers,
+        timeout=args.timeout,
+        origin=origin,
+    )
+
+    if args.target == "asgi":
+        stats, elapsed = asyncio.run(_run_asgi(cfg))
+    elif args.target == "uvicorn":
+        # The workers inherit SQLITE_PATH and the keys chosen above.
+        with _uvicorn(args.workers) as base_url:
+            stats, elapsed = asyncio.run(_drive(cfg, None, base_url))
+    else:
+        stats, elapsed = asyncio.run(_drive(cfg, None, args.target.rstrip("/")))
+
+    results, overall = _summaries(stats, elapsed)
+    params = {
+        "target": args.target,
+        "workers": args.workers if args.target == "uvicorn" else None,
+        "users": cfg.users,
+        "ramp_seconds": cfg.ramp_seconds,
+        "duration": cfg.duration,
+        "mix": cfg.mix,
+        "attachment_bytes": cfg.attachment_bytes,
+        "summary": overall,
+    }
+    doc = _bench.report("load", results, params)
+    _bench.emit(doc, as_json=args.json, out=args.out)
+    if not args.json:
+        print(
+            f"[load] {overall['requests']} requests in {overall['elapsed_seconds']}s: "
+            f"{overall['throughput_rps']} req/s, error rate {overall['error_rate']:.2%}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,277 @@
+from __future__ import annotations
+
+import argparse
+import fnmatch
+import json
+import math
+import shlex
+import subprocess
+import sys
+import tempfile
+from dataclasses import dataclass
+from pathlib import Path
+
+
+# Performance regression gate over the bench_*.py / loadgen.py JSON reports.
+# Usage (from backend/):
+#   python scripts/perf_gate.py run --suite crypto --suite service --record     # store a baseline
+#   python scripts/perf_gate.py run --suite crypto --suite service              # compare; exit 1 on regression
+#   python scripts/perf_gate.py compare crypto.json service.json                # compare existing reports
+#   python scripts/perf_gate.py record crypto.json                              # store existing reports
+#
+# Baselines live in one JSON file keyed by host fingerprint + Python minor version, then
+# suite, then benchmark name; a report is only ever compared with a baseline from the
+# same kind of host and interpreter. A benchmark regresses when its metric (p50 by
+# default) grows by more than the threshold AND Welch's t on the means exceeds --z, so
+# a noisy sample alone does not fail the gate. Where a report carries a SQL statement
+# count (bench_service), any increase fails outright: that is how an N+1 shows up.
+#
+# Exit codes: 0 ok, 1 regression, 2 no comparable baseline (0 with --allow-missing).
+
+_SCRIPTS = Path(__file__).resolve().parent
+_SUITES = {"crypto": "bench_crypto.py", "service": "bench_service.py", "load": "loadgen.py"}
+
+# Run-length knobs: changing them does not make two runs incomparable.
+_IGNORED_PARAMS = {"repeat", "send_repeat", "argon2_repeat", "budget_seconds", "summary"}
+
+
+@dataclass
+class Verdict:
+    suite: str
+    name: str
+    status: str  # ok | regression | improvement | new
+    detail: str
+
+
+def die(msg: str, code: int = 2) -> None:
+    print(msg, file=sys.stderr)
+    raise SystemExit(code)
+
+
+def _baseline_key(report: dict) -> str:
+    major, minor = report["python"].split(".")[:2]
+    return f"{report['host']['fingerprint']}/{report['implementation'].lower()}{major}.{minor}"
+
+
+def _load_json(path: Path) -> dict:
+    try:
+        return json.loads(path.read_text())
+    except FileNotFoundError:
+        die(f"[gate] {path} not found")
+    except json.JSONDecodeError as exc:
+        die(f"[gate] {path} is not valid JSON: {exc}")
+    raise AssertionError("unreachable")
+
+
+def _load_baselines(path: Path) -> dict:
+    if not path.exists():
+        return {"schema": 1, "baselines": {}}
+    return _load_json(path)
+
+
+def _comparable_params(params: dict) -> dict:
+    return {k: v for k, v in params.items() if k not in _IGNORED_PARAMS}
+
+
+def record(reports: list[dict], baseline_path: Path) -> None:
+    doc = _load_baselines(baseline_path)
+    for report in reports:
+        key = _baseline_key(report)
+        entry = doc["baselines"].setdefault(key, {"host": report["host"], "python": report["python"], "suites": {}})
+        entry["python"] = report["python"]
+        entry["suites"][report["suite"]] = {
+            "recorded_at": report["created_at"],
+            "revision": report.get("revision"),
+            "packages": report.get("packages", {}),
+            "params": report["params"],
+            "results": {r["name"]: r for r in report["results"]},
+        }
+        print(f"[gate] recorded {report['suite']} ({len(report['results'])} benchmarks) under {key}")
+    baseline_path.write_text(json.dumps(doc, indent=2, sort_keys=True) + "\n")
+
+
+def _threshold_for(name: str, default: float, overrides: list[tuple[str, float]]) -> float:
+    for pattern, value in overrides:
+        if fnmatch.fnmatchcase(name, pattern):
+            return value
+    return default
+
+
+def _welch_t(cur: dict, base: dict) -> float:
+    # Summary statistics only: enough for a one-sided "current is slower" test.
+    var = (cur["stdev"] ** 2) / max(1, cur["samples"]) + (base["stdev"] ** 2) / max(1, base["samples"])
+    if var <= 0:
+        return math.inf if cur["mean"] > base["mean"] else 0.0
+    return (cur["mean"] - base["mean"]) / math.sqrt(var)
+
+
+def _judge(suite: str, cur: dict, base: dict | None, *, metric: str, threshold: float, z: float) -> Verdict:
+    name = cur["name"]
+    if base is None:
+        return Verdict(suite, name, "new", "no baseline entry")
+
+    cur_q, base_q = cur.get("extra", {}).get("queries"), base.get("extra", {}).get("queries")
+    if cur_q is not None and base_q is not None and cur_q > base_q:
+        return Verdict(suite, name, "regression", f"SQL statements {base_q} -> {cur_q}")
+
+    b, c = base[metric], cur[metric]
+    if b <= 0:
+        return Verdict(suite, name, "ok", f"{metric} {c} {cur['unit']} (baseline 0)")
+    change = c / b - 1.0
+    t = _welch_t(cur, base)
+    detail = f"{metric} {b} -> {c} {cur['unit']} ({change:+.1%}, t={t:.1f}, limit +{threshold:.0%})"
+    if change > threshold and t > z:
+        return Verdict(suite, name, "regression", detail)
+    if change < -threshold and -t > z:
+        return Verdict(suite, name, "improvement", detail)
+    return Verdict(suite, name, "ok", detail)
+
+
+def compare(
+    reports: list[dict],
+    baseline_path: Path,
+    *,
+    metric: str,
+    threshold: float,
+    overrides: list[tuple[str, float]],
+    z: float,
+    allow_missing: bool,
+) -> int:
+    doc = _load_baselines(baseline_path)
+    verdicts: list[Verdict] = []
+    missing: list[str] = []
+    for report in reports:
+        key = _baseline_key(report)
+        base_suite = doc["baselines"].get(key, {}).get("suites", {}).get(report["suite"])
+        if base_suite is None:
+            missing.append(f"{report['suite']}: no baseline for {key}")
+            continue
+        if _comparable_params(base_suite["params"]) != _comparable_params(report["params"]):
+            missing.append(
+                f"{report['suite']}: parameters differ from the baseline "
+                f"({_comparable_params(base_suite['params'])} vs {_comparable_params(report['params'])})"
+            )
+            continue
+        for r in report["results"]:
+            verdicts.append(
+                _judge(
+                    report["suite"],
+                    r,
+                    base_suite["results"].get(r["name"]),
+                    metric=metric,
+                    threshold=_threshold_for(r["name"], threshold, overrides),
+                    z=z,
+                )
+            )
+
+    for v in verdicts:
+        marker = {"ok": " ", "new": "?", "improvement": "+", "regression": "!"}[v.status]
+        print(f"[gate] {marker} {v.suite}/{v.name}: {v.status} - {v.detail}")
+    for m in missing:
+        print(f"[gate] ? {m}", file=sys.stderr)
+
+    regressions = [v for v in verdicts if v.status == "regression"]
+    if regressions:
+        print(f"[gate] FAIL: {len(regressions)} regression(s)")
+        return 1
+    if missing and not allow_missing:
+        print("[gate] no comparable baseline; record one with `perf_gate.py record` on this host")
+        return 2
+    print(f"[gate] OK ({len(verdicts)} benchmarks compared)")
+    return 0
+
+
+def _run_suites(suites: list[str], suite_args: dict[str, list[str]]) -> list[dict]:
+    reports = []
+    with tempfile.TemporaryDirectory(prefix="perf-gate-") as tmp:
+        for suite in suites:
+            out = Path(tmp) / f"{suite}.json"
+            cmd = [sys.executable, str(_SCRIPTS / _SUITES[suite]), "--out", str(out), *suite_args.get(suite, [])]
+            print(f"[gate] running {' '.join(shlex.quote(c) for c in cmd)}", file=sys.stderr)
+            # The suite's table goes to our stdout; only the JSON file is parsed.
+            if subprocess.run(cmd).returncode != 0:
+                die(f"[gate] suite {suite} failed")
+            reports.append(_load_json(out))
+    return reports
+
+
+def _parse_override(value: str) -> tuple[str, float]:
+    pattern, sep, threshold = value.rpartition("=")
+    if not sep or not pattern:
+        raise argparse.ArgumentTypeError("expected PATTERN=FRACTION, e.g. 'list_inbox*=0.05'")
+    return pattern, float(threshold)
+
+
+def _parse_suite_args(values: list[str]) -> dict[str, list[str]]:
+    out: dict[str, list[str]] = {}
+    for v in values:
+        suite, sep, args = v.partition("=")
+        if not sep or suite not in _SUITES:
+            die(f"[gate] --suite-args expects SUITE=\"ARGS\" with SUITE one of {', '.join(_SUITES)}")
+        out.setdefault(suite, []).extend(shlex.split(args))
+    return out
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Store benchmark baselines and fail on regressions")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    def _common(p: argparse.ArgumentParser) -> None:
+        p.add_argument("--baseline", type=Path, default=Path("perf-baselines.json"), help="baseline store (JSON)")
+
+    def _compare_opts(p: argparse.ArgumentParser) -> None:
+        p.add_argument("--metric", choices=["p50", "p95", "p99", "mean"], default="p50")
+        p.add_argument("--threshold", type=float, default=0.10, help="allowed relative slowdown (0.10 = 10%%)")
+        p.add_argument(
+            "--threshold-for",
+            type=_parse_override,
+            action="append",
+            default=[],
+            metavar="PATTERN=FRACTION",
+            help="per-benchmark threshold, glob on the name (first match wins)",
+        )
+        p.add_argument("--z", type=float, default=3.0, help="Welch t required before a slowdown counts")
+        p.add_argument("--allow-missing", action="store_true", help="exit 0 when no comparable baseline exists")
+
+    p_record = sub.add_parser("record", help="store reports as the baseline for this host/Python")
+    p_record.add_argument("reports", nargs="+", type=Path)
+    _common(p_record)
+
+    p_compare = sub.add_parser("compare", help="compare reports with the stored baseline")
+    p_compare.add_argument("reports", nargs="+", type=Path)
+    _common(p_compare)
+    _compare_opts(p_compare)
+
+    p_run = sub.add_parser("run", help="run suites, then compare (or --record)")
+    p_run.add_argument("--suite", action="append", choices=sorted(_SUITES), help="default: crypto and service")
+    p_run.add_argument("--suite-args", action="append", default=[], metavar='SUITE="ARGS"', help="extra arguments for one suite")
+    p_run.add_argument("--record", action="store_true", help="store the results instead of comparing")
+    _common(p_run)
+    _compare_opts(p_run)
+
+    args = parser.parse_args()
+
+    if args.command == "run":
+        reports = _run_suites(args.suite or ["crypto", "service"], _parse_suite_args(args.suite_args))
+    else:
+        reports = [_load_json(p) for p in args.reports]
+
+    if args.command == "record" or (args.command == "run" and args.record):
+        record(reports, args.baseline)
+        return
+
+    raise SystemExit(
+        compare(
+            reports,
+            args.baseline,
+            metric=args.metric,
+            threshold=args.threshold,
+            overrides=args.threshold_for,
+            z=args.z,
+            allow_missing=args.allow_missing,
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
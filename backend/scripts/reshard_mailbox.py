@@ -0,0 +1,103 @@
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import sqlite3
+import sys
+
+from app.core.config import settings
+from app.db.init import init_sqlite_schema, open_mailbox_shard
+from app.db.shards import existing_shard_indexes, shard_for, shard_path
+
+
+# Moves mailbox rows (message_recipients) into the layout of MAILBOX_SHARDS=N. Usage (from
+# backend/, app stopped):
+#   MAILBOX_SHARDS=4 python scripts/reshard_mailbox.py          # turn on / change N
+#   python scripts/reshard_mailbox.py --shards 0                # back into the main file
+#
+# - rows are read from the main file and from every shard file present, whatever layout
+#   they were written with, and copied to the file their recipient hashes to;
+# - rows of messages that no longer exist (leftovers of a failed send) are dropped;
+# - copies use INSERT OR IGNORE and only misplaced rows are deleted afterwards, so an
+#   interrupted run is finished by running it again;
+# - shard files beyond N are removed once empty.
+
+
+def _columns(conn: sqlite3.Connection) -> str:
+    return ", ".join(row[1] for row in conn.execute("PRAGMA main.table_info(message_recipients)"))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Move mailbox rows into the MAILBOX_SHARDS layout")
+    parser.add_argument("--shards", type=int, default=settings.mailbox_shards, help="target shard count (default: MAILBOX_SHARDS)")
+    args = parser.parse_args()
+
+    if settings.database_url:
+        raise SystemExit("[reshard] DATABASE_URL is set; mailbox sharding applies to SQLite only")
+    n = args.shards
+    if not 0 <= n <= 8:
+        raise SystemExit("[reshard] --shards must be between 0 and 8")
+
+    files = sorted(set(existing_shard_indexes()) | set(range(n)))
+    for i in files:
+        open_mailbox_shard(shard_path(i)).close()
+
+    conn = sqlite3.connect(settings.sqlite_path, isolation_level=None)
+    try:
+        conn.create_function("mailbox_shard", 1, lambda user_id: shard_for(user_id, n) if n else None, deterministic=True)
+        for i in files:
+            conn.execute(f"ATTACH DATABASE ? AS mbox{i}", (str(shard_path(i)),))
+        columns = _columns(conn)
+        tables = ["main"] + [f"mbox{i}" for i in files]
+
+        def target(schema: str) -> str:
+            # Rows of `schema` that belong somewhere else.
+            if n == 0:
+                return "1" if schema != "main" else "0"
+            if schema == "main" or int(schema[4:]) >= n:
+                return "1"
+            return f"mailbox_shard(recipient_user_id) != {schema[4:]}"
+
+        before = {t: conn.execute(f"SELECT COUNT(*) FROM {t}.message_recipients").fetchone()[0] for t in tables}
+        conn.execute("BEGIN IMMEDIATE")
+        for src in tables:
+            misplaced = f"FROM {src}.message_recipients WHERE {target(src)} AND message_id IN (SELECT id FROM main.messages)"
+            if n == 0:
+                conn.execute(f"INSERT OR IGNORE INTO main.message_recipients ({columns}) SELECT {columns} {misplaced}")
+            else:
+                for k in range(n):
+                    conn.execute(
+                        f"INSERT OR IGNORE INTO mbox{k}.message_recipients ({columns}) "
+                        f"SELECT {columns} {misplaced} AND mailbox_shard(recipient_user_id) = {k}"
+                    )
+        for src in tables:
+            conn.execute(f"DELETE FROM {src}.message_recipients WHERE {target(src)}")
+            if src != "main":
+                conn.execute(f"DELETE FROM {src}.mailbox_shard")
+                if int(src[4:]) < n:
+                    conn.execute(f"INSERT INTO {src}.mailbox_shard (shard_index, shard_count) VALUES (?, ?)", (int(src[4:]), n))
+        conn.execute("COMMIT")
+        after = {t: conn.execute(f"SELECT COUNT(*) FROM {t}.message_recipients").fetchone()[0] for t in tables}
+        for i in files:
+            conn.execute(f"DETACH DATABASE mbox{i}")
+    finally:
+        conn.close()
+
+    for i in files:
+        if i >= n and after[f"mbox{i}"] == 0:
+            for suffix in ("", "-wal", "-shm"):
+                path = f"{shard_path(i)}{suffix}"
+                if os.path.exists(path):
+                    os.remove(path)
+
+    # Checks the new layout the way startup will (with --shards in place of MAILBOX_SHARDS).
+    settings.mailbox_shards = n
+    init_sqlite_schema()
+
+    json.dump({"shards": n, "before": before, "after": after}, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+from __future__ import annotations
+
+import argparse
+import json
+import sys
+
+from app.core.key_rotation import ENVELOPES, pending_rewrap_counts, rewrap_envelope
+from app.db.init import init_schema
+from app.db.models import KeyRotationCheckpoint
+from app.db.session import SessionLocal
+
+
+# KEK rotation, operator side. Usage (from backend/, same environment as the app):
+#   1. set DATA_KEY (etc.) to the new key, bump DATA_KEY_VERSION and move the old key to DATA_KEY_RETIRED=1:<base64>
+#   2. restart the app (new envelopes use the new key; the background worker starts re-wrapping)
+#      or run this script:       python scripts/rewrap_keys.py [--batch-size N] [--pause-ms N]
+#   3. check progress:           python scripts/rewrap_keys.py --status
+#   4. once everything reports 0 pending, drop the *_RETIRED entry. Messages that fail their
+#      authenticity check stay on the retired key (reported as skipped) until resolved.
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Re-wrap stored keys under the current KEK versions")
+    parser.add_argument("--status", action="store_true", help="only report envelopes still under retired keys")
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--pause-ms", type=int, default=100, help="pause between batches (lets app writers in)")
+    args = parser.parse_args()
+
+    init_schema()
+    db = SessionLocal()
+    try:
+        if not args.status:
+            for env in ENVELOPES:
+                n = rewrap_envelope(db, env, batch_size=args.batch_size, pause_seconds=args.pause_ms / 1000.0)
+                cp = db.get(KeyRotationCheckpoint, env.name)
+                skipped = f", skipped {cp.skipped}" if cp is not None and cp.skipped else ""
+                print(f"[rewrap] {env.name}: re-wrapped {n}{skipped}")
+        pending = pending_rewrap_counts(db)
+    finally:
+        db.close()
+
+    json.dump(pending, sys.stdout, indent=2)
+    print()
+    if any(pending.values()):
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
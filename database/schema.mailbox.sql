@@ -0,0 +1,27 @@
+-- Mailbox shard (MAILBOX_SHARDS > 0): one file per shard next to the main database,
+-- holding the message_recipients rows of the users that hash to it (app/db/shards.py).
+-- Same columns and indexes as message_recipients in schema.sql; no foreign keys, since
+-- SQLite cannot enforce them across files (messages/users live in the main file).
+
+CREATE TABLE IF NOT EXISTS message_recipients (
+  message_id TEXT NOT NULL,
+  recipient_user_id TEXT NOT NULL,
+
+  delivered_at TEXT NOT NULL,
+  read_at TEXT,
+  deleted_at TEXT,
+
+  -- Result of last authenticity verification (defense-in-depth, optional cache)
+  authenticity_verified INTEGER NOT NULL DEFAULT 0,
+
+  PRIMARY KEY (message_id, recipient_user_id)
+);
+
+CREATE INDEX IF NOT EXISTS idx_message_recipients_recipient ON message_recipients(recipient_user_id);
+
+-- Which slot of which layout this file is; startup refuses a file from another layout
+-- (MAILBOX_SHARDS changed without scripts/reshard_mailbox.py).
+CREATE TABLE IF NOT EXISTS mailbox_shard (
+  shard_index INTEGER NOT NULL,
+  shard_count INTEGER NOT NULL
+);
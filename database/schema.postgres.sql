@@ -0,0 +1,323 @@
+-- PostgreSQL variant of schema.sql (DATABASE_URL=postgresql+psycopg://...).
+-- Same tables, columns and constraints; native types instead of SQLite's affinities:
+-- BYTEA for ciphertext/nonce/tag/HMAC, TIMESTAMPTZ for times (UTC), BOOLEAN for flags,
+-- BIGINT for byte counters. Applied by app/db/init.py under an advisory lock.
+
+-- USERS
+CREATE TABLE IF NOT EXISTS users (
+  id TEXT PRIMARY KEY, -- UUID (TEXT, same keys as the SQLite schema)
+  email TEXT NOT NULL UNIQUE,
+  username TEXT NOT NULL UNIQUE,
+
+  -- Argon2 encoded hash string (includes parameters + salt)
+  password_hash TEXT NOT NULL,
+  password_updated_at TIMESTAMPTZ NOT NULL,
+
+  -- 2FA (TOTP) state
+  totp_enabled BOOLEAN NOT NULL DEFAULT FALSE,
+
+  -- Anti-replay: last accepted TOTP time-step (monotonic counter)
+  totp_last_used_step BIGINT,
+
+  -- TOTP secret stored encrypted at rest (AES-256-GCM), encrypted server-side
+  totp_secret_enc BYTEA,
+  totp_secret_nonce BYTEA,
+  totp_secret_tag BYTEA,
+  totp_secret_version INTEGER NOT NULL DEFAULT 1, -- KEK version (key rotation)
+
+  -- Per-user HMAC key (for message authenticity) stored encrypted at rest
+  hmac_key_enc BYTEA,
+  hmac_key_nonce BYTEA,
+  hmac_key_tag BYTEA,
+  hmac_key_version INTEGER NOT NULL DEFAULT 1, -- KEK version (key rotation)
+
+  -- Account security state
+  is_active BOOLEAN NOT NULL DEFAULT TRUE,
+  failed_login_count INTEGER NOT NULL DEFAULT 0,
+  locked_until TIMESTAMPTZ,
+  last_login_at TIMESTAMPTZ,
+
+  created_at TIMESTAMPTZ NOT NULL,
+  updated_at TIMESTAMPTZ NOT NULL
+);
+
+-- users.email needs no extra index here: the UNIQUE constraint already is one.
+
+-- SESSIONS (server-side sessions recommended; token itself never stored)
+CREATE TABLE IF NOT EXISTS user_sessions (
+  id TEXT PRIMARY KEY, -- UUID
+  user_id TEXT NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+
+  -- SHA-256(token) to protect against DB read-only leakage
+  session_token_hash BYTEA NOT NULL,
+
+  created_at TIMESTAMPTZ NOT NULL,
+  expires_at TIMESTAMPTZ NOT NULL,
+  revoked_at TIMESTAMPTZ,
+
+  ip_address TEXT,
+  user_agent TEXT
+);
+
+CREATE UNIQUE INDEX IF NOT EXISTS ux_user_sessions_token_hash ON user_sessions(session_token_hash);
+CREATE INDEX IF NOT EXISTS idx_user_sessions_user_id ON user_sessions(user_id);
+
+-- MESSAGES
+CREATE TABLE IF NOT EXISTS messages (
+  id TEXT PRIMARY KEY, -- UUID
+  sender_user_id TEXT NOT NULL REFERENCES users(id) ON DELETE RESTRICT,
+
+  -- Envelope encryption: per-message DEK encrypted with server KEK (AES-256-GCM)
+  content_key_enc BYTEA NOT NULL,
+  content_key_nonce BYTEA NOT NULL,
+  content_key_tag BYTEA NOT NULL,
+  content_key_version INTEGER NOT NULL DEFAULT 1, -- DATA_KEY version (key rotation)
+
+  -- Encrypted subject/body (AES-256-GCM using per-message DEK)
+  subject_ciphertext BYTEA NOT NULL,
+  subject_nonce BYTEA NOT NULL,
+  subject_tag BYTEA NOT NULL,
+
+  body_ciphertext BYTEA NOT NULL,
+  body_nonce BYTEA NOT NULL,
+  body_tag BYTEA NOT NULL,
+
+  -- Payload format of the body plaintext: 0 = raw, 1 = deflate, 2 = zstd (compressed before encryption)
+  body_format INTEGER NOT NULL DEFAULT 0,
+
+  -- Authenticity: HMAC-SHA-256 computed by backend using sender-specific key
+  hmac_sha256 BYTEA NOT NULL,
+  hmac_format INTEGER NOT NULL DEFAULT 1, -- 2 = payload excludes KEK-wrapped fields (re-wrappable)
+
+  -- Conversation threading: thread_id = id of the first message in the thread
+  thread_id TEXT,
+  in_reply_to TEXT REFERENCES messages(id) ON DELETE SET NULL,
+
+  created_at TIMESTAMPTZ NOT NULL,
+  deleted_by_sender_at TIMESTAMPTZ,
+
+  -- Self-destruct time (NULL = keep until deleted by everyone)
+  expires_at TIMESTAMPTZ
+);
+
+CREATE INDEX IF NOT EXISTS idx_messages_sender ON messages(sender_user_id);
+CREATE INDEX IF NOT EXISTS idx_messages_created_at ON messages(created_at);
+CREATE INDEX IF NOT EXISTS idx_messages_thread_created ON messages(thread_id, created_at);
+-- Partial indexes keep purge candidate scans proportional to the garbage, not the table.
+CREATE INDEX IF NOT EXISTS idx_messages_expires ON messages(expires_at) WHERE expires_at IS NOT NULL;
+CREATE INDEX IF NOT EXISTS idx_messages_sender_deleted ON messages(deleted_by_sender_at, id)
+  WHERE deleted_by_sender_at IS NOT NULL;
+-- PostgreSQL does not index referencing columns by itself; without this every purged
+-- message would scan messages for replies to SET NULL.
+CREATE INDEX IF NOT EXISTS idx_messages_in_reply_to ON messages(in_reply_to) WHERE in_reply_to IS NOT NULL;
+
+-- MESSAGE RECIPIENTS (N:N)
+CREATE TABLE IF NOT EXISTS message_recipients (
+  message_id TEXT NOT NULL REFERENCES messages(id) ON DELETE CASCADE,
+  recipient_user_id TEXT NOT NULL REFERENCES users(id) ON DELETE RESTRICT,
+
+  delivered_at TIMESTAMPTZ NOT NULL,
+  read_at TIMESTAMPTZ,
+  deleted_at TIMESTAMPTZ,
+
+  -- Result of last authenticity verification (defense-in-depth, optional cache)
+  authenticity_verified BOOLEAN NOT NULL DEFAULT FALSE,
+
+  PRIMARY KEY (message_id, recipient_user_id)
+);
+
+CREATE INDEX IF NOT EXISTS idx_message_recipients_recipient ON message_recipients(recipient_user_id);
+
+-- ATTACHMENT BLOBS (encrypted content shared by reference between messages, e.g. on forward)
+CREATE TABLE IF NOT EXISTS attachment_blobs (
+  id TEXT PRIMARY KEY, -- UUID
+
+  -- AES-256-GCM using a per-blob key; the key is wrapped per attachment under the message DEK
+  ciphertext BYTEA NOT NULL,
+  nonce BYTEA NOT NULL,
+  tag BYTEA NOT NULL,
+
+  -- Payload format of the plaintext: 0 = raw, 1 = deflate, 2 = zstd
+  payload_format INTEGER NOT NULL DEFAULT 0,
+
+  -- SHA-256 of ciphertext, covered by the message HMAC without re-reading the blob
+  ciphertext_sha256 BYTEA NOT NULL,
+
+  -- Number of attachments rows referencing this blob
+  ref_count INTEGER NOT NULL DEFAULT 0,
+
+  created_at TIMESTAMPTZ NOT NULL
+);
+
+-- Ciphertext is already incompressible: store it out of line without a TOAST compression attempt.
+ALTER TABLE attachment_blobs ALTER COLUMN ciphertext SET STORAGE EXTERNAL;
+
+-- ATTACHMENTS (integral part of message, encrypted at rest)
+CREATE TABLE IF NOT EXISTS attachments (
+  id TEXT PRIMARY KEY, -- UUID
+  message_id TEXT NOT NULL REFERENCES messages(id) ON DELETE CASCADE,
+
+  filename TEXT NOT NULL,
+  content_type TEXT NOT NULL,
+  size_bytes BIGINT NOT NULL,
+
+  -- Encrypted blob (AES-256-GCM using message DEK or per-attachment DEK)
+  blob_ciphertext BYTEA NOT NULL,
+  blob_nonce BYTEA NOT NULL,
+  blob_tag BYTEA NOT NULL,
+
+  -- Payload format of the blob plaintext: 0 = raw, 1 = deflate, 2 = zstd (compressed before encryption)
+  blob_format INTEGER NOT NULL DEFAULT 0,
+
+  -- Shared storage (attachment_blobs); legacy inline blob_* columns are empty when set
+  blob_id TEXT REFERENCES attachment_blobs(id) ON DELETE RESTRICT,
+  blob_key_enc BYTEA,
+  blob_key_nonce BYTEA,
+  blob_key_tag BYTEA,
+
+  created_at TIMESTAMPTZ NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS idx_attachments_message ON attachments(message_id);
+CREATE INDEX IF NOT EXISTS idx_attachments_blob ON attachments(blob_id);
+
+-- UPLOAD SESSIONS (resumable attachment uploads staged before send)
+CREATE TABLE IF NOT EXISTS upload_sessions (
+  id TEXT PRIMARY KEY, -- UUID
+  user_id TEXT NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+
+  filename TEXT NOT NULL,
+  content_type TEXT NOT NULL,
+  size_bytes BIGINT NOT NULL,
+  received_bytes BIGINT NOT NULL DEFAULT 0,
+
+  -- Per-session staging key (AES-256-GCM) wrapped under the server KEK
+  session_key_enc BYTEA NOT NULL,
+  session_key_nonce BYTEA NOT NULL,
+  session_key_tag BYTEA NOT NULL,
+  session_key_version INTEGER NOT NULL DEFAULT 1,
+
+  -- Set on finalize: assembled blob + its key wrapped under the session key
+  blob_id TEXT REFERENCES attachment_blobs(id) ON DELETE RESTRICT,
+  blob_key_enc BYTEA,
+  blob_key_nonce BYTEA,
+  blob_key_tag BYTEA,
+
+  status TEXT NOT NULL DEFAULT 'open', -- open | finalized | consumed
+
+  created_at TIMESTAMPTZ NOT NULL,
+  expires_at TIMESTAMPTZ NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS idx_upload_sessions_user ON upload_sessions(user_id);
+CREATE INDEX IF NOT EXISTS idx_upload_sessions_expires ON upload_sessions(expires_at);
+-- Checked on every blob delete (ON DELETE RESTRICT).
+CREATE INDEX IF NOT EXISTS idx_upload_sessions_blob ON upload_sessions(blob_id) WHERE blob_id IS NOT NULL;
+
+-- UPLOAD CHUNKS (each chunk encrypted on arrival with the session key)
+CREATE TABLE IF NOT EXISTS upload_chunks (
+  upload_id TEXT NOT NULL REFERENCES upload_sessions(id) ON DELETE CASCADE,
+  "offset" BIGINT NOT NULL, -- reserved word in PostgreSQL
+  size_bytes INTEGER NOT NULL,
+
+  ciphertext BYTEA NOT NULL,
+  nonce BYTEA NOT NULL,
+  tag BYTEA NOT NULL,
+
+  PRIMARY KEY (upload_id, "offset")
+);
+
+ALTER TABLE upload_chunks ALTER COLUMN ciphertext SET STORAGE EXTERNAL;
+
+-- IDEMPOTENCY KEYS (safe client retries of /messages/send)
+CREATE TABLE IF NOT EXISTS idempotency_keys (
+  user_id TEXT NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+  key TEXT NOT NULL,
+
+  -- SHA-256 over the request; reusing a key for a different request is rejected
+  request_fingerprint BYTEA NOT NULL,
+
+  -- NULL while the first request is still in progress
+  message_id TEXT,
+
+  -- The reserving request: only it may complete or release the key, and only while it
+  -- keeps renewing the lease; an expired lease lets a retry take over
+  owner_token TEXT,
+  lease_expires_at TIMESTAMPTZ,
+
+  created_at TIMESTAMPTZ NOT NULL,
+  expires_at TIMESTAMPTZ NOT NULL,
+
+  PRIMARY KEY (user_id, key)
+);
+
+CREATE INDEX IF NOT EXISTS idx_idempotency_keys_expires ON idempotency_keys(expires_at);
+
+-- RATE LIMIT BUCKETS (fixed-window counters shared by all workers, RATE_LIMIT_STORE=database)
+CREATE TABLE IF NOT EXISTS rate_limit_buckets (
+  limiter TEXT NOT NULL,
+  -- HMAC of the limiter key (client IP, e-mail); neither is stored in clear
+  bucket_key BYTEA NOT NULL,
+
+  -- Unix time of the window start, aligned to the window length
+  window_start BIGINT NOT NULL,
+  hits INTEGER NOT NULL DEFAULT 0,
+
+  PRIMARY KEY (limiter, bucket_key)
+);
+
+CREATE INDEX IF NOT EXISTS idx_rate_limit_buckets_window ON rate_limit_buckets(window_start);
+
+-- EXPORT JOBS (mailbox export progress; the archive itself is streamed, never stored)
+CREATE TABLE IF NOT EXISTS export_jobs (
+  id TEXT PRIMARY KEY, -- UUID
+  user_id TEXT NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+
+  status TEXT NOT NULL DEFAULT 'pending', -- pending | running | completed | failed
+  encrypted BOOLEAN NOT NULL DEFAULT FALSE, -- members re-encrypted to a client-supplied export key
+
+  total_messages INTEGER NOT NULL DEFAULT 0,
+  exported_messages INTEGER NOT NULL DEFAULT 0,
+  exported_bytes BIGINT NOT NULL DEFAULT 0,
+
+  created_at TIMESTAMPTZ NOT NULL,
+  started_at TIMESTAMPTZ,
+  finished_at TIMESTAMPTZ,
+
+  -- The download streaming it: only that one reports progress, and only while it renews
+  -- the lease; an expired lease lets a new download take the job over
+  owner_token TEXT,
+  lease_expires_at TIMESTAMPTZ
+);
+
+CREATE INDEX IF NOT EXISTS idx_export_jobs_user ON export_jobs(user_id);
+
+-- KEY ROTATION CHECKPOINTS (resume point of the background KEK re-wrap job)
+CREATE TABLE IF NOT EXISTS key_rotation_checkpoints (
+  name TEXT PRIMARY KEY, -- envelope family, e.g. messages.content_key
+  target_version INTEGER NOT NULL,
+  last_id TEXT, -- keyset cursor (primary key of the last processed row)
+  rewrapped BIGINT NOT NULL DEFAULT 0,
+  skipped BIGINT NOT NULL DEFAULT 0, -- rows left on the retired key (failed authenticity check)
+  completed_at TIMESTAMPTZ,
+  updated_at TIMESTAMPTZ NOT NULL
+);
+
+-- AUDIT EVENTS (security-relevant events; do not store secrets)
+CREATE TABLE IF NOT EXISTS audit_events (
+  id BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+  user_id TEXT REFERENCES users(id) ON DELETE SET NULL,
+
+  event_type TEXT NOT NULL,
+  event_time TIMESTAMPTZ NOT NULL,
+  success BOOLEAN NOT NULL,
+
+  ip_address TEXT,
+  user_agent TEXT,
+
+  -- Redacted detail (no tokens, no secrets, no ciphertext)
+  details_redacted TEXT
+);
+
+CREATE INDEX IF NOT EXISTS idx_audit_events_time ON audit_events(event_time);
+CREATE INDEX IF NOT EXISTS idx_audit_events_user ON audit_events(user_id);
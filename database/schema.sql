@@ -1,5 +1,9 @@
 PRAGMA foreign_keys = ON;
 
+-- Lets the purge worker return freed pages with PRAGMA incremental_vacuum.
+-- Only takes effect on a new (empty) database; existing files need a one-off VACUUM.
+PRAGMA auto_vacuum = INCREMENTAL;
+
 -- USERS
 CREATE TABLE IF NOT EXISTS users (
   id TEXT PRIMARY KEY, -- UUID (TEXT) for portability in SQLite
@@ -20,11 +24,13 @@ CREATE TABLE IF NOT EXISTS users (
   totp_secret_enc BLOB,
   totp_secret_nonce BLOB,
   totp_secret_tag BLOB,
+  totp_secret_version INTEGER NOT NULL DEFAULT 1, -- KEK version (key rotation)
 
   -- Per-user HMAC key (for message authenticity) stored encrypted at rest
   hmac_key_enc BLOB,
   hmac_key_nonce BLOB,
   hmac_key_tag BLOB,
+  hmac_key_version INTEGER NOT NULL DEFAULT 1, -- KEK version (key rotation)
 
   -- Account security state
   is_active INTEGER NOT NULL DEFAULT 1,
@@ -68,6 +74,7 @@ CREATE TABLE IF NOT EXISTS messages (
   content_key_enc BLOB NOT NULL,
   content_key_nonce BLOB NOT NULL,
   content_key_tag BLOB NOT NULL,
+  content_key_version INTEGER NOT NULL DEFAULT 1, -- DATA_KEY version (key rotation)
 
   -- Encrypted subject/body (AES-256-GCM using per-message DEK)
   subject_ciphertext BLOB NOT NULL,
@@ -78,13 +85,25 @@ CREATE TABLE IF NOT EXISTS messages (
   body_nonce BLOB NOT NULL,
   body_tag BLOB NOT NULL,
 
+  -- Payload format of the body plaintext: 0 = raw, 1 = deflate, 2 = zstd (compressed before encryption)
+  body_format INTEGER NOT NULL DEFAULT 0,
+
   -- Authenticity: HMAC-SHA-256 computed by backend using sender-specific key
   hmac_sha256 BLOB NOT NULL,
+  hmac_format INTEGER NOT NULL DEFAULT 1, -- 2 = payload excludes KEK-wrapped fields (re-wrappable)
+
+  -- Conversation threading: thread_id = id of the first message in the thread
+  thread_id TEXT,
+  in_reply_to TEXT,
 
   created_at TEXT NOT NULL,
   deleted_by_sender_at TEXT,
 
-  FOREIGN KEY (sender_user_id) REFERENCES users(id) ON DELETE RESTRICT
+  -- Self-destruct time (NULL = keep until deleted by everyone)
+  expires_at TEXT,
+
+  FOREIGN KEY (sender_user_id) REFERENCES users(id) ON DELETE RESTRICT,
+  FOREIGN KEY (in_reply_to) REFERENCES messages(id) ON DELETE SET NULL
 );
 
 CREATE INDEX IF NOT EXISTS idx_messages_sender ON messages(sender_user_id);
@@ -109,6 +128,27 @@ CREATE TABLE IF NOT EXISTS message_recipients (
 
 CREATE INDEX IF NOT EXISTS idx_message_recipients_recipient ON message_recipients(recipient_user_id);
 
+-- ATTACHMENT BLOBS (encrypted content shared by reference between messages, e.g. on forward)
+CREATE TABLE IF NOT EXISTS attachment_blobs (
+  id TEXT PRIMARY KEY, -- UUID
+
+  -- AES-256-GCM using a per-blob key; the key is wrapped per attachment under the message DEK
+  ciphertext BLOB NOT NULL,
+  nonce BLOB NOT NULL,
+  tag BLOB NOT NULL,
+
+  -- Payload format of the plaintext: 0 = raw, 1 = deflate, 2 = zstd
+  payload_format INTEGER NOT NULL DEFAULT 0,
+
+  -- SHA-256 of ciphertext, covered by the message HMAC without re-reading the blob
+  ciphertext_sha256 BLOB NOT NULL,
+
+  -- Number of attachments rows referencing this blob
+  ref_count INTEGER NOT NULL DEFAULT 0,
+
+  created_at TEXT NOT NULL
+);
+
 -- ATTACHMENTS (integral part of message, encrypted at rest)
 CREATE TABLE IF NOT EXISTS attachments (
   id TEXT PRIMARY KEY, -- UUID
@@ -123,13 +163,148 @@ CREATE TABLE IF NOT EXISTS attachments (
   blob_nonce BLOB NOT NULL,
   blob_tag BLOB NOT NULL,
 
+  -- Payload format of the blob plaintext: 0 = raw, 1 = deflate, 2 = zstd (compressed before encryption)
+  blob_format INTEGER NOT NULL DEFAULT 0,
+
+  -- Shared storage (attachment_blobs); legacy inline blob_* columns are empty when set
+  blob_id TEXT,
+  blob_key_enc BLOB,
+  blob_key_nonce BLOB,
+  blob_key_tag BLOB,
+
   created_at TEXT NOT NULL,
 
-  FOREIGN KEY (message_id) REFERENCES messages(id) ON DELETE CASCADE
+  FOREIGN KEY (message_id) REFERENCES messages(id) ON DELETE CASCADE,
+  FOREIGN KEY (blob_id) REFERENCES attachment_blobs(id) ON DELETE RESTRICT
 );
 
 CREATE INDEX IF NOT EXISTS idx_attachments_message ON attachments(message_id);
 
+-- UPLOAD SESSIONS (resumable attachment uploads staged before send)
+CREATE TABLE IF NOT EXISTS upload_sessions (
+  id TEXT PRIMARY KEY, -- UUID
+  user_id TEXT NOT NULL,
+
+  filename TEXT NOT NULL,
+  content_type TEXT NOT NULL,
+  size_bytes INTEGER NOT NULL,
+  received_bytes INTEGER NOT NULL DEFAULT 0,
+
+  -- Per-session staging key (AES-256-GCM) wrapped under the server KEK
+  session_key_enc BLOB NOT NULL,
+  session_key_nonce BLOB NOT NULL,
+  session_key_tag BLOB NOT NULL,
+  session_key_version INTEGER NOT NULL DEFAULT 1,
+
+  -- Set on finalize: assembled blob + its key wrapped under the session key
+  blob_id TEXT,
+  blob_key_enc BLOB,
+  blob_key_nonce BLOB,
+  blob_key_tag BLOB,
+
+  status TEXT NOT NULL DEFAULT 'open', -- open | finalized | consumed
+
+  created_at TEXT NOT NULL,
+  expires_at TEXT NOT NULL,
+
+  FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE,
+  FOREIGN KEY (blob_id) REFERENCES attachment_blobs(id) ON DELETE RESTRICT
+);
+
+CREATE INDEX IF NOT EXISTS idx_upload_sessions_user ON upload_sessions(user_id);
+CREATE INDEX IF NOT EXISTS idx_upload_sessions_expires ON upload_sessions(expires_at);
+
+-- UPLOAD CHUNKS (each chunk encrypted on arrival with the session key)
+CREATE TABLE IF NOT EXISTS upload_chunks (
+  upload_id TEXT NOT NULL,
+  offset INTEGER NOT NULL,
+  size_bytes INTEGER NOT NULL,
+
+  ciphertext BLOB NOT NULL,
+  nonce BLOB NOT NULL,
+  tag BLOB NOT NULL,
+
+  PRIMARY KEY (upload_id, offset),
+  FOREIGN KEY (upload_id) REFERENCES upload_sessions(id) ON DELETE CASCADE
+);
+
+-- IDEMPOTENCY KEYS (safe client retries of /messages/send)
+CREATE TABLE IF NOT EXISTS idempotency_keys (
+  user_id TEXT NOT NULL,
+  key TEXT NOT NULL,
+
+  -- SHA-256 over the request; reusing a key for a different request is rejected
+  request_fingerprint BLOB NOT NULL,
+
+  -- NULL while the first request is still in progress
+  message_id TEXT,
+
+  -- The reserving request: only it may complete or release the key, and only while it
+  -- keeps renewing the lease; an expired lease lets a retry take over
+  owner_token TEXT,
+  lease_expires_at TEXT,
+
+  created_at TEXT NOT NULL,
+  expires_at TEXT NOT NULL,
+
+  PRIMARY KEY (user_id, key),
+  FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+);
+
+CREATE INDEX IF NOT EXISTS idx_idempotency_keys_expires ON idempotency_keys(expires_at);
+
+-- RATE LIMIT BUCKETS (fixed-window counters shared by all workers, RATE_LIMIT_STORE=database)
+CREATE TABLE IF NOT EXISTS rate_limit_buckets (
+  limiter TEXT NOT NULL,
+  -- HMAC of the limiter key (client IP, e-mail); neither is stored in clear
+  bucket_key BLOB NOT NULL,
+
+  -- Unix time of the window start, aligned to the window length
+  window_start INTEGER NOT NULL,
+  hits INTEGER NOT NULL DEFAULT 0,
+
+  PRIMARY KEY (limiter, bucket_key)
+);
+
+CREATE INDEX IF NOT EXISTS idx_rate_limit_buckets_window ON rate_limit_buckets(window_start);
+
+-- EXPORT JOBS (mailbox export progress; the archive itself is streamed, never stored)
+CREATE TABLE IF NOT EXISTS export_jobs (
+  id TEXT PRIMARY KEY, -- UUID
+  user_id TEXT NOT NULL,
+
+  status TEXT NOT NULL DEFAULT 'pending', -- pending | running | completed | failed
+  encrypted INTEGER NOT NULL DEFAULT 0,   -- members re-encrypted to a client-supplied export key
+
+  total_messages INTEGER NOT NULL DEFAULT 0,
+  exported_messages INTEGER NOT NULL DEFAULT 0,
+  exported_bytes INTEGER NOT NULL DEFAULT 0,
+
+  created_at TEXT NOT NULL,
+  started_at TEXT,
+  finished_at TEXT,
+
+  -- The download streaming it: only that one reports progress, and only while it renews
+  -- the lease; an expired lease lets a new download take the job over
+  owner_token TEXT,
+  lease_expires_at TEXT,
+
+  FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+);
+
+CREATE INDEX IF NOT EXISTS idx_export_jobs_user ON export_jobs(user_id);
+
+-- KEY ROTATION CHECKPOINTS (resume point of the background KEK re-wrap job)
+CREATE TABLE IF NOT EXISTS key_rotation_checkpoints (
+  name TEXT PRIMARY KEY, -- envelope family, e.g. messages.content_key
+  target_version INTEGER NOT NULL,
+  last_id TEXT, -- keyset cursor (primary key of the last processed row)
+  rewrapped INTEGER NOT NULL DEFAULT 0,
+  skipped INTEGER NOT NULL DEFAULT 0, -- rows left on the retired key (failed authenticity check)
+  completed_at TEXT,
+  updated_at TEXT NOT NULL
+);
+
 -- AUDIT EVENTS (security-relevant events; do not store secrets)
 CREATE TABLE IF NOT EXISTS audit_events (
   id INTEGER PRIMARY KEY AUTOINCREMENT,